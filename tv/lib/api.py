@@ -86,8 +86,10 @@ __all__ = [
 # increase this by 1 every time the API changes
 APIVERSION = 0
 
+import copy
 import logging
 import os
+import threading
 
 import sqlite3
 try:
@@ -173,8 +175,8 @@ class StorageManager(object):
     StorageManagers allow two kinds of data storage:
 
     - Simple Storage: simple key/value pair storage.  Useful for extensions
-      with basic storage needs.  See the set_value(), get_value(), and
-      clear_value() methods.
+      with basic storage needs.  See the set_value(), get_value(),
+      clear_value(), set_many() and get_many() methods.
 
     - SQLite Storage: Use an SQLite connection.  Use this if you have complex
       storage needs and want a relational database to handle it.  Call
@@ -187,8 +189,31 @@ class StorageManager(object):
     Simple and SQLite storage can be used together if needed, however they
     share the same underlying SQLite connection.  You should avoid using the
     simple storage API while in the middle of an SQLite transation.
+
+    Values read with the simple API are cached in memory after they are
+    decoded, so repeated calls to get_value() don't touch the database.  The
+    cache only knows about changes made through the simple API, don't modify
+    the simple_data table directly using get_sqlite_connection().
+
+    Commit and durability semantics for the simple API:
+
+    - By default every call to set_value(), set_many() and clear_value() is
+      committed to disk before it returns.
+
+    - If enable_write_behind() has been called, changes are buffered in
+      memory and written to disk in a single transaction.  This happens
+      ``flush_interval`` seconds after the first buffered change, when
+      flush() is called, when disable_write_behind() is called and when the
+      extension is unloaded or Miro shuts down cleanly.  Buffered changes are
+      immediately visible to get_value() and friends, but if Miro crashes
+      they will be lost.  Use this mode for data that is written often and
+      that you can afford to lose a few seconds of, like playback
+      statistics.  Call flush() after changes that must not be lost.
     """
 
+    # default number of seconds to buffer changes in write-behind mode
+    WRITE_BEHIND_INTERVAL = 5.0
+
     def __init__(self, unique_name):
         """Create a StorageManager
 
@@ -201,11 +226,24 @@ class StorageManager(object):
         self._cursor = None
         # stores if we've run through _ensure_simple_api_table()
         self._checked_for_simple_api_table = False
+        # maps keys -> decoded values for the simple API.  Keys that we know
+        # aren't stored map to _MISSING.
+        self._cache = {}
+        # maps keys -> JSON strings that haven't been written yet.  Keys
+        # that have been cleared map to None.
+        self._pending = {}
+        self._write_behind = False
+        self._flush_interval = self.WRITE_BEHIND_INTERVAL
+        self._flush_timeout = None
+        # In write-behind mode we flush from the event loop thread, which
+        # may not be the thread the extension uses.  This lock protects the
+        # connection and the members above.
+        self._lock = threading.RLock()
 
     def _ensure_connection(self):
         if self._connection is None:
             self._connection = sqlite3.connect(self._sqlite_path(),
-                    isolation_level=None)
+                    isolation_level=None, check_same_thread=False)
             self._cursor = self._connection.cursor()
 
     def _sqlite_path(self):
@@ -229,6 +267,155 @@ class StorageManager(object):
                     "(key TEXT PRIMARY KEY, value TEXT)")
         self._checked_for_simple_api_table = True
 
+    def enable_write_behind(self, flush_interval=None):
+        """Buffer changes made with the simple API instead of committing
+        them right away.
+
+        See the class docstring for the durability trade-offs.
+
+        :param flush_interval: seconds to wait after a change before writing
+            it to disk.  Defaults to WRITE_BEHIND_INTERVAL.
+        """
+        with self._lock:
+            if flush_interval is not None:
+                self._flush_interval = flush_interval
+            self._write_behind = True
+
+    def disable_write_behind(self):
+        """Go back to committing every change right away.
+
+        Any buffered changes are flushed before this returns.
+        """
+        with self._lock:
+            self._write_behind = False
+            self.flush()
+
+    def flush(self):
+        """Write all buffered changes to disk in a single transaction.
+
+        This is a no-op if there are no buffered changes.
+        """
+        with self._lock:
+            self._cancel_flush_timeout()
+            if not self._pending:
+                return
+            pending = self._pending
+            self._pending = {}
+            try:
+                self._write_changes(pending)
+            except:
+                # Keep the changes so that we can try again and so that
+                # get_value() and friends still see them.
+                pending.update(self._pending)
+                self._pending = pending
+                self._cache_changes(pending)
+                if self._write_behind:
+                    self._schedule_flush()
+                raise
+
+    def _write_changes(self, changes):
+        """Write a dict of changes to the simple_data table.
+
+        :param changes: maps keys -> JSON strings, or None to delete the key
+        """
+        self._ensure_simple_api_table()
+        to_set = []
+        to_clear = []
+        for key, encoded in changes.iteritems():
+            if encoded is None:
+                to_clear.append((key,))
+            else:
+                to_set.append((key, encoded))
+        self._cursor.execute("BEGIN TRANSACTION")
+        try:
+            if to_set:
+                self._cursor.executemany("INSERT OR REPLACE INTO simple_data "
+                        "(key, value) VALUES (?, ?)", to_set)
+            if to_clear:
+                self._cursor.executemany("DELETE FROM simple_data "
+                        "WHERE key=?", to_clear)
+        except:
+            self._cursor.execute("ROLLBACK TRANSACTION")
+            # we don't know what's on disk anymore
+            self._cache = {}
+            raise
+        else:
+            self._cursor.execute("COMMIT TRANSACTION")
+
+    def _schedule_flush(self):
+        if self._flush_timeout is None:
+            from miro import eventloop
+            self._flush_timeout = eventloop.add_timeout(self._flush_interval,
+                    self._flush_from_timeout,
+                    'flush extension storage for %s' % self._unique_name)
+
+    def _flush_from_timeout(self):
+        with self._lock:
+            self._flush_timeout = None
+            self.flush()
+
+    def _cancel_flush_timeout(self):
+        if self._flush_timeout is not None:
+            self._flush_timeout.cancel()
+            self._flush_timeout = None
+
+    def _cache_changes(self, changes):
+        """Update our cache with changes that we're storing.
+
+        :param changes: maps keys -> JSON strings, or None to delete the key
+        """
+        for key, encoded in changes.iteritems():
+            if encoded is None:
+                self._cache[key] = _MISSING
+            else:
+                # decode the value we just encoded, this way cached values
+                # are the same as ones we would read from disk (tuples
+                # become lists, etc).
+                self._cache[key] = json.loads(encoded)
+
+    def _store_changes(self, changes):
+        """Store changes, either right away or by buffering them.
+
+        :param changes: maps keys -> JSON strings, or None to delete the key
+        """
+        with self._lock:
+            self._cache_changes(changes)
+            if self._write_behind:
+                self._pending.update(changes)
+                self._schedule_flush()
+            else:
+                self._write_changes(changes)
+
+    def _lookup(self, keys):
+        """Lookup decoded values for a list of keys.
+
+        Values that aren't cached are read from the database in a single
+        query.  Keys that aren't stored get _MISSING.
+
+        :returns: dict mapping keys to values
+        """
+        with self._lock:
+            results = {}
+            to_fetch = []
+            for key in keys:
+                try:
+                    results[key] = self._cache[key]
+                except KeyError:
+                    to_fetch.append(key)
+            if to_fetch:
+                self._ensure_simple_api_table()
+                # fetch in chunks to stay below SQLITE_MAX_VARIABLE_NUMBER
+                for start in xrange(0, len(to_fetch), 500):
+                    chunk = to_fetch[start:start+500]
+                    self._cursor.execute("SELECT key, value FROM simple_data "
+                            "WHERE key IN (%s)" % ', '.join('?' * len(chunk)),
+                            chunk)
+                    for key, value in self._cursor.fetchall():
+                        self._cache[key] = json.loads(value)
+                for key in to_fetch:
+                    results[key] = self._cache.setdefault(key, _MISSING)
+            return results
+
     def set_value(self, key, value):
         """Set a value using the simple API
 
@@ -238,11 +425,18 @@ class StorageManager(object):
         :param key: key to set (unicode or an ASCII bytestring)
         :param value: value to set
         """
-        self._ensure_simple_api_table()
-        self._cursor.execute("INSERT OR REPLACE INTO simple_data "
-                "(key, value) VALUES (?, ?)",
-                (key, json.dumps(value)))
-        self._connection.commit()
+        self._store_changes({key: json.dumps(value)})
+
+    def set_many(self, values):
+        """Set multiple values using the simple API
+
+        This works like calling set_value() for each item in values, but all
+        the values are committed in a single transaction.
+
+        :param values: dict mapping keys to values
+        """
+        self._store_changes(dict((key, json.dumps(value))
+                                 for key, value in values.iteritems()))
 
     def get_value(self, key):
         """Get a value using the simple API
@@ -253,14 +447,27 @@ class StorageManager(object):
         :returns: value set with set_value()
         :raises KeyError: key not set
         """
-        self._ensure_simple_api_table()
-        self._cursor.execute("SELECT value FROM simple_data WHERE key=?",
-                (key,))
-        row = self._cursor.fetchone()
-        if row is None:
+        value = self._lookup([key])[key]
+        if value is _MISSING:
             raise KeyError(key)
-        else:
-            return json.loads(row[0])
+        return _copy_value(value)
+
+    def get_many(self, keys, default=None):
+        """Get multiple values using the simple API
+
+        Values that aren't already cached are fetched with a single query.
+
+        :param keys: list of keys to retrieve
+        :param default: value to use for keys that aren't set
+        :returns: dict mapping each key in keys to its value
+        """
+        results = self._lookup(keys)
+        for key, value in results.iteritems():
+            if value is _MISSING:
+                results[key] = default
+            else:
+                results[key] = _copy_value(value)
+        return results
 
     def key_exists(self, key):
         """Test if a key is stored using the simple API
@@ -268,10 +475,7 @@ class StorageManager(object):
         :param key: key to retrieve
         :returns: True if a value set with set_value()
         """
-        self._ensure_simple_api_table()
-        self._cursor.execute("SELECT value FROM simple_data WHERE key=?",
-                (key,))
-        return self._cursor.fetchone() is not None
+        return self._lookup([key])[key] is not _MISSING
 
     def clear_value(self, key):
         """Clear a value using the simple API
@@ -283,9 +487,20 @@ class StorageManager(object):
 
         :param key: key to clear
         """
-        self._ensure_simple_api_table()
-        self._cursor.execute("DELETE FROM simple_data WHERE key=?", (key,))
-        self._connection.commit()
+        self._store_changes({key: None})
+
+# Marks keys that we know aren't stored in StorageManager._cache
+_MISSING = object()
+
+def _copy_value(value):
+    """Copy a cached value before returning it.
+
+    This keeps extensions that modify the lists/dicts that they get back from
+    changing our cache.
+    """
+    if isinstance(value, (list, dict)):
+        return copy.deepcopy(value)
+    return value
 
 class ExtensionContext(object):
     """ExtensionContext -- Stores objects specific to an extension
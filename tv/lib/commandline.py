@@ -103,7 +103,9 @@ def _get_item_for_path(path):
         app.controller.failed_soft("commandline.add_video", msg)
         return None
 
-@eventloop.idle_iterator
+# The user adds videos from the frontend and is waiting to see them, so run
+# ahead of any background work that's queued up.
+@eventloop.interactive_idle_iterator
 def add_videos(paths):
     # filter out non-existent paths
     paths = [p for p in paths if fileutil.exists(p)]
@@ -102,6 +102,8 @@ class Controller:
         httpclient.cleanup_libcurl()
         logging.info("Writing HTTP passwords")
         httpauth.write_to_file()
+        logging.info("Writing redirect cache")
+        httpclient.write_redirect_cache()
         logging.info("Shutting down event loop thread")
         eventloop.shutdown()
         logging.info("Saving cached ItemInfo objects")
@@ -134,6 +136,9 @@ class Controller:
 
             logging.info("Joining event loop ...")
             eventloop.join()
+            if getattr(app, 'extension_manager', None) is not None:
+                logging.info("Flushing extension storage...")
+                app.extension_manager.flush_storage()
             logging.info("Saving preferences...")
             app.config.save()
 
@@ -30,20 +30,45 @@
 """miro.data.connectionpool -- SQLite connection pool """
 import contextlib
 import logging
+import thread
+import threading
+import time
 
 import sqlite3
 
 from miro import messages
 from miro.data import dbcollations
 
+# PRAGMA statements to run on new connections.  The frontend only reads from
+# the database, so we give each connection a bigger page cache and keep temp
+# tables (like the ones ItemFetcherNoWAL creates) in memory.
+CONNECTION_PRAGMAS = [
+    'cache_size=4000',
+    'temp_store=MEMORY',
+]
+# Extra PRAGMA statements for databases on local disks.  SQLite versions
+# without mmap support ignore mmap_size.
+LOCAL_CONNECTION_PRAGMAS = CONNECTION_PRAGMAS + [
+    'mmap_size=67108864',
+]
+
 class ConnectionLimitError(StandardError):
     """We've hit our connection limits."""
 
 class Connection(object):
-    """Wraps the sqlite3.Connection object."""
+    """Wraps the sqlite3.Connection object.
+
+    :attribute thread_id: thread that last checked out the connection
+    :attribute last_used: time when the connection was last released
+    """
     def __init__(self, path):
+        # ConnectionPool makes sure that only 1 thread uses a connection at
+        # once, so it's safe to turn off check_same_thread
         self._connection = sqlite3.connect(
-            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False)
+        self.thread_id = thread.get_ident()
+        self.last_used = time.time()
 
     def execute(self, sql, values=()):
         return self._connection.execute(sql, values)
@@ -63,21 +88,48 @@ class Connection(object):
 class ConnectionPool(object):
     """Pool of SQLite database connections
 
+    Connections are pinned to threads: when a thread asks for a connection we
+    give it back the one it used last, if it's free.  That connection has the
+    pages that thread was reading in its cache.
+
+    If all connections are checked out, get_connection() waits for another
+    thread to release one.
+
     :attribute wal_mode: Is the database using WAL mode for its journal?
     """
-    def __init__(self, db_path, min_connections=2, max_connections=7):
+
+    # PRAGMA statements to run on new connections
+    pragmas = LOCAL_CONNECTION_PRAGMAS
+
+    def __init__(self, db_path, min_connections=2, max_connections=7,
+                 wait_timeout=5.0, idle_timeout=None):
         """Create a new ConnectionPool
 
         :param db_path: path to the database to connect to
         :param min_connections: Minimum number of connections to maintain
         :param max_connections: Maximum number of connections to the database
+        :param wait_timeout: how many seconds get_connection() waits for a
+        connection to be released before giving up
+        :param idle_timeout: If None, connections past min_connections are
+        closed when they are released.  Otherwise, they are kept until they
+        have been unused for idle_timeout seconds and reap_idle_connections()
+        is called.
         """
         self.db_path = db_path
         self.min_connections = min_connections
         self.max_connections = max_connections
+        self.wait_timeout = wait_timeout
+        self.idle_timeout = idle_timeout
         self.all_connections = set()
         self.free_connections = []
+        self.condition = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.high_water_mark = 0
         self._check_wal_mode()
+        self._warm_up()
 
     def _check_wal_mode(self):
         """Try to set journal_mode=wall and return if it was successful
@@ -87,48 +139,179 @@ class ConnectionPool(object):
         self.wal_mode = cursor.fetchone()[0] == u'wal'
         self.release_connection(connection)
 
+    def _warm_up(self):
+        """Open min_connections connections ahead of time."""
+        with self.condition:
+            while len(self.all_connections) < self.min_connections:
+                self.free_connections.append(self._make_new_connection())
+
     def _make_new_connection(self):
         # TODO: should have error handling here, but what should we do?
         connection = Connection(self.db_path)
         dbcollations.setup_collations(connection)
-        self.free_connections.append(connection)
+        for pragma in self.pragmas:
+            connection.execute("PRAGMA %s" % pragma)
+        # Read in the schema now rather than on the first real query
+        connection.execute("SELECT COUNT(*) FROM sqlite_master")
         self.all_connections.add(connection)
+        return connection
+
+    def _close_connection(self, connection):
+        connection.close()
+        self.all_connections.remove(connection)
 
     def destroy(self):
         """Forcably destroy all connections."""
-        for connection in self.all_connections:
-            connection.close()
-        self.all_connections = []
-        self.free_connections = []
+        with self.condition:
+            for connection in self.all_connections:
+                connection.close()
+            self.all_connections = set()
+            self.free_connections = []
 
-    def get_connection(self):
+    def get_connection(self, timeout=None):
         """Get a new connection to the database
 
         When you're finished with the connection, call release_connection() to
         put it back into the pool.
 
-        If there are max_connections checked out and get_connection() is
-        called again, ConnectionLimitError will be raised.
+        If there are max_connections checked out, we wait for another thread
+        to release one.  If that doesn't happen in time, or if the current
+        thread has all of the connections checked out, ConnectionLimitError
+        will be raised.
 
+        :param timeout: seconds to wait for a connection.  If None, we use
+        wait_timeout.
         :returns sqlite3.Connection object
         """
-        if not self.free_connections:
-            if len(self.all_connections) < self.max_connections:
-                self._make_new_connection()
-            else:
-                raise ConnectionLimitError()
-        return self.free_connections.pop()
+        if timeout is None:
+            timeout = self.wait_timeout
+        thread_id = thread.get_ident()
+        with self.condition:
+            connection = self._get_free_connection(thread_id)
+            if connection is None:
+                connection = self._wait_for_connection(thread_id, timeout)
+            connection.thread_id = thread_id
+            self.checkouts += 1
+            self.high_water_mark = max(self.high_water_mark,
+                                       self._checked_out_count())
+            return connection
+
+    def _get_free_connection(self, thread_id):
+        """Get a free connection, or make a new one.
+
+        :returns: Connection object or None if we're at max_connections and
+        none are free
+        """
+        for i in reversed(xrange(len(self.free_connections))):
+            if self.free_connections[i].thread_id == thread_id:
+                return self.free_connections.pop(i)
+        if len(self.all_connections) < self.max_connections:
+            return self._make_new_connection()
+        if self.free_connections:
+            # use the connection that's been free the longest
+            return self.free_connections.pop(0)
+        return None
+
+    def _wait_for_connection(self, thread_id, timeout):
+        start = time.time()
+        self.waits += 1
+        try:
+            while True:
+                remaining = start + timeout - time.time()
+                if (remaining <= 0 or
+                        not self._other_threads_have_connections(thread_id)):
+                    # waiting won't help if this thread has all the
+                    # connections checked out
+                    self.timeouts += 1
+                    raise ConnectionLimitError()
+                self.condition.wait(remaining)
+                connection = self._get_free_connection(thread_id)
+                if connection is not None:
+                    return connection
+        finally:
+            self.wait_time += time.time() - start
+
+    def _other_threads_have_connections(self, thread_id):
+        free = set(self.free_connections)
+        for connection in self.all_connections:
+            if connection not in free and connection.thread_id != thread_id:
+                return True
+        return False
+
+    def _checked_out_count(self):
+        return len(self.all_connections) - len(self.free_connections)
 
     def release_connection(self, connection):
         """Put a connection back into the pool."""
 
-        if connection not in self.all_connections:
-            raise ValueError("%s not from this pool" % connection)
-        if len(self.all_connections) > self.min_connections:
-            connection.close()
-            self.all_connections.remove(connection)
-        else:
-            self.free_connections.append(connection)
+        with self.condition:
+            if connection not in self.all_connections:
+                raise ValueError("%s not from this pool" % connection)
+            connection.last_used = time.time()
+            if (self.idle_timeout is None and
+                    len(self.all_connections) > self.min_connections):
+                self._close_connection(connection)
+            else:
+                self.free_connections.append(connection)
+            self.condition.notify()
+
+    def reap_idle_connections(self):
+        """Close connections that have been free for longer than
+        idle_timeout.
+
+        We never close connections if it would leave us with less than
+        min_connections.
+
+        :returns: number of connections closed
+        """
+        if self.idle_timeout is None:
+            return 0
+        cutoff = time.time() - self.idle_timeout
+        with self.condition:
+            max_to_close = len(self.all_connections) - self.min_connections
+            to_close = [c for c in self.free_connections
+                        if c.last_used < cutoff][:max_to_close]
+            for connection in to_close:
+                self.free_connections.remove(connection)
+                self._close_connection(connection)
+        return len(to_close)
+
+    def close_free_connections(self):
+        """Close all connections that aren't checked out.
+
+        Connections that are checked out still get closed when they are
+        released, unless we need them for min_connections.
+        """
+        with self.condition:
+            for connection in self.free_connections:
+                self._close_connection(connection)
+            self.free_connections = []
+            # don't keep connections that get released after this
+            self.min_connections = 0
+            self.idle_timeout = None
+
+    def get_stats(self):
+        """Get usage stats for the pool.
+
+        :returns: dict with the following keys:
+            - connections: number of open connections
+            - checked_out: number of connections currently checked out
+            - high_water_mark: max number of connections checked out at once
+            - checkouts: number of get_connection() calls that succeeded
+            - waits: number of get_connection() calls that had to wait
+            - wait_time: total seconds spent waiting in get_connection()
+            - timeouts: number of get_connection() calls that failed
+        """
+        with self.condition:
+            return {
+                'connections': len(self.all_connections),
+                'checked_out': self._checked_out_count(),
+                'high_water_mark': self.high_water_mark,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+            }
 
     @contextlib.contextmanager
     def context(self):
@@ -145,13 +328,22 @@ class ConnectionPool(object):
         connection.rollback()
         self.release_connection(connection)
 
+# how long share pools keep unused connections open
+IDLE_POOL_TIMEOUT = 60
+
 class DeviceConnectionPool(ConnectionPool):
     """ConnectionPool for a device."""
+
+    # Don't memory-map the database, it's on the device.
+    pragmas = CONNECTION_PRAGMAS
+
     def __init__(self, device_info):
         # min_connections is 0 since we should normally not have any
         # connections to the device database.  The max connections is 2 in
         # case the user is on the video tab and is playing items from the
-        # audio tab (or vice-versa)
+        # audio tab (or vice-versa).  Connections get closed as soon as
+        # they're released, otherwise they could stop the device from being
+        # unmounted.
         ConnectionPool.__init__(self, device_info.sqlite_path,
                                 min_connections=0, max_connections=2)
 
@@ -165,7 +357,8 @@ class ShareConnectionPool(ConnectionPool):
         #   - switching away from tab #2
         #   - switching to tab #3
         ConnectionPool.__init__(self, share_info.sqlite_path,
-                                min_connections=0, max_connections=3)
+                                min_connections=0, max_connections=3,
+                                idle_timeout=IDLE_POOL_TIMEOUT)
 
 class ConnectionPoolTracker(object):
     """Manage ConnectionPool for the frontend
@@ -194,6 +387,28 @@ class ConnectionPoolTracker(object):
     def get_all_pools(self):
         return [self.main_pool] + self.pool_map.values()
 
+    def reap_idle_connections(self):
+        """Close share connections that haven't been used in a while.
+
+        The frontend should call this periodically.
+        """
+        for tab_id, pool in self.pool_map.items():
+            count = pool.reap_idle_connections()
+            if count:
+                logging.debug("closed %d idle connections for %s", count,
+                              tab_id)
+
+    def get_stats(self):
+        """Get stats for each pool.
+
+        :returns: dict mapping pool names to the results of get_stats().  The
+        main pool is named "main", other pools are named after their tab id.
+        """
+        rv = dict((tab_id, pool.get_stats())
+                  for tab_id, pool in self.pool_map.items())
+        rv['main'] = self.main_pool.get_stats()
+        return rv
+
     def _make_connection_pool(self, tab_info):
         if isinstance(tab_info, messages.DeviceInfo):
             return DeviceConnectionPool(tab_info)
@@ -208,7 +423,9 @@ class ConnectionPoolTracker(object):
 
     def _ensure_no_connection_pool(self, tab_id):
         if tab_id in self.pool_map:
-            del self.pool_map[tab_id]
+            # Item lists may still have connections checked out, those will
+            # get closed when they are released.
+            self.pool_map.pop(tab_id).close_free_connections()
 
     def on_tabs_changed(self, message):
         if message.type != 'connect':
@@ -39,7 +39,9 @@ to join the tables together in order to create an ItemInfo.
 import datetime
 import itertools
 import functools
+import logging
 import os
+import sqlite3
 
 from miro import app
 from miro import displaytext
@@ -49,6 +51,7 @@ from miro import fileutil
 from miro import prefs
 from miro import schema
 from miro import util
+from miro.data import connectionpool
 from miro.gtcache import gettext as _
 from miro.plat import resources
 from miro.plat.utils import PlatformFilenameType
@@ -182,6 +185,60 @@ class ItemSelectInfo(object):
     # name of the column that stores video paths
     path_column = 'filename'
 
+    # Projection profiles.  Each one maps a profile name to the ItemInfo
+    # attributes that we select up front when creating ItemInfos for a
+    # particular part of the interface.  Attributes that aren't in a profile
+    # get loaded the first time they're accessed (see
+    # ItemInfoLazyAttributeGetter).  Attributes that aren't in
+    # select_columns are ignored, which lets the device and sharing
+    # subclasses use the same profiles.
+    _state_attrs = (
+        'id', 'new', 'title', 'feed_id', 'feed_url', 'parent_id',
+        'parent_title', 'is_file_item', 'is_container_item', 'keep',
+        'pending_manual_download', 'pending_reason', 'watched_time',
+        'filename_unicode', 'video_path', 'file_type', 'duration_ms',
+        'feed_expire', 'feed_expire_time', 'downloader_state',
+        'downloader_activity', 'downloaded_size', 'downloader_size', 'rate',
+        'short_reason_failed',
+        # used by the grouping functions in the frontend
+        'artist', 'album', 'album_artist', 'show',
+    )
+    # everything that the list view columns use (see the renderers in
+    # frontends/widgets/style.py), so that rendering rows doesn't need lazy
+    # loads
+    _list_attrs = _state_attrs + (
+        'date_added', 'last_watched', 'release_date', 'size', 'track',
+        'year', 'genre', 'rating', 'play_count', 'skip_count', 'has_drm',
+        'kind', 'eta', 'downloader_type', 'url', 'metadata_description',
+        'entry_description', 'seeders', 'leechers', 'upload_rate',
+        'upload_size', 'cover_art_path_unicode', 'icon_cache_path_unicode',
+        'screenshot_path_unicode', 'enclosure_format',
+        'downloader_content_type',
+    )
+    profiles = {
+        'list': frozenset(_list_attrs),
+        'album': frozenset(_list_attrs + (
+            'album_tracks',
+        )),
+        'details': frozenset(_state_attrs + (
+            'date_added', 'release_date', 'size', 'has_drm', 'resume_time',
+            'metadata_description', 'entry_description', 'license',
+            'permalink', 'url', 'mime_type', 'enclosure_format',
+            'cover_art_path_unicode', 'icon_cache_path_unicode',
+            'screenshot_path_unicode', 'expired', 'was_downloaded',
+            'eligible_for_autodownload', 'feed_auto_downloadable',
+            'feed_get_everything', 'downloader_type',
+            'downloader_content_type', 'eta', 'upload_rate', 'upload_size',
+            'seeders', 'leechers', 'connections',
+        )),
+        'playback': frozenset((
+            'id', 'title', 'feed_id', 'feed_url', 'parent_id',
+            'is_file_item', 'filename_unicode', 'video_path', 'file_type',
+            'duration_ms', 'resume_time', 'subtitle_encoding', 'artist',
+            'album', 'kind', 'play_count', 'skip_count',
+        )),
+    }
+
     # how to join the main table to other tables.  Maps table names to
     # (item_column, other_column) tuples
     join_info = {
@@ -192,7 +249,22 @@ class ItemSelectInfo(object):
         'item_fts': ('id', 'docid'),
     }
 
-    def __init__(self):
+    def __init__(self, profile=None):
+        """Create an ItemSelectInfo
+
+        :param profile: name of a projection profile to only select the
+        columns that it lists, or None to select all columns.
+        """
+        self.profile = profile
+        if profile is not None:
+            self.full_select_info = self.__class__()
+            profile_attrs = self.profiles[profile]
+            self.select_columns = [
+                c for c in self.full_select_info.select_columns
+                if c.attr_name == 'id' or c.attr_name in profile_attrs
+            ]
+        else:
+            self.full_select_info = self
         self.joined_tables = set(c.table for c in self.select_columns
                                  if c.table != self.table_name)
 
@@ -238,6 +310,36 @@ class ItemInfoAttributeGetter(object):
             raise AttributeError("class attribute not supported")
         return instance.row_data[self.index]
 
+class ItemInfoLazyAttributeGetter(object):
+    """Descriptor for attributes that a projection profile leaves out.
+
+    The first time one of these is accessed, we fetch the full row for the
+    item and read the value from that.
+    """
+    def __init__(self, index, default):
+        self.index = index
+        self.default = default
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError("class attribute not supported")
+        full_row_data = instance.full_row_data
+        if full_row_data is None:
+            full_row_data = instance.load_full_row()
+        if not full_row_data:
+            # the item is gone from the database or we couldn't read it
+            return self.default
+        return full_row_data[self.index]
+
+def _find_attribute_default(bases, attr_name):
+    """Find the default value that ItemInfoBase defines for an attribute."""
+    for base in bases:
+        for klass in base.__mro__:
+            value = klass.__dict__.get(attr_name)
+            if value is not None and not hasattr(value, '__get__'):
+                return value
+    return None
+
 class ItemInfoMeta(type):
     """Metaclass for ItemInfo.
 
@@ -246,6 +348,9 @@ class ItemInfoMeta(type):
           ItemSelectInfo object.
         - storing the result row from sqlite in an instance attribute called
           "row_data"
+
+    If select_info uses a projection profile, the attributes that it leaves
+    out are implemented with ItemInfoLazyAttributeGetter.
     """
     def __new__(cls, classname, bases, dct):
         count = itertools.count()
@@ -254,6 +359,14 @@ class ItemInfoMeta(type):
             for select_column in select_info.select_columns:
                 attribute = ItemInfoAttributeGetter(count.next())
                 dct[select_column.attr_name] = attribute
+            if select_info.profile is not None:
+                full_columns = select_info.full_select_info.select_columns
+                for i, select_column in enumerate(full_columns):
+                    attr_name = select_column.attr_name
+                    if attr_name not in dct:
+                        default = _find_attribute_default(bases, attr_name)
+                        dct[attr_name] = ItemInfoLazyAttributeGetter(i,
+                                                                     default)
         return type.__new__(cls, classname, bases, dct)
 
 class ItemInfoBase(object):
@@ -272,6 +385,11 @@ class ItemInfoBase(object):
     html_stripper = util.HTMLStripper()
     # DeviceInfo for the device this item is on
     device = None
+    # For ItemInfos that use a projection profile: object that we call
+    # fetch_full_row() on to load the columns that the profile left out
+    # and the row that it returned.
+    row_loader = None
+    full_row_data = None
 
     # default values for columns from the item table.  For DeviceItemInfo and
     # SharingItemInfo, we will use these for columns that don't exist in their
@@ -366,6 +484,26 @@ class ItemInfoBase(object):
         """
         self.row_data = row_data
 
+    def load_full_row(self):
+        """Fetch all columns for this item.
+
+        This is called when we access an attribute that our projection
+        profile left out.  The data comes from a new read transaction, so it
+        may be newer than the data in row_data.
+
+        :returns: the full row, or an empty tuple if we couldn't fetch it
+        """
+        try:
+            row = self.row_loader.fetch_full_row(self.id)
+        except (sqlite3.DatabaseError, connectionpool.ConnectionLimitError), e:
+            logging.warn("%s while loading item %s", e, self.id,
+                         exc_info=True)
+            row = None
+        if row is None:
+            row = ()
+        self.full_row_data = row
+        return row
+
     def __hash__(self):
         return hash(self.row_data)
 
@@ -695,6 +833,27 @@ class ItemInfo(ItemInfoBase):
     source_type = 'database'
     select_info = ItemSelectInfo()
 
+# maps (ItemInfo class, profile name) to classes made by
+# projected_item_info_class()
+_projected_item_info_classes = {}
+
+def projected_item_info_class(item_info_class, profile):
+    """Get a subclass of an ItemInfo class that uses a projection profile.
+
+    :param item_info_class: ItemInfo, DeviceItemInfo or SharingItemInfo
+    :param profile: key from ItemSelectInfo.profiles
+    """
+    key = (item_info_class, profile)
+    try:
+        return _projected_item_info_classes[key]
+    except KeyError:
+        select_info = item_info_class.select_info.__class__(profile)
+        classname = '%s_%s' % (item_info_class.__name__, profile)
+        klass = ItemInfoMeta(classname, (item_info_class,),
+                             {'select_info': select_info})
+        _projected_item_info_classes[key] = klass
+        return klass
+
 class DBErrorItemInfo(ItemInfoBase):
     """DBErrorItemInfo is used as a placeholder when we get DatabaseErrors
     """
@@ -871,12 +1030,23 @@ class ItemSource(object):
 
     :attribute select_info: ItemSelectInfo for a database
     :attribute connection_pool: ConnectionPool for the same database
+    :attribute profile: projection profile that we use, or None to select
+    all columns
     """
 
     select_info = ItemSelectInfo()
+    item_info_class = ItemInfo
 
-    def __init__(self):
+    def __init__(self, profile=None):
         self.connection_pool = app.connection_pools.get_main_pool()
+        self._set_profile(profile)
+
+    def _set_profile(self, profile):
+        self.profile = profile
+        if profile is not None:
+            self.item_info_class = projected_item_info_class(
+                self.item_info_class, profile)
+            self.select_info = self.item_info_class.select_info
 
     def get_connection(self):
         """Get a database connection to use.
@@ -898,29 +1068,69 @@ class ItemSource(object):
         """Is this database using WAL mode for transactions?"""
         return self.connection_pool.wal_mode
 
-    def make_item_info(self, row_data):
-        """Create an ItemInfo from a result row."""
-        return ItemInfo(row_data)
+    def make_item_info(self, row_data, row_loader=None):
+        """Create an ItemInfo from a result row.
+
+        :param row_data: result row with values for select_info
+        :param row_loader: object to fetch the columns that our projection
+        profile leaves out with.  If None, we will use ourselves.
+        """
+        info = self._construct_item_info(row_data)
+        if self.profile is not None:
+            info.row_loader = row_loader if row_loader is not None else self
+        return info
+
+    def _construct_item_info(self, row_data):
+        return self.item_info_class(row_data)
+
+    def fetch_full_row(self, item_id, connection=None):
+        """Fetch all the columns for an item, ignoring our projection
+        profile.
+
+        :param item_id: id of the item to fetch
+        :param connection: connection to use.  If None, we will get one from
+        our connection pool.
+        :returns: row data or None if the item doesn't exist
+        """
+        if connection is not None:
+            return self._fetch_full_row(connection, item_id)
+        connection = self.get_connection()
+        try:
+            return self._fetch_full_row(connection, item_id)
+        finally:
+            self.release_connection(connection)
+
+    def _fetch_full_row(self, connection, item_id):
+        rows = _fetch_item_rows(connection, [item_id],
+                                self.select_info.full_select_info).fetchall()
+        if rows:
+            return rows[0]
+        else:
+            return None
 
 class DeviceItemSource(ItemSource):
 
     select_info = DeviceItemSelectInfo()
+    item_info_class = DeviceItemInfo
 
-    def __init__(self, device_info):
+    def __init__(self, device_info, profile=None):
         self.connection_pool = \
                 app.connection_pools.get_device_pool(device_info.id)
         self.device_info = device_info
+        self._set_profile(profile)
 
-    def make_item_info(self, row_data):
-        return DeviceItemInfo(self.device_info, row_data)
+    def _construct_item_info(self, row_data):
+        return self.item_info_class(self.device_info, row_data)
 
 class SharingItemSource(ItemSource):
     select_info = SharingItemSelectInfo()
+    item_info_class = SharingItemInfo
 
-    def __init__(self, share_info):
+    def __init__(self, share_info, profile=None):
         self.connection_pool = \
                 app.connection_pools.get_sharing_pool(share_info.id)
         self.share_info = share_info
+        self._set_profile(profile)
 
-    def make_item_info(self, row_data):
-        return SharingItemInfo(self.share_info, row_data)
+    def _construct_item_info(self, row_data):
+        return self.item_info_class(self.share_info, row_data)
@@ -0,0 +1,372 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+
+"""miro.data.itemindex -- In-memory column index for item lists.
+
+ItemColumnIndex keeps the values of the columns that we commonly sort, filter
+and group by for every item that matches a base query (for example, all items
+in a feed or on the music tab).  ItemLists can use it to change their sort or
+filters and to calculate group boundaries without going back to the
+database.
+"""
+
+import logging
+import re
+
+from miro import util
+
+_DIGITS_RE = re.compile(u'([0-9]+)')
+
+def name_collation_key(text):
+    """Sort key that orders names the same way as the name collation.
+
+    This follows the rules in namecollation.cpp: case is ignored, a leading
+    "the " or "a " is skipped, and runs of digits are compared by their
+    numeric value and sort after other characters.  NULL values sort first,
+    like in sqlite.
+    """
+    if text is None:
+        return None
+    text = text.lower()
+    for prefix in (u'the ', u'a '):
+        if text.startswith(prefix):
+            text = text[len(prefix):]
+            break
+    parts = _DIGITS_RE.split(text)
+    key = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            key.append((1, int(part)))
+        elif part:
+            if i + 1 < len(parts):
+                # The next character is a digit, which should sort after any
+                # other character.
+                part += u'\uffff'
+            key.append((0, part))
+    return tuple(key)
+
+def _sql_equal(value, other):
+    return value is not None and other is not None and value == other
+
+def _sql_not_equal(value, other):
+    return value is not None and other is not None and value != other
+
+def _sql_compare(compare_func):
+    def func(value, other):
+        return (value is not None and other is not None and
+                compare_func(value, other))
+    return func
+
+class ItemColumnIndex(object):
+    """Columnar cache of item data for a base ItemTrackerQuery.
+
+    Each column is stored as a list with an entry for every item that
+    matches the base query.  The lists are parallel: ids[pos] is the id of
+    the item whose data is stored at position pos in every column.
+
+    select_ids() can handle queries that add simple conditions and a simple
+    order by to the base query.  Queries with a full-text search, complex
+    conditions or complex orders need to be run in the database.
+    """
+
+    # columns that we keep for each item
+    COLUMNS = [
+        'feed_id', 'parent_id', 'file_type', 'kind', 'title', 'artist',
+        'album', 'album_artist', 'track', 'year', 'genre', 'rating', 'show',
+        'parent_title', 'release_date', 'creation_time', 'size', 'duration',
+        'filename', 'watched_time', 'downloaded_time', 'expired',
+    ]
+
+    # Operators that we can evaluate for "<column> <operator> ?" conditions.
+    # These follow SQL semantics: comparing with NULL is only true for IS and
+    # IS NOT.
+    OPERATORS = {
+        '=': _sql_equal,
+        '!=': _sql_not_equal,
+        '<': _sql_compare(lambda a, b: a < b),
+        '>': _sql_compare(lambda a, b: a > b),
+        '<=': _sql_compare(lambda a, b: a <= b),
+        '>=': _sql_compare(lambda a, b: a >= b),
+        'IS': lambda a, b: a == b,
+        'IS NOT': lambda a, b: a != b,
+    }
+
+    # collations that we can sort with and the key functions that emulate
+    # them.
+    COLLATIONS = {
+        None: None,
+        'name': name_collation_key,
+    }
+
+    # if more than this many items change at once, reload all the data rather
+    # than updating items one by one.
+    RELOAD_THRESHOLD = 500
+
+    def __init__(self, base_query, item_source):
+        """Create an ItemColumnIndex.
+
+        :param base_query: ItemTrackerQuery that selects the items to index
+        :param item_source: ItemSource to get connections from
+        """
+        self.base_query = base_query
+        self.item_source = item_source
+        self.table = base_query.table_name()
+        self.load()
+
+    def load(self):
+        """Load data for all items from the database."""
+        self.ids = []
+        self.positions = {}
+        self.values = dict((column, []) for column in self.COLUMNS)
+        # maps (column, key_func) to a list with key_func applied to each
+        # value of the column.  We calculate these when we first need them.
+        self.derived_values = {}
+        for row in self._select_rows():
+            self._set_row(row)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _select_rows(self, id_list=None):
+        """Select rows for items that match our base query.
+
+        :param id_list: if given, only select rows for these ids
+        :returns: list of row tuples.  The first value is the item id, the
+        rest are the values for COLUMNS.
+        """
+        if id_list is None:
+            queries = [self.base_query]
+        else:
+            queries = []
+            for ids in util.split_values_for_sqlite(id_list):
+                query = self.base_query.copy()
+                sql = "%s.id IN (%s)" % (self.table,
+                                         ', '.join('?' for i in ids))
+                query.add_complex_condition(['id'], sql, ids)
+                queries.append(query)
+        connection = self.item_source.get_connection()
+        try:
+            rows = []
+            for query in queries:
+                rows.extend(self._select_rows_for_query(connection, query))
+            return rows
+        finally:
+            self.item_source.release_connection(connection)
+
+    def _select_rows_for_query(self, connection, query):
+        sql_parts = []
+        arg_list = []
+        select_columns = ', '.join('%s.%s' % (self.table, column)
+                                   for column in ['id'] + self.COLUMNS)
+        sql_parts.append("SELECT %s FROM %s" % (select_columns, self.table))
+        query._add_joins(sql_parts, arg_list)
+        query._add_conditions(sql_parts, arg_list)
+        return connection.execute(' '.join(sql_parts), arg_list).fetchall()
+
+    def _set_row(self, row):
+        id_ = row[0]
+        try:
+            pos = self.positions[id_]
+        except KeyError:
+            pos = self.positions[id_] = len(self.ids)
+            self.ids.append(id_)
+            for column, value in zip(self.COLUMNS, row[1:]):
+                self.values[column].append(value)
+            for (column, key_func), lst in self.derived_values.items():
+                lst.append(key_func(self.values[column][pos]))
+        else:
+            for column, value in zip(self.COLUMNS, row[1:]):
+                self.values[column][pos] = value
+            for (column, key_func), lst in self.derived_values.items():
+                lst[pos] = key_func(self.values[column][pos])
+
+    def _remove_id(self, id_):
+        # move the last item into the hole, so that we don't have to shift
+        # any of the lists
+        pos = self.positions.pop(id_)
+        last_pos = len(self.ids) - 1
+        lists = ([self.ids] + self.values.values() +
+                 self.derived_values.values())
+        if pos != last_pos:
+            moved_id = self.ids[last_pos]
+            self.positions[moved_id] = pos
+            for lst in lists:
+                lst[pos] = lst[last_pos]
+        for lst in lists:
+            del lst[last_pos]
+
+    def on_item_changes(self, message):
+        """Update the index for an ItemChanges message."""
+        other_tables = self.base_query.get_other_tables_to_track()
+        if ((message.dlstats_changed and
+             'remote_downloader' in other_tables) or
+            (message.playlists_changed and
+             'playlist_item_map' in other_tables)):
+            self.load()
+            return
+        for id_ in message.removed:
+            if id_ in self.positions:
+                self._remove_id(id_)
+        columns = set(self.COLUMNS)
+        columns.update(self.base_query.get_columns_to_track())
+        if message.changed_columns.intersection(columns):
+            ids_to_check = set(message.added).union(message.changed)
+        else:
+            ids_to_check = set(message.added)
+        if not ids_to_check:
+            return
+        if len(ids_to_check) > self.RELOAD_THRESHOLD:
+            self.load()
+            return
+        # changed items can start or stop matching the base query, so check
+        # all of them
+        found_ids = set()
+        for row in self._select_rows(list(ids_to_check)):
+            self._set_row(row)
+            found_ids.add(row[0])
+        for id_ in ids_to_check - found_ids:
+            if id_ in self.positions:
+                self._remove_id(id_)
+
+    def contains_all(self, id_list):
+        """Check if we have data for all items in a list."""
+        positions = self.positions
+        for id_ in id_list:
+            if id_ not in positions:
+                return False
+        return True
+
+    def get_positions(self, id_list):
+        """Get the positions of items in our column lists.
+
+        :raises KeyError: an id isn't in the index
+        """
+        return [self.positions[id_] for id_ in id_list]
+
+    def get_values(self, column):
+        """Get the list of values for a column."""
+        return self.values[column]
+
+    def get_derived_values(self, column, key_func):
+        """Get the result of key_func for each value of a column."""
+        try:
+            return self.derived_values[(column, key_func)]
+        except KeyError:
+            lst = [key_func(value) for value in self.values[column]]
+            self.derived_values[(column, key_func)] = lst
+            return lst
+
+    def get_name_keys(self, column):
+        """Get util.name_sort_key() for each value of a column.
+
+        These match the *_sort_key attributes of ItemInfo, which makes them
+        useful for grouping.
+        """
+        return self.get_derived_values(column, util.name_sort_key)
+
+    # selecting
+    def can_handle(self, query):
+        """Check if select_ids() can run a query.
+
+        query must be the base query with simple conditions and a simple
+        order by added to it.
+        """
+        if query.match_string is not None or query.limit is not None:
+            return False
+        base_count = len(self.base_query.conditions)
+        if query.conditions[:base_count] != self.base_query.conditions:
+            return False
+        for cond in query.conditions[base_count:]:
+            if not self._can_evaluate(cond):
+                return False
+        if query.order_by is not None:
+            if query.order_by.terms is None:
+                return False
+            for table, column, descending, collation in query.order_by.terms:
+                if (table != self.table or column not in self.values or
+                    collation not in self.COLLATIONS):
+                    return False
+        return True
+
+    def _can_evaluate(self, cond):
+        if cond.operator not in self.OPERATORS or len(cond.columns) != 1:
+            return False
+        table, column = cond.columns[0]
+        return table == self.table and column in self.values
+
+    def select_ids(self, query):
+        """Get the ids for a query without using the database.
+
+        Items that compare equal using the order by are sorted by id.
+
+        :param query: ItemTrackerQuery that can_handle() returned True for
+        :returns: list of item ids
+        """
+        positions = xrange(len(self.ids))
+        for cond in query.conditions[len(self.base_query.conditions):]:
+            table, column = cond.columns[0]
+            test = self.OPERATORS[cond.operator]
+            value = cond.values[0]
+            column_values = self.values[column]
+            positions = [pos for pos in positions
+                         if test(column_values[pos], value)]
+        ids = self.ids
+        positions = sorted(positions, key=ids.__getitem__)
+        if query.order_by is not None:
+            # Sort by each term starting with the last one.  Since sort() is
+            # stable, this results in the correct multi-column sort.
+            for table, column, descending, collation in reversed(
+                query.order_by.terms):
+                key_func = self.COLLATIONS[collation]
+                if key_func is not None:
+                    keys = self.get_derived_values(column, key_func)
+                else:
+                    keys = self.values[column]
+                positions.sort(key=keys.__getitem__, reverse=descending)
+        logging.debug("ItemColumnIndex: selected %d of %d items",
+                      len(positions), len(ids))
+        return [ids[pos] for pos in positions]
+
+    def calc_group_starts(self, id_list, key_func):
+        """Find where groups start in a list.
+
+        :param id_list: list of item ids, in sorted order
+        :param key_func: function that inputs the index and a list of
+        positions and returns a list of grouping keys for them.
+        :returns: list of the indexes in id_list that start a new group
+        """
+        keys = key_func(self, self.get_positions(id_list))
+        starts = []
+        last_key = object()
+        for i, key in enumerate(keys):
+            if key != last_key:
+                starts.append(i)
+                last_key = key
+        return starts
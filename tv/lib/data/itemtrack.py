@@ -34,6 +34,7 @@ import logging
 import string
 import sqlite3
 import random
+import time
 import weakref
 
 from miro import app
@@ -47,7 +48,7 @@ from miro.gtcache import gettext as _
 
 ItemTrackerCondition = util.namedtuple(
     "ItemTrackerCondition",
-    "columns sql values",
+    "columns sql values operator",
 
     """ItemTrackerCondition defines one term for the WHERE clause of a query.
 
@@ -56,16 +57,20 @@ ItemTrackerCondition = util.namedtuple(
     re-run the query.
     :attribute sql: sql string for the clause
     :attribute values: list of values to use to fill in sql
+    :attribute operator: operator for simple "<column> <operator> ?"
+    conditions created with add_condition().  None for complex conditions.
     """)
 
 ItemTrackerOrderBy = util.namedtuple(
     "ItemTrackerOrderBy",
-    "columns sql",
+    "columns sql terms",
 
     """ItemTrackerOrderBy defines one term for the ORDER BY clause of a query.
 
     :attribute columns: list of (table, column) tuples used in the query
     :attribute sql: sql expression
+    :attribute terms: list of (table, column, descending, collation) tuples
+    for orders created with set_order_by().  None for complex orders.
     """)
 
 class ItemTrackerQueryBase(object):
@@ -117,7 +122,8 @@ class ItemTrackerQueryBase(object):
         """
         table, column = self._parse_column(column)
         sql = "%s.%s %s ?" % (table, column, operator)
-        cond = ItemTrackerCondition([(table, column)], sql, (value,))
+        cond = ItemTrackerCondition([(table, column)], sql, (value,),
+                                    operator)
         self.conditions.append(cond)
 
     def set_search(self, search_string):
@@ -160,7 +166,7 @@ class ItemTrackerQueryBase(object):
         :param values: tuple of values to substitute into sql
         """
         columns = [self._parse_column(c) for c in columns]
-        cond = ItemTrackerCondition(columns, sql, values)
+        cond = ItemTrackerCondition(columns, sql, values, None)
         self.conditions.append(cond)
 
     def set_order_by(self, columns, collations=None):
@@ -180,6 +186,7 @@ class ItemTrackerQueryBase(object):
 
         sql_parts = []
         order_by_columns = []
+        terms = []
         for column, collation in zip(columns, collations):
             if column[0] == '-':
                 descending = True
@@ -188,10 +195,11 @@ class ItemTrackerQueryBase(object):
                 descending = False
             table, column = self._parse_column(column)
             order_by_columns.append((table, column))
+            terms.append((table, column, descending, collation))
             sql_parts.append(self._order_by_expression(table, column,
                                                        descending, collation))
         self.order_by = ItemTrackerOrderBy(order_by_columns,
-                                           ', '.join(sql_parts))
+                                           ', '.join(sql_parts), terms)
 
     def set_complex_order_by(self, columns, sql):
         """Change the ORDER BY clause to a complex SQL expression
@@ -200,7 +208,7 @@ class ItemTrackerQueryBase(object):
         :param sql: SQL to execute
         """
         order_by_columns = [self._parse_column(c) for c in columns]
-        self.order_by = ItemTrackerOrderBy(order_by_columns, sql)
+        self.order_by = ItemTrackerOrderBy(order_by_columns, sql, None)
 
     def _order_by_expression(self, table, column, descending, collation):
         parts = []
@@ -407,6 +415,13 @@ class ItemTracker(signals.SignalEmitter):
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
+    # do_idle_work() sizes its fetches so that each one takes about this many
+    # seconds.  This keeps the UI responsive while we load the rest of the
+    # list.
+    IDLE_FETCH_TIME = 0.05
+    # limits for the number of rows we fetch at one time in do_idle_work()
+    MIN_IDLE_FETCH_SIZE = 25
+    MAX_IDLE_FETCH_SIZE = 1000
 
     def __init__(self, idle_scheduler, query, item_source):
         """Create an ItemTracker
@@ -423,6 +438,7 @@ class ItemTracker(signals.SignalEmitter):
         self.create_signal("list-changed")
         self.idle_scheduler = idle_scheduler
         self.idle_work_scheduled = False
+        self.idle_fetch_size = self.MIN_IDLE_FETCH_SIZE
         self.item_fetcher = None
         self.item_source = item_source
         self._db_retry_callback_pending = False
@@ -482,15 +498,28 @@ class ItemTracker(signals.SignalEmitter):
         self._destroy_item_fetcher()
         try:
             connection = self.item_source.get_connection()
-            self.id_list = self.query.select_ids(connection)
+            self.id_list = self._select_ids(connection)
         except sqlite3.DatabaseError, e:
             logging.warn("%s while fetching items", e, exc_info=True)
             self.id_list = []
             self._run_db_error_dialog()
         self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
         self.row_data = {}
+        # all rows before this index are loaded
+        self._idle_fetch_index = 0
+        # stats for the rows that do_idle_work() loaded
+        self._idle_fetch_count = 0
+        self._idle_fetch_time = 0.0
         self.item_fetcher = self.make_item_fetcher(connection, self.id_list)
 
+    def _select_ids(self, connection):
+        """Get the ids for our query.
+
+        Subclasses can override this to avoid running the query in the
+        database.
+        """
+        return self.query.select_ids(connection)
+
     def _schedule_idle_work(self):
         """Schedule do_idle_work to be called some time in the
         future using idle_scheduler.
@@ -505,20 +534,73 @@ class ItemTracker(signals.SignalEmitter):
             # destroy() was called while the idle callback was still
             # scheduled.  Just return.
             return
-        for i in xrange(len(self.id_list)):
-            if not self._row_loaded(i):
-                # row data unloaded, call _ensure_row_loaded to load this row
-                # and adjecent rows then schedule another run later
-                self._ensure_row_loaded(i)
-                self._schedule_idle_work()
-                return
+        rows_to_load = self._rows_for_idle_fetch()
+        if rows_to_load:
+            # load the next chunk of rows, then schedule another run later
+            start = time.time()
+            self._load_rows(rows_to_load)
+            self._update_idle_fetch_size(len(rows_to_load),
+                                         time.time() - start)
+            self._schedule_idle_work()
+            return
         # no rows need loading
+        self._log_idle_fetch_stats()
         self.item_fetcher.done_fetching()
 
+    def _rows_for_idle_fetch(self):
+        """Get the indexes of the next rows for do_idle_work() to load.
+
+        We start at _idle_fetch_index rather than the start of the list, so
+        loading the whole list in the background is O(N) instead of O(N^2).
+        """
+        index = self._idle_fetch_index
+        while index < len(self.id_list) and self._row_loaded(index):
+            index += 1
+        self._idle_fetch_index = index
+        rows_to_load = []
+        # rows after index may have been loaded by _ensure_row_loaded(), skip
+        # those ones.
+        for i in xrange(index, len(self.id_list)):
+            if not self._row_loaded(i):
+                rows_to_load.append(i)
+                if len(rows_to_load) >= self.idle_fetch_size:
+                    break
+        return rows_to_load
+
+    def _update_idle_fetch_size(self, row_count, elapsed):
+        """Change idle_fetch_size based on how long the last fetch took.
+
+        We aim for fetches that take IDLE_FETCH_TIME seconds, but we only
+        double the size at each step, since the first fetches are usually
+        slower than the later ones.
+        """
+        self._idle_fetch_count += row_count
+        self._idle_fetch_time += elapsed
+        if elapsed > 0:
+            size = int(row_count * self.IDLE_FETCH_TIME / elapsed)
+        else:
+            size = self.MAX_IDLE_FETCH_SIZE
+        size = min(size, self.idle_fetch_size * 2)
+        self.idle_fetch_size = max(self.MIN_IDLE_FETCH_SIZE,
+                                   min(size, self.MAX_IDLE_FETCH_SIZE))
+
+    def _log_idle_fetch_stats(self):
+        if self._idle_fetch_count == 0 or self._idle_fetch_time <= 0:
+            return
+        logging.timing("ItemTracker: loaded %d rows in %.3f secs "
+                       "(%.0f rows/sec, fetch size: %d)",
+                       self._idle_fetch_count, self._idle_fetch_time,
+                       self._idle_fetch_count / self._idle_fetch_time,
+                       self.idle_fetch_size)
+        self._idle_fetch_count = 0
+        self._idle_fetch_time = 0.0
+
     def _uncache_row_data(self, id_list):
         for id_ in id_list:
             if id_ in self.row_data:
                 del self.row_data[id_]
+                self._idle_fetch_index = min(self._idle_fetch_index,
+                                             self.id_to_index[id_])
 
     def _refetch_id_list(self):
         """Refetch a new id list after we already have one."""
@@ -636,6 +718,17 @@ class ItemTracker(signals.SignalEmitter):
         self._set_query(new_query)
         self._refetch_id_list()
 
+    def change_item_source(self, item_source):
+        """Change the ItemSource that we use to create ItemInfos.
+
+        This will cause the list-change signal to be emitted, since we
+        refetch the list with the new ItemSource.
+
+        :param item_source: ItemSource object for the same database
+        """
+        self.item_source = item_source
+        self._refetch_id_list()
+
     def on_item_changes(self, message):
         """Call this when items get changed and the list needs to be
         updated.
@@ -706,6 +799,18 @@ class ItemFetcher(object):
     def path_column(self):
         return self.item_source.select_info.path_column
 
+    def make_item_info(self, row):
+        return self.item_source.make_item_info(row, self)
+
+    def fetch_full_row(self, item_id):
+        """Fetch all columns for an item for ItemInfo.load_full_row()
+
+        If we still have our connection, we use it rather than getting
+        another one from the connection pool.  Device and sharing pools only
+        allow a couple connections.
+        """
+        return self.item_source.fetch_full_row(item_id, self.connection)
+
     def release_connection(self):
         if self.connection is not None:
             self.item_source.release_connection(self.connection)
@@ -787,7 +892,7 @@ class ItemFetcherWAL(ItemFetcher):
                  (self.table_name(), ', '.join(str(i) for i in id_list)))
         sql = ' '.join((self._sql, where))
         cursor = self.connection.execute(sql)
-        return [self.item_source.make_item_info(row) for row in cursor]
+        return [self.make_item_info(row) for row in cursor]
 
     def refresh_items(self, changed_ids):
         # We ignore changed_ids and just start a new transaction which will
@@ -864,7 +969,7 @@ WHERE $table_name.id in ($id_list)""")
         id_list_str = ', '.join(str(i) for i in id_list)
         sql = "SELECT * FROM %s WHERE id IN (%s)" % (self.temp_table_name,
                                                      id_list_str)
-        return [self.item_source.make_item_info(row)
+        return [self.make_item_info(row)
                 for row in self.connection.execute(sql)]
 
     def refresh_items(self, changed_ids):
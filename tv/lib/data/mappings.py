@@ -61,6 +61,10 @@ class SharingItemPlaylistMap(object):
             rv[playlist_id].add(item_id)
         return rv
 
+    def clear(self):
+        """Remove all entries."""
+        self.connection.execute("DELETE FROM sharing_item_playlist_map")
+
     def remove_playlist(self, playlist_id):
         """Remove all entries for a playlist """
         self.connection.execute("DELETE FROM sharing_item_playlist_map "
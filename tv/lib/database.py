@@ -513,18 +513,25 @@ class AttributeUpdateTracker(object):
 
     def __set__(self, instance, value):
         if instance.__dict__.get(self.name, "BOGUS VALUE FOO") != value:
-            instance.changed_attributes.add(self.name)
+            try:
+                instance.__dict__['changed_attributes'].add(self.name)
+            except KeyError:
+                instance.changed_attributes = set([self.name])
         instance.__dict__[self.name] = value
 
 class DDBObject(signals.SignalEmitter):
     """Dynamic Database object
     """
 
+    # Shared, empty, changed_attributes value.  Most objects are never
+    # changed after they're restored from the DB, so we only create a
+    # set for an object once one of its attributes changes.
+    changed_attributes = frozenset()
+
     def __init__(self, *args, **kwargs):
         self.confirm_db_thread()
         self.in_db_init = True
         signals.SignalEmitter.__init__(self, 'removed')
-        self.changed_attributes = set()
 
         if 'db_info' in kwargs:
             self.db_info = kwargs.pop('db_info')
@@ -659,7 +666,8 @@ class DDBObject(signals.SignalEmitter):
         setattr(cls, name, AttributeUpdateTracker(name))
 
     def reset_changed_attributes(self):
-        self.changed_attributes = set()
+        # go back to using the shared, empty, class attribute
+        self.__dict__.pop('changed_attributes', None)
 
     def _bulk_update_db_values(self, dct):
         """Safely update many DB values at a time.
@@ -674,7 +682,10 @@ class DDBObject(signals.SignalEmitter):
         :param dct: dict of new values for our database attributes
         """
         self.__dict__.update(dct)
-        self.changed_attributes.update(dct.keys())
+        try:
+            self.__dict__['changed_attributes'].update(dct.keys())
+        except KeyError:
+            self.changed_attributes = set(dct.keys())
 
     def get_id(self):
         """Returns unique integer associated with this object
@@ -114,6 +114,10 @@ def alter_table_columns(cursor, table, delete_columns, rename_columns,
 
        Don't rename the id column--that would be bad.
 
+    If cursor is an UpgradeCursor, the table isn't rewritten right away.
+    Instead, the changes are combined with other changes to the same table
+    and applied in one pass.  See UpgradeCursor for details.
+
     :param table: the table to remove the columns from
     :param delete_columns: list of columns to delete
     :param rename_columns: dict mapping old column names to new column names
@@ -121,6 +125,10 @@ def alter_table_columns(cursor, table, delete_columns, rename_columns,
     """
     if new_types is None:
         new_types = {}
+    if isinstance(cursor, UpgradeCursor):
+        cursor.plan_table_rewrite(table, delete_columns, rename_columns,
+                                  new_types)
+        return
     cursor.execute("PRAGMA table_info('%s')" % table)
     old_columns = []
     new_columns = []
@@ -158,6 +166,260 @@ def alter_table_columns(cursor, table, delete_columns, rename_columns,
     for sql in index_sql:
         cursor.execute(sql)
 
+class _PendingTableRewrite(object):
+    """Column changes to a table that haven't been applied yet."""
+    def __init__(self, cursor, table):
+        self.table = table
+        self.table_re = re.compile(r'\b%s\b' % re.escape(table), re.I)
+        # number of alter_table_columns() calls we've combined
+        self.call_count = 0
+        # list of [original name, current name, type, type changed] lists
+        self.columns = []
+        # lowercase names of the columns in the table before the rewrite
+        self.table_columns = set()
+        # maps lowercase names of columns added with ADD COLUMN to their type
+        self.added_columns = {}
+        cursor.execute("PRAGMA table_info('%s')" % table)
+        for column_info in cursor.fetchall():
+            self.columns.append([column_info[1], column_info[1],
+                                 column_info[2], False])
+            self.table_columns.add(column_info[1].lower())
+        # The rewrite drops any triggers for the table
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                       "WHERE type='trigger' AND tbl_name=?", (table,))
+        self.has_triggers = cursor.fetchone()[0] > 0
+
+    def add_column(self, column, col_type):
+        """Add a column that was added to the table with ADD COLUMN.
+
+        :returns: False if column clashes with a column in the table, either
+            before or after the rewrite.
+        """
+        current_columns = set(c[1].lower() for c in self.columns)
+        if (column.lower() in self.table_columns or
+                column.lower() in current_columns):
+            return False
+        # PRAGMA table_info normalizes the type names, so set the type
+        # explicitly to keep it the same as in the ADD COLUMN statement.
+        self.columns.append([column, column, col_type, True])
+        self.table_columns.add(column.lower())
+        self.added_columns[column.lower()] = col_type
+        return True
+
+    def changed_columns(self):
+        """Get the columns that the rewrite will change.
+
+        This includes columns that will be deleted, renamed or have their
+        type changed.
+
+        :returns: set of lowercase column names
+        """
+        remaining = set(column[0].lower() for column in self.columns)
+        changed = self.table_columns - remaining
+        for original, current, col_type, type_changed in self.columns:
+            if original != current:
+                changed.add(original.lower())
+                changed.add(current.lower())
+            if (type_changed and
+                    self.added_columns.get(original.lower()) != col_type):
+                changed.add(current.lower())
+        return changed
+
+    def add_changes(self, delete_columns, rename_columns, new_types):
+        """Add changes from an alter_table_columns() call.
+
+        The column names are the current names, with all the earlier
+        changes applied.
+        """
+        self.call_count += 1
+        new_columns = []
+        for original, current, col_type, type_changed in self.columns:
+            if current in delete_columns:
+                continue
+            if current in rename_columns:
+                current = rename_columns[current]
+            if current in new_types:
+                col_type = new_types[current]
+                type_changed = True
+            elif original.lower() in self.added_columns:
+                # The column was added before this call, so
+                # alter_table_columns() would have normalized the type
+                type_changed = False
+            new_columns.append([original, current, col_type, type_changed])
+        self.columns = new_columns
+
+    def apply(self, cursor):
+        """Rewrite the table with all of our changes."""
+        remaining = set(column[0] for column in self.columns)
+        delete_columns = []
+        cursor.execute("PRAGMA table_info('%s')" % self.table)
+        for column_info in cursor.fetchall():
+            if column_info[1] not in remaining:
+                delete_columns.append(column_info[1])
+        rename_columns = {}
+        new_types = {}
+        for original, current, col_type, type_changed in self.columns:
+            if original != current:
+                rename_columns[original] = current
+            if type_changed:
+                new_types[current] = col_type
+        alter_table_columns(cursor, self.table, delete_columns,
+                            rename_columns, new_types)
+
+class UpgradeCursor(object):
+    """Cursor wrapper that combines table rewrites from upgrade functions.
+
+    alter_table_columns() (and remove_column()/rename_column()) copies the
+    entire table.  When upgrading from an old version, many upgrade functions
+    rewrite the same big tables, like item.  If an upgrade function calls
+    alter_table_columns() with an UpgradeCursor, we just remember the
+    changes.  Before any statement that depends on those changes runs, we
+    apply all the changes we've seen in one pass.  Statements that don't
+    depend on them, like SELECT/UPDATE/DELETE statements that only use
+    unchanged columns, or simple ADD COLUMN statements, run right away.  This
+    means that rewrites of a table from different upgrade functions get
+    coalesced as long as nothing in between needs the new table layout.
+
+    Call flush() to apply any remaining changes at the end of the upgrade.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        # maps table names to _PendingTableRewrite objects
+        self.pending_rewrites = {}
+        # number of alter_table_columns() calls
+        self.planned_rewrite_count = 0
+        # number of times we actually rewrote a table
+        self.rewrite_count = 0
+        # Maps SQL to the result of _can_run_before_rewrites().  Upgrade
+        # functions often run the same statement for each row in a table.
+        self._statement_cache = {}
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    # matches simple ADD COLUMN statements, without default values or
+    # constraints
+    _add_column_re = re.compile(r'^\s*ALTER\s+TABLE\s+(\w+)\s+ADD\s+'
+                                r'(?:COLUMN\s+)?(\w+)(?:\s+(\w+))?\s*$',
+                                re.I)
+
+    # matches statements that only work with the data in tables
+    _data_statement_re = re.compile(r'^\s*(SELECT|UPDATE|DELETE)\b', re.I)
+    _word_re = re.compile(r'\w+')
+
+    def execute(self, sql, *args):
+        if (self.pending_rewrites and
+                not self._can_run_before_rewrites(sql) and
+                not self._add_column_to_pending_rewrite(sql)):
+            self._flush_tables_used(sql, args)
+        return self.cursor.execute(sql, *args)
+
+    def _can_run_before_rewrites(self, sql):
+        try:
+            return self._statement_cache[sql]
+        except KeyError:
+            rv = self._calc_can_run_before_rewrites(sql)
+            self._statement_cache[sql] = rv
+            return rv
+
+    def _calc_can_run_before_rewrites(self, sql):
+        """Check if a statement gives the same results before and after the
+        pending rewrites.
+
+        This is true for SELECT, UPDATE and DELETE statements that don't use
+        any of the columns that the rewrites will change.  Statements that
+        use "*", look at the schema or fire triggers could see the
+        difference, so we don't run those.
+        """
+        if self._data_statement_re.match(sql) is None or '*' in sql:
+            return False
+        words = set(word.lower() for word in self._word_re.findall(sql))
+        if 'sqlite_master' in words:
+            return False
+        for table, rewrite in self.pending_rewrites.items():
+            if rewrite.table_re.search(sql) is None:
+                continue
+            if rewrite.has_triggers or words & rewrite.changed_columns():
+                return False
+        return True
+
+    def _add_column_to_pending_rewrite(self, sql):
+        """Handle ALTER TABLE ... ADD COLUMN for a table we're rewriting.
+
+        SQLite adds columns to the end of the table without copying it.  Our
+        rewrite keeps the column order, so we can add the column before
+        rewriting the table and still end up with the same schema.  We can't
+        do that if the column has a default value or constraints, since
+        alter_table_columns() doesn't keep those, or if the name clashes with
+        a column that we will delete or rename.
+
+        :returns: True if the column can be added without rewriting the table
+        """
+        match = self._add_column_re.match(sql)
+        if match is None:
+            return False
+        table, column, col_type = match.groups()
+        rewrite = self.pending_rewrites.get(table)
+        if rewrite is None:
+            return False
+        for other_table, other_rewrite in self.pending_rewrites.items():
+            if other_table != table and other_rewrite.table_re.search(sql):
+                return False
+        if not rewrite.add_column(column, col_type or ''):
+            return False
+        self._statement_cache.clear()
+        return True
+
+    def executemany(self, sql, *args):
+        if self.pending_rewrites:
+            self._flush_tables_used(sql, ())
+        return self.cursor.executemany(sql, *args)
+
+    def executescript(self, sql):
+        self.flush()
+        return self.cursor.executescript(sql)
+
+    def plan_table_rewrite(self, table, delete_columns, rename_columns,
+                           new_types):
+        self.planned_rewrite_count += 1
+        self._statement_cache.clear()
+        if table not in self.pending_rewrites:
+            self.pending_rewrites[table] = _PendingTableRewrite(self.cursor,
+                                                                table)
+        self.pending_rewrites[table].add_changes(delete_columns,
+                                                 rename_columns, new_types)
+
+    def flush(self):
+        """Apply all pending table rewrites."""
+        for table in self.pending_rewrites.keys():
+            self._apply_rewrite(table)
+
+    def _get_params(self, args):
+        if not args:
+            return ()
+        params = args[0]
+        if isinstance(params, dict):
+            return params.values()
+        return params
+
+    def _flush_tables_used(self, sql, args):
+        params = self._get_params(args)
+        for table, rewrite in self.pending_rewrites.items():
+            if rewrite.table_re.search(sql) or table in params:
+                self._apply_rewrite(table)
+
+    def _apply_rewrite(self, table):
+        rewrite = self.pending_rewrites.pop(table)
+        self._statement_cache.clear()
+        start = time.time()
+        rewrite.apply(self.cursor)
+        self.rewrite_count += 1
+        logging.timing("rewrote %s table for %d upgrade changes: %.3f secs",
+                       table, rewrite.call_count, time.time() - start)
+
 def get_object_tables(cursor):
     """Returns a list of tables that store ``DDBObject`` subclasses.
     """
@@ -172,6 +434,10 @@ def get_next_id(cursor):
     This will be 1 higher than the max id for all the tables in the
     DB.
     """
+    if isinstance(cursor, UpgradeCursor):
+        # Table rewrites don't change ids, so there's no need to apply them
+        # before looking at the max ids.
+        cursor = cursor.cursor
     max_id = 0
     for table in get_object_tables(cursor):
         # skip tables that don't store DDBObjects
@@ -231,7 +497,7 @@ def contexts_for_upgrade_func(func):
         return set(['main']) # default case
 
 def new_style_upgrade(cursor, saved_version, upgrade_to, context,
-                      show_progress):
+                      show_progress, coalesce_rewrites=True):
     """Upgrade a database using new-style upgrade functions.
 
     This method replaces the upgrade() method.  However, we still need
@@ -246,6 +512,11 @@ def new_style_upgrade(cursor, saved_version, upgrade_to, context,
 
         upgrade3(cursor)
         upgrade4(cursor)
+
+    :param coalesce_rewrites: pass an UpgradeCursor to the upgrade functions
+        so that table rewrites can be combined
+    :returns: list of (version, seconds) tuples, giving the time each upgrade
+        function took
     """
 
     if saved_version > upgrade_to:
@@ -256,17 +527,49 @@ def new_style_upgrade(cursor, saved_version, upgrade_to, context,
     if show_progress:
         dbupgradeprogress.new_style_progress(saved_version, saved_version,
                                              upgrade_to)
+    if coalesce_rewrites:
+        upgrade_cursor = UpgradeCursor(cursor)
+    else:
+        upgrade_cursor = cursor
+    upgrade_start = time.time()
+    timings = []
     for version in xrange(saved_version + 1, upgrade_to + 1):
         if util.chatter:
             logging.info("upgrading database to version %s", version)
         upgrade_func = get_upgrade_func(version)
         if context in contexts_for_upgrade_func(upgrade_func):
+            start = time.time()
             cursor.execute("BEGIN TRANSACTION")
-            upgrade_func(cursor)
+            upgrade_func(upgrade_cursor)
             cursor.execute("COMMIT TRANSACTION")
+            timings.append((version, time.time() - start))
         if show_progress:
             dbupgradeprogress.new_style_progress(saved_version, version,
                                                  upgrade_to)
+    if coalesce_rewrites:
+        cursor.execute("BEGIN TRANSACTION")
+        upgrade_cursor.flush()
+        cursor.execute("COMMIT TRANSACTION")
+    _log_upgrade_timings(saved_version, upgrade_to, timings,
+                         time.time() - upgrade_start, upgrade_cursor)
+    return timings
+
+def _log_upgrade_timings(saved_version, upgrade_to, timings, total_time,
+                         upgrade_cursor):
+    if not timings:
+        return
+    if isinstance(upgrade_cursor, UpgradeCursor):
+        rewrite_info = ", %d table rewrites for %d alter_table_columns() " \
+                "calls" % (upgrade_cursor.rewrite_count,
+                           upgrade_cursor.planned_rewrite_count)
+    else:
+        rewrite_info = ""
+    logging.timing("database upgrade %s -> %s: %d steps in %.3f secs%s",
+                   saved_version, upgrade_to, len(timings), total_time,
+                   rewrite_info)
+    for version, elapsed in sorted(timings, key=lambda t: t[1],
+                                   reverse=True)[:10]:
+        logging.timing("upgrade%s: %.3f secs", version, elapsed)
 
 def upgrade(savedObjects, save_version, upgrade_to, show_progress):
     """Upgrade a list of SavableObjects that were saved using an old
@@ -4298,3 +4601,14 @@ def upgrade195(cursor):
         else:
             size = None
         cursor.execute("UPDATE item SET size=? WHERE id=?", (size, item_id))
+
+def upgrade196(cursor):
+    """Add last_checked to icon_cache so we can revalidate old icons."""
+    cursor.execute("ALTER TABLE icon_cache ADD last_checked timestamp")
+
+@run_on_both
+def upgrade197(cursor):
+    """Add the fingerprint column to metadata_status."""
+    cursor.execute("ALTER TABLE metadata_status ADD fingerprint text")
+    cursor.execute("CREATE INDEX metadata_fingerprint ON "
+                   "metadata_status (fingerprint)")
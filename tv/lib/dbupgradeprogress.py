@@ -37,6 +37,7 @@ from miro import messages
 _doing_20_upgrade = False
 _doing_new_style_upgrade = False
 _sent_upgrade_start = False
+_last_total_progress = 0.0
 
 def doing_20_upgrade():
     """Call this if we are upgrading from a 2.0-style database.
@@ -67,6 +68,14 @@ def upgrade_end():
     """Call at the end of the database upgrades."""
     messages.DatabaseUpgradeEnd().send_to_frontend()
 
+def database_copy_progress(copied_bytes, total_bytes):
+    """Call while copying the database file before running upgrades."""
+    progress = _calc_progress(0, copied_bytes, total_bytes)
+    # copying takes us from 0% to 5%.  We may copy again later in the upgrade
+    # (after converting a 2.0 database), don't move the bar backwards then.
+    total = max(0.05 * progress, _last_total_progress)
+    _send_message(_('Copying Database'), progress, total)
+
 def old_style_progress(start_version, current_version, end_version):
     """Call while stepping through old-style upgrades"""
     progress = _calc_progress(start_version, current_version, end_version)
@@ -104,10 +113,11 @@ def infocache_progress(current_item, total_items):
     _send_message(_('Preparing Items'), progress, total)
 
 def _send_message(stage, stage_progress, total_progress):
-    global _sent_upgrade_start
+    global _sent_upgrade_start, _last_total_progress
     if not _sent_upgrade_start:
         upgrade_start()
         _sent_upgrade_start = True
+    _last_total_progress = total_progress
     messages.DatabaseUpgradeProgress(stage, stage_progress,
             total_progress).send_to_frontend()
 
@@ -79,7 +79,7 @@ from miro.plat.utils import (filename_to_unicode, unicode_to_filename,
 # how much slower converting a file is, compared to copying
 CONVERSION_SCALE = 500
 # schema version for device databases
-DB_VERSION = 194
+DB_VERSION = 197
 
 def unicode_to_path(path):
     """
@@ -1506,7 +1506,7 @@ def _device_not_valid(device):
         return True
     return False
 
-@eventloop.idle_iterator
+@eventloop.background_idle_iterator
 def scan_device_for_files(device):
     # XXX is this as_idle() safe?
 
@@ -1519,15 +1519,19 @@ def scan_device_for_files(device):
     found_files = []
     start = time.time()
 
-    for path in fileutil.miro_allfiles(device.mount):
-        relpath = os.path.relpath(path, device.mount)
-        if ((filetypes.is_video_filename(path) or
-            filetypes.is_audio_filename(path)) and
-            relpath.lower() not in known_files):
-            found_files.append(relpath)
-        if time.time() - start > 0.3:
+    walker = fileutil.DirectoryWalker(device.mount)
+    for batch in walker.iter_batches(timeout=0.05):
+        for path in batch:
+            relpath = os.path.relpath(path, device.mount)
+            if ((filetypes.is_video_filename(path) or
+                filetypes.is_audio_filename(path)) and
+                relpath.lower() not in known_files):
+                found_files.append(relpath)
+        # an empty batch means that the walker threads are still working
+        if not batch or time.time() - start > 0.3:
             yield # let other stuff run
             if _device_not_valid(device):
+                walker.cancel()
                 break
             start = time.time()
 
@@ -29,6 +29,8 @@
 
 """directorywatch -- watch directories for changes.  """
 
+import weakref
+
 from miro import app
 from miro import signals
 
@@ -43,7 +45,13 @@ class DirectoryWatcher(signals.SignalEmitter):
 
     The API is pretty simple, frontends only need to implement
     startup(), then emit signals whenever files get added/removed.
+    Frontends that keep track of the files inside the directories they
+    watch can also implement has_file().
     """
+
+    # all DirectoryWatcher objects that currently exist
+    _all_watchers = weakref.WeakSet()
+
     def __init__(self, root_directory, skip_dirs=None):
         """Construct a new DirectoryWatcher
 
@@ -55,11 +63,32 @@ class DirectoryWatcher(signals.SignalEmitter):
             self.skip_dirs = set(skip_dirs)
         else:
             self.skip_dirs = set()
+        DirectoryWatcher._all_watchers.add(self)
         self.startup(root_directory)
 
     def startup(self, root_directory):
         raise NotImplementedError()
 
+    def has_file(self, path):
+        """Check if we know that a file exists.
+
+        If this returns True, the file is inside a directory that we're
+        watching, so we'll emit the deleted signal if it gets removed.
+        Callers can use this to skip checking the filesystem.
+
+        This may be called from any thread.  The default implementation
+        always returns False.
+        """
+        return False
+
+    @classmethod
+    def any_watcher_has_file(cls, path):
+        """Check if any DirectoryWatcher knows that a file exists."""
+        for watcher in list(cls._all_watchers):
+            if watcher.has_file(path):
+                return True
+        return False
+
     @classmethod
     def install(cls):
         app.directory_watcher = cls
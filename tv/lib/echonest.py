@@ -101,8 +101,9 @@ def exec_codegen(codegen_info, media_path, callback, errback):
         errback(media_path, error)
 
     logging.debug("Invoking echonest codegen on %s", media_path)
-    eventloop.call_in_thread(thread_callback, thread_errback, thread_function,
-                             'exec echonest codegen')
+    eventloop.call_in_thread_category('codegen', thread_callback,
+                                      thread_errback, thread_function,
+                                      'exec echonest codegen')
 
 def cant_run_codegen():
     # Windows doesn't support uname, but we know we can run ENMFP-codegen
@@ -35,10 +35,11 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import collections
 import errno
 import heapq
 import logging
-import Queue
+import math
 import select
 import socket
 import threading
@@ -54,12 +55,189 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+# Priorities for idle calls.  Idle calls with a higher priority always run
+# before ones with a lower priority.
+#   - PRIORITY_INTERACTIVE is for work that the user is waiting on.
+#   - PRIORITY_NORMAL is the default.
+#   - PRIORITY_BACKGROUND is for long-running maintenance work, like scanning
+#     directories and requesting icons, that can wait until things are quiet.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BACKGROUND)
+
+# Max time to spend running idle calls in one loop iteration.  After that, we
+# go back to select() to handle socket callbacks and timeouts, then continue
+# with the rest of the idles.
+IDLE_TIME_BUDGET = 0.1
+
+class LatencyHistogram(object):
+    """Track a distribution of times using logarithmic buckets.
+
+    Bucket N holds times up to BASE * 2 ** N seconds (the last bucket holds
+    everything larger than that).  This lets us estimate percentiles using a
+    fixed amount of memory, no matter how many times get recorded.
+    """
+    BASE = 0.0001
+    BUCKET_COUNT = 20
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        if duration <= self.BASE:
+            index = 0
+        else:
+            index = min(int(math.ceil(math.log(duration / self.BASE, 2))),
+                        self.BUCKET_COUNT - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, percent):
+        """Estimate a percentile of the recorded times.
+
+        :returns: the upper bound of the bucket that the percentile falls
+                  into, or 0 if nothing was recorded
+        """
+        if self.count == 0:
+            return 0.0
+        target = self.count * percent / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target and index < self.BUCKET_COUNT - 1:
+                return min(self.BASE * 2 ** index, self.max)
+        return self.max
+
+class LoopProfiler(object):
+    """Collect statistics about where the event loop spends its time.
+
+    LoopProfiler tracks:
+      - call counts and latency histograms for each idle/timeout/urgent call,
+        keyed by the name passed to add_idle(), add_timeout(), etc.
+      - the depth of the idle queue, sampled at the start of each loop
+      - how long calls wait in the thread pool queue before a thread picks
+        them up
+
+    Profiling is off by default.  Use enable_profiling() to turn it on.
+    """
+    # how many seconds of idle queue depth history to keep
+    QUEUE_DEPTH_HISTORY = 300
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = clock()
+        self.calls = {}
+        self.threadpool_waits = {}
+        self.idle_queue_max = 0
+        self.idle_queue_samples = 0
+        self.idle_queue_total = 0
+        # list of (time, max depth) tuples, one per second
+        self.idle_queue_history = collections.deque(
+            maxlen=self.QUEUE_DEPTH_HISTORY)
+        self._lock = threading.Lock()
+
+    def record_call(self, name, duration):
+        try:
+            histogram = self.calls[name]
+        except KeyError:
+            histogram = self.calls[name] = LatencyHistogram()
+        histogram.add(duration)
+
+    def record_threadpool_wait(self, name, duration):
+        # thread pool waits get recorded from the pool threads, so we need to
+        # lock here.
+        self._lock.acquire()
+        try:
+            try:
+                histogram = self.threadpool_waits[name]
+            except KeyError:
+                histogram = self.threadpool_waits[name] = LatencyHistogram()
+            histogram.add(duration)
+        finally:
+            self._lock.release()
+
+    def sample_idle_queue(self, depth):
+        self.idle_queue_max = max(self.idle_queue_max, depth)
+        self.idle_queue_samples += 1
+        self.idle_queue_total += depth
+        now = int(clock())
+        history = self.idle_queue_history
+        if history and history[-1][0] == now:
+            if depth > history[-1][1]:
+                history[-1] = (now, depth)
+        else:
+            history.append((now, depth))
+
+    def format_report(self, limit=30):
+        """Format the data we've collected as a string.
+
+        :param limit: max number of calls to list in each section
+        """
+        lines = ['Event loop profile (%.1f secs)' %
+                 (clock() - self.start_time)]
+        lines.append('')
+        lines.append('Calls by total time:')
+        lines.extend(self._format_histograms(self.calls, limit))
+        lines.append('')
+        lines.append('Thread pool queue waits:')
+        self._lock.acquire()
+        try:
+            waits = self.threadpool_waits.copy()
+        finally:
+            self._lock.release()
+        lines.extend(self._format_histograms(waits, limit))
+        lines.append('')
+        lines.append('Thread pool categories:')
+        for stats in _eventloop.threadpool.get_stats():
+            lines.append('  %(name)s: %(running)d/%(max_running)d running, '
+                         '%(queued)d queued, %(completed)d done, '
+                         '%(canceled)d canceled, wait p50 %(wait_p50).4f '
+                         'p99 %(wait_p99).4f, run p50 %(run_p50).4f '
+                         'p99 %(run_p99).4f' % stats)
+        lines.append('')
+        if self.idle_queue_samples:
+            average = float(self.idle_queue_total) / self.idle_queue_samples
+        else:
+            average = 0.0
+        lines.append('Idle queue depth: max %d, average %.1f' %
+                     (self.idle_queue_max, average))
+        if self.idle_queue_history:
+            lines.append('  recent: %s' % ' '.join(
+                str(depth) for (when, depth) in self.idle_queue_history))
+        return '\n'.join(lines)
+
+    def _format_histograms(self, histograms, limit):
+        items = sorted(histograms.items(), key=lambda i: i[1].total,
+                       reverse=True)
+        lines = []
+        for name, histogram in items[:limit]:
+            lines.append('  %8.3f total %6d calls  p50 %8.4f  p99 %8.4f  '
+                         'max %8.4f  %s' % (histogram.total, histogram.count,
+                                            histogram.percentile(50),
+                                            histogram.percentile(99),
+                                            histogram.max, name))
+        if len(items) > limit:
+            lines.append('  (%d more)' % (len(items) - limit))
+        return lines
+
+# LoopProfiler object if profiling is enabled
+_profiler = None
+
 class DelayedCall(object):
-    def __init__(self, function, name, args, kwargs):
+    def __init__(self, function, name, args, kwargs, key=None):
         self.function = function
         self.name = name
         self.args = args
         self.kwargs = kwargs
+        self.key = key
         self.canceled = False
 
     def _unlink(self):
@@ -90,6 +268,8 @@ class DelayedCall(object):
                 total = 0
             total += end - start
             cumulative[self.name] = total
+            if _profiler is not None:
+                _profiler.record_call(self.name, end - start)
             if total > 5.0:
                 logging.timing("%s cumulative is too slow (%.3f secs)",
                                self.name, total)
@@ -125,18 +305,36 @@ class Scheduler(object):
         return dc.dispatch()
 
 class CallQueue(object):
+    """Queue of idle calls to run.
+
+    Calls run in priority order, then in the order that they were added.
+
+    Calls can optionally be added with a key.  If a call with the same key is
+    already waiting to run, then we don't add a second one.
+    """
     def __init__(self):
-        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.queues = [collections.deque() for priority in PRIORITIES]
+        self.keyed_calls = {}
         self.quit_flag = False
         self.queue_size_warning_count = 0
 
-    def add_idle(self, function, name, args=None, kwargs=None):
+    def add_idle(self, function, name, args=None, kwargs=None,
+                 priority=PRIORITY_NORMAL, key=None):
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
-        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
-        self.queue.put(dc)
+        with self.lock:
+            if key is not None:
+                existing = self.keyed_calls.get(key)
+                if existing is not None and not existing.canceled:
+                    return existing
+            dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs,
+                             key)
+            self.queues[priority].append(dc)
+            if key is not None:
+                self.keyed_calls[key] = dc
 
         # Check if our queue size is too big and log a warning if so.  Only do
         # this a few times.  That should be enough to track down errors, but
@@ -145,19 +343,38 @@ class CallQueue(object):
         # NOTE: the code below doesn't take into account that this method
         # runs on multiple threads.  However, the worst that can happen is
         # we log an extra warning or two, so this doesn't seem bad.
-        if self.queue_size_warning_count < 5 and self.queue.qsize() > 1000:
+        if self.queue_size_warning_count < 5 and self.qsize() > 1000:
             if self.queue_size_warning_count < 5:
                 logging.stacktrace("Queued called size too large")
                 self.queue_size_warning_count += 1
 
         return dc
 
+    def _pop_next_call(self):
+        with self.lock:
+            for queue in self.queues:
+                if queue:
+                    dc = queue.popleft()
+                    if (dc.key is not None and
+                            self.keyed_calls.get(dc.key) is dc):
+                        del self.keyed_calls[dc.key]
+                    return dc
+        return None
+
     def process_next_idle(self):
-        dc = self.queue.get()
+        dc = self._pop_next_call()
+        if dc is None:
+            return True
         return dc.dispatch()
 
     def has_pending_idle(self):
-        return not self.queue.empty()
+        for queue in self.queues:
+            if queue:
+                return True
+        return False
+
+    def qsize(self):
+        return sum(len(queue) for queue in self.queues)
 
     def process_idles(self):
         # Note: used for testing purposes
@@ -165,60 +382,294 @@ class CallQueue(object):
             self.process_next_idle()
 
 
+class ThreadPoolCall(object):
+    """A call scheduled with call_in_thread()."""
+    def __init__(self, category, callback, errback, function, name, args,
+                 kwargs):
+        self.category = category
+        self.callback = callback
+        self.errback = errback
+        self.function = function
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.queue_time = clock()
+        self.started = False
+        self.canceled = False
+
+    def cancel(self):
+        """Cancel the call if it hasn't started yet.
+
+        Use this when the object that scheduled the call goes away before
+        the call runs.  Once a call has started, it can't be canceled and its
+        callback or errback will still be called.
+
+        :returns: True if the call was canceled
+        """
+        return self.category.pool.cancel_call(self)
+
+class ThreadPoolCategory(object):
+    """Group of thread pool calls that share a queue and concurrency limit.
+
+    We also track how long calls in each category wait in the queue and how
+    long they take to run.
+    """
+    def __init__(self, pool, name, max_running):
+        self.pool = pool
+        self.name = name
+        self.max_running = max_running
+        self.queue = collections.deque()
+        self.running = 0
+        self.canceled_count = 0
+        self.wait_times = LatencyHistogram()
+        self.run_times = LatencyHistogram()
+
+    def can_run_call(self):
+        return len(self.queue) > 0 and self.running < self.max_running
+
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    Calls are grouped into categories.  Each category has its own queue and
+    a limit on how many of its calls can run at once, so that one slow kind
+    of call (for example connecting to an unresponsive share) can't take
+    over all the threads.
+
+    The pool keeps MIN_THREADS threads around and starts more, up to
+    MAX_THREADS, when calls are waiting and no thread is free.  The extra
+    threads exit once there's nothing for them to do.
     """
-    THREADS = 4
+    MIN_THREADS = 2
+    MAX_THREADS = 8
+    DEFAULT_CATEGORY = 'default'
+    # max number of concurrent calls for each category.  Categories not
+    # listed here get DEFAULT_CATEGORY_LIMIT.
+    CATEGORY_LIMITS = {
+        'default': 4,
+        'dns': 4,
+        'sharing': 2,
+        'codegen': 1,
+        'filesystem': 2,
+    }
+    DEFAULT_CATEGORY_LIMIT = 2
 
     def __init__(self, event_loop):
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
+        self.condition = threading.Condition(threading.Lock())
+        self.categories = {}
         self.threads = []
+        self.idle_threads = 0
+        self.started = False
+        self.quitting = False
+
+    def get_category(self, name):
+        """Get a ThreadPoolCategory, creating it if needed.
+
+        Must be called with our condition lock held.
+        """
+        try:
+            return self.categories[name]
+        except KeyError:
+            max_running = self.CATEGORY_LIMITS.get(name,
+                                                   self.DEFAULT_CATEGORY_LIMIT)
+            category = ThreadPoolCategory(self, name, max_running)
+            self.categories[name] = category
+            return category
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
-                                 target=thread_body,
-                                 args=[self.thread_loop])
-            t.setDaemon(True)
-            t.start()
-            self.threads.append(t)
+        with self.condition:
+            self.started = True
+            self.quitting = False
+            while len(self.threads) < self.MIN_THREADS:
+                self._start_thread()
+
+    def _start_thread(self):
+        t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
+                             target=thread_body,
+                             args=[self.thread_loop])
+        t.setDaemon(True)
+        self.threads.append(t)
+        t.start()
+
+    def _next_call(self):
+        """Pick the next call to run.
+
+        We go through the categories that have calls waiting and pick the
+        one whose first call has been waiting the longest.
+
+        Must be called with our condition lock held.
+
+        :returns: ThreadPoolCall or None if nothing can run now
+        """
+        best = None
+        for category in self.categories.itervalues():
+            if category.can_run_call():
+                if (best is None or
+                        category.queue[0].queue_time <
+                        best.queue[0].queue_time):
+                    best = category
+        if best is None:
+            return None
+        call = best.queue.popleft()
+        call.started = True
+        best.running += 1
+        best.wait_times.add(clock() - call.queue_time)
+        return call
 
     def thread_loop(self):
+        me = threading.currentThread()
+        call = None
         while True:
-            next_item = self.queue.get()
-            if next_item == "QUIT":
-                break
-            else:
-                callback, errback, func, name, args, kwargs, = next_item
-            try:
-                result = func(*args, **kwargs)
-            except KeyboardInterrupt:
-                raise
-            except Exception, exc:
-                logging.debug(">>> thread_loop: %s %s %s %s\n%s",
-                              func, name, args, kwargs,
-                              "".join(traceback.format_exc()))
-                func = errback
-                name = 'Thread Pool Errback (%s)' % name
-                args = (exc,)
-            else:
-                func = callback
-                name = 'Thread Pool Callback (%s)' % name
-                args = (result,)
-            if not self.event_loop.quit_flag:
-                self.event_loop.idle_queue.add_idle(func, name, args=args)
-                self.event_loop.wakeup()
+            if call is None:
+                with self.condition:
+                    call = self._next_call()
+                    while call is None:
+                        if me not in self.threads:
+                            # close_threads() gave up waiting for us
+                            return
+                        if (self.quitting or
+                                len(self.threads) > self.MIN_THREADS):
+                            # nothing to do and we're an extra thread
+                            self.threads.remove(me)
+                            return
+                        self.idle_threads += 1
+                        self.condition.wait()
+                        call = self._next_call()
+            call = self._run_call(call)
+
+    def _run_call(self, call):
+        """Run a call and queue its callback.
+
+        :returns: the next call for this thread to run, or None
+        """
+        if _profiler is not None:
+            _profiler.record_threadpool_wait(call.name,
+                                             clock() - call.queue_time)
+        start = clock()
+        try:
+            result = call.function(*call.args, **call.kwargs)
+        except KeyboardInterrupt:
+            raise
+        except Exception, exc:
+            logging.debug(">>> thread_loop: %s %s %s %s\n%s",
+                          call.function, call.name, call.args, call.kwargs,
+                          "".join(traceback.format_exc()))
+            func = call.errback
+            name = 'Thread Pool Errback (%s)' % call.name
+            args = (exc,)
+        else:
+            func = call.callback
+            name = 'Thread Pool Callback (%s)' % call.name
+            args = (result,)
+        run_time = clock() - start
+        call.function = call.args = call.kwargs = None
+        # queue the callback before updating our stats, so that once a call
+        # is counted as finished its callback is already waiting to run
+        if not self.event_loop.quit_flag:
+            self.event_loop.idle_queue.add_idle(func, name, args=args)
+            self.event_loop.wakeup()
+        with self.condition:
+            call.category.running -= 1
+            call.category.run_times.add(run_time)
+            # Take our next call while we hold the lock.  Only wake another
+            # thread if there are calls left over after that, otherwise
+            # we'd start threads that find nothing to do and exit.
+            next_call = self._next_call()
+            if self._runnable_count() > 0:
+                self._wake_thread()
+        return next_call
+
+    def _runnable_count(self):
+        """Count the calls that could start right now.
+
+        Must be called with our condition lock held.
+        """
+        return sum(min(len(category.queue),
+                       category.max_running - category.running)
+                   for category in self.categories.itervalues()
+                   if category.can_run_call())
+
+    def _wake_thread(self):
+        """Make sure a thread is available to run a call.
+
+        Must be called with our condition lock held.
+        """
+        if self.idle_threads > 0:
+            # decrement idle_threads here rather than in the woken thread,
+            # otherwise several calls in a row would all count on the same
+            # idle thread.
+            self.idle_threads -= 1
+            self.condition.notify()
+        elif len(self.threads) < self.MAX_THREADS:
+            self._start_thread()
 
     def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+        return self.queue_call_with_category(self.DEFAULT_CATEGORY, callback,
+                                             errback, function, name, *args,
+                                             **kwargs)
+
+    def queue_call_with_category(self, category_name, callback, errback,
+                                 function, name, *args, **kwargs):
+        with self.condition:
+            category = self.get_category(category_name)
+            call = ThreadPoolCall(category, callback, errback, function,
+                                  name, args, kwargs)
+            category.queue.append(call)
+            if self.started and category.running < category.max_running:
+                self._wake_thread()
+        return call
+
+    def cancel_call(self, call):
+        with self.condition:
+            if call.started or call.canceled:
+                return False
+            call.category.queue.remove(call)
+            call.category.canceled_count += 1
+            call.canceled = True
+        call.callback = call.errback = call.function = None
+        call.args = call.kwargs = None
+        return True
+
+    def has_queued_calls(self):
+        with self.condition:
+            for category in self.categories.itervalues():
+                if category.queue:
+                    return True
+            return False
+
+    def get_stats(self):
+        """Get statistics for each category.
+
+        :returns: list of dicts, sorted by category name
+        """
+        rv = []
+        with self.condition:
+            for name in sorted(self.categories):
+                category = self.categories[name]
+                rv.append({
+                    'name': name,
+                    'max_running': category.max_running,
+                    'running': category.running,
+                    'queued': len(category.queue),
+                    'canceled': category.canceled_count,
+                    'completed': category.run_times.count,
+                    'wait_p50': category.wait_times.percentile(50),
+                    'wait_p99': category.wait_times.percentile(99),
+                    'run_p50': category.run_times.percentile(50),
+                    'run_p99': category.run_times.percentile(99),
+                })
+        return rv
 
     def close_threads(self):
-        for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
+        with self.condition:
+            self.started = False
+            self.quitting = True
+            self.idle_threads = 0
+            self.condition.notifyAll()
+            threads = list(self.threads)
         # Why is there a timeout on the join() here, what's wrong?  On
         # shutdown, the system waits for the eventloop to finish using 
         # eventloop.join() but eventloop calls close_threads() which wait
@@ -226,12 +677,123 @@ class ThreadPool(object):
         # in a blocking operation which is exactly the point of having them
         # so eventloop.join() in turn blocks.  So if it doesn't clean up
         # in time let the daemon flag in the Thread() do its job.  See #16584.
-        for t in self.threads:
+        for t in threads:
             try:
                 t.join(0.5)
             except StandardError:
                 pass
-        self.threads = []
+        with self.condition:
+            self.threads = []
+
+class SelectPoller(object):
+    """Wait for sockets to become ready using select().
+
+    Pollers keep track of which fds we're interested in, so that we don't
+    need to rebuild the fd lists every time through the event loop.
+    """
+    def __init__(self):
+        self.read_fds = set()
+        self.write_fds = set()
+
+    def update(self, fd, readable, writable):
+        """Change the events that we wait for on an fd.
+
+        Passing False for both readable and writable stops watching the fd.
+        """
+        if readable:
+            self.read_fds.add(fd)
+        else:
+            self.read_fds.discard(fd)
+        if writable:
+            self.write_fds.add(fd)
+        else:
+            self.write_fds.discard(fd)
+
+    def poll(self, timeout):
+        """Wait for events.
+
+        :param timeout: max time to wait in seconds, or None to wait forever
+        :returns: (read_fds_ready, write_fds_ready, exc_fds_ready) tuple
+        """
+        return select.select(self.read_fds, self.write_fds, [], timeout)
+
+class EpollPoller(object):
+    """Wait for sockets to become ready using epoll.
+
+    Unlike select(), epoll doesn't have a limit on the fd numbers it can
+    handle and doesn't need to be passed all the fds each time we wait.
+    """
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.masks = {}
+
+    def update(self, fd, readable, writable):
+        mask = 0
+        if readable:
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if writable:
+            mask |= select.EPOLLOUT
+        old_mask = self.masks.get(fd, 0)
+        if mask == old_mask:
+            return
+        try:
+            if mask == 0:
+                del self.masks[fd]
+                self.epoll.unregister(fd)
+            elif old_mask == 0:
+                self.masks[fd] = mask
+                self._register(fd, mask)
+            else:
+                self.masks[fd] = mask
+                self._modify(fd, mask)
+        except (IOError, OSError), e:
+            # The fd was probably closed before we stopped watching it.
+            # The kernel drops closed fds from the epoll set, so there's
+            # nothing left to do.
+            if e.errno not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def _register(self, fd, mask):
+        try:
+            self.epoll.register(fd, mask)
+        except (IOError, OSError), e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fd, mask)
+
+    def _modify(self, fd, mask):
+        try:
+            self.epoll.modify(fd, mask)
+        except (IOError, OSError), e:
+            # The fd number was closed and reused, so the kernel forgot
+            # about it
+            if e.errno != errno.ENOENT:
+                raise
+            self.epoll.register(fd, mask)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        read_ready = []
+        write_ready = []
+        for fd, events in self.epoll.poll(timeout):
+            mask = self.masks.get(fd, 0)
+            # select() reports errors and hangups as both readable and
+            # writable.  Do the same, so that the callbacks see the error.
+            if events & (select.EPOLLERR | select.EPOLLHUP):
+                events |= mask
+            if events & (select.EPOLLIN | select.EPOLLPRI):
+                read_ready.append(fd)
+            if events & select.EPOLLOUT:
+                write_ready.append(fd)
+        return read_ready, write_ready, []
+
+def make_poller():
+    """Create the best poller object for this platform."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    else:
+        return SelectPoller()
 
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
@@ -243,6 +805,15 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.quit_flag = False
         self.wake_sender, self.wake_receiver = util.make_dummy_socket_pair()
         self.loop_ready = threading.Event()
+        # Used to avoid writing to wake_sender unless the loop is actually
+        # waiting for events.  These get set when:
+        #   - _sleeping: we are waiting for events with a non-zero timeout
+        #   - _wakeup_requested: wakeup() was called since the last wait
+        #   - _wakeup_sent: wakeup() wrote to wake_sender during this wait
+        self._wakeup_lock = threading.Lock()
+        self._sleeping = False
+        self._wakeup_requested = False
+        self._wakeup_sent = False
 
     def loop(self):
         self.loop_ready.set()
@@ -253,17 +824,25 @@ class SimpleEventLoop(signals.SignalEmitter):
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
+            with self._wakeup_lock:
+                if self._wakeup_requested:
+                    # wakeup() was called while we were handling events.
+                    # Check the sockets, but don't wait for anything.
+                    timeout = 0
+                self._wakeup_requested = False
+                self._sleeping = (timeout != 0)
             try:
                 read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
-            except select.error, (err, detail):
-                if err == errno.EINTR:
-                    logging.warning ("eventloop: %s", detail)
+                        self.wait_for_events(timeout)
+            except (select.error, IOError, OSError), e:
+                self._stop_sleeping()
+                self.emit('end-loop')
+                if e.args[0] == errno.EINTR:
+                    logging.warning ("eventloop: %s", e.args[-1])
+                    continue
                 else:
-                    self.emit('end-loop')
                     raise
+            self._stop_sleeping()
             if self.quit_flag:
                 self.emit('end-loop')
                 break
@@ -272,7 +851,36 @@ class SimpleEventLoop(signals.SignalEmitter):
             self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
             self.emit('end-loop')
 
+    def wait_for_events(self, timeout):
+        """Wait for our sockets to be ready.
+
+        By default this calls calc_fds() and passes the result to
+        select().  Subclasses can override this to use a different method.
+
+        :returns: (read_fds_ready, write_fds_ready, exc_fds_ready) tuple
+        """
+        readfds, writefds, excfds = self.calc_fds()
+        readfds.append(self.wake_receiver.fileno())
+        return select.select(readfds, writefds, excfds, timeout)
+
+    def _stop_sleeping(self):
+        with self._wakeup_lock:
+            self._sleeping = False
+            self._wakeup_sent = False
+
     def wakeup(self):
+        """Wake up the event loop.
+
+        We only write to the wake up socket if the loop is waiting for
+        events.  Otherwise, we just set a flag that the loop checks before it
+        waits again.  This avoids a system call for each wakeup() while the
+        loop is busy.
+        """
+        with self._wakeup_lock:
+            self._wakeup_requested = True
+            if not self._sleeping or self._wakeup_sent:
+                return
+            self._wakeup_sent = True
         try:
             self.wake_sender.send("b")
         except socket.error, e:
@@ -293,33 +901,54 @@ class EventLoop(SimpleEventLoop):
         self.write_callbacks = {}
         self.clear_removed_callbacks()
         self.idles_for_next_loop = []
+        self.poller = make_poller()
+        self.poller.update(self.wake_receiver.fileno(), True, False)
 
     def clear_removed_callbacks(self):
         self.removed_read_callbacks = set()
         self.removed_write_callbacks = set()
 
     def add_read_callback(self, sock, callback):
-        self.read_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.read_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_read_callback(self, sock):
-        del self.read_callbacks[sock.fileno()]
-        self.removed_read_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.read_callbacks[fd]
+        self.removed_read_callbacks.add(fd)
+        self._update_poller(fd)
 
     def add_write_callback(self, sock, callback):
-        self.write_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.write_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_write_callback(self, sock):
-        del self.write_callbacks[sock.fileno()]
-        self.removed_write_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.write_callbacks[fd]
+        self.removed_write_callbacks.add(fd)
+        self._update_poller(fd)
+
+    def _update_poller(self, fd):
+        self.poller.update(fd, fd in self.read_callbacks,
+                           fd in self.write_callbacks)
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
-        self.threadpool.queue_call(callback, errback, function, name,
-                                  *args, **kwargs)
+        return self.threadpool.queue_call(callback, errback, function, name,
+                                          *args, **kwargs)
+
+    def call_in_thread_category(self, category, callback, errback, function,
+                                name, *args, **kwargs):
+        return self.threadpool.queue_call_with_category(
+            category, callback, errback, function, name, *args, **kwargs)
 
-    def run_idle_next_loop(self, function, name, args=None, kwargs=None):
+    def run_idle_next_loop(self, function, name, args=None, kwargs=None,
+                           priority=PRIORITY_NORMAL):
         """Add an idle callback to be called on the next event loop."""
-        self.idles_for_next_loop.append((function, name, args, kwargs))
+        self.idles_for_next_loop.append((function, name, args, kwargs,
+                                         priority))
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
         self._process_urgent_events()
@@ -334,21 +963,27 @@ class EventLoop(SimpleEventLoop):
             if self.quit_flag:
                 break
 
-    def calc_fds(self):
-        return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
+    def wait_for_events(self, timeout):
+        return self.poller.poll(timeout)
 
     def calc_timeout(self):
+        if self.idle_queue.has_pending_idle():
+            # we ran out of time for idles on the last loop.  Check the
+            # sockets, but don't wait on them.
+            return 0
         return self.scheduler.next_timeout()
 
     def do_begin_loop(self):
         self.clear_removed_callbacks()
         self._add_idles_for_next_loop()
+        if _profiler is not None:
+            _profiler.sample_idle_queue(self.idle_queue.qsize())
 
     def _add_idles_for_next_loop(self):
         if not self.idles_for_next_loop:
             return
-        for func, name, args, kwargs in self.idles_for_next_loop:
-            self.idle_queue.add_idle(func, name, args, kwargs)
+        for func, name, args, kwargs, priority in self.idles_for_next_loop:
+            self.idle_queue.add_idle(func, name, args, kwargs, priority)
         self.idles_for_next_loop = []
         # call wakeup() to make sure we process the idles we just
         # added
@@ -367,7 +1002,11 @@ class EventLoop(SimpleEventLoop):
 
         "events" are implemented as functions that should be called
         with no arguments.
+
+        We stop generating idle calls once IDLE_TIME_BUDGET has been used
+        up.  Any leftover idles will run on the next iteration.
         """
+        start = clock()
         for callback in self.generate_callbacks(write_fds_ready,
                                                self.write_callbacks,
                                                self.removed_write_callbacks):
@@ -380,6 +1019,8 @@ class EventLoop(SimpleEventLoop):
             yield self.scheduler.process_next_timeout
         while self.idle_queue.has_pending_idle():
             yield self.idle_queue.process_next_idle
+            if clock() - start > IDLE_TIME_BUDGET:
+                break
 
     def generate_callbacks(self, ready_list, map_, removed):
         for fd in ready_list:
@@ -397,6 +1038,7 @@ class EventLoop(SimpleEventLoop):
                     success = trapcall.trap_call(when, function)
                     if not success:
                         del map_[fd]
+                        self._update_poller(fd)
                     return success
                 yield callback_event
 
@@ -455,12 +1097,20 @@ def add_timeout(delay, function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
-def add_idle(function, name, args=None, kwargs=None):
+def add_idle(function, name, args=None, kwargs=None,
+             priority=PRIORITY_NORMAL, key=None):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    :param priority: PRIORITY_INTERACTIVE, PRIORITY_NORMAL or
+                     PRIORITY_BACKGROUND
+    :param key: if given, and an idle call with the same key is already
+                waiting to run, don't schedule a new call.  Instead, return
+                the ``DelayedCall`` for the pending one.
     """
-    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs,
+                                        priority, key)
     _eventloop.wakeup()
     return dc
 
@@ -476,13 +1126,27 @@ def add_urgent_call(function, name, args=None, kwargs=None):
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
     """Schedule a function to be called in a separate thread.
 
+    Returns a ``ThreadPoolCall`` object that can be used to cancel the
+    call.
+
     .. Warning::
 
        Do not put code that accesses the database or the UI here!
     """
-    _eventloop.call_in_thread(
+    return _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_thread_category(category, callback, errback, function, name,
+                            *args, **kwargs):
+    """Like call_in_thread(), but put the call in a thread pool category.
+
+    Calls in the same category share a queue and a limit on how many of
+    them run at once (see ThreadPool.CATEGORY_LIMITS).  Use this for calls
+    that might block for a long time, so they don't hold up other calls.
+    """
+    return _eventloop.call_in_thread_category(
+        category, callback, errback, function, name, *args, **kwargs)
+
 lt = None
 
 profile_file = None
@@ -504,6 +1168,46 @@ def startup():
     lt.start()
     _eventloop.loop_ready.wait()
 
+def enable_profiling():
+    """Start collecting statistics about the event loop.
+
+    This has a small cost for every call the event loop makes, so it's off by
+    default.  If profiling is already enabled, this does nothing.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = LoopProfiler()
+
+def disable_profiling():
+    """Stop collecting event loop statistics and throw away the data."""
+    global _profiler
+    _profiler = None
+
+def profiling_enabled():
+    return _profiler is not None
+
+def reset_profile():
+    """Throw away the event loop statistics collected so far."""
+    if _profiler is not None:
+        _profiler.reset()
+
+def get_profile_report(limit=30):
+    """Get a report of the event loop statistics as a string.
+
+    :returns: the report, or None if profiling is not enabled
+    """
+    if _profiler is None:
+        return None
+    return _profiler.format_report(limit)
+
+def log_profile_report(limit=30):
+    """Write the event loop statistics to the log."""
+    report = get_profile_report(limit)
+    if report is None:
+        logging.info("Event loop profiling is not enabled")
+    else:
+        logging.info(report)
+
 def setup_config_watcher():
     app.backend_config_watcher = config.ConfigWatcher(
             lambda func, *args: add_idle(func, "config callback", args=args))
@@ -563,7 +1267,8 @@ def as_urgent(func):
                                args=args, kwargs=kwargs)
     return queuer
 
-def idle_iterate(func, name, args=None, kwargs=None):
+def idle_iterate(func, name, args=None, kwargs=None,
+                 priority=PRIORITY_NORMAL):
     """Iterate over a generator function using add_idle for each
     iteration.
 
@@ -582,15 +1287,18 @@ def idle_iterate(func, name, args=None, kwargs=None):
             yield
 
         eventloop.idle_iterate(foo, 'Foo', args=(1, 2, 3))
+
+    :param priority: priority to use for each step
     """
     if args is None:
         args = ()
     if kwargs is None:
         kwargs = {}
     iterator = func(*args, **kwargs)
-    add_idle(_idle_iterate_step, name, args=(iterator, name))
+    add_idle(_idle_iterate_step, name, args=(iterator, name, priority),
+             priority=priority)
 
-def _idle_iterate_step(iterator, name):
+def _idle_iterate_step(iterator, name, priority):
     try:
         retval = iterator.next()
     except StopIteration:
@@ -600,7 +1308,7 @@ def _idle_iterate_step(iterator, name):
             logging.warn("idle_iterate yield value ignored: %s (%s)",
                          retval, name)
         _eventloop.run_idle_next_loop(_idle_iterate_step, name,
-                args=(iterator, name))
+                args=(iterator, name, priority), priority=priority)
 
 def idle_iterator(func):
     """Decorator to wrap a generator function in a ``idle_iterate()``
@@ -611,26 +1319,53 @@ def idle_iterator(func):
                             args=args, kwargs=kwargs)
     return queuer
 
+def interactive_idle_iterator(func):
+    """Like ``idle_iterator``, but runs each step with PRIORITY_INTERACTIVE.
+
+    Use this for work started by a user action, where the user is waiting
+    for the results.
+    """
+    def queuer(*args, **kwargs):
+        return idle_iterate(func,
+                            "%s() (using interactive_idle_iterator)" %
+                            func.__name__,
+                            args=args, kwargs=kwargs,
+                            priority=PRIORITY_INTERACTIVE)
+    return queuer
+
+def background_idle_iterator(func):
+    """Like ``idle_iterator``, but runs each step with PRIORITY_BACKGROUND.
+    """
+    def queuer(*args, **kwargs):
+        return idle_iterate(func,
+                            "%s() (using background_idle_iterator)" %
+                            func.__name__,
+                            args=args, kwargs=kwargs,
+                            priority=PRIORITY_BACKGROUND)
+    return queuer
+
 class DelayedFunctionCaller(object):
     """Call a function sometime in the future using add_idle()/add_timeout()
 
     This class also tracks whether a function has been scheduled and avoids
     scheduling it twice.
     """
-    def __init__(self, func):
+    def __init__(self, func, priority=PRIORITY_NORMAL):
         """Create a DelayedFunctionCaller
 
         :param func: function to call.
+        :param priority: priority to use for call_when_idle()
         """
         self.dc = None
         self.func = func
         self.name = 'delayed call to %s' % func
+        self.priority = priority
 
     def call_when_idle(self, *args, **kwargs):
         """Call our function when we're idle."""
         if self.dc is None:
             self.dc = add_idle(self.call_now, self.name, args=args,
-                               kwargs=kwargs)
+                               kwargs=kwargs, priority=self.priority)
 
     def call_after_timeout(self, timeout, *args, **kwargs):
         """Call our function after a timeout."""
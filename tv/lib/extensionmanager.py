@@ -67,6 +67,8 @@ class Extension:
         self.loaded = False
         # maps hook names -> hook functions
         self.hooks = {}
+        # ExtensionContext passed to load(), or None if we aren't loaded
+        self.context = None
 
     def module_obj(self):
         """Gets the module object for this extension.
@@ -253,7 +255,8 @@ class ExtensionManager(object):
         """
         logging.info("extension manager: loading: %r", ext)
         load = getattr(sys.modules[ext.ext_module], "load")
-        load(api.ExtensionContext(ext.ext_module))
+        ext.context = api.ExtensionContext(ext.ext_module)
+        load(ext.context)
         self._register_hooks(ext)
         ext.loaded = True
 
@@ -278,8 +281,22 @@ class ExtensionManager(object):
         logging.info("extension manager: unloading: %r", ext)
         unload = getattr(sys.modules[ext.ext_module], "unload")
         unload()
+        if ext.context is not None:
+            ext.context.storage_manager.flush()
+            ext.context = None
         ext.loaded = False
 
+    def flush_storage(self):
+        """Write buffered simple API changes for all loaded extensions to
+        disk.
+        """
+        for ext in self.extensions:
+            if ext.context is not None:
+                try:
+                    ext.context.storage_manager.flush()
+                except StandardError:
+                    logging.exception("error flushing storage for %r", ext)
+
     def load_extensions(self):
         """Loads all extensions that are enabled.
         """
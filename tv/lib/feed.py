@@ -68,7 +68,7 @@ from miro import fileutil
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
 from miro.plat.filebundle import is_file_bundle
 from miro import filetypes
-from miro.item import FeedParserValues
+from miro.item import FeedParserValues, KnownFiles
 from miro import searchengines
 from miro import workerprocess
 from miro.clock import clock
@@ -2093,15 +2093,16 @@ class DirectoryScannerImplBase(FeedImpl):
         # If we are not longer valid just return
         if not self.ufeed.id_exists():
             return
-        # find deleted paths that we have items for
-        to_remove = []
-        for item in self.items:
-            if item.get_filename() in self._watcher_paths_deleted:
-                to_remove.append(item)
+        # find deleted paths that we have items for.  The deleted path may
+        # be a directory, so check for items inside it as well.
+        to_remove_ids = set()
+        for path in self._watcher_paths_deleted:
+            to_remove_ids.update(models.Item.ids_for_path_or_directory(
+                path, feed_id=self.ufeed_id))
+        to_remove = [models.Item.get_by_id(item_id)
+                     for item_id in to_remove_ids]
         # find added paths don't have an item
-        known_files = self.calc_known_files()
-        for x in self.items:
-            known_files.add_path(x.get_filename())
+        known_files = self.calc_known_files(include_own_items=True)
         to_add = []
         start = time.time()
         for f in self._filter_paths(self._watcher_paths_added, known_files):
@@ -2126,14 +2127,19 @@ class DirectoryScannerImplBase(FeedImpl):
         self._watcher_paths_added = set()
         self._watcher_update_timeout = None
 
-    def calc_known_files(self):
-        # Calculate files known about by feeds other than the directory feed
-        # Using a select statement is good here because we don't want to
-        # construct all the Item objects if we don't need to.
-        known_files = fileutil.FileSet(row[0] for row in
-                models.Item.select(['filename'],
-                    'filename IS NOT NULL AND '
-                    '(feed_id is NULL or feed_id != ?)', (self.ufeed_id,)))
+    def calc_known_files(self, include_own_items=False):
+        """Calculate files that we shouldn't create items for.
+
+        This uses Item's path index, so it doesn't need to load anything from
+        the DB and stays up to date as items get added/removed.
+
+        :param include_own_items: If False, only files known about by feeds
+            other than the directory feed are included.
+        """
+        if include_own_items:
+            known_files = KnownFiles()
+        else:
+            known_files = KnownFiles(exclude_feed_id=self.ufeed_id)
         for path in self.pending_paths_to_add:
             known_files.add_path(path)
         self._add_known_files(known_files)
@@ -2153,7 +2159,7 @@ class DirectoryScannerImplBase(FeedImpl):
             self.updating = True
             self.schedule_update()
 
-    @eventloop.idle_iterator
+    @eventloop.background_idle_iterator
     def do_update(self):
 
         def should_halt_early():
@@ -2220,22 +2226,19 @@ class DirectoryScannerImplBase(FeedImpl):
         # files on the filesystem
         scan_dir = self._scan_dir()
         if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
-            all_files = []
-            start = time.time()
-            for f in fileutil.miro_allfiles(scan_dir):
-                all_files.append(f)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
+            # The walk happens in DirectoryWalker's threads, we filter the
+            # paths as they come in.
+            walker = fileutil.DirectoryWalker(scan_dir)
             start = time.time()
             to_add = []
-            for path in self._filter_paths(all_files, known_files):
-                to_add.append(path)
-                if time.time() - start > 0.4:
+            for batch in walker.iter_batches(timeout=0.05):
+                to_add.extend(self._filter_paths(batch, known_files))
+                # an empty batch means that the walker threads are still
+                # working, let other things run while we wait.
+                if not batch or time.time() - start > 0.4:
                     yield
                     if should_halt_early():
+                        walker.cancel()
                         return
                     start = time.time()
 
@@ -32,14 +32,29 @@
 where file locking semantics can cause problems.
 """
 
+import hashlib
 import logging
 import os
+import Queue
 import shutil
+import stat
+import sys
+import threading
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 from miro import u3info
 
 from miro.plat.filebundle import is_file_bundle
 
+# Max number of threads that a DirectoryWalker uses
+WALKER_MAX_THREADS = 4
+# Number of paths that DirectoryWalker sends back at once
+WALKER_BATCH_SIZE = 500
+
 def makedirs(path):
     path = expand_filename(path)
     return os.makedirs(path)
@@ -139,6 +154,62 @@ def copy_with_progress(input_path, output_path, block_size=32*1024):
                     break
                 data = input.read(block_size)
 
+# ioctl request to make a copy-on-write clone of a file on linux
+_FICLONE = 0x40049409
+
+def clone_file(input_path, output_path):
+    """Try to make a copy-on-write clone of a file.
+
+    This only works on filesystems that support reflinks (btrfs, XFS and
+    friends).  The clone shares the data blocks with the original, so it's
+    created almost instantly no matter how big the file is.
+
+    :returns: True if the clone was made, False if the file needs to be copied
+        the normal way.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    if not sys.platform.startswith('linux'):
+        return False
+    with file(input_path, 'rb') as input:
+        with file(output_path, 'wb') as output:
+            try:
+                fcntl.ioctl(output.fileno(), _FICLONE, input.fileno())
+            except (IOError, OSError):
+                cloned = False
+            else:
+                cloned = True
+    if not cloned:
+        os.remove(output_path)
+    return cloned
+
+# Number of bytes that calc_fingerprint() reads from each end of a file
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+def calc_fingerprint(path):
+    """Calculate a cheap fingerprint for the contents of a file.
+
+    The fingerprint is made from the file size and a hash of the first and
+    last FINGERPRINT_BLOCK_SIZE bytes.  We don't read the whole file, so
+    files with the same fingerprint could in theory have different contents,
+    but for media files that's very unlikely.
+
+    :returns: fingerprint as a unicode string
+    :raises EnvironmentError: error reading the file
+    """
+    with file(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(0)
+        hasher = hashlib.sha1()
+        hasher.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        if size > FINGERPRINT_BLOCK_SIZE:
+            f.seek(max(FINGERPRINT_BLOCK_SIZE, size - FINGERPRINT_BLOCK_SIZE))
+            hasher.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return u'%d-%s' % (size, hasher.hexdigest())
+
 try:
     samefile = os.path.samefile
 except AttributeError:
@@ -289,56 +360,257 @@ def miro_listdir(directory):
             pass
     return files, directories
 
-def miro_allfiles(directory, checked=None):
-    """Directory listing that's safe and convenient for finding new
-    videos in a directory.
+def _skip_name(name):
+    """Should DirectoryWalker skip a directory entry based on its name?"""
+    name_lower = name.lower()
+    # thumbs.db is a windows file that speeds up thumbnails.  We know it's
+    # not a movie file.
+    return (name.startswith('.') or name_lower == 'thumbs.db' or
+            name_lower == "incomplete downloads")
 
-    Returns a list of files consisting of absolute pathnames.
+def _list_directory(directory):
+    """List a directory for DirectoryWalker.
 
-    OSErrors are silently ignored.  Hidden files aren't returned.
-    Pathnames are run through os.path.normcase.
+    :returns: (files, subdirectories) tuple.  files is a list of names of
+    regular files, subdirectories is a list of (name, is_symlink) tuples.
     """
-    if checked is None:
-        checked = set()
-    expanded_directory = expand_filename(directory)
-    expanded_directory = os.path.abspath(os.path.normcase(expanded_directory))
-    real_directory = os.path.realpath(expanded_directory)
-    if real_directory in checked:
-        logging.debug('%s is a symlink to a directory that has '
-            'already been checked; skipping', repr(expanded_directory))
-        return
-    checked.add(real_directory)
-    if expanded_directory in deletes_in_progress:
-        return
-    if is_file_bundle(expanded_directory):
-        return
-    try:
-        listing = os.listdir(expanded_directory)
-    except OSError:
-        logging.debug('OSError walking directory; continuing', exc_info=1)
-        return
-    for name in listing:
-        name_lower = name.lower()
-        if (name.startswith('.') or name_lower == 'thumbs.db' or
-                name_lower == "incomplete downloads"):
-            # thumbs.db is a windows file that speeds up thumbnails.
-            # We know it's not a movie file.
+    files = []
+    subdirectories = []
+    if scandir is not None:
+        # scandir gives us the file type from the directory entry, so we
+        # only need to stat symlinks.
+        for entry in scandir(directory):
+            if _skip_name(entry.name):
+                continue
+            try:
+                if entry.is_dir():
+                    subdirectories.append((entry.name, entry.is_symlink()))
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:
+                logging.debug('OSError walking directory; continuing',
+                              exc_info=1)
+        return files, subdirectories
+    for name in os.listdir(directory):
+        if _skip_name(name):
             continue
-        path = os.path.join(directory, os.path.normcase(name))
-        expanded_path = os.path.join(expanded_directory, os.path.normcase(name))
-        if expanded_path in deletes_in_progress:
+        path = os.path.join(directory, name)
+        try:
+            mode = os.lstat(path).st_mode
+            is_symlink = stat.S_ISLNK(mode)
+            if is_symlink:
+                mode = os.stat(path).st_mode
+        except OSError:
+            logging.debug('OSError walking directory; continuing',
+                          exc_info=1)
             continue
+        if stat.S_ISDIR(mode):
+            subdirectories.append((name, is_symlink))
+        elif stat.S_ISREG(mode):
+            files.append(name)
+    return files, subdirectories
+
+class DirectoryWalker(object):
+    """Find all files in a directory tree, using several threads.
+
+    DirectoryWalker skips the same things that miro_allfiles() always has:
+    hidden files, thumbs.db, "Incomplete Downloads" directories, file bundles,
+    paths in deletes_in_progress and symlinks to directories that we've
+    already walked.  Pathnames are run through os.path.normcase.
+
+    Subdirectories are walked in parallel by up to max_threads threads.
+    Results are sent back in batches of paths using get_batch() or
+    iter_batches(), so that callers can start working before the walk is
+    finished.
+    """
+    # object put on the result queue when all directories have been walked
+    _DONE = object()
+
+    def __init__(self, directory, max_threads=WALKER_MAX_THREADS,
+                 batch_size=WALKER_BATCH_SIZE, dir_filter=None):
+        """Create a DirectoryWalker.
+
+        :param directory: directory to walk
+        :param max_threads: maximum number of threads to walk with
+        :param batch_size: number of paths to put in each batch
+        :param dir_filter: function called with the directory and a list of
+            subdirectory names in it.  It should remove the names of
+            subdirectories that shouldn't be walked from the list.
+        """
+        self.directory = directory
+        self.max_threads = max_threads
+        self.batch_size = batch_size
+        self.dir_filter = dir_filter
+        self.lock = threading.Lock()
+        self.directory_queue = Queue.Queue()
+        self.result_queue = Queue.Queue()
+        # real paths of directories that we've walked
+        self.checked = set()
+        # number of directories that have been queued but not walked
+        self.outstanding = 0
+        self.threads = []
+        self.cancelled = False
+        self.finished = False
+        self.started = False
+
+    def start(self):
+        """Start walking.  This is called automatically by get_batch()."""
+        if self.started:
+            return
+        self.started = True
+        expanded = expand_filename(self.directory)
+        expanded = os.path.abspath(os.path.normcase(expanded))
+        with self.lock:
+            self._queue_directory(self.directory, expanded,
+                                  os.path.realpath(expanded))
+            if self.outstanding == 0:
+                self.result_queue.put(self._DONE)
+
+    def cancel(self):
+        """Stop walking.
+
+        Our threads stop after they finish the directory they're working on.
+        """
+        self.cancelled = True
+
+    def get_batch(self, timeout=None):
+        """Get the next batch of paths.
+
+        :param timeout: seconds to wait for a batch.  None to wait until one
+            is ready
+        :returns: a list of paths, an empty list if the timeout expired before
+            a batch was ready, or None if the walk is finished
+        """
+        self.start()
+        if self.finished:
+            return None
+        try:
+            batch = self.result_queue.get(timeout=timeout)
+        except Queue.Empty:
+            return []
+        if batch is self._DONE:
+            self.finished = True
+            return None
+        return batch
+
+    def iter_batches(self, timeout=None):
+        """Iterate through batches of paths until the walk is finished.
+
+        :param timeout: passed to get_batch().  If this is not None, we may
+            yield empty lists, which allows callers to do other work while
+            they wait.
+        """
+        while True:
+            batch = self.get_batch(timeout)
+            if batch is None:
+                return
+            yield batch
+
+    def _queue_directory(self, path, expanded_path, real_path):
+        # Must be called with our lock held
+        if real_path in self.checked:
+            logging.debug('%s is a symlink to a directory that has '
+                          'already been checked; skipping', repr(path))
+            return
+        self.checked.add(real_path)
+        if (expanded_path in deletes_in_progress or
+                is_file_bundle(expanded_path)):
+            return
+        self.outstanding += 1
+        self.directory_queue.put((path, expanded_path, real_path))
+        if (len(self.threads) < self.max_threads and
+                len(self.threads) < self.outstanding):
+            thread = threading.Thread(target=self._thread_loop,
+                                      name='Directory Walker (%s)' %
+                                      self.directory)
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def _thread_loop(self):
+        while True:
+            job = self.directory_queue.get()
+            if job is None:
+                return
+            paths = []
+            try:
+                if not self.cancelled:
+                    paths = self._walk_directory(*job)
+            except StandardError:
+                logging.exception("Error walking %r", job[0])
+            finally:
+                self._directory_finished(paths)
+
+    def _directory_finished(self, paths):
+        """Call when a thread is done walking a directory.
+
+        :param paths: paths found in the directory
+        """
+        with self.lock:
+            # Send the paths before we decrement outstanding.  Otherwise
+            # another thread could finish the last directory and send _DONE
+            # before our paths.
+            for i in xrange(0, len(paths), self.batch_size):
+                self.result_queue.put(paths[i:i+self.batch_size])
+            self.outstanding -= 1
+            if self.outstanding > 0:
+                return
+            self.result_queue.put(self._DONE)
+            for i in xrange(len(self.threads)):
+                self.directory_queue.put(None)
+
+    def _walk_directory(self, directory, expanded_directory,
+                        real_directory):
+        """Walk a single directory.
+
+        Subdirectories get queued up to be walked.
+
+        :returns: list of file paths in the directory
+        """
         try:
-            if (os.path.isdir(expanded_path) and
-              not is_file_bundle(expanded_path)):
-                for fn in miro_allfiles(path, checked):
-                    yield fn
-            elif os.path.isfile(expanded_path):
-                yield path
+            files, subdirectories = _list_directory(expanded_directory)
         except OSError:
-            logging.debug('OSError walking directory; continuing', exc_info=1)
-            pass
+            logging.debug('OSError walking directory; continuing',
+                          exc_info=1)
+            return []
+        if self.dir_filter is not None and subdirectories:
+            names = [name for (name, is_symlink) in subdirectories]
+            self.dir_filter(expanded_directory, names)
+            names = set(names)
+            subdirectories = [(name, is_symlink)
+                              for (name, is_symlink) in subdirectories
+                              if name in names]
+        with self.lock:
+            for name, is_symlink in subdirectories:
+                name = os.path.normcase(name)
+                expanded_path = os.path.join(expanded_directory, name)
+                if is_symlink:
+                    real_path = os.path.realpath(expanded_path)
+                else:
+                    real_path = os.path.join(real_directory, name)
+                self._queue_directory(os.path.join(directory, name),
+                                      expanded_path, real_path)
+        rv = []
+        for name in files:
+            name = os.path.normcase(name)
+            if os.path.join(expanded_directory, name) in deletes_in_progress:
+                continue
+            rv.append(os.path.join(directory, name))
+        return rv
+
+def miro_allfiles(directory):
+    """Directory listing that's safe and convenient for finding new
+    videos in a directory.
+
+    Returns an iterator of file pathnames.  See DirectoryWalker for what gets
+    skipped.
 
+    OSErrors are silently ignored.  Hidden files aren't returned.
+    Pathnames are run through os.path.normcase.
+    """
+    for batch in DirectoryWalker(directory).iter_batches():
+        for path in batch:
+            yield path
 
 def expand_filename(filename):
     if not filename:
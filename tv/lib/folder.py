@@ -172,8 +172,9 @@ class PlaylistFolderItemMap(playlist.PlaylistItemMap):
     """Single row in the map that associates playlist folders with their 
     child items.
     """
-    def setup_new(self, playlist_id, item_id):
-        playlist.PlaylistItemMap.setup_new(self, playlist_id, item_id)
+    def setup_new(self, playlist_id, item_id, position=None):
+        playlist.PlaylistItemMap.setup_new(self, playlist_id, item_id,
+                                           position)
         self.count = 1
 
     def inc_count(self):
@@ -197,6 +198,17 @@ class PlaylistFolderItemMap(playlist.PlaylistItemMap):
         except ObjectNotFoundError:
             cls(playlist_id, item_id)
 
+    @classmethod
+    def add_item_ids(cls, playlist_id, item_ids):
+        existing = cls.maps_for_item_ids(playlist_id, item_ids)
+        position = cls.next_position(playlist_id)
+        for item_id in item_ids:
+            if item_id in existing:
+                existing[item_id].inc_count()
+            else:
+                existing[item_id] = cls(playlist_id, item_id, position)
+                position += playlist.POSITION_GAP
+
     @classmethod
     def remove_item_id(cls, playlist_id, item_id):
         view = cls.make_view('playlist_id=? AND item_id=?',
@@ -204,6 +216,13 @@ class PlaylistFolderItemMap(playlist.PlaylistItemMap):
         map_ = view.get_singleton()
         map_.dec_count()
 
+    @classmethod
+    def remove_item_ids(cls, playlist_id, item_ids):
+        maps = cls.maps_for_item_ids(playlist_id, item_ids)
+        for map_ in maps.values():
+            map_.dec_count()
+        return maps.keys()
+
 class PlaylistFolder(FolderBase, playlist.PlaylistMixin):
     MapClass = PlaylistFolderItemMap
 
@@ -415,6 +415,30 @@ class MiroInterpreter(cmd.Cmd):
         return self.handle_item_complete(text, self._get_item_view(),
                 lambda i: i.is_downloaded())
 
+    def do_profile(self, line):
+        """profile [on|off|reset|dump|log] -- Profiles the event loop."""
+        command = line.strip() or 'dump'
+        if command == 'on':
+            eventloop.enable_profiling()
+        elif command == 'off':
+            eventloop.disable_profiling()
+        elif command == 'reset':
+            eventloop.reset_profile()
+        elif command == 'dump':
+            report = eventloop.get_profile_report()
+            if report is None:
+                print "Profiling is off.  Use \"profile on\" to enable it."
+            else:
+                print report
+        elif command == 'log':
+            eventloop.log_profile_report()
+        else:
+            print "Unknown profile command: %s" % command
+
+    def complete_profile(self, text, line, begidx, endidx):
+        return [c for c in ('on', 'off', 'reset', 'dump', 'log')
+                if c.startswith(text)]
+
     @run_in_event_loop
     def do_testdialog(self, line):
         """testdialog -- Tests the cli dialog system."""
@@ -56,6 +56,7 @@ from miro import messages
 from miro import eventloop
 from miro import conversions
 from miro import filetypes
+from miro.data import connectionpool
 from miro.gtcache import gettext as _
 from miro.gtcache import ngettext
 from miro.frontends.widgets import dialogs
@@ -91,6 +92,7 @@ from miro.plat.utils import get_plat_media_player_name_path
 from miro.plat import resources
 from miro.plat.frontends.widgets.threads import call_on_ui_thread
 from miro.plat.frontends.widgets import widgetset
+from miro.plat.frontends.widgets import timer
 from miro import fileutil
 
 class Application:
@@ -152,6 +154,7 @@ class Application:
         initializes the ui, and displays the :class:`MiroWindow`.
         """
         data.init()
+        self.reap_idle_connections()
         # Send a couple messages to the backend, when we get responses,
         # WidgetsMessageHandler() will call build_window()
         messages.TrackGuides().send_to_backend()
@@ -175,6 +178,13 @@ class Application:
         self._window_show_callback = self.window.connect_weak('show',
                 self.on_window_show)
 
+    def reap_idle_connections(self):
+        """Close idle share database connections, then schedule the next
+        check.
+        """
+        app.connection_pools.reap_idle_connections()
+        timer.add(connectionpool.IDLE_POOL_TIMEOUT, self.reap_idle_connections)
+
     def setup_globals(self):
         app.item_list_controller_manager = \
                 itemlistcontroller.ItemListControllerManager()
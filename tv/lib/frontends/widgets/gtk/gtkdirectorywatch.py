@@ -48,6 +48,13 @@ class GTKDirectoryWatcher(directorywatch.DirectoryWatcher):
         # the frontend thread
         glib.idle_add(self._add_directory, gio.File(directory), False)
 
+    def has_file(self, path):
+        try:
+            content_set = self._contents[os.path.dirname(path)]
+        except KeyError:
+            return False
+        return os.path.basename(path) in content_set
+
     def _add_directory(self, f, send_contents):
         if f.get_path() in self.skip_dirs:
             logging.info("Not watching directory: %s", f.get_path())
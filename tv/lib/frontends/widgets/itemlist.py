@@ -36,10 +36,15 @@ It also defines several ItemTrackerQuery subclasses that correspond to tabs
 in the interface.
 """
 
+import bisect
 import collections
+import logging
+import sqlite3
 
 from miro import app
+from miro import prefs
 from miro.data import item
+from miro.data import itemindex
 from miro.data import itemtrack
 from miro.frontends.widgets import itemfilter
 from miro.frontends.widgets import itemsort
@@ -58,9 +63,11 @@ class ItemList(itemtrack.ItemTracker):
         - simpler interface to construct queries:
             - set_filters/select_filter changes the filters
             - set_sort changes the sort
+        - optionally, an ItemColumnIndex that lets us sort, filter and group
+          in memory (see the ITEM_LIST_COLUMN_INDEX pref)
     """
     def __init__(self, tab_type, tab_id, sort=None, group_func=None,
-                 filters=None, search_text=None):
+                 filters=None, search_text=None, profile=None):
         """Create a new ItemList
 
         Note: outside classes shouldn't call this directly.  Instead, they
@@ -72,9 +79,12 @@ class ItemList(itemtrack.ItemTracker):
         :param group_func: initial grouping to use
         :param filters: initial filters
         :param search_text: initial search text
+        :param profile: projection profile for our ItemInfos (see
+        ItemSelectInfo.profiles), or None to select all columns
         """
         self.tab_type = tab_type
         self.tab_id = tab_id
+        self.profile = profile
         self.base_query = self._make_base_query(tab_type, tab_id)
         self.item_attributes = collections.defaultdict(dict)
         self.filter_set = itemfilter.ItemFilterSet()
@@ -86,9 +96,14 @@ class ItemList(itemtrack.ItemTracker):
             self.sorter = sort
         self.search_text = search_text
         self.group_func = group_func
+        item_source = self._make_item_source()
+        self.column_index = self._make_column_index(item_source)
         itemtrack.ItemTracker.__init__(self, call_on_ui_thread,
-                                       self._make_query(),
-                                       self._make_item_source())
+                                       self._make_query(), item_source)
+
+    def destroy(self):
+        itemtrack.ItemTracker.destroy(self)
+        self.column_index = None
 
     def is_for_device(self):
         return self.tab_type.startswith('device-')
@@ -200,13 +215,54 @@ class ItemList(itemtrack.ItemTracker):
     def _make_item_source(self):
         if self.is_for_device():
             device_info = app.tabs['connect'].get_tab(self.device_id())
-            return item.DeviceItemSource(device_info)
+            return item.DeviceItemSource(device_info, self.profile)
         elif self.is_for_share():
             share_info = app.tabs['connect'].get_tab('sharing-%s' %
                                                      self.share_id())
-            return item.SharingItemSource(share_info)
+            return item.SharingItemSource(share_info, self.profile)
         else:
-            return item.ItemSource()
+            return item.ItemSource(self.profile)
+
+    def set_profile(self, profile):
+        """Change the projection profile for our ItemInfos.
+
+        Columns that aren't in the profile still get loaded when they're
+        accessed, so this only affects performance.
+        """
+        if profile == self.profile:
+            return
+        self.profile = profile
+        self.change_item_source(self._make_item_source())
+
+    def _make_column_index(self, item_source):
+        if not app.config.get(prefs.ITEM_LIST_COLUMN_INDEX):
+            return None
+        # device and share items are stored in different tables.  Manual
+        # lists are small and have a condition with lots of values.
+        if (type(item_source) is not item.ItemSource or
+            self.tab_type == 'manual'):
+            return None
+        try:
+            return itemindex.ItemColumnIndex(self.base_query, item_source)
+        except sqlite3.DatabaseError, e:
+            logging.warn("%s while loading column index", e, exc_info=True)
+            return None
+
+    def _select_ids(self, connection):
+        if (self.column_index is not None and
+            self.column_index.can_handle(self.query)):
+            return self.column_index.select_ids(self.query)
+        return itemtrack.ItemTracker._select_ids(self, connection)
+
+    def on_item_changes(self, message):
+        if self.column_index is not None:
+            try:
+                self.column_index.on_item_changes(message)
+            except sqlite3.DatabaseError, e:
+                logging.warn("%s while updating column index", e,
+                             exc_info=True)
+                self.column_index = None
+        itemtrack.ItemTracker.on_item_changes(self, message)
 
     def _make_query(self):
         query = self.base_query.copy()
@@ -297,8 +353,43 @@ class ItemList(itemtrack.ItemTracker):
 
     def _reset_group_info(self):
         self.group_info = [None] * len(self)
+        # list of rows that start a group.  None means we haven't calculated
+        # it yet, False means that we can't use the column index for the
+        # current grouping.
+        self.group_starts = None
 
     def _calc_group_info(self, row):
+        if self.group_starts is None:
+            self.group_starts = self._calc_group_starts()
+        if self.group_starts is False:
+            self._calc_group_info_from_rows(row)
+            return
+        i = bisect.bisect_right(self.group_starts, row) - 1
+        start = self.group_starts[i]
+        if i + 1 < len(self.group_starts):
+            end = self.group_starts[i + 1]
+        else:
+            end = len(self)
+        first_info = self.get_row(start)
+        for row in xrange(start, end):
+            self.group_info[row] = (row-start, end-start, first_info)
+
+    def _calc_group_starts(self):
+        """Use our column index to find the rows that start groups.
+
+        This avoids loading every item in a group just to find out where the
+        group ends.
+
+        :returns: sorted list of rows, or False if the column index can't be
+        used.
+        """
+        key_func = getattr(self.group_func, 'index_keys', None)
+        if (key_func is None or self.column_index is None or
+            not self.column_index.contains_all(self.id_list)):
+            return False
+        return self.column_index.calc_group_starts(self.id_list, key_func)
+
+    def _calc_group_info_from_rows(self, row):
         # FIXME: for normal item lists, this is fairly fast, but it is slow in
         # a specific case:
         #
@@ -376,14 +467,14 @@ class ItemListPool(object):
         self._refcounts = {}
 
     def get(self, tab_type, tab_id, sort=None, group_func=None, filters=None,
-           search_text=None):
+           search_text=None, profile=None):
         """Get an ItemList to use.
 
         This method will first try to re-use an existing ItemList from the
         pool.  If it can't, then a new ItemList will be created.
 
-        sort, group_func, and filters are only used if a new ItemList is
-        created.
+        sort, group_func, filters and profile are only used if a new ItemList
+        is created.
 
         :returns: ItemList object.  When you are done with it, you must pass
         the ItemList to the release() method.
@@ -395,7 +486,7 @@ class ItemListPool(object):
                     return obj
         # no existing list found, make new list
         new_list = ItemList(tab_type, tab_id, sort, group_func, filters,
-                            search_text)
+                            search_text, profile)
         self.all_item_lists.add(new_list)
         app.item_tracker_updater.add_tracker(new_list)
         self._refcounts[new_list] = 1
@@ -429,14 +520,38 @@ class ItemListPool(object):
             app.item_tracker_updater.remove_tracker(item_list)
 
 # grouping functions
+#
+# Grouping functions can have an index_keys attribute, which calculates the
+# same grouping using an ItemColumnIndex.  It inputs the index and a list of
+# positions in it and returns a list of grouping keys.
 def album_grouping(info):
     """Grouping function that groups infos by albums."""
     return (info.album_artist_sort_key, info.album_sort_key)
 
+def _album_grouping_index_keys(index, positions):
+    album_artists = index.get_values('album_artist')
+    album_artist_keys = index.get_name_keys('album_artist')
+    artist_keys = index.get_name_keys('artist')
+    album_keys = index.get_name_keys('album')
+    keys = []
+    for pos in positions:
+        if album_artists[pos]:
+            artist_key = album_artist_keys[pos]
+        else:
+            artist_key = artist_keys[pos]
+        keys.append((artist_key, album_keys[pos]))
+    return keys
+album_grouping.index_keys = _album_grouping_index_keys
+
 def feed_grouping(info):
     """Grouping function that groups infos by their feed."""
     return info.feed_id
 
+def _feed_grouping_index_keys(index, positions):
+    feed_ids = index.get_values('feed_id')
+    return [feed_ids[pos] for pos in positions]
+feed_grouping.index_keys = _feed_grouping_index_keys
+
 def video_grouping(info):
     """Grouping function that groups infos for the videos tab.
 
@@ -450,3 +565,19 @@ def video_grouping(info):
         return info.parent_title_for_sort
     else:
         return None
+
+def _video_grouping_index_keys(index, positions):
+    shows = index.get_values('show')
+    parent_titles = index.get_values('parent_title')
+    feed_ids = index.get_values('feed_id')
+    parent_ids = index.get_values('parent_id')
+    keys = []
+    for pos in positions:
+        if shows[pos] is not None:
+            keys.append(shows[pos])
+        elif parent_titles[pos] is not None:
+            keys.append((parent_titles[pos], feed_ids[pos], parent_ids[pos]))
+        else:
+            keys.append(None)
+    return keys
+video_grouping.index_keys = _video_grouping_index_keys
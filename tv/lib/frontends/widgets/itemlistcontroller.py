@@ -462,6 +462,7 @@ class ItemListController(object):
                                            self.selected_view)
         self._selection_changed('item-list-view-changed')
         self.expand_or_contract_item_details()
+        self.item_list.set_profile(self.get_item_list_profile(view))
 
     def get_current_item_view(self):
         return self.views[self.selected_view]
@@ -572,11 +573,24 @@ class ItemListController(object):
         filters = app.widget_state.get_filters(self.type, self.id)
         sorter = self.get_sorter()
         group_func = self.get_item_list_grouping()
+        view = app.widget_state.get_selected_view(self.type, self.id)
         return app.item_list_pool.get(self.type, self.id, sorter, group_func,
-                                      filters, self._search_text)
+                                      filters, self._search_text,
+                                      self.get_item_list_profile(view))
     def get_item_list_grouping(self):
         return itemlist.album_grouping
 
+    def get_item_list_profile(self, view):
+        """Get the projection profile to use for our ItemList when a view is
+        selected.
+        """
+        if view == WidgetStateStore.get_list_view_type():
+            return 'list'
+        elif view == WidgetStateStore.get_album_view_type():
+            return 'album'
+        else:
+            return 'details'
+
     def expand_or_contract_item_details(self):
         expanded = app.widget_state.get_item_details_expanded(
                 self.selected_view)
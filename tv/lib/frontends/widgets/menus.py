@@ -364,6 +364,10 @@ class DevMenu(Menu):
     def on_memory_stats(menu_item):
         app.widgetapp.memory_stats()
 
+    @menu_item(_("Log Event Loop Profile"))
+    def on_log_event_loop_profile(menu_item):
+        messages.LogEventLoopProfile().send_to_backend()
+
     @menu_item(_("Force Feedparser Processing"))
     def on_force_feedparser_processing(menu_item):
         app.widgetapp.force_feedparser_processing()
@@ -121,7 +121,8 @@ class PlaybackManager (signals.SignalEmitter):
     def start_with_items(self, item_infos):
         """Start playback, playing a static list of ItemInfos."""
         id_list = [i.id for i in item_infos]
-        item_list = app.item_list_pool.get(u'manual', id_list)
+        item_list = app.item_list_pool.get(u'manual', id_list,
+                                           profile='playback')
         self.start(None, item_list)
 
     def goto_currently_playing(self):
@@ -35,11 +35,15 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import collections
+import email.utils
 import logging
 import os
 import stat
 import threading
+import time
 import urllib
+import urlparse
 import Queue
 from cStringIO import StringIO
 
@@ -60,6 +64,11 @@ from miro.plat import utils
 from miro.plat.resources import get_osname
 from miro.net import NetworkError, ConnectionError, ConnectionTimeout
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 try:
     import gzip
 except:
@@ -67,6 +76,10 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# max number of redirects to remember in the redirect cache
+REDIRECT_CACHE_SIZE = 5000
+# how long to remember permanent redirects that don't specify a max-age
+PERMANENT_REDIRECT_MAX_AGE = 60 * 60 * 24 * 30
 
 _logged_noproxy_error = False
 
@@ -213,6 +226,11 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        # URL that was passed to grab_url().  This is different from url if
+        # we used the redirect cache to skip some redirects.
+        self.original_url = url
+        # Did we skip a temporary redirect using the redirect cache?
+        self.skipped_temporary_redirect = False
         self.requires_cookies = False
         self.head_request = False
         self.invalid_url = False
@@ -239,6 +257,35 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
+    def use_redirect_cache(self):
+        """Skip redirects that we've already seen using redirect_cache.
+
+        We only do this for simple GET/HEAD requests.  POST requests and
+        requests with extra headers might be redirected somewhere else.
+        """
+        if (self.invalid_url or self.post_vars is not None or
+                self.post_files is not None or self.extra_headers):
+            return
+        url, temporary = redirect_cache.resolve(self.url)
+        if url != self.url:
+            self.url = url
+            self.skipped_temporary_redirect = temporary
+            self.parse_url()
+
+    def stop_using_redirect_cache(self):
+        """Go back to requesting original_url.
+
+        :returns: True if we were using the redirect cache before
+        """
+        if self.url == self.original_url:
+            return False
+        redirect_cache.invalidate(self.original_url)
+        self.url = self.original_url
+        self.skipped_temporary_redirect = False
+        self.invalid_url = False
+        self.parse_url()
+        return True
+
     def build_handle(self, out_headers):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
@@ -366,6 +413,10 @@ class CurlTransfer(object):
         self.status_code = None
         self.trying_head_request = False
         self.saw_head_success = False
+        # URL of the response we are currently reading headers for and the
+        # redirects that we've seen so far.  Used to fill redirect_cache.
+        self.response_url = self.options.url
+        self.redirects_seen = []
 
     def _send_new_request(self):
         self._reset_transfer_data()
@@ -596,6 +647,7 @@ class CurlTransfer(object):
                 self.status_code = None
             elif 'location' in self.headers:
                 # doing a redirect, clear out the headers
+                self._record_redirect()
                 self.headers = {}
             elif not self.headers_finished:
                 curl_manager.call_after_perform(self.on_headers_finished)
@@ -623,6 +675,39 @@ class CurlTransfer(object):
         else:
             self.headers[header] += (',%s' % value)
 
+    def _record_redirect(self):
+        if self.status_code is None or not (300 <= self.status_code <= 399):
+            return
+        location = urlparse.urljoin(self.response_url,
+                                    self.headers['location'])
+        try:
+            location.decode('ascii')
+        except UnicodeError:
+            # libcurl will escape this for us, but we don't want to store
+            # it.
+            expires = None
+        else:
+            expires = calc_redirect_expiration(self.status_code, self.headers)
+        temporary = self.status_code not in (301, 308)
+        self.redirects_seen.append((self.response_url, location, temporary,
+                                    expires))
+        self.response_url = location
+
+    def _store_redirects(self):
+        if not self.redirects_seen:
+            return
+        count = self.handle.getinfo(pycurl.REDIRECT_COUNT)
+        if count > 0:
+            time_per_redirect = (self.handle.getinfo(pycurl.REDIRECT_TIME) /
+                                 count)
+        else:
+            time_per_redirect = 0.0
+        for url, location, temporary, expires in self.redirects_seen:
+            if expires is not None:
+                redirect_cache.add(url, location, temporary, expires,
+                                   time_per_redirect)
+        self.redirects_seen = []
+
     def on_headers_finished(self):
         if self.header_callback:
             eventloop.add_idle(self.header_callback,
@@ -644,11 +729,12 @@ class CurlTransfer(object):
             # Use libcurl's content length rather than the raw header string
             info['content-length'] = self.stats.download_total
             info['total-size'] = self.stats.download_total + self.resume_from
-        info['original-url'] = self.options.url
+        info['original-url'] = self.options.original_url
         info['redirected-url'] = self.handle.getinfo(pycurl.EFFECTIVE_URL)
         info['filename'] = self.calc_filename(info['redirected-url'])
         info['charset'] = self.calc_charset()
-        if self.saw_temporary_redirect:
+        if (self.saw_temporary_redirect or
+                self.options.skipped_temporary_redirect):
             info['updated-url'] = info['original-url']
         else:
             info['updated-url'] = info['redirected-url']
@@ -675,6 +761,7 @@ class CurlTransfer(object):
                 info['body'] = self.buffer.getvalue()
 
         if self.check_response_code(info['status']):
+            self._store_redirects()
             if not self.trying_head_request:
                 self.call_callback(info)
             else:
@@ -798,6 +885,14 @@ class CurlTransfer(object):
 
     def call_errback(self, error):
         self._cleanup_filehandle()
+        if (not isinstance(error, AuthorizationCanceled) and
+                self.options.stop_using_redirect_cache()):
+            # The URL from the redirect cache didn't work, maybe the redirect
+            # changed.  Try again, starting with the original URL.
+            logging.info("httpclient: %s failed, retrying without redirect "
+                         "cache (%s)", self.options.url, error)
+            self._send_new_request()
+            return
         eventloop.add_idle(self.errback, 'curl transfer errback',
                            args=(error,))
 
@@ -858,6 +953,241 @@ class TransferStats(object):
         self.initial_size = 0
         self.status_code = None
 
+def calc_redirect_expiration(status_code, headers):
+    """Figure out how long we can cache a redirect response.
+
+    Permanent redirects are cacheable unless the response says otherwise.
+    Temporary redirects are only cacheable if they include a max-age or
+    expires header.
+
+    :param status_code: HTTP status of the redirect
+    :param headers: dict of headers from the redirect response
+    :returns: time that the redirect expires, or None if it's not cacheable
+    """
+    now = time.time()
+    cache_control = [part.strip().lower()
+                     for part in headers.get('cache-control', '').split(',')]
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return None
+    for part in cache_control:
+        if part.startswith('max-age='):
+            try:
+                max_age = int(part[len('max-age='):].strip('"'))
+            except ValueError:
+                continue
+            if max_age <= 0:
+                return None
+            return now + max_age
+    if 'expires' in headers:
+        parsed = email.utils.parsedate_tz(headers['expires'])
+        if parsed is None:
+            # invalid expires headers mean the response is already expired
+            return None
+        expires = email.utils.mktime_tz(parsed)
+        if expires <= now:
+            return None
+        return expires
+    if status_code in (301, 308):
+        return now + PERMANENT_REDIRECT_MAX_AGE
+    return None
+
+class RedirectCache(object):
+    """Remembers redirects so we can skip them on later requests.
+
+    Many podcast hosts send enclosures and thumbnails through several
+    tracking redirects.  RedirectCache stores permanent redirects and
+    temporary redirects that are explicitly cacheable, so that grab_url() and
+    grab_headers() can go straight to the final URL.
+
+    RedirectCache is used from both the eventloop and the libcurl thread, so
+    all access is protected by a lock.  The least recently used entries are
+    dropped once we have more than max_size of them.
+    """
+    def __init__(self, max_size=REDIRECT_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forget all redirects and reset our stats."""
+        self.lock.acquire()
+        try:
+            # maps URL -> (location, temporary, expires, time_saved)
+            self.entries = collections.OrderedDict()
+            self.hits = self.misses = 0
+            self.redirects_skipped = 0
+            self.time_saved = 0.0
+        finally:
+            self.lock.release()
+
+    def add(self, url, location, temporary, expires, time_saved):
+        """Store a redirect
+
+        :param url: URL that was redirected
+        :param location: URL that url was redirected to
+        :param temporary: is this a temporary redirect?
+        :param expires: time that the redirect expires
+        :param time_saved: estimate of how many seconds we save by skipping
+            the redirect
+        """
+        self.lock.acquire()
+        try:
+            self.entries.pop(url, None)
+            self.entries[url] = (location, temporary, expires, time_saved)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def resolve(self, url):
+        """Follow cached redirects for a URL.
+
+        :returns: (final_url, temporary) tuple.  final_url is the URL to
+            request.  temporary is True if we skipped a temporary redirect.
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            temporary = False
+            skipped = 0
+            seen = set([url])
+            while skipped < REDIRECTION_LIMIT:
+                try:
+                    location, temp, expires, time_saved = self.entries[url]
+                except KeyError:
+                    break
+                if expires <= now:
+                    del self.entries[url]
+                    break
+                if location in seen:
+                    # circular redirects shouldn't be cacheable, but let's
+                    # not loop forever if they are
+                    break
+                # mark as recently used
+                del self.entries[url]
+                self.entries[url] = (location, temp, expires, time_saved)
+                seen.add(location)
+                url = location
+                temporary = temporary or temp
+                skipped += 1
+                self.time_saved += time_saved
+            if skipped > 0:
+                self.hits += 1
+                self.redirects_skipped += skipped
+            else:
+                self.misses += 1
+            return url, temporary
+        finally:
+            self.lock.release()
+
+    def invalidate(self, url):
+        """Remove all cached redirects starting from url."""
+        self.lock.acquire()
+        try:
+            for i in xrange(REDIRECTION_LIMIT):
+                try:
+                    location = self.entries.pop(url)[0]
+                except KeyError:
+                    break
+                url = location
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """Get stats for the redirect cache.
+
+        :returns: dict with the following keys:
+            - size: number of cached redirects
+            - hits: lookups where we skipped at least 1 redirect
+            - misses: lookups where we couldn't skip any redirects
+            - hit_rate: hits / (hits + misses)
+            - redirects_skipped: total number of redirects skipped
+            - time_saved: estimate of seconds saved by skipping redirects
+        """
+        self.lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            if lookups > 0:
+                hit_rate = float(self.hits) / lookups
+            else:
+                hit_rate = 0.0
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': hit_rate,
+                'redirects_skipped': self.redirects_skipped,
+                'time_saved': self.time_saved,
+            }
+        finally:
+            self.lock.release()
+
+    def write_to_file(self, path):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            dump_data = [(url, location, temporary, expires, time_saved)
+                    for url, (location, temporary, expires, time_saved)
+                    in self.entries.iteritems()
+                    if expires > now]
+        finally:
+            self.lock.release()
+        try:
+            f = open(path, 'wt')
+            try:
+                json.dump(dump_data, f)
+            finally:
+                f.close()
+        except IOError, e:
+            logging.warn("Error writing out redirect cache: %s", e)
+
+    def restore_from_file(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            f = open(path, 'rt')
+            try:
+                dump_data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            logging.warn("Error reading in redirect cache: %s", e)
+            return
+        if not isinstance(dump_data, list):
+            logging.warn("Error reading in redirect cache: bad data")
+            return
+        now = time.time()
+        for entry in dump_data:
+            try:
+                url, location, temporary, expires, time_saved = entry
+                if not isinstance(expires, (int, long, float)):
+                    raise ValueError("bad expiration time: %r" % expires)
+                url = url.encode('ascii')
+                location = location.encode('ascii')
+            except (TypeError, ValueError, UnicodeError, AttributeError), e:
+                logging.warn("Skipping bad redirect cache entry %r: %s",
+                             entry, e)
+                continue
+            if expires > now:
+                self.add(url, location, temporary, expires, time_saved)
+
+redirect_cache = RedirectCache()
+
+def _default_redirect_cache_file():
+    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+    return os.path.join(support_dir, 'redirect-cache')
+
+def restore_redirect_cache(path=None):
+    if path is None:
+        path = _default_redirect_cache_file()
+    redirect_cache.restore_from_file(path)
+
+def write_redirect_cache(path=None):
+    if path is None:
+        path = _default_redirect_cache_file()
+    redirect_cache.write_to_file(path)
+    logging.info("redirect cache stats: %s", redirect_cache.get_stats())
+
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
 
@@ -1041,7 +1371,8 @@ def grab_url(url, callback, errback, header_callback=None,
         'total-size': Total size of the download (this is different from
             content-length because it includes the data we are resuming from)
         'original-url': the URL passed to grab_url()
-        'redirected_url': the last URL we were redirected to
+        'redirected_url': the last URL we were redirected to.  This includes
+            redirects that we skipped because they were in the redirect cache.
         'updated': the URL that we should save in the database, this will be
             either original-url or redirected-url depending on if we received
             a permanent redirect or a temporary one.
@@ -1056,6 +1387,7 @@ def grab_url(url, callback, errback, header_callback=None,
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
                 post_files, write_file, extra_headers)
+        options.use_redirect_cache()
         transfer = CurlTransfer(options, callback, errback, header_callback,
                 content_check_callback)
         transfer.start()
@@ -1085,6 +1417,7 @@ def _grab_file_url(url, callback, errback, default_mime_type):
 
 def _grab_headers_using_get(url, callback, errback):
     options = TransferOptions(url)
+    options.use_redirect_cache()
     options._cancel_on_body_data = True
     transfer = CurlTransfer(options, callback, errback)
     transfer.start()
@@ -1100,6 +1433,7 @@ def grab_headers(url, callback, errback):
 
     url = sanitize_url(url)
     options = TransferOptions(url)
+    options.use_redirect_cache()
     options.head_request = True
     transfer = CurlTransfer(options, callback, errback_intercept)
     transfer.start()
@@ -28,11 +28,22 @@
 # statement from all source files in the program, then also delete it here.
 
 import os
+import heapq
 import logging
+import itertools
 import collections
+import urlparse
+from datetime import datetime, timedelta
+from cStringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 from miro import httpclient
 from miro import eventloop
+from miro import trapcall
 from miro.database import DDBObject, ObjectNotFoundError
 from miro.download_utils import next_free_filename, get_file_url_path
 from miro.util import unicodify
@@ -41,14 +52,185 @@ from miro import app
 from miro import prefs
 from miro import fileutil
 
-RUNNING_MAX = 3
+# max number of icon downloads running at once
+RUNNING_MAX = 6
+# max number of icon downloads running at once for a single host
+RUNNING_MAX_PER_HOST = 2
+# max number of request_update() calls to handle in a single idle callback
+REQUESTS_PER_IDLE = 50
+# how often we ask the server if a cached icon has changed
+REVALIDATE_AFTER = timedelta(days=7)
+# the largest size that the frontend displays icons at.  If the
+# DOWNSCALE_ICONS pref is set, we shrink bigger images down to this.
+ICON_MAX_SIZE = (190, 190)
+
+# fetch priorities, from most to least important
+VITAL, NORMAL, REVALIDATE = range(3)
+
+def downscale_image(data, max_size):
+    """Shrink image data so that it fits inside max_size.
+
+    If PIL isn't available, the image already fits, or we can't decode it,
+    data is returned unchanged.
+    """
+    if Image is None:
+        return data
+    try:
+        image = Image.open(StringIO(data))
+        if image.size[0] <= max_size[0] and image.size[1] <= max_size[1]:
+            return data
+        image_format = image.format
+        image.thumbnail(max_size, Image.ANTIALIAS)
+        output = StringIO()
+        image.save(output, image_format)
+    except StandardError, e:
+        logging.debug("iconcache: can't downscale image: %s", e)
+        return data
+    return output.getvalue()
+
+def write_icon_file(old_filename, cachedir, name, data, max_size=None):
+    """Save a downloaded icon to the icon cache directory.
+
+    This runs in the thread pool, so it must not touch the database.
+
+    :param old_filename: file that currently holds the icon, or None.  If
+                         it's set, the new icon replaces it.
+    :param cachedir: icon cache directory
+    :param name: filename suggested by the server
+    :param data: image data
+    :param max_size: if not None, downscale the image to fit inside this
+    :returns: the filename that we saved the icon to, or None if we
+              couldn't move the icon into place.
+    """
+    try:
+        fileutil.makedirs(cachedir)
+    except OSError:
+        pass
+
+    if max_size is not None:
+        data = downscale_image(data, max_size)
+
+    # Write to a temp file.
+    if old_filename:
+        tmp_filename = old_filename + ".part"
+    else:
+        tmp_filename = os.path.join(cachedir, name) + ".part"
+    tmp_filename, output = next_free_filename(tmp_filename)
+    try:
+        try:
+            output.write(data)
+        finally:
+            output.close()
+    except IOError:
+        _remove_file(tmp_filename)
+        raise
+
+    if old_filename:
+        filename = old_filename
+    else:
+        filename = unicode_to_filename(unicode(name), cachedir)
+        filename, fp = next_free_filename(os.path.join(cachedir, filename))
+        # we need to move the file here--so we close the file pointer
+        # and then move the file.
+        fp.close()
+    try:
+        _remove_file(filename)
+        fileutil.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        logging.exception("iconcache: fileutil.move failed")
+        _remove_file(tmp_filename)
+        return None
+    return filename
+
+def _remove_file(filename):
+    try:
+        fileutil.remove(filename)
+    except OSError:
+        pass
+
+def find_orphaned_files(cachedir, known_icons, cutoff):
+    """Find files in the icon cache directory that no IconCache uses.
+
+    This runs in the thread pool.
+
+    :param cachedir: icon cache directory
+    :param known_icons: set of normcased paths that IconCache objects use
+    :param cutoff: skip files modified after this time.  They may have
+                   been written after known_icons was calculated.
+    :returns: list of (path, size) tuples
+    """
+    orphans = []
+    for name in os.listdir(cachedir):
+        if name.startswith('.') or name == 'extracted':
+            continue
+        path = os.path.normcase(os.path.join(cachedir, name))
+        if path in known_icons:
+            continue
+        try:
+            stat_info = os.lstat(path)
+        except OSError:
+            continue
+        if stat_info.st_mtime < cutoff:
+            orphans.append((path, stat_info.st_size))
+    return orphans
+
+def remove_orphaned_files(orphans):
+    """Delete files returned by find_orphaned_files().
+
+    This runs in the thread pool.
+
+    :returns: (number of files removed, bytes reclaimed)
+    """
+    count = size = 0
+    for path, file_size in orphans:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        count += 1
+        size += file_size
+    return count, size
+
+class IconFetch(object):
+    """HTTP request for an icon.
+
+    All IconCache objects that want the same url with the same cache
+    validators share a single IconFetch.
+    """
+    def __init__(self, url, etag, modified, priority):
+        self.url = url
+        self.etag = etag
+        self.modified = modified
+        self.priority = priority
+        self.host = urlparse.urlparse(url)[1].lower()
+        self.started = False
+        self.callbacks = []
+
+    def key(self):
+        return (self.url, self.etag, self.modified)
 
 class IconCacheUpdater:
+    """Schedules icon updates.
+
+    request_update() calls are handled in batches from an idle callback.
+    IconCache objects that need to hit the network call fetch(), which
+    queues an IconFetch.  Fetches are started in priority order, while
+    keeping under both RUNNING_MAX and RUNNING_MAX_PER_HOST.
+    """
     def __init__(self):
         self.idle = collections.deque()
         self.vital = collections.deque()
-        self.running_count = 0
+        self.processing_scheduled = False
         self.in_shutdown = False
+        # maps (url, etag, modified) -> IconFetch for queued and running
+        # fetches
+        self.fetches = {}
+        # for each priority, maps host -> heap of (sort_key, counter,
+        # IconFetch) tuples
+        self.fetch_queues = tuple({} for i in range(REVALIDATE + 1))
+        self.running_count = 0
+        self.running_per_host = collections.defaultdict(int)
+        self.counter = itertools.count()
 
     def request_update(self, item, is_vital=False):
         if is_vital:
@@ -56,29 +238,101 @@ class IconCacheUpdater:
             if (item.filename and fileutil.access(item.filename, os.R_OK)
                    and item.url == item.dbItem.get_thumbnail_url()):
                 is_vital = False
-        if self.running_count < RUNNING_MAX:
-            eventloop.add_idle(item.request_icon, "Icon Request")
-            self.running_count += 1
+        if is_vital:
+            self.vital.append(item)
         else:
-            if is_vital:
-                self.vital.append(item)
+            self.idle.append(item)
+        if not self.processing_scheduled:
+            eventloop.add_idle(self.process_requests, "Icon Request",
+                               priority=eventloop.PRIORITY_BACKGROUND)
+            self.processing_scheduled = True
+
+    def process_requests(self):
+        self.processing_scheduled = False
+        for i in xrange(REQUESTS_PER_IDLE):
+            if self.in_shutdown:
+                return
+            if len(self.vital) > 0:
+                self.vital.popleft().request_icon(is_vital=True)
+            elif len(self.idle) > 0:
+                self.idle.popleft().request_icon()
             else:
-                self.idle.append(item)
-
-    def update_finished(self):
-        if self.in_shutdown:
-            self.running_count -= 1
-            return
-
-        if len(self.vital) > 0:
-            item = self.vital.popleft()
-        elif len(self.idle) > 0:
-            item = self.idle.popleft()
+                return
+        if len(self.vital) > 0 or len(self.idle) > 0:
+            eventloop.add_idle(self.process_requests, "Icon Request",
+                               priority=eventloop.PRIORITY_BACKGROUND)
+            self.processing_scheduled = True
+
+    def fetch(self, url, callback, errback, etag=None, modified=None,
+              priority=NORMAL, sort_key=None):
+        """Download an icon.
+
+        :param url: URL to download
+        :param callback: called with the httpclient info dict on success
+        :param errback: called with the error on failure
+        :param etag: ETag of the copy we have cached
+        :param modified: Last-Modified value of the copy we have cached
+        :param priority: VITAL, NORMAL or REVALIDATE
+        :param sort_key: fetches with the same priority are started in
+                         order of this value (then in the order they were
+                         queued).
+        """
+        key = (url, etag, modified)
+        try:
+            fetch = self.fetches[key]
+        except KeyError:
+            fetch = self.fetches[key] = IconFetch(url, etag, modified,
+                                                  priority)
+            self._queue_fetch(fetch, sort_key)
         else:
-            self.running_count -= 1
+            if not fetch.started and priority < fetch.priority:
+                # The old queue entry is skipped once the priority changes
+                fetch.priority = priority
+                self._queue_fetch(fetch, sort_key)
+        fetch.callbacks.append((callback, errback))
+        self._start_fetches()
+
+    def _queue_fetch(self, fetch, sort_key):
+        queue = self.fetch_queues[fetch.priority].setdefault(fetch.host, [])
+        heapq.heappush(queue, (sort_key, self.counter.next(), fetch))
+
+    def _start_fetches(self):
+        if self.in_shutdown:
             return
-
-        eventloop.add_idle(item.request_icon, "Icon Request")
+        for priority, queues in enumerate(self.fetch_queues):
+            for host in queues.keys():
+                if self.running_count >= RUNNING_MAX:
+                    return
+                queue = queues[host]
+                while (queue and self.running_count < RUNNING_MAX and
+                       self.running_per_host[host] < RUNNING_MAX_PER_HOST):
+                    fetch = heapq.heappop(queue)[2]
+                    if not fetch.started and fetch.priority == priority:
+                        self._start_fetch(fetch)
+                if not queue:
+                    del queues[host]
+
+    def _start_fetch(self, fetch):
+        fetch.started = True
+        self.running_count += 1
+        self.running_per_host[fetch.host] += 1
+        httpclient.grab_url(fetch.url,
+                lambda info: self._fetch_finished(fetch, info, None),
+                lambda error: self._fetch_finished(fetch, None, error),
+                etag=fetch.etag, modified=fetch.modified)
+
+    def _fetch_finished(self, fetch, info, error):
+        del self.fetches[fetch.key()]
+        self.running_count -= 1
+        self.running_per_host[fetch.host] -= 1
+        if self.running_per_host[fetch.host] == 0:
+            del self.running_per_host[fetch.host]
+        for callback, errback in fetch.callbacks:
+            if error is None:
+                trapcall.trap_call("Icon fetch callback", callback, info)
+            else:
+                trapcall.trap_call("Icon fetch errback", errback, error)
+        self._start_fetches()
 
     @eventloop.as_idle
     def clear_vital(self):
@@ -98,11 +352,13 @@ class IconCache(DDBObject):
         self.modified = None
         self.filename = None
         self.url = None
+        self.last_checked = None
 
         self.updating = False
         self.needsUpdate = False
         self.dbItem = dbItem
         self.removed = False
+        self._write_call = None
 
         self.request_update(is_vital=dbItem.ICON_CACHE_VITAL)
 
@@ -126,6 +382,10 @@ class IconCache(DDBObject):
 
     def remove(self):
         self.removed = True
+        if self._write_call is not None:
+            # don't bother writing an icon that we're going to throw away
+            if self._write_call.cancel():
+                self._write_call = None
         if self.filename:
             self.remove_file(self.filename)
         DDBObject.remove(self)
@@ -137,22 +397,19 @@ class IconCache(DDBObject):
         self.url = None
         self.etag = None
         self.modified = None
+        self.last_checked = None
         self.removed = False
         self.updating = False
         self.needsUpdate = False
         self.icon_changed()
 
     def remove_file(self, filename):
-        try:
-            fileutil.remove(filename)
-        except OSError:
-            pass
+        _remove_file(filename)
 
     def error_callback(self, url, error=None):
         self.dbItem.confirm_db_thread()
 
         if self.removed:
-            icon_cache_updater.update_finished()
             return
 
         # Don't clear the cache on an error.
@@ -161,119 +418,84 @@ class IconCache(DDBObject):
             self.etag = None
             self.modified = None
             self.icon_changed()
+        self.update_done()
+
+    def update_done(self):
         self.updating = False
         if self.needsUpdate:
             self.needsUpdate = False
             self.request_update(True)
-        icon_cache_updater.update_finished()
 
     def update_icon_cache(self, url, info):
         self.dbItem.confirm_db_thread()
 
         if self.removed:
-            icon_cache_updater.update_finished()
             return
 
-        needs_save = False
-        needsChange = False
-
         if info == None or (info['status'] != 304 and info['status'] != 200):
             self.error_callback(url, "bad response")
             return
-        try:
+
+        if info['status'] == 304:
             # Our cache is good.  Hooray!
-            if info['status'] == 304:
-                return
+            self.last_checked = datetime.now()
+            self.signal_change()
+            self.update_done()
+            return
 
-            needsChange = True
-
-            # We have to update it, and if we can't write to the file, we
-            # should pick a new filename.
-            if ((self.filename and
-                 not fileutil.access(self.filename, os.R_OK | os.W_OK))):
-                self.filename = None
-
-            cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
-            try:
-                fileutil.makedirs(cachedir)
-            except OSError:
-                pass
-
-            try:
-                # Write to a temp file.
-                if self.filename:
-                    tmp_filename = self.filename + ".part"
-                else:
-                    tmp_filename = os.path.join(cachedir, info["filename"]) + ".part"
-                tmp_filename, output = next_free_filename(tmp_filename)
-                output.write(info["body"])
-                output.close()
-            except IOError:
-                self.remove_file(tmp_filename)
-                return
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#1, candidate = %r', tmp_filename)
-                return
+        # We have to update it, and if we can't write to the file, we
+        # should pick a new filename.
+        if ((self.filename and
+             not fileutil.access(self.filename, os.R_OK | os.W_OK))):
+            self.filename = None
 
-            filename = unicode(info["filename"])
-            filename = unicode_to_filename(filename, cachedir)
-            filename = os.path.join(cachedir, filename)
-            needs_save = True
-            try:
-                filename, fp = next_free_filename(filename)
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#2, candidate = %r', filename)
-                return
+        if app.config.get(prefs.DOWNSCALE_ICONS):
+            max_size = ICON_MAX_SIZE
+        else:
+            max_size = None
+        self._write_call = eventloop.call_in_thread_category('filesystem',
+            lambda filename: self.icon_written(url, info, filename),
+            lambda error: self.icon_write_failed(url, error),
+            write_icon_file, "Write icon", self.filename,
+            app.config.get(prefs.ICON_CACHE_DIRECTORY), info["filename"],
+            info["body"], max_size)
+
+    def icon_written(self, url, info, filename):
+        """Called once write_icon_file() has saved a new icon."""
+        self.dbItem.confirm_db_thread()
+        self._write_call = None
 
-            if self.filename:
-                filename = self.filename
-                self.filename = None
+        if self.removed:
+            if filename:
                 self.remove_file(filename)
+            return
 
-            # we need to move the file here--so we close the file
-            # pointer and then move the file.
-            fp.close()
-            try:
-                self.remove_file(filename)
-                fileutil.rename(tmp_filename, filename)
-            except (IOError, OSError):
-                logging.exception("iconcache: fileutil.move failed")
-                filename = None
-
-            self.filename = filename
-
-            etag = unicodify(info.get("etag"))
-            modified = unicodify(info.get("modified"))
-
-            if self.etag != etag:
-                needs_save = True
-                self.etag = etag
-            if self.modified != modified:
-                needs_save = True
-                self.modified = modified
-            if self.url != url:
-                needs_save = True
-                self.url = url
-        finally:
-            if needsChange:
-                self.icon_changed(needs_save=needs_save)
-            self.updating = False
-            if self.needsUpdate:
-                self.needsUpdate = False
-                self.request_update(True)
-            icon_cache_updater.update_finished()
-
-    def request_icon(self):
+        self.filename = filename
+        self.etag = unicodify(info.get("etag"))
+        self.modified = unicodify(info.get("modified"))
+        self.url = url
+        self.last_checked = datetime.now()
+        self.icon_changed()
+        self.update_done()
+
+    def icon_write_failed(self, url, error):
+        self._write_call = None
+        logging.warn("iconcache: error saving icon for %s: %s", url, error)
+        if self.removed:
+            return
+        self.update_done()
+
+    def needs_revalidation(self):
+        return (self.last_checked is None or
+                datetime.now() - self.last_checked > REVALIDATE_AFTER)
+
+    def request_icon(self, is_vital=False):
         if self.removed:
-            icon_cache_updater.update_finished()
             return
 
         self.dbItem.confirm_db_thread()
         if self.updating:
             self.needsUpdate = True
-            icon_cache_updater.update_finished()
             return
 
         if hasattr(self.dbItem, "get_thumbnail_url"):
@@ -281,11 +503,25 @@ class IconCache(DDBObject):
         else:
             url = self.url
 
-        # Only verify each icon once per run unless the url changes
+        if is_vital:
+            priority = VITAL
+        else:
+            priority = NORMAL
+        etag = modified = sort_key = None
         if (url == self.url and self.filename
                 and fileutil.access(self.filename, os.R_OK)):
-            icon_cache_updater.update_finished()
-            return
+            # We already have the icon.  Every so often, check if it's
+            # changed, oldest icons first.
+            if not self.needs_revalidation():
+                return
+            etag = self.etag
+            modified = self.modified
+            priority = REVALIDATE
+            # last_checked is NULL for icons from before we tracked it.
+            # Check those first, and make sure the key can be compared with
+            # datetimes.
+            sort_key = (self.last_checked is not None,
+                        self.last_checked or datetime.min)
 
         self.updating = True
 
@@ -295,8 +531,11 @@ class IconCache(DDBObject):
             return
 
         # Last try, get the icon from HTTP.
-        httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+        icon_cache_updater.fetch(url,
+                lambda info: self.update_icon_cache(url, info),
+                lambda error: self.error_callback(url, error),
+                etag=etag, modified=modified, priority=priority,
+                sort_key=sort_key)
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
@@ -309,6 +548,7 @@ class IconCache(DDBObject):
         self.removed = False
         self.updating = False
         self.needsUpdate = False
+        self._write_call = None
 
     def is_valid(self):
         self.dbItem.confirm_db_thread()
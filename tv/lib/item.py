@@ -57,6 +57,7 @@ from miro import database
 from miro import httpclient
 from miro import iconcache
 from miro import databaselog
+from miro import directorywatch
 from miro import downloader
 from miro import eventloop
 from miro import prefs
@@ -327,57 +328,194 @@ class FileFeedParserValues(FeedParserValues):
             'release_date': datetime.min,
         }
 
-class _ItemsForPathCountTracker(object):
-    """Helps Item implement have_item_for_path
+class _ItemPathIndex(object):
+    """Index of the filenames for our items.
 
-    This class tracks how many items we have for a given path.  It's optimized
-    pretty agressively.  We call it many times when importing new files.
+    This class tracks which items we have for a given path.  It's optimized
+    pretty agressively.  We call it many times when importing new files and
+    every time a watched directory changes.
+
+    Paths are normalized so that they work case-insensitively, then hashed
+    into dicts.  We also keep a map of directories to the paths inside them
+    and a map of directories to their subdirectories, which lets us find all
+    items under a directory without looking at the rest of the index.
+
+    The index gets built from the database the first time it's used, after
+    that it's updated by Item as items get created, changed and removed.
     """
 
-    def get_count(self, path):
+    def _ensure_loaded(self):
         try:
-            counts = self.count_for_paths
+            return self.items_for_path
         except AttributeError:
-            counts = self._init_counts_for_paths()
-        return counts[self._count_key(path)]
-
-    def _init_counts_for_paths(self):
+            pass
+        # maps normalized paths to dicts mapping item ids to feed ids
+        self.items_for_path = {}
+        # maps item ids to their normalized path
+        self.path_for_item = {}
+        # maps normalized directories to sets of normalized paths inside them
+        self.paths_in_directory = {}
+        # maps normalized directories to sets of their subdirectories that
+        # have items somewhere inside them
+        self.subdirectories = {}
         # Use a raw DB query for this one, since we want to be as fast as
         # possible
-        counts = collections.defaultdict(int)
-        app.db.cursor.execute("SELECT lower(filename), COUNT(*) "
-                              "FROM item "
-                              "GROUP BY filename")
-        counts.update(app.db.cursor)
-        self.count_for_paths = counts
-        return counts
-
-    def _count_key(self, path):
+        app.db.cursor.execute("SELECT id, filename, feed_id FROM item "
+                              "WHERE filename IS NOT NULL")
+        for item_id, filename, feed_id in app.db.cursor.fetchall():
+            # filenames are stored as unicode in the DB, so we just need to
+            # lowercase them.
+            self._add(item_id, filename.lower(), feed_id)
+        return self.items_for_path
+
+    def _key(self, path):
         # normalize paths so that they match whats in the database, and work
         # case-insensitively
         return filename_to_unicode(path).lower()
 
+    def _directory_key(self, path):
+        return self._key(path).rstrip(os.sep) + os.sep
+
+    def _add(self, item_id, key, feed_id):
+        self.items_for_path.setdefault(key, {})[item_id] = feed_id
+        self.path_for_item[item_id] = key
+        directory = os.path.dirname(key) + os.sep
+        paths = self.paths_in_directory.get(directory)
+        if paths is None:
+            paths = self.paths_in_directory[directory] = set()
+            self._add_directory(directory)
+        paths.add(key)
+
+    def _parent_directory(self, directory):
+        return os.path.dirname(directory.rstrip(os.sep)) + os.sep
+
+    def _add_directory(self, directory):
+        # link directory to its parents in subdirectories
+        while True:
+            parent = self._parent_directory(directory)
+            if parent == directory:
+                return
+            children = self.subdirectories.setdefault(parent, set())
+            if directory in children:
+                return # the rest of the chain is already linked
+            children.add(directory)
+            directory = parent
+
+    def _remove_directory(self, directory):
+        # unlink directories that don't have any items left inside them
+        while (directory not in self.paths_in_directory and
+               directory not in self.subdirectories):
+            parent = self._parent_directory(directory)
+            if parent == directory:
+                return
+            children = self.subdirectories[parent]
+            children.discard(directory)
+            if children:
+                return
+            del self.subdirectories[parent]
+            directory = parent
+
+    def _remove(self, item_id):
+        key = self.path_for_item.pop(item_id, None)
+        if key is None:
+            return
+        items = self.items_for_path[key]
+        del items[item_id]
+        if not items:
+            del self.items_for_path[key]
+            directory = os.path.dirname(key) + os.sep
+            paths = self.paths_in_directory[directory]
+            paths.discard(key)
+            if not paths:
+                del self.paths_in_directory[directory]
+                self._remove_directory(directory)
+
     def reset(self):
         try:
-            del self.count_for_paths
+            del self.items_for_path
         except AttributeError:
             pass
 
-    def add_item(self, item):
-        if item.filename is None:
-            return
-        try:
-            self.count_for_paths[self._count_key(item.filename)] += 1
-        except AttributeError:
-            return # counts not created yet we can just ignore
+    def update_item(self, item):
+        """Add an item to the index, or update it if it's already there."""
+        if not hasattr(self, 'items_for_path'):
+            return # index not created yet we can just ignore
+        self._remove(item.id)
+        if item.filename is not None:
+            self._add(item.id, self._key(item.filename), item.feed_id)
 
     def remove_item(self, item):
-        if item.filename is None:
-            return
-        try:
-            self.count_for_paths[self._count_key(item.filename)] -= 1
-        except AttributeError:
-            return # counts not created yet we can just ignore
+        if not hasattr(self, 'items_for_path'):
+            return # index not created yet we can just ignore
+        self._remove(item.id)
+
+    def get_count(self, path):
+        """Get the number of items for a path."""
+        return len(self._ensure_loaded().get(self._key(path), ()))
+
+    def contains_path(self, path, exclude_feed_id=None):
+        """Check if we have an item for a path.
+
+        :param exclude_feed_id: if given, ignore items in this feed
+        """
+        items = self._ensure_loaded().get(self._key(path))
+        if not items:
+            return False
+        if exclude_feed_id is None:
+            return True
+        for feed_id in items.itervalues():
+            if feed_id != exclude_feed_id:
+                return True
+        return False
+
+    def item_ids_for_path(self, path, feed_id=None):
+        """Get the ids of items for a path.
+
+        :param feed_id: if given, only return items in this feed
+        """
+        items = self._ensure_loaded().get(self._key(path), {})
+        return [item_id for item_id, item_feed_id in items.iteritems()
+                if feed_id is None or item_feed_id == feed_id]
+
+    def item_ids_in_directory(self, directory, feed_id=None):
+        """Get the ids of items anywhere below a directory.
+
+        :param feed_id: if given, only return items in this feed
+        """
+        self._ensure_loaded()
+        rv = []
+        to_visit = [self._directory_key(directory)]
+        while to_visit:
+            dir_key = to_visit.pop()
+            for key in self.paths_in_directory.get(dir_key, ()):
+                for item_id, item_feed_id in (
+                        self.items_for_path[key].iteritems()):
+                    if feed_id is None or item_feed_id == feed_id:
+                        rv.append(item_id)
+            to_visit.extend(self.subdirectories.get(dir_key, ()))
+        return rv
+
+class KnownFiles(object):
+    """Track paths that we shouldn't create new items for.
+
+    KnownFiles works like fileutil.FileSet, except that it also contains the
+    paths of all our items, using Item's path index.  It stays up to date as
+    items get added and removed.
+    """
+    def __init__(self, exclude_feed_id=None):
+        """Create a KnownFiles object.
+
+        :param exclude_feed_id: don't count items in this feed as known
+        """
+        self.exclude_feed_id = exclude_feed_id
+        self.extra_files = fileutil.FileSet()
+
+    def add_path(self, path):
+        self.extra_files.add_path(path)
+
+    def contains_path(self, path):
+        return (self.extra_files.contains_path(path) or
+                Item._path_index.contains_path(path, self.exclude_feed_id))
 
 class ItemChangeTracker(signals.SignalEmitter):
     """Tracks changes to items and send the ItemChanges message."""
@@ -398,6 +536,10 @@ class ItemChangeTracker(signals.SignalEmitter):
         self.playlists_changed = False
 
     def after_event_finished(self, event_loop, success):
+        # In group commit mode, the changes might not be committed yet.  Wait
+        # until they are, otherwise the frontend would read the old data.
+        if app.db is not None and app.db.has_uncommitted_changes():
+            return
         self.send_changes()
 
     def send_changes(self):
@@ -549,7 +691,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.expiring = None
         self.showMoreInfo = False
         self.playing = False
-        Item._path_count_tracker.add_item(self)
+        Item._path_index.update_item(self)
 
     def playlists_changed(self, added=False):
         """Called when the item gets added/removed from playlists."""
@@ -930,7 +1072,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
     def downloader_view(cls, dler_id):
         return cls.make_view("downloader_id=?", (dler_id,))
 
-    _path_count_tracker = _ItemsForPathCountTracker()
+    _path_index = _ItemPathIndex()
 
     @classmethod
     def have_item_for_path(cls, path):
@@ -939,8 +1081,19 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         This method is optimized to avoid DB queries if at all possible.
         """
         # NOTE: use Item here rather than cls, since FileItem and Item share
-        # the same _path_count_tracker.
-        return Item._path_count_tracker.get_count(path) > 0
+        # the same _path_index.
+        return Item._path_index.get_count(path) > 0
+
+    @classmethod
+    def ids_for_path_or_directory(cls, path, feed_id=None):
+        """Get the ids of items for a path.
+
+        If path is a directory, this includes all items anywhere inside it.
+
+        :param feed_id: if given, only return items in this feed
+        """
+        return (Item._path_index.item_ids_for_path(path, feed_id) +
+                Item._path_index.item_ids_in_directory(path, feed_id))
 
     def _look_for_downloader(self):
         self.set_downloader(downloader.lookup_downloader(self.get_url()))
@@ -1065,7 +1218,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.signal_change()
 
     def set_filename(self, filename):
-        Item._path_count_tracker.remove_item(self)
+        Item._path_index.remove_item(self)
         self.filename = filename
         try:
             self.size = os.path.getsize(filename)
@@ -1077,7 +1230,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         else:
             metadata = app.local_metadata_manager.get_metadata(filename)
         self.update_from_metadata(metadata)
-        Item._path_count_tracker.add_item(self)
+        Item._path_index.update_item(self)
 
     def file_moved(self, new_filename):
         app.local_metadata_manager.file_moved(self.filename, new_filename)
@@ -1144,6 +1297,8 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
             del self._state
         if hasattr(self, "_size"):
             del self._size
+        # catch changes to filename and feed_id
+        Item._path_index.update_item(self)
 
     def recalc_feed_counts(self):
         self.get_feed().recalc_counts()
@@ -1291,7 +1446,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
             for item in self.get_children():
                 item.make_deleted()
                 item.remove()
-        Item._path_count_tracker.remove_item(self)
+        Item._path_index.remove_item(self)
         self.delete_files()
         self.resume_time = 0
         self.expired = True
@@ -2008,6 +2163,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.signal_change()
         self._replace_file_items()
         signals.system.download_complete(self)
+        app.db.request_commit()
 
         for other in Item.make_view('downloader_id IS NULL AND url=?',
                 (self.url,)):
@@ -2081,7 +2237,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
                 item.migrate(newdir)
 
     def remove(self):
-        Item._path_count_tracker.remove_item(self)
+        Item._path_index.remove_item(self)
         if self.has_downloader():
             self.set_downloader(None)
         self.remove_icon_cache()
@@ -2108,13 +2264,17 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         """
         if not self.id_exists():
             return True
-        if (self.is_container_item is not None and
-                not fileutil.exists(self.get_filename()) and
-                not self._allow_nonexistent_paths):
+        if (self.needs_deleted_check() and
+                not fileutil.exists(self.get_filename())):
             self.expire()
             return True
         return False
 
+    def needs_deleted_check(self):
+        """Should we check if our file has been deleted outside of miro?"""
+        return (self.is_container_item is not None and
+                not self._allow_nonexistent_paths)
+
     def _get_downloader(self):
         try:
             return self._downloader
@@ -2415,11 +2575,50 @@ def filename_to_title(filename):
 def fp_values_for_file(filename, title=None, description=None):
     return FileFeedParserValues(filename, title, description)
 
-class DeletedFileChecker(object):
-    """Utility class that manages calling Item.check_deleted().
+def _find_devices(paths, device_cache):
+    """Figure out which device each path is on.
+
+    This runs in the thread pool.  device_cache maps directories to device
+    ids, so we only stat each directory once per run_checks() pass.
 
-    This class ensures that we only schedule one idle callback at a time.
+    :returns: list of device ids, with None for paths whose directory
+        doesn't exist
     """
+    devices = []
+    for path in paths:
+        directory = os.path.dirname(path)
+        try:
+            device = device_cache[directory]
+        except KeyError:
+            try:
+                device = os.stat(directory).st_dev
+            except OSError:
+                device = None
+            device_cache[directory] = device
+        devices.append(device)
+    return devices
+
+def _find_missing(paths):
+    """Return the paths that don't exist.  This runs in the thread pool."""
+    return [path for path in paths if not fileutil.exists(path)]
+
+class DeletedFileChecker(object):
+    """Utility class that checks if item files were deleted outside of miro.
+
+    Items passed to schedule_check() are handled in chunks from an idle
+    callback.  We skip files that a DirectoryWatcher knows about, then check
+    if the rest exist in the thread pool so that slow filesystems (like
+    NFS/SMB shares) don't block the event loop.  Checks are grouped by
+    device and we limit how many run at once on any single device.  Items
+    with missing files are expired in bulk.
+    """
+    # number of items to handle in a single idle callback or thread pool call
+    CHUNK_SIZE = 100
+    # max number of thread pool calls to run at once
+    RUNNING_MAX = 3
+    # max number of thread pool calls to run at once for a single device
+    RUNNING_MAX_PER_DEVICE = 2
+
     def __init__(self):
         # track items that we should call check_deleted for
         self.items_to_check = set()
@@ -2427,6 +2626,17 @@ class DeletedFileChecker(object):
         self.check_scheduled = False
         # track if we should be checking yet
         self.started = False
+        # maps device id -> deque of lists of (item, path) tuples waiting to
+        # be checked
+        self.pending_checks = {}
+        self.running_count = 0
+        self.running_per_device = collections.defaultdict(int)
+        # (item, path) tuples for missing files that we haven't handled yet
+        self.missing = []
+        self.apply_scheduled = False
+        # directory -> device id cache used by _find_devices().  It gets
+        # replaced at the start of each run_checks() pass.
+        self.device_cache = {}
 
     def schedule_check(self, item):
         self.items_to_check.add(item)
@@ -2446,33 +2656,114 @@ class DeletedFileChecker(object):
         it only schedules one callback.
         """
         if self.started and not self.check_scheduled:
-            eventloop.add_idle(self.run_checks, 'checking items deleted')
+            eventloop.add_idle(self.run_checks, 'checking items deleted',
+                               priority=eventloop.PRIORITY_BACKGROUND)
             self.check_scheduled = True
 
     def run_checks(self):
-        """Call check_deleted() for the items that are scheduled to check."""
+        """Start checking files for the items that are scheduled to check."""
         self.check_scheduled = False
         # Grab a limited number items at a time to prevent us from using too
         # much time in for this idle callback.
-        # Update items_to_check immediately in case schedule_check() is called
-        # in response to us calling check_deleted()
-        items_this_pass = []
-        for x in xrange(100):
+        to_check = []
+        for x in xrange(self.CHUNK_SIZE):
             try:
-                to_check = self.items_to_check.pop()
-                items_this_pass.append(to_check)
+                item = self.items_to_check.pop()
             except KeyError:
                 break # items_to_check is empty
-
+            if not (item.id_exists() and item.needs_deleted_check()):
+                continue
+            path = item.get_filename()
+            if directorywatch.DirectoryWatcher.any_watcher_has_file(path):
+                continue
+            to_check.append((item, path))
+
+        if to_check:
+            # Start with a fresh cache so that we notice when drives get
+            # mounted/unmounted and don't keep every directory around
+            # forever.  Replace the dict rather than clearing it since
+            # earlier _find_devices() calls may still be using it.
+            self.device_cache = {}
+            eventloop.call_in_thread_category('filesystem',
+                lambda devices: self._on_devices_found(to_check, devices),
+                self._on_thread_error, _find_devices,
+                'Find devices for deleted file check',
+                [path for item, path in to_check], self.device_cache)
+        if self.items_to_check:
+            self._ensure_run_checks_scheduled()
+
+    def _on_devices_found(self, to_check, devices):
+        for (item, path), device in zip(to_check, devices):
+            if device is None:
+                # the directory is gone, so the file must be too
+                self.missing.append((item, path))
+            else:
+                queue = self.pending_checks.setdefault(device,
+                                                       collections.deque())
+                if not queue or len(queue[-1]) >= self.CHUNK_SIZE:
+                    queue.append([])
+                queue[-1].append((item, path))
+        self._start_checks()
+        self._ensure_apply_scheduled()
+
+    def _start_checks(self):
+        for device in self.pending_checks.keys():
+            queue = self.pending_checks[device]
+            while (queue and self.running_count < self.RUNNING_MAX and
+                   self.running_per_device[device] <
+                   self.RUNNING_MAX_PER_DEVICE):
+                self._start_check(device, queue.popleft())
+            if not queue:
+                del self.pending_checks[device]
+
+    def _start_check(self, device, chunk):
+        self.running_count += 1
+        self.running_per_device[device] += 1
+        def callback(missing_paths):
+            self._on_check_finished(device)
+            missing_paths = set(missing_paths)
+            self.missing.extend((item, path) for item, path in chunk
+                                if path in missing_paths)
+            self._ensure_apply_scheduled()
+        def errback(error):
+            self._on_check_finished(device)
+            self._on_thread_error(error)
+        eventloop.call_in_thread_category('filesystem', callback, errback,
+                                          _find_missing,
+                                          'Check for deleted files',
+                                          [path for item, path in chunk])
+
+    def _on_check_finished(self, device):
+        self.running_count -= 1
+        self.running_per_device[device] -= 1
+        if self.running_per_device[device] == 0:
+            del self.running_per_device[device]
+        self._start_checks()
+
+    def _on_thread_error(self, error):
+        logging.warn("DeletedFileChecker: error checking files: %s", error)
+
+    def _ensure_apply_scheduled(self):
+        if self.missing and not self.apply_scheduled:
+            eventloop.add_idle(self.apply_results,
+                               'expire items with deleted files',
+                               priority=eventloop.PRIORITY_BACKGROUND)
+            self.apply_scheduled = True
+
+    def apply_results(self):
+        """Expire items whose files we found were deleted."""
+        self.apply_scheduled = False
+        missing = self.missing
+        self.missing = []
         app.bulk_sql_manager.start()
         try:
-            for item in items_this_pass:
-                if item.id_exists():
-                    item.check_deleted()
+            for item, path in missing:
+                # Make sure nothing changed while we were checking
+                if (item.id_exists() and item.needs_deleted_check() and
+                        item.get_filename() == path):
+                    item.expire()
         finally:
             app.bulk_sql_manager.finish()
-            if self.items_to_check:
-                self._ensure_run_checks_scheduled()
 
 class DeviceItemChangeTracker(object):
     """Track changes to DeviceItems and send the DeviceItemChanges message.
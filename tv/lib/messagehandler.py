@@ -461,7 +461,14 @@ class BackendMessageHandler(messages.MessageHandler):
     def call_handler(self, method, message):
         name = 'handling backend message: %s' % message
         logging.debug("handling backend %s", message)
-        eventloop.add_urgent_call(method, name, args=(message,))
+        eventloop.add_urgent_call(self._call_handler_method, name,
+                                  args=(method, message))
+
+    def _call_handler_method(self, method, message):
+        method(message)
+        # Backend messages come from user actions.  Don't let group commit
+        # delay saving them.
+        app.db.request_commit()
 
     def folder_class_for_type(self, typ):
         if typ == 'feed':
@@ -974,6 +981,7 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             logging.warn("AddVideosToPlaylist: Playlist not found -- %s",
                     message.playlist_id)
             return
+        to_add = []
         for id_ in message.video_ids:
             try:
                 item_ = item.Item.get_by_id(id_)
@@ -984,7 +992,8 @@ New ids: %s""", playlist_item_ids, message.item_ids)
                 logging.warn("AddVideosToPlaylist: Item not downloaded (%s)",
                         item_)
             else:
-                playlist.add_item(item_)
+                to_add.append(id_)
+        playlist.add_ids(to_add)
 
     def handle_remove_videos_from_playlist(self, message):
         try:
@@ -1001,15 +1010,10 @@ New ids: %s""", playlist_item_ids, message.item_ids)
                     message.playlist_id)
                 return
 
-        not_removed = []
-        for id_ in message.video_ids:
-            found = False
-            for playlist in playlists:
-                if playlist.contains_id(id_):
-                    playlist.remove_id(id_)
-                    found = True
-            if not found:
-                not_removed.append(id_)
+        removed = set()
+        for playlist in playlists:
+            removed.update(playlist.remove_ids(message.video_ids))
+        not_removed = [id_ for id_ in message.video_ids if id_ not in removed]
         for id_ in not_removed:
             logging.warn("RemoveVideosFromPlaylist: Id not found -- %s", id_)
 
@@ -1642,6 +1646,13 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         time.sleep(message.n)
         logging.debug('handle_clog_backend: Backend out of snooze.  Yawn!')
 
+    def handle_log_event_loop_profile(self, message):
+        if eventloop.profiling_enabled():
+            eventloop.log_profile_report()
+        else:
+            logging.info('Event loop profiling enabled')
+            eventloop.enable_profiling()
+
     def handle_force_feedparser_processing(self, message):
         # For all our RSS feeds, force an update
         for f in feed.Feed.make_view():
@@ -886,6 +886,13 @@ class ClogBackend(BackendMessage):
     def __init__(self, n=0):
         self.n = n
 
+class LogEventLoopProfile(BackendMessage):
+    """Dev message: write event loop profiling stats to the log.
+
+    If profiling isn't enabled yet, this enables it.
+    """
+    pass
+
 class ForceFeedparserProcessing(BackendMessage):
     """Force the backend to do a bunch of feedparser updates
     """
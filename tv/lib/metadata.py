@@ -52,6 +52,7 @@ from miro import messages
 from miro import net
 from miro import prefs
 from miro import signals
+from miro import util
 from miro import workerprocess
 from miro.plat.utils import (filename_to_unicode,
                              get_enmfp_executable_info)
@@ -105,6 +106,8 @@ class MetadataStatus(database.DDBObject):
         self.mutagen_thinks_drm = False
         self.echonest_id = None
         self.max_entry_priority = -1
+        # fingerprint of the file contents, set when mutagen finishes
+        self.fingerprint = None
         # current processor tracks what processor we should be running for
         # this status.  We don't save it to the database.
         self.current_processor = u'mutagen'
@@ -159,6 +162,55 @@ class MetadataStatus(database.DDBObject):
                                  db_info=db_info)
             return view.get_singleton()
 
+    @classmethod
+    def get_by_paths(cls, paths, db_info=None):
+        """Get objects for a list of paths.
+
+        This works like get_by_path(), but objects that aren't in the cache
+        are loaded using one query for each chunk of paths.
+
+        :returns: dict mapping paths to MetadataStatus objects.  Paths that
+        aren't in the database are left out.
+        """
+        if db_info is None:
+            db_info = app.db_info
+
+        rv = {}
+        paths_to_load = {}
+        for path in paths:
+            try:
+                cache_value = db_info.db.cache.get('metadata', path)
+            except KeyError:
+                cache_value = None
+            if cache_value is not None:
+                rv[path] = cache_value
+            else:
+                paths_to_load[filename_to_unicode(path)] = path
+        for chunk in util.split_values_for_sqlite(paths_to_load.keys()):
+            view = cls.make_view('path IN (%s)' % ', '.join('?' * len(chunk)),
+                                 chunk, db_info=db_info)
+            for status in view:
+                rv[paths_to_load[filename_to_unicode(status.path)]] = status
+        return rv
+
+    @classmethod
+    def get_by_fingerprints(cls, fingerprints, db_info=None):
+        """Find finished objects for a list of content fingerprints.
+
+        :returns: dict mapping fingerprints to a MetadataStatus with that
+        fingerprint that we've finished processing.  Fingerprints without a
+        match are left out.
+        """
+        rv = {}
+        for chunk in util.split_values_for_sqlite(list(set(fingerprints))):
+            view = cls.make_view('fingerprint IN (%s) AND finished_status >= ?'
+                                 % ', '.join('?' * len(chunk)),
+                                 list(chunk) + [cls.FINISHED_STATUS_VERSION],
+                                 db_info=db_info)
+            for status in view:
+                rv.setdefault(status.fingerprint, status)
+        return rv
+
     @classmethod
     def paths_for_album(cls, album, db_info=None):
         rows = cls.select(['path',],
@@ -401,6 +453,23 @@ class MetadataEntry(database.DDBObject):
                              order_by='priority ASC',
                              db_info=db_info)
 
+    @classmethod
+    def metadata_for_statuses(cls, status_ids, db_info=None):
+        """Get the enabled entries for a list of MetadataStatus ids.
+
+        :returns: dict mapping status ids to lists of MetadataEntry objects,
+        sorted by priority.
+        """
+        rv = collections.defaultdict(list)
+        for chunk in util.split_values_for_sqlite(list(status_ids)):
+            view = cls.make_view('status_id IN (%s) AND NOT disabled' %
+                                 ', '.join('?' * len(chunk)),
+                                 chunk, order_by='priority ASC',
+                                 db_info=db_info)
+            for entry in view:
+                rv[entry.status_id].append(entry)
+        return rv
+
     @classmethod
     def get_entry(cls, source, status, db_info=None):
         view = cls.make_view('source=? AND status_id=?',
@@ -1068,6 +1137,26 @@ class _ProcessingCountTracker(object):
     def file_being_processed(self, path):
         return path in self.file_types
 
+class _MetadataResultBatch(object):
+    """Tracks work for a batch of metadata results.
+
+    MetadataManagerBase uses this to handle work for all the results at once
+    after it processes each one.
+
+    :attribute new_entries: maps status ids to MetadataEntry objects created
+    for the batch
+    :attribute statuses_to_recalculate: maps paths to MetadataStatus objects
+    that we need to recalculate the full metadata for
+    :attribute created_cover_art_paths: paths whose result created cover art
+    :attribute fingerprint_matches: maps fingerprints from the mutagen results
+    to finished MetadataStatus objects with the same fingerprint
+    """
+    def __init__(self):
+        self.new_entries = collections.defaultdict(list)
+        self.statuses_to_recalculate = {}
+        self.created_cover_art_paths = []
+        self.fingerprint_matches = {}
+
 class MetadataManagerBase(signals.SignalEmitter):
     """Extract and track metadata for files.
 
@@ -1390,9 +1479,18 @@ class MetadataManagerBase(signals.SignalEmitter):
         :raises KeyError: path not in the metadata system
         """
         status = self._get_status_for_path(path)
+        entries = MetadataEntry.metadata_for_status(status, self.db_info)
+        return self._calc_metadata(status, entries)
+
+    def _calc_metadata(self, status, entries):
+        """Calculate the metadata dict for a MetadataStatus
 
-        metadata = self._get_metadata_from_filename(path)
-        for entry in MetadataEntry.metadata_for_status(status, self.db_info):
+        :param status: MetadataStatus object
+        :param entries: enabled MetadataEntry objects for status, sorted by
+        priority
+        """
+        metadata = self._get_metadata_from_filename(status.path)
+        for entry in entries:
             entry_metadata = entry.get_metadata()
             metadata.update(entry_metadata)
         metadata['has_drm'] = status.get_has_drm()
@@ -1695,15 +1793,35 @@ class MetadataManagerBase(signals.SignalEmitter):
         self._send_progress_updates()
 
     def _process_metadata_finished(self):
+        """Apply the results in metadata_finished.
+
+        We handle the results as a batch: statuses are looked up with one
+        query per chunk of paths, paths that need their full metadata
+        recalculated share one query for their entries, and we only look up
+        the other items in an album once per batch when we get new cover art.
+        """
+        if not self.metadata_finished:
+            return
+        statuses = MetadataStatus.get_by_paths(
+            [path for (processor, path, result) in self.metadata_finished],
+            self.db_info)
+        batch = _MetadataResultBatch()
+        fingerprints = [result['fingerprint']
+                        for (processor, path, result) in self.metadata_finished
+                        if 'fingerprint' in result]
+        if fingerprints:
+            batch.fingerprint_matches = MetadataStatus.get_by_fingerprints(
+                fingerprints, self.db_info)
         for (processor, path, result) in self.metadata_finished:
             try:
-                status = MetadataStatus.get_by_path(path, self.db_info)
-            except database.ObjectNotFoundError:
+                status = statuses[path]
+            except KeyError:
                 logging.warn("_process_metadata_finished -- path removed: %r",
                              path)
                 continue
             if path not in self._retry_net_lookup_entries:
-                self._process_metadata_result(status, processor, path, result)
+                self._process_metadata_result(status, processor, path, result,
+                                              batch)
             else:
                 retry_entry = self._retry_net_lookup_entries.pop(path)
                 if retry_entry.id_exists():
@@ -1716,15 +1834,29 @@ class MetadataManagerBase(signals.SignalEmitter):
                                  path)
 
         self.metadata_finished = []
+        self._update_metadata_for_batch(batch)
+        self._update_cover_art_for_batch(batch)
 
-    def _process_metadata_result(self, status, processor, path, result):
+    def _process_metadata_result(self, status, processor, path, result,
+                                 batch):
         if not status.need_metadata_for_source(processor.source_name):
             logging.warn("_process_metadata_finished -- got duplicate "
                          "metadata for %s (source: %s)", path,
                          processor.source_name)
             return
-        self._make_new_metadata_entry(status, processor, path, result)
-        self.count_tracker.file_updated(path, result)
+        # pop off fingerprint, that's stored in the status
+        fingerprint = result.pop('fingerprint', None)
+        if fingerprint is not None:
+            status.fingerprint = fingerprint
+        other_status = batch.fingerprint_matches.get(fingerprint)
+        if (other_status is not None and other_status is not status and
+            other_status.id_exists() and status.max_entry_priority < 0):
+            self._copy_metadata_from_status(status, other_status, path, batch)
+            self.count_tracker.file_updated(path, self.new_metadata[path])
+        else:
+            self._make_new_metadata_entry(status, processor, path, result,
+                                          batch)
+            self.count_tracker.file_updated(path, result)
         self.run_next_processor(status)
         if status.current_processor == u'echonest':
             self.count_tracker.file_finished_local_processing(status.path)
@@ -1736,29 +1868,91 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.count_tracker.file_finished(path)
         self.new_metadata[path].update(result)
 
-    def _make_new_metadata_entry(self, status, processor, path, result):
+    def _make_new_metadata_entry(self, status, processor, path, result,
+                                 batch):
         # pop off created_cover_art, that's for us not the MetadataEntry
         created_cover_art = result.pop('created_cover_art', False)
         entry = MetadataEntry(status, processor.source_name, result,
                               db_info=self.db_info)
+        batch.new_entries[status.id].append(entry)
         if entry.priority >= status.max_entry_priority:
             # If this entry is going to overwrite all other metadata, then
-            # we don't have to call get_metadata().  Just send the new
+            # we don't have to recalculate the metadata.  Just send the new
             # values.
             can_skip_get_metadata = True
         else:
             can_skip_get_metadata = False
         status.update_after_success(entry, result)
-        if can_skip_get_metadata:
-            self.new_metadata[path].update(result)
-        else:
-            self.new_metadata[path] = self.get_metadata(path)
-        # add cover-art-path for other items in the same album
-        if created_cover_art and 'album' in self.new_metadata[path]:
-            album = self.new_metadata[path]['album']
-            cover_art = self.new_metadata[path]['cover_art']
+        self.new_metadata[path].update(result)
+        if not can_skip_get_metadata:
+            batch.statuses_to_recalculate[path] = status
+        if created_cover_art:
+            batch.created_cover_art_paths.append(path)
+
+    def _copy_metadata_from_status(self, status, other_status, path, batch):
+        """Copy metadata from another file with the same contents.
+
+        This happens when files get moved or copied outside of Miro and we see
+        them as new paths.  Rather than running the movie data program and
+        echonest again, we clone the other file's entries.  The clones point
+        to the same screenshot and cover art files as the originals.
+        """
+        status.copy_status(other_status)
+        # copy_status() keeps our net_lookup_enabled value.  Make sure that
+        # echonest_status and current_processor match it.
+        status.set_net_lookup_enabled(status.net_lookup_enabled)
+        entries = []
+        for entry in MetadataEntry.metadata_for_status(other_status,
+                                                       self.db_info):
+            new_entry = MetadataEntry(status, entry.source,
+                                      entry.get_metadata(),
+                                      db_info=self.db_info)
+            if (new_entry.source == u'echonest' and
+                not status.net_lookup_enabled):
+                new_entry.disabled = True
+                new_entry.signal_change()
+            else:
+                entries.append(new_entry)
+        batch.new_entries[status.id].extend(entries)
+        batch.statuses_to_recalculate.pop(path, None)
+        self.new_metadata[path] = self._calc_metadata(status, entries)
+
+    def _update_metadata_for_batch(self, batch):
+        """Recalculate the full metadata for paths that need it."""
+        if not batch.statuses_to_recalculate:
+            return
+        statuses = batch.statuses_to_recalculate.values()
+        all_entries = MetadataEntry.metadata_for_statuses(
+            [status.id for status in statuses], self.db_info)
+        for status in statuses:
+            entries = all_entries[status.id]
+            # If we're inside a bulk insert, the entries that we just created
+            # haven't been saved yet, so the query won't find them.
+            entry_ids = set(entry.id for entry in entries)
+            entries.extend(entry for entry in batch.new_entries[status.id]
+                           if entry.id not in entry_ids)
+            entries.sort(key=lambda entry: entry.priority)
+            self.new_metadata[status.path] = self._calc_metadata(status,
+                                                                 entries)
+
+    def _update_cover_art_for_batch(self, batch):
+        """Add the cover art path for other items in the same album as items
+        that we created cover art for.
+        """
+        new_cover_art = {}
+        for path in batch.created_cover_art_paths:
+            metadata = self.new_metadata[path]
+            if 'album' in metadata:
+                new_cover_art[metadata['album']] = metadata['cover_art']
+        if not new_cover_art:
+            return
+        for album, cover_art in new_cover_art.items():
             for path in MetadataStatus.paths_for_album(album, self.db_info):
                 self.new_metadata[path]['cover_art'] = cover_art
+        # also handle items in this batch whose entries we haven't saved yet
+        for metadata in self.new_metadata.values():
+            if metadata.get('album') in new_cover_art:
+                metadata['cover_art'] = new_cover_art[metadata['album']]
 
     def _process_metadata_errors(self):
         for (processor, path, error) in self.metadata_errors:
@@ -1842,8 +2036,8 @@ class DeviceMetadataManager(MetadataManagerBase):
         # for devices we just use a simple count tracker
         return ProgressCountTracker()
 
-    def get_metadata(self, path):
-        metadata = MetadataManagerBase.get_metadata(self, path)
+    def _calc_metadata(self, status, entries):
+        metadata = MetadataManagerBase._calc_metadata(self, status, entries)
         # device items expect cover art and screenshots to be relative to
         # the device mount
         for key in ('cover_art', 'screenshot'):
@@ -27,12 +27,84 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import logging
 import os.path
 
+from miro import app
 from miro import download_utils
 from miro import fileutil
+from miro import prefs
+from miro import subprocessmanager
 from miro.plat.utils import run_media_metadata_extractor
 
+class MovieDataMessage(subprocessmanager.SubprocessMessage):
+    pass
+
+class ExtractMovieData(MovieDataMessage):
+    def __init__(self, movie_path, thumbnail_path):
+        self.movie_path = movie_path
+        self.thumbnail_path = thumbnail_path
+
+class MovieDataResult(subprocessmanager.SubprocessResponse):
+    def __init__(self, result):
+        self.result = result
+
+class MovieDataHandler(subprocessmanager.SubprocessHandler):
+    """Runs the movie data extractor inside the extractor process."""
+    def handle_extract_movie_data(self, msg):
+        result = run_media_metadata_extractor(msg.movie_path,
+                                              msg.thumbnail_path)
+        MovieDataResult(result).send_to_main_process()
+
+class MovieDataExtractorError(StandardError):
+    """The extractor process crashed or hung while handling a file."""
+
+class MovieDataExtractor(object):
+    """Runs the movie data extractor in a long-lived process.
+
+    Loading GStreamer (or QTKit on OS X) takes longer than running the
+    extractor on most files, so rather than loading it for each file, we keep
+    a process running and send it files one at a time.
+
+    The process gets restarted after it handles FILES_PER_PROCESS files,
+    since the media frameworks tend to leak memory.  It also gets restarted
+    if it crashes or takes more than TIMEOUT seconds for a file.  TIMEOUT is
+    shorter than the workerprocess hang check, so normally we kill a hung
+    extractor before the worker process gets restarted.
+    """
+    FILES_PER_PROCESS = 500
+    TIMEOUT = 60
+
+    def __init__(self):
+        log_root, log_ext = os.path.splitext(
+            app.config.get(prefs.HELPER_LOG_PATHNAME))
+        self.process = subprocessmanager.BlockingSubprocess(
+            MovieDataHandler, log_pathname=log_root + '-moviedata' + log_ext)
+        self.file_count = 0
+
+    def run(self, movie_path, thumbnail_path):
+        """Run the extractor on a file.
+
+        :returns: (file_type, duration, success) tuple
+        :raises MovieDataExtractorError: the extractor process failed
+        """
+        if not self.process.is_running:
+            self.file_count = 0
+        self.file_count += 1
+        try:
+            response = self.process.call(
+                ExtractMovieData(movie_path, thumbnail_path), self.TIMEOUT)
+        except subprocessmanager.SubprocessCallError, e:
+            logging.warn("movie data extractor failed for %s: %s",
+                         movie_path, e)
+            raise MovieDataExtractorError(str(e))
+        if self.file_count >= self.FILES_PER_PROCESS:
+            self.process.shutdown()
+        return response.result
+
+    def shutdown(self):
+        self.process.shutdown()
+
 def convert_mdp_result(source_path, screenshot, result):
     """Convert the movie data program result for the metadata manager
     """
@@ -78,15 +150,22 @@ def _make_screenshot_path(source_path, image_directory):
     # open is not an option.  We'll just have to live with the race condition
     return download_utils.next_free_filename(path)
 
-def process_file(source_path, image_directory):
+def process_file(source_path, image_directory, extractor=None):
     """Send a file to the movie data program.
 
     :param source_path: path to the file to process
     :param image_directory: directory to put screenshut files
+    :param extractor: MovieDataExtractor to use.  If None, we run the
+    extractor in this process.
     :returns: dictionary with metadata info
     """
     screenshot, fp = _make_screenshot_path(source_path, image_directory)
-    result = run_media_metadata_extractor(source_path, screenshot)
-    # we can close the file now, since MDP has written to it
-    fp.close()
+    try:
+        if extractor is not None:
+            result = extractor.run(source_path, screenshot)
+        else:
+            result = run_media_metadata_extractor(source_path, screenshot)
+    finally:
+        # we can close the file now, since MDP has written to it
+        fp.close()
     return convert_mdp_result(source_path, screenshot, result)
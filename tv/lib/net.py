@@ -328,7 +328,8 @@ class AsyncSocket(object):
             eventloop.remove_write_callback(self.socket)
             trap_call(self, errback, ConnectionTimeout(host))
             self.connectionErrback = None
-        eventloop.call_in_thread(onAddressLookup, handleGetAddrInfoException,
+        eventloop.call_in_thread_category('dns', onAddressLookup,
+                                 handleGetAddrInfoException,
                                  socket.getaddrinfo,
                                  "getAddrInfo - %s:%s" % (host, port),
                                  host, port)
@@ -30,32 +30,177 @@
 """``miro.playlist`` -- Miro playlist support.
 """
 
+import contextlib
 import logging
 
 from miro.gtcache import gettext as _
+from miro import app
 from miro import dialogs
 from miro import database
+from miro import eventloop
 from miro import models
 from miro.databasehelper import make_simple_get_set
 
+# Playlist positions are spaced out by POSITION_GAP.  This leaves room to
+# move items around by only changing the position of the moved items.  When
+# we run out of room, we renumber the whole playlist.
+POSITION_GAP = 1024
+
+# max number of ids to put into a single "IN (...)" clause.  SQLite limits the
+# number of variables in a statement.
+ID_CHUNK_SIZE = 500
+
+# how often to re-run compact_all_positions(), in seconds
+COMPACT_INTERVAL = 60 * 60
+
+def _chunks(ids):
+    for start in xrange(0, len(ids), ID_CHUNK_SIZE):
+        yield ids[start:start+ID_CHUNK_SIZE]
+
+@contextlib.contextmanager
+def bulk_sql():
+    """Run a block of code using app.bulk_sql_manager.
+
+    If the bulk SQL manager is already active, we let the outer block
+    finish it.  We do commit any pending inserts/removes first, since the
+    playlist code queries the DB to find existing rows.
+    """
+    if app.bulk_sql_manager.active:
+        app.bulk_sql_manager.commit()
+        yield
+    else:
+        app.bulk_sql_manager.start()
+        try:
+            yield
+        finally:
+            app.bulk_sql_manager.finish()
+
+def _longest_increasing_run(values):
+    """Find the longest increasing subsequence of values.
+
+    :returns: set of indexes into values for the subsequence
+    """
+    # tails[k] is the index of the smallest value that ends an increasing
+    # subsequence of length k+1.
+    tails = []
+    tail_values = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        # binary search for the first tail >= value
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if tail_values[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low > 0:
+            previous[i] = tails[low-1]
+        if low == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[low] = i
+            tail_values[low] = value
+    indexes = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        indexes.add(i)
+        i = previous[i]
+    return indexes
+
+def calc_new_positions(old_positions):
+    """Calculate positions for a list of rows that has been reordered.
+
+    :param old_positions: current positions of the rows, in the new order
+    :returns: list of new positions, or None if there's not enough room
+        between the rows that stay put and the whole list needs to be
+        renumbered.
+    """
+    fixed = _longest_increasing_run(old_positions)
+    new_positions = list(old_positions)
+    i = 0
+    while i < len(new_positions):
+        if i in fixed:
+            i += 1
+            continue
+        # find the run of moved rows that starts here
+        end = i
+        while end < len(new_positions) and end not in fixed:
+            end += 1
+        if i > 0:
+            lower = new_positions[i-1]
+        else:
+            lower = None
+        if end < len(new_positions):
+            upper = new_positions[end]
+        else:
+            upper = None
+        count = end - i
+        if lower is None and upper is None:
+            return None
+        elif upper is None:
+            step = POSITION_GAP
+            first = lower + step
+        elif lower is None:
+            step = POSITION_GAP
+            first = upper - step * count
+        else:
+            step = (upper - lower) // (count + 1)
+            if step < 1:
+                return None
+            first = lower + step
+        for j in xrange(count):
+            new_positions[i+j] = first + step * j
+        i = end
+    return new_positions
+
 class PlaylistItemMap(database.DDBObject):
     """Single row in the map that associates playlists with their
     child items.
     """
 
-    def setup_new(self, playlist_id, item_id):
+    def setup_new(self, playlist_id, item_id, position=None):
         self.playlist_id = playlist_id
         self.item_id = item_id
-        rows = self.select(['MAX(position+1)'], 'playlist_id=?',
+        if position is None:
+            position = self.next_position(playlist_id)
+        self.position = position
+
+    @classmethod
+    def next_position(cls, playlist_id):
+        """Get the position for an item added to the end of a playlist."""
+        rows = cls.select(['MAX(position)'], 'playlist_id=?',
                 (playlist_id,), convert=False)
-        self.position = rows[0][0]
-        if self.position is None:
-            self.position = 0
+        if rows[0][0] is None:
+            return 0
+        else:
+            return rows[0][0] + POSITION_GAP
 
     @classmethod
     def playlist_view(cls, playlist_id):
         return cls.make_view("playlist_id=?", (playlist_id,))
 
+    @classmethod
+    def ordered_playlist_view(cls, playlist_id):
+        return cls.make_view("playlist_id=?", (playlist_id,),
+                             order_by='position')
+
+    @classmethod
+    def maps_for_item_ids(cls, playlist_id, item_ids):
+        """Get the map objects for a list of item ids.
+
+        :returns: dict mapping item ids to map objects.  Items that aren't
+            in the playlist won't be included.
+        """
+        maps = {}
+        for chunk in _chunks(list(item_ids)):
+            where = 'playlist_id=? AND item_id IN (%s)' % (
+                ', '.join('?' * len(chunk)))
+            for map_ in cls.make_view(where, [playlist_id] + chunk):
+                maps[map_.item_id] = map_
+        return maps
+
     @classmethod
     def remove_item_from_playlists(cls, item):
         cls.delete('item_id=?', (item.id,))
@@ -64,10 +209,41 @@ class PlaylistItemMap(database.DDBObject):
     def add_item_id(cls, playlist_id, item_id):
         cls(playlist_id, item_id)
 
+    @classmethod
+    def add_item_ids(cls, playlist_id, item_ids):
+        """Add several items to the end of a playlist.
+
+        Callers should make sure that the items aren't already in the
+        playlist.
+        """
+        position = cls.next_position(playlist_id)
+        for item_id in item_ids:
+            cls(playlist_id, item_id, position)
+            position += POSITION_GAP
+
     @classmethod
     def remove_item_id(cls, playlist_id, item_id):
         cls.delete('playlist_id=? AND item_id=?', (playlist_id, item_id))
 
+    @classmethod
+    def remove_item_ids(cls, playlist_id, item_ids):
+        """Remove several items from a playlist.
+
+        :returns: list of item ids that were in the playlist
+        """
+        maps = cls.maps_for_item_ids(playlist_id, item_ids)
+        for map_ in maps.values():
+            map_.remove()
+        return maps.keys()
+
+    @classmethod
+    def compact_positions(cls, playlist_id):
+        """Renumber a playlist so that its positions are evenly spaced."""
+        for i, map_ in enumerate(cls.ordered_playlist_view(playlist_id)):
+            if map_.position != i * POSITION_GAP:
+                map_.position = i * POSITION_GAP
+                map_.signal_change()
+
 class PlaylistMixin:
     """Class that handles basic playlist functionality.  PlaylistMixin
     is used by both SavedPlaylist and folder.PlaylistFolder.
@@ -88,6 +264,20 @@ class PlaylistMixin:
         if folder is not None:
             folder.add_id(item_id)
 
+    def add_ids(self, item_ids):
+        """Add several items to end of the playlist.
+
+        This is much faster than calling add_id() for each item, since it
+        adds everything in a single transaction.
+        """
+        with bulk_sql():
+            self.MapClass.add_item_ids(self.id, item_ids)
+            for item_id in item_ids:
+                models.Item.get_by_id(item_id).playlists_changed(added=True)
+            folder = self.get_folder()
+            if folder is not None:
+                folder.add_ids(item_ids)
+
     def remove_id(self, item_id, signal_change=True):
         """Remove an item from the playlist."""
         try:
@@ -103,6 +293,23 @@ class PlaylistMixin:
             item = models.Item.get_by_id(item_id)
             item.playlists_changed()
 
+    def remove_ids(self, item_ids, signal_change=True):
+        """Remove several items from the playlist in a single transaction.
+
+        Items that aren't in the playlist are ignored.
+
+        :returns: list of item ids that were removed
+        """
+        with bulk_sql():
+            removed = self.MapClass.remove_item_ids(self.id, item_ids)
+            folder = self.get_folder()
+            if folder is not None:
+                folder.remove_ids(removed)
+            if signal_change:
+                for item_id in removed:
+                    models.Item.get_by_id(item_id).playlists_changed()
+        return removed
+
     def add_item(self, item):
         """Add an item to the end of the playlist"""
         return self.add_id(item.id)
@@ -116,16 +323,52 @@ class PlaylistMixin:
                 (self.id, item_id))
         return view.count() > 0
 
+    def get_item_ids(self):
+        """Get the ids for the items in the playlist, in order."""
+        return [map_.item_id for map_ in
+                self.MapClass.ordered_playlist_view(self.id)]
+
     def reorder(self, new_order):
         """reorder items in the playlist.  new_order should contain a
         list of ids one for each item in the playlist.
+
+        Only the rows for items that moved relative to the others get
+        updated.
         """
-        for i, item_id in enumerate(new_order):
-            map_ = self.MapClass.make_view('playlist_id=? AND item_id=?',
-                    (self.id, item_id)).get_singleton()
-            map_.position = i
-            map_.signal_change()
-            models.Item.playlist_reordered()
+        maps = self.MapClass.maps_for_item_ids(self.id, new_order)
+        maps = [maps[item_id] for item_id in new_order]
+        new_positions = calc_new_positions([m.position for m in maps])
+        if new_positions is None:
+            # not enough room between positions, renumber everything
+            new_positions = [i * POSITION_GAP for i in xrange(len(maps))]
+        with bulk_sql():
+            for map_, position in zip(maps, new_positions):
+                if map_.position != position:
+                    map_.position = position
+                    map_.signal_change()
+        models.Item.playlist_reordered()
+
+    def move_range(self, item_ids, before_id=None):
+        """Move items to a new spot in the playlist.
+
+        :param item_ids: items to move, in the order that they should end up
+        :param before_id: item to move them in front of, or None to move
+            them to the end of the playlist.
+        """
+        moving = set(item_ids)
+        new_order = [item_id for item_id in self.get_item_ids()
+                     if item_id not in moving]
+        if before_id is None or before_id in moving:
+            index = len(new_order)
+        else:
+            index = new_order.index(before_id)
+        new_order[index:index] = item_ids
+        self.reorder(new_order)
+
+    def compact_positions(self):
+        """Renumber our positions so that they're evenly spaced out again."""
+        with bulk_sql():
+            self.MapClass.compact_positions(self.id)
 
 class SavedPlaylist(database.DDBObject, PlaylistMixin):
     """An ordered list of videos that the user has saved.
@@ -140,8 +383,7 @@ class SavedPlaylist(database.DDBObject, PlaylistMixin):
         self.title = title
         self.folder_id = None
         if item_ids is not None:
-            for id_ in item_ids:
-                self.add_id(id_)
+            self.add_ids(item_ids)
 
     @classmethod
     def folder_view(cls, id_):
@@ -158,6 +400,17 @@ class SavedPlaylist(database.DDBObject, PlaylistMixin):
         if view.count() == 0:
             PlaylistMixin.add_id(self, item_id)
 
+    def add_ids(self, item_ids):
+        # Don't allow items to be added more than once.
+        existing = self.MapClass.maps_for_item_ids(self.id, item_ids)
+        to_add = []
+        for item_id in item_ids:
+            if item_id not in existing:
+                to_add.append(item_id)
+                existing[item_id] = None
+        if to_add:
+            PlaylistMixin.add_ids(self, to_add)
+
     get_title, set_title = make_simple_get_set('title')
 
     def get_folder(self):
@@ -222,6 +475,31 @@ class SavedPlaylist(database.DDBObject, PlaylistMixin):
         self._remove_ids_from_folder()
         database.DDBObject.remove(self)
 
+def compact_all_positions():
+    """Renumber every playlist so that positions are evenly spaced.
+
+    Moving items around uses up the space between positions, and
+    playlists created by older versions don't have any space at all.  This
+    gets run periodically to restore it.  Rows that are already in the
+    right place aren't touched.
+    """
+    with bulk_sql():
+        for playlist in SavedPlaylist.make_view():
+            playlist.MapClass.compact_positions(playlist.id)
+        for folder in models.PlaylistFolder.make_view():
+            folder.MapClass.compact_positions(folder.id)
+
+def compact_positions_periodically():
+    """Run compact_all_positions() now and then every COMPACT_INTERVAL
+    seconds.
+    """
+    try:
+        compact_all_positions()
+    finally:
+        eventloop.add_timeout(COMPACT_INTERVAL,
+                              compact_positions_periodically,
+                              "compact playlist positions")
+
 def fix_missing_item_ids():
     for map_ in PlaylistItemMap.make_view("item_id NOT IN "
                                           "(SELECT id FROM item)"):
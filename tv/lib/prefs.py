@@ -118,6 +118,17 @@ SUBTITLE_FONT               = Pref(key='subtitleFont',          default=None,  p
 # language setting: "system" uses system default; all other languages are overrides
 LANGUAGE                    = Pref(key='language',              default="system", platformSpecific=False)
 MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=1, platformSpecific=False)
+# shrink downloaded icons to the largest size the frontend displays them at
+DOWNSCALE_ICONS             = Pref(key='downscaleIcons',        default=False, platformSpecific=False)
+# Group commit: keep database transactions open across event loop callbacks
+# for up to DB_GROUP_COMMIT_TIME seconds or DB_GROUP_COMMIT_STATEMENTS
+# statements.  This saves a lot of commits and fsyncs, but changes made in the
+# last DB_GROUP_COMMIT_TIME seconds can be lost if we crash.  The database
+# itself stays consistent.  0 means commit after every callback.
+DB_GROUP_COMMIT_TIME        = Pref(key='dbGroupCommitTime',     default=0,     platformSpecific=False)
+DB_GROUP_COMMIT_STATEMENTS  = Pref(key='dbGroupCommitStatements', default=1000, platformSpecific=False)
+# sort, filter and group item lists in memory instead of querying the database
+ITEM_LIST_COLUMN_INDEX      = Pref(key='itemListColumnIndex',   default=False, platformSpecific=False)
 SHOW_UNKNOWN_DEVICES        = Pref(key='showUnknownDevices',    default=False, platformSpecific=False)
 SHARE_MEDIA                 = Pref(key='ShareMedia',            default=False, platformSpecific=False)
 SHARE_DISCOVERABLE          = Pref(key='ShareDiscoverable',     default=True, platformSpecific=False)
@@ -399,6 +399,7 @@ class IconCacheSchema (DDBObjectSchema):
         ('modified', SchemaString(noneOk=True)),
         ('filename', SchemaFilename(noneOk=True)),
         ('url', SchemaURL(noneOk=True)),
+        ('last_checked', SchemaDateTime(noneOk=True)),
         ]
 
 class ItemSchema(MultiClassObjectSchema):
@@ -949,10 +950,12 @@ class MetadataStatusSchema(DDBObjectSchema):
         ('net_lookup_enabled', SchemaBool()),
         ('mutagen_thinks_drm', SchemaBool()),
         ('max_entry_priority', SchemaInt()),
+        ('fingerprint', SchemaString(noneOk=True)),
     ]
 
     indexes = (
         ('metadata_finished', ('finished_status',)),
+        ('metadata_fingerprint', ('fingerprint',)),
     )
 
     unique_indexes = (
@@ -996,7 +999,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 195
+VERSION = 197
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
@@ -27,6 +27,7 @@
 # statement from all source files in the program, then also delete it here.
 
 import errno
+import itertools
 import logging
 import os
 import sys
@@ -125,6 +126,8 @@ class Share(object):
         self.db_info = database.DBInfo(self.db)
         self.__class__._used_db_paths.add(self.db_path)
         self.tracker = None
+        # _ShareCache saved from our last connection to the share
+        self.cache = None
         # SharingInfo object for this share.  We use this to send updates to
         # the frontend when things change.
         self.info = None
@@ -192,16 +195,22 @@ class Share(object):
 
     def stop_tracking(self):
         if self.tracker is not None:
+            # Keep our items around if we can ask the server for only the
+            # changes when we reconnect.
+            self.cache = self.tracker.make_cache()
             self.tracker.client_disconnect()
             self.tracker = None
-            self.reset_database()
+            if self.cache is None:
+                self.reset_database()
             if self.info:
                 self.info.is_updating = False
                 self.info.mount = False
                 self.send_tabs_changed()
 
     def reset_database(self):
+        self.cache = None
         SharingItem.delete(db_info=self.db_info)
+        mappings.SharingItemPlaylistMap(self.db.connection).clear()
         self.db.forget_all_objects()
         self.db.cache.clear_all()
 
@@ -291,10 +300,11 @@ class SharingTracker(object):
                 raise IOError('test connect failed')
             client.disconnect()
 
-        eventloop.call_in_thread(success,
-                                 failure,
-                                 testconnect,
-                                 'DAAP test connect')
+        eventloop.call_in_thread_category('sharing',
+                                          success,
+                                          failure,
+                                          testconnect,
+                                          'DAAP test connect')
 
     def mdns_callback_backend(self, added, fullname, host, port):
         # SAFE: the shared name should be unique.  (Or else you could not
@@ -552,6 +562,8 @@ class _ClientUpdateResult(object):
         playlist_deleted_items - dictionary tracking items deleted from
                                  playlists.  Maps playlist ids to a list of
                                  item ids.
+        db_key - (id, name) tuple for the DAAP database on the server
+        revision - server revision that this result brings us up to
     """
     def __init__(self, client, update=False):
         self.update = update
@@ -564,6 +576,8 @@ class _ClientUpdateResult(object):
         self.playlist_deleted_items = {}
 
         self.fetch_from_client(client)
+        self.db_key = (client.db_id, client.db_name)
+        self.revision = client.revision
 
     def strip_nuls_from_data(self, data_list):
         """Strip nul characters from items/playlist data
@@ -621,6 +635,34 @@ class _ClientUpdateResult(object):
         self.playlist_items[playlist_key] = items.keys()
         self.playlist_deleted_items[playlist_key] = deleted
 
+class _ShareCache(object):
+    """Data that we keep for a share after disconnecting from it.
+
+    When we disconnect, Share keeps its database and one of these objects
+    around.  If we reconnect to the same DAAP database, we can ask the server
+    for only the changes since the last revision we saw, rather than
+    downloading the entire library again.
+
+    Attributes:
+        db_key - (id, name) tuple for the DAAP database on the server
+        revision - last server revision that we got data for
+        playlist_tracker - _ClientPlaylistTracker for the share
+    """
+    def __init__(self, db_key, revision, playlist_tracker):
+        self.db_key = db_key
+        self.revision = revision
+        self.playlist_tracker = playlist_tracker
+
+    def can_update_from(self, db_key, revision):
+        """Can we use this cache for a connection?
+
+        :param db_key: db_key for the database on the server
+        :param revision: current revision of the server
+        """
+        # If the server's revision is less than ours, then the server has
+        # restarted since we saw it.
+        return db_key == self.db_key and revision >= self.revision
+
 class _ClientPlaylistTracker(object):
     """Tracks playlist data from the DAAP client for SharingItemTrackerImpl
 
@@ -728,15 +770,34 @@ class SharingItemTrackerImpl(object):
         'com.apple.itunes.episode-sort': 'episode_number'
     }
 
+    # How many items to create/update/remove in a single bulk transaction
+    IMPORT_CHUNK_SIZE = 500
+
     def __init__(self, share):
         self.client = None
         self.share = share
         self.playlist_item_map = mappings.SharingItemPlaylistMap(
             share.db_info.db.connection)
-        self.current_item_ids = set()
+        # maps DAAP ids to SharingItems
+        self.items = {}
         self.current_playlist_ids = set()
-        self.playlist_tracker = _ClientPlaylistTracker()
         self.info_cache = dict()
+        self.db_key = self.revision = None
+        self.supports_update = False
+        # Take over the cached data from our last connection.
+        # cached_formats maps DAAP ids to file formats for the cached items,
+        # we use it in the client thread to get new paths for them.
+        self.cache = share.cache
+        share.cache = None
+        self.cached_formats = {}
+        if self.cache is not None:
+            self.playlist_tracker = self.cache.playlist_tracker
+            for sharing_item in SharingItem.make_view(db_info=share.db_info):
+                self.items[sharing_item.daap_id] = sharing_item
+                self.cached_formats[sharing_item.daap_id] = (
+                    sharing_item.file_format)
+        else:
+            self.playlist_tracker = _ClientPlaylistTracker()
         self.share.update_started()
         self.start_thread()
 
@@ -832,15 +893,63 @@ class SharingItemTrackerImpl(object):
     def get_item_path(self, result, daap_id):
         return unicode(result.item_paths[daap_id])
 
-    def make_sharing_item(self, rawitem, result):
-        kwargs = self.convert_raw_sharing_item(rawitem, result)
-        kwargs['host'] = unicode(self.client.host)
-        kwargs['port'] = self.client.port
-        kwargs['address'] = unicode(self.address)
-        return SharingItem(self.share, **kwargs)
+    def make_sharing_item(self, item_data):
+        return SharingItem(self.share, **item_data)
 
-    def get_sharing_item(self, daap_id):
-        return SharingItem.get_by_daap_id(daap_id, db_info=self.share.db_info)
+    def update_sharing_item(self, sharing_item, item_data):
+        """Update a SharingItem with data from the server.
+
+        Only the attributes whose values changed are set, and we only call
+        signal_change() if there was a change.
+        """
+        changed = False
+        for key, value in item_data.iteritems():
+            if getattr(sharing_item, key, None) != value:
+                setattr(sharing_item, key, value)
+                changed = True
+        if changed:
+            sharing_item.signal_change()
+
+    def iter_item_data(self, result):
+        """Iterate through the item data for a client result.
+
+        :returns: iterator yielding (daap_id, item_data) tuples.  item_data
+        is a dict of SharingItem attributes.
+        """
+        location = {
+            'host': unicode(self.client.host),
+            'port': self.client.port,
+            'address': unicode(self.address),
+        }
+        for daap_id, rawitem in result.items.iteritems():
+            item_data = self.convert_raw_sharing_item(rawitem, result)
+            item_data.update(location)
+            yield daap_id, item_data
+        # Items cached from a previous connection that the server didn't send.
+        # Their paths include the session id, so they still need updating.
+        for daap_id in result.item_paths:
+            if daap_id not in result.items:
+                item_data = {'video_path': self.get_item_path(result, daap_id)}
+                item_data.update(location)
+                yield daap_id, item_data
+
+    def iter_chunks(self, iterable):
+        """Split up an iterable into lists of IMPORT_CHUNK_SIZE values."""
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, self.IMPORT_CHUNK_SIZE))
+            if not chunk:
+                return
+            yield chunk
+
+    def make_cache(self):
+        """Make a _ShareCache to use when we reconnect.
+
+        :returns: _ShareCache or None if the server doesn't support updates
+        """
+        if not self.supports_update or self.db_key is None:
+            return None
+        return _ShareCache(self.db_key, self.revision, self.playlist_tracker)
 
     def make_playlist_sharing_info(self, daap_id, playlist_data):
         return messages.SharingPlaylistInfo(
@@ -852,10 +961,12 @@ class SharingItemTrackerImpl(object):
     def client_disconnect(self):
         client = self.client
         self.client = None
-        eventloop.call_in_thread(self.client_disconnect_callback,
-                                 self.client_disconnect_error_callback,
-                                 client.disconnect,
-                                 'DAAP client connect')
+        eventloop.call_in_thread_category(
+            'sharing',
+            self.client_disconnect_callback,
+            self.client_disconnect_error_callback,
+            client.disconnect,
+            'DAAP client connect')
 
     def client_disconnect_error_callback(self, unused):
         self.client_disconnect_callback_common()
@@ -870,7 +981,27 @@ class SharingItemTrackerImpl(object):
 
     def client_connect(self):
         self.make_client()
-        result = _ClientUpdateResult(self.client)
+        if self.cache is not None and self.client.supports_update:
+            if not self.client.databases(update=False):
+                raise IOError('Cannot get database')
+            db_key = (self.client.db_id, self.client.db_name)
+            if self.cache.can_update_from(db_key, self.client.revision):
+                return self.client_connect_from_cache()
+        return _ClientUpdateResult(self.client)
+
+    def client_connect_from_cache(self):
+        """Connect to the server and only fetch the changes since the
+        revision in our cache.
+        """
+        self.client.old_revision = self.cache.revision
+        result = _ClientUpdateResult(self.client, update=True)
+        # Get new paths for the items the server didn't send.  They contain
+        # the session id, so they're different for every connection.
+        deleted_items = set(result.deleted_items)
+        for daap_id, file_format in self.cached_formats.iteritems():
+            if daap_id not in result.items and daap_id not in deleted_items:
+                result.item_paths[daap_id] = (
+                    self.client.daap_get_file_request(daap_id, file_format))
         return result
 
     def make_client(self):
@@ -889,6 +1020,7 @@ class SharingItemTrackerImpl(object):
         # Lousy Windows and Python API.
         address, port = self.client.conn.sock.getpeername()
         self.address = address
+        self.supports_update = self.client.supports_update
 
     def client_update(self):
         logging.debug('CLIENT UPDATE')
@@ -900,43 +1032,66 @@ class SharingItemTrackerImpl(object):
         logging.debug('CLIENT UPDATE CALLBACK')
         self.update_sharing_items(result)
         self.update_playlists(result)
+        self.revision = result.revision
 
     def client_update_error_callback(self, unused):
         self.client_connect_update_error_callback(unused, update=True)
 
     # NB: this runs in the eventloop (backend) thread.
     def client_connect_callback(self, result):
-        # ignore deleted items for the first run
-        result.deleted_items = []
-        result.deleted_playlists = []
-        result.playlist_deleted_items = {}
+        if not result.update:
+            # We got the full listing from the server, so there's nothing to
+            # delete, except for cached items that the server didn't send.
+            result.deleted_items = [daap_id for daap_id in self.items
+                                    if daap_id not in result.items]
+            result.deleted_playlists = []
+            result.playlist_deleted_items = {}
+            if self.cache is not None:
+                self.playlist_item_map.clear()
+                self.playlist_tracker = _ClientPlaylistTracker()
+        self.cache = self.cached_formats = None
+        self.db_key = result.db_key
         self.update_sharing_items(result)
         self.update_playlists(result)
+        self.revision = result.revision
         self.share.update_finished()
 
     def update_sharing_items(self, result):
         """Create or update SharingItems on the database.
 
-        :param new_item_data: _ClientUpdateResult
+        We work in chunks of IMPORT_CHUNK_SIZE items using the share's
+        BulkSQLManager, so that each chunk is a single transaction.  Items
+        whose data hasn't changed are left alone.
+
+        :param result: _ClientUpdateResult
         """
-        for daap_id, item_data in result.items.items():
-            if daap_id not in self.current_item_ids:
-                self.make_sharing_item(item_data, result)
-                self.current_item_ids.add(daap_id)
-            else:
-                sharing_item = self.get_sharing_item(daap_id)
-                new_data = self.convert_raw_sharing_item(item_data, result)
-                for key, value in new_data.items():
-                    setattr(sharing_item, key, value)
-                sharing_item.signal_change()
-        for item_id in result.deleted_items:
+        bulk_sql_manager = self.share.db_info.bulk_sql_manager
+        for chunk in self.iter_chunks(self.iter_item_data(result)):
+            bulk_sql_manager.start()
+            try:
+                for daap_id, item_data in chunk:
+                    if daap_id not in self.items:
+                        self.items[daap_id] = self.make_sharing_item(item_data)
+                    else:
+                        self.update_sharing_item(self.items[daap_id],
+                                                 item_data)
+            finally:
+                bulk_sql_manager.finish()
+
+        for chunk in self.iter_chunks(result.deleted_items):
+            bulk_sql_manager.start()
             try:
-                sharing_item = SharingItem.get_by_daap_id(
-                    item_id, db_info=self.share.db_info)
-            except database.ObjectNotFound:
-                logging.warn("SharingItemTrackerImpl.update_sharing_items: "
-                             "deleted item not found: %s", item_id)
-            sharing_item.remove()
+                for daap_id in chunk:
+                    try:
+                        sharing_item = self.items.pop(daap_id)
+                    except KeyError:
+                        logging.warn("SharingItemTrackerImpl."
+                                     "update_sharing_items: deleted item "
+                                     "not found: %s", daap_id)
+                        continue
+                    sharing_item.remove()
+            finally:
+                bulk_sql_manager.finish()
 
     def update_playlists(self, result):
         added = []
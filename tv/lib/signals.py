@@ -137,15 +137,26 @@ class CallbackSet(object):
     def __len__(self):
         return len(self.callbacks) + len(self.callbacks_after)
 
+# maps tuples of signal names to themselves.  Used to share signal name tuples
+# between SignalEmitters with the same signals.
+_signal_name_tuples = {}
+
+def _intern_signal_names(signal_names):
+    return _signal_name_tuples.setdefault(signal_names, signal_names)
+
 class SignalEmitter(object):
+    # Many SignalEmitters (for example DDBObjects) never get anything
+    # connected to them, so we wait until we need to before creating
+    # per-instance callback data.  Until then these class attributes are
+    # used.
+    signal_callbacks = None
+    id_generator = None
+    _currently_emitting = None
+    _okay_to_nest = frozenset()
+    _frozen = False
+
     def __init__(self, *signal_names):
-        self.signal_callbacks = {}
-        self.id_generator = itertools.count()
-        self._currently_emitting = set()
-        self._okay_to_nest = set()
-        self._frozen = False
-        for name in signal_names:
-            self.create_signal(name)
+        self._signal_names = _intern_signal_names(signal_names)
 
     def freeze_signals(self):
         self._frozen = True
@@ -154,20 +165,37 @@ class SignalEmitter(object):
         self._frozen = False
 
     def create_signal(self, name, okay_to_nest=False):
-        if name in self.signal_callbacks:
+        if name in self._signal_names:
             raise KeyError("%s was already created" % name)
-        self.signal_callbacks[name] = CallbackSet()
+        self._signal_names = _intern_signal_names(self._signal_names +
+                                                  (name,))
         if okay_to_nest:
-            self._okay_to_nest.add(name)
+            self._okay_to_nest = self._okay_to_nest.union([name])
 
     def get_callbacks(self, signal_name):
-        try:
-            return self.signal_callbacks[signal_name]
-        except KeyError:
+        callbacks = self._get_existing_callbacks(signal_name)
+        if callbacks is None:
+            if self.signal_callbacks is None:
+                self.signal_callbacks = {}
+                self.id_generator = itertools.count()
+            callbacks = self.signal_callbacks[signal_name] = CallbackSet()
+        return callbacks
+
+    def _get_existing_callbacks(self, signal_name):
+        """Like get_callbacks(), but return None rather than creating a
+        CallbackSet if nothing has been connected to the signal yet.
+        """
+        if signal_name not in self._signal_names:
             raise KeyError("Signal: %s doesn't exist" % signal_name)
+        if self.signal_callbacks is None:
+            return None
+        return self.signal_callbacks.get(signal_name)
 
     def _check_already_connected(self, name, func):
-        for callback in self.get_callbacks(name).all_callbacks():
+        callbacks = self._get_existing_callbacks(name)
+        if callbacks is None:
+            return
+        for callback in callbacks.all_callbacks():
             if callback.compare_function(func):
                 raise ValueError("signal %s already connected to %s" %
                         (name, func))
@@ -180,8 +208,8 @@ class SignalEmitter(object):
         raised.
         """
         self._check_already_connected(name, func)
-        id_ = self.id_generator.next()
         callbacks = self.get_callbacks(name)
+        id_ = self.id_generator.next()
         callbacks.add_callback(id_, Callback(func, extra_args))
         return (name, id_)
 
@@ -192,8 +220,8 @@ class SignalEmitter(object):
         connect() then the ones connected with connect_after()
         """
         self._check_already_connected(name, func)
-        id_ = self.id_generator.next()
         callbacks = self.get_callbacks(name)
+        id_ = self.id_generator.next()
         callbacks.add_callback_after(id_, Callback(func, extra_args))
         return (name, id_)
 
@@ -208,8 +236,8 @@ class SignalEmitter(object):
         self._check_already_connected(name, method)
         if not hasattr(method, 'im_self'):
             raise TypeError("connect_weak must be called with object methods")
-        id_ = self.id_generator.next()
         callbacks = self.get_callbacks(name)
+        id_ = self.id_generator.next()
         callbacks.add_callback(id_, WeakCallback(method, extra_args))
         return (name, id_)
 
@@ -217,25 +245,34 @@ class SignalEmitter(object):
         """Disconnect a signal.  callback_handle must be the return value from
         connect() or connect_weak().
         """
-        callbacks = self.get_callbacks(callback_handle[0])
+        callbacks = self._get_existing_callbacks(callback_handle[0])
+        if callbacks is None:
+            logging.warning(
+                "disconnect called but callback_handle not in the callback")
+            return
         callbacks.remove_callback(callback_handle[1])
 
     def disconnect_all(self):
-        for signal in self.signal_callbacks:
-            self.signal_callbacks[signal] = CallbackSet()
+        if self.signal_callbacks is not None:
+            # keep id_generator around so that old callback handles don't
+            # match new callbacks
+            self.signal_callbacks = {}
 
     def emit(self, name, *args):
         if self._frozen:
             return
         if name not in self._okay_to_nest:
-            if name in self._currently_emitting:
+            if self._currently_emitting is None:
+                self._currently_emitting = set()
+            elif name in self._currently_emitting:
                 raise NestedSignalError("Can't emit %s while handling %s" %
                         (name, name))
             self._currently_emitting.add(name)
         try:
             callback_returned_true = self._run_signal(name, args)
         finally:
-            self._currently_emitting.discard(name)
+            if self._currently_emitting is not None:
+                self._currently_emitting.discard(name)
             self.clear_old_weak_references()
         return callback_returned_true
 
@@ -249,15 +286,18 @@ class SignalEmitter(object):
             if self_callback(*args):
                 callback_returned_true = True
         if not callback_returned_true:
-            for callback in self.get_callbacks(name).all_callbacks():
-                if callback.invoke(self, args):
-                    callback_returned_true = True
-                    break
+            callbacks = self._get_existing_callbacks(name)
+            if callbacks is not None:
+                for callback in callbacks.all_callbacks():
+                    if callback.invoke(self, args):
+                        callback_returned_true = True
+                        break
         return callback_returned_true
 
     def clear_old_weak_references(self):
-        for callback_set in self.signal_callbacks.values():
-            callback_set.clear_old_weak_references()
+        if self.signal_callbacks is not None:
+            for callback_set in self.signal_callbacks.values():
+                callback_set.clear_old_weak_references()
 
 class SystemSignals(SignalEmitter):
     """System wide signals for Miro.  These can be accessed from the singleton
@@ -253,6 +253,8 @@ def startup():
     logging.info("Reading HTTP Password list")
     httpauth.init()
     httpauth.restore_from_file()
+    logging.info("Reading redirect cache")
+    httpclient.restore_redirect_cache()
     logging.info("Starting libCURL thread")
     httpclient.init_libcurl()
     httpclient.start_thread()
@@ -278,6 +280,8 @@ def finish_startup(obj, thread):
     logging.info("Restoring database...")
     start = time.time()
     app.db = storedatabase.LiveStorage()
+    app.db.set_group_commit(app.config.get(prefs.DB_GROUP_COMMIT_TIME),
+                            app.config.get(prefs.DB_GROUP_COMMIT_STATEMENTS))
     try:
         app.db.upgrade_database()
     except databaseupgrade.DatabaseTooNewError:
@@ -459,6 +463,8 @@ def on_frontend_started():
     eventloop.add_timeout(60, item.update_incomplete_metadata,
             "update metadata data")
     eventloop.add_timeout(90, clear_icon_cache_orphans, "clear orphans")
+    eventloop.add_timeout(120, playlist.compact_positions_periodically,
+            "compact playlist positions")
 
 def setup_global_feeds():
     setup_global_feed(u'dtv:manualFeed', initiallyAutoDownloadable=False)
@@ -554,6 +560,12 @@ def _get_theme_history():
     else:
         return theme.ThemeHistory()
 
+# dtv_variables key that stores the state of the icon cache at the end of
+# the last orphan sweep
+ICON_CACHE_SWEEP_KEY = 'icon_cache_sweep'
+# number of orphaned icon files to delete in a single thread pool call
+ICON_CACHE_DELETE_BATCH_SIZE = 500
+
 @eventloop.idle_iterator
 def clear_icon_cache_orphans():
     # delete icon_cache rows from the database with no associated
@@ -576,27 +588,83 @@ def clear_icon_cache_orphans():
     if not os.path.isdir(cachedir):
         return
 
-    existingFiles = [os.path.normcase(os.path.join(cachedir, f))
-            for f in os.listdir(cachedir)]
+    start_time = time.time()
+    known_icons = set(os.path.normcase(fileutil.expand_filename(path))
+                      for path in iconcache.IconCache.all_filenames())
     yield None
 
-    knownIcons = iconcache.IconCache.all_filenames()
-    yield None
+    # Skip the sweep if neither the icon_cache rows nor the directory
+    # changed since the last one.
+    try:
+        last_marker = app.db.get_variable(ICON_CACHE_SWEEP_KEY)
+    except KeyError:
+        last_marker = None
+    if _icon_cache_sweep_marker(cachedir, known_icons) == last_marker:
+        logging.debug("icon cache unchanged since last sweep")
+        return
 
-    knownIcons = [ os.path.normcase(fileutil.expand_filename(path)) for path in
-            knownIcons]
-    yield None
+    _IconCacheSweep(cachedir, known_icons, start_time).start()
 
-    for filename in existingFiles:
-        if (os.path.exists(filename)
-                and os.path.basename(filename)[0] != '.'
-                and os.path.basename(filename) != 'extracted'
-                and not filename in knownIcons):
-            try:
-                os.remove(filename)
-            except OSError:
-                pass
-        yield None
+def _icon_cache_sweep_marker(cachedir, known_icons):
+    try:
+        mtime = os.stat(cachedir).st_mtime
+    except OSError:
+        mtime = None
+    return (mtime, hash(frozenset(known_icons)))
+
+class _IconCacheSweep(object):
+    """Removes files that no IconCache uses from the icon cache directory.
+
+    Listing the directory and deleting files happens in the thread pool.
+    Files are deleted in batches so that we don't tie up a thread pool
+    thread for too long.
+    """
+    def __init__(self, cachedir, known_icons, start_time):
+        self.cachedir = cachedir
+        self.known_icons = known_icons
+        self.start_time = start_time
+        self.removed_count = 0
+        self.removed_size = 0
+
+    def start(self):
+        eventloop.call_in_thread_category('filesystem',
+                                          self.on_list, self.on_error,
+                                          iconcache.find_orphaned_files,
+                                          "Find icon cache orphans",
+                                          self.cachedir, self.known_icons,
+                                          self.start_time)
+
+    def on_list(self, orphans):
+        self.orphans = orphans
+        self.remove_next_batch()
+
+    def remove_next_batch(self):
+        if not self.orphans:
+            self.finished()
+            return
+        batch = self.orphans[:ICON_CACHE_DELETE_BATCH_SIZE]
+        del self.orphans[:ICON_CACHE_DELETE_BATCH_SIZE]
+        eventloop.call_in_thread_category('filesystem',
+                                          self.on_batch_removed,
+                                          self.on_error,
+                                          iconcache.remove_orphaned_files,
+                                          "Remove icon cache orphans", batch)
+
+    def on_batch_removed(self, result):
+        self.removed_count += result[0]
+        self.removed_size += result[1]
+        self.remove_next_batch()
+
+    def on_error(self, error):
+        logging.warn("error clearing icon cache orphans: %s", error)
+
+    def finished(self):
+        app.db.set_variable(ICON_CACHE_SWEEP_KEY,
+                            _icon_cache_sweep_marker(self.cachedir,
+                                                     self.known_icons))
+        logging.info("icon cache sweep: removed %d files (%d bytes) "
+                     "in %0.1f seconds", self.removed_count,
+                     self.removed_size, time.time() - self.start_time)
 
 def send_startup_crash_report(report):
     logging.info("Startup failed, waiting to send crash report")
@@ -56,6 +56,7 @@ import traceback
 import time
 import os
 import sys
+import tempfile
 from cStringIO import StringIO
 
 try:
@@ -174,6 +175,131 @@ class DatabaseObjectCache(object):
         """Clear all objects in the cache"""
         self._objects = {}
 
+class _SpilledBuffer(object):
+    """Stores a buffer value in TransactionReplayLog's temporary file.
+
+    buffer objects can't be pickled, so we convert them to this.
+    """
+    def __init__(self, data):
+        self.data = data
+
+def _encode_spilled_values(values):
+    return tuple(_SpilledBuffer(str(v)) if isinstance(v, buffer) else v
+                 for v in values)
+
+def _decode_spilled_values(values):
+    return tuple(buffer(v.data) if isinstance(v, _SpilledBuffer) else v
+                 for v in values)
+
+class TransactionReplayLog(object):
+    """Log of the update statements run in the current transaction.
+
+    LiveStorage uses this to re-run the transaction after an error.  It
+    works like a list of (sql, values, many) tuples, but to keep memory
+    usage bounded during big bulk inserts, once the statements hold more than
+    MEMORY_LIMIT values, we pickle them to a temporary file.
+    """
+
+    # max number of values to keep in memory before spilling to disk
+    MEMORY_LIMIT = 20000
+
+    def __init__(self):
+        self._statements = []
+        self._memory_values = 0
+        self._file = None
+        # offsets of each statement in _file
+        self._file_offsets = []
+        # stats for instrumentation
+        self.peak_memory_values = 0
+        self.spill_count = 0
+
+    def __len__(self):
+        return len(self._file_offsets) + len(self._statements)
+
+    def __iter__(self):
+        if self._file_offsets:
+            self._file.seek(0)
+            for i in xrange(len(self._file_offsets)):
+                sql, values, many = cPickle.load(self._file)
+                if many:
+                    values = [_decode_spilled_values(v) for v in values]
+                else:
+                    values = _decode_spilled_values(values)
+                yield (sql, values, many)
+            self._file.seek(0, os.SEEK_END)
+        for statement in self._statements:
+            yield statement
+
+    def append(self, statement):
+        sql, values, many = statement
+        self._statements.append(statement)
+        if many:
+            self._memory_values += sum(len(v) for v in values)
+        else:
+            self._memory_values += len(values)
+        self.peak_memory_values = max(self.peak_memory_values,
+                                      self._memory_values)
+        if self._memory_values > self.MEMORY_LIMIT:
+            self._spill()
+
+    def _spill(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='miro-replay-log-')
+            self.spill_count += 1
+        # __iter__() may have left the file position in the middle
+        self._file.seek(0, os.SEEK_END)
+        for sql, values, many in self._statements:
+            if many:
+                values = [_encode_spilled_values(v) for v in values]
+            else:
+                values = _encode_spilled_values(values)
+            self._file_offsets.append(self._file.tell())
+            cPickle.dump((sql, values, many), self._file,
+                         cPickle.HIGHEST_PROTOCOL)
+        self._statements = []
+        self._memory_values = 0
+
+    def truncate(self, length):
+        """Remove statements from the end of the log so it's length long."""
+        file_count = len(self._file_offsets)
+        if length >= file_count:
+            del self._statements[length - file_count:]
+            self._memory_values = self._count_memory_values()
+        else:
+            self._file.truncate(self._file_offsets[length])
+            self._file.seek(0, os.SEEK_END)
+            del self._file_offsets[length:]
+            self._statements = []
+            self._memory_values = 0
+
+    def _count_memory_values(self):
+        count = 0
+        for sql, values, many in self._statements:
+            if many:
+                count += sum(len(v) for v in values)
+            else:
+                count += len(values)
+        return count
+
+    def clear(self):
+        """Remove all statements from the log."""
+        self._statements = []
+        self._memory_values = 0
+        self._file_offsets = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def memory_values(self):
+        """Get the number of values that we're holding in memory."""
+        return self._memory_values
+
+    def spilled_bytes(self):
+        """Get the size of our temporary file."""
+        if self._file is None:
+            return 0
+        return self._file.tell()
+
 class LiveStorageErrorHandler(object):
     """Handle database errors for LiveStorage.
     """
@@ -442,7 +568,19 @@ class LiveStorage(signals.SignalEmitter):
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
-        self._statements_in_transaction = []
+        self._statements_in_transaction = TransactionReplayLog()
+        # group commit state, see set_group_commit()
+        self._group_commit_time = 0
+        self._group_commit_statements = 0
+        self._transaction_start_time = None
+        # index in _statements_in_transaction where the statements for the
+        # current event loop callback start
+        self._callback_start_index = 0
+        self._in_callback_savepoint = False
+        self._commit_requested = False
+        self._group_commit_timeout = None
+        # number of COMMITs we've run, used to measure group commit
+        self.commit_count = 0
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -549,14 +687,100 @@ class LiveStorage(signals.SignalEmitter):
             logging.warn("Sucessfully wrote database to %s.  Changes "
                          "will now be saved as normal.", self.path)
 
-    def _copy_data_to_path(self, new_path):
-        """Copy the contents of our database to a new file.  """
+    def _copy_data_to_path(self, new_path, progress_callback=None):
+        """Copy the contents of our database to a new file.
+
+        If our database is stored in a file, we copy the file directly,
+        otherwise we copy the data table by table using SQL.
+
+        :param new_path: path to copy to
+        :param progress_callback: function to call with (copied_bytes,
+            total_bytes) while copying the file
+        """
         self.finish_transaction()
-        # add the database at new_path to our current connection
         self._ensure_database_directory_exists(new_path)
         # delete any data currently at new_path
         if os.path.exists(new_path):
             os.remove(new_path)
+        db_file = self._get_database_file()
+        if db_file is not None and self._checkpoint_wal():
+            self._copy_database_file(db_file, new_path, progress_callback)
+        else:
+            self._copy_data_with_sql(new_path)
+
+    def _get_database_file(self):
+        """Get the path to the file for our main database.
+
+        :returns: path of the file or None if we're using an in-memory
+            database
+        """
+        if self.temp_mode:
+            return None
+        self.cursor.execute("PRAGMA database_list")
+        for seq, name, path in self.cursor.fetchall():
+            if name == 'main':
+                if path:
+                    return path
+                return None
+        return None
+
+    def _checkpoint_wal(self):
+        """Write all the changes in the WAL file back to the database file
+
+        After this the database file contains all of the committed data, so
+        it's safe to copy it with a simple file copy.
+
+        :returns: True if the checkpoint completed
+        """
+        try:
+            self.cursor.execute("PRAGMA wal_checkpoint(FULL)")
+            busy, log_frames, checkpointed_frames = self.cursor.fetchone()
+        except sqlite3.DatabaseError, e:
+            logging.warn("error running PRAGMA wal_checkpoint: %s", e)
+            return False
+        # If we're not in WAL mode, log_frames and checkpointed_frames are
+        # both -1
+        if busy or log_frames != checkpointed_frames:
+            logging.info("WAL checkpoint incomplete (busy: %s, frames: %s, "
+                         "checkpointed: %s)", busy, log_frames,
+                         checkpointed_frames)
+            return False
+        return True
+
+    def _copy_database_file(self, db_file, new_path, progress_callback):
+        """Copy our database file to new_path.
+
+        _checkpoint_wal() must be called before this.  We don't write to the
+        database while copying, so we get a consistent snapshot.
+        """
+        start = time.time()
+        total_bytes = os.path.getsize(db_file)
+        if fileutil.clone_file(db_file, new_path):
+            method = 'clone'
+            if progress_callback is not None:
+                progress_callback(total_bytes, total_bytes)
+        else:
+            method = 'copy'
+            copied_bytes = 0
+            last_percent = 0
+            for count in fileutil.copy_with_progress(db_file, new_path,
+                                                     block_size=1024*1024):
+                copied_bytes += count
+                # only report progress for every percent that we copy
+                percent = copied_bytes * 100 // total_bytes
+                if progress_callback is not None and percent != last_percent:
+                    progress_callback(copied_bytes, total_bytes)
+                    last_percent = percent
+        logging.timing("database %s to %s: %d bytes in %0.3f secs", method,
+                       new_path, total_bytes, time.time() - start)
+
+    def _copy_data_with_sql(self, new_path):
+        """Copy our database to new_path using SQL statements.
+
+        This is used when we're using an in-memory database, or when we can't
+        copy the database file directly.
+        """
+        # add the database at new_path to our current connection
         self.cursor.execute("ATTACH ? as newdb",
                             (filename_to_unicode(new_path),))
         self.cursor.execute("BEGIN TRANSACTION")
@@ -709,24 +933,38 @@ class LiveStorage(signals.SignalEmitter):
         us to keep the database file unmodified in case the upgrade
         fails.
 
-        It also creates a backup in the backups/ directory of the
-        database.
+        The unmodified file also serves as the backup of the database.  Once
+        the upgrade succeeds, _change_database_file_back() moves it to the
+        backups/ directory.  This way we only make one full copy of the
+        database for each upgrade.
 
         :param ver: the current version (as string)
         """
         logging.info("database path: %s", self.path)
 
-        # copy the db to a backup file for posterity
-        target_path = self.get_backup_directory()
-        save_name = self._find_unused_db_name(
-            target_path, "%s_%s" % (LiveStorage.backup_filename_prefix, ver))
-        self._copy_data_to_path(os.path.join(target_path, save_name))
+        backup_dir = self.get_backup_directory()
+        backup_name = self._find_unused_db_name(
+            backup_dir, "%s_%s" % (LiveStorage.backup_filename_prefix, ver))
+        backup_path = os.path.join(backup_dir, backup_name)
+        if (self._get_database_file() is not None and
+                os.path.exists(self.path)):
+            self._upgrade_backup_path = backup_path
+        else:
+            # we're not using a file for our database, so we need to copy
+            # the data to the backup
+            self._copy_data_to_path(backup_path)
+            self._upgrade_backup_path = None
 
         # copy the db to the file we're going to operate on
         target_path = os.path.dirname(self.path)
         save_name = self._find_unused_db_name(
             target_path, "upgrading_database_%s" % ver)
-        self._copy_data_to_path(os.path.join(target_path, save_name))
+        if self.show_upgrade_progress():
+            progress_callback = dbupgradeprogress.database_copy_progress
+        else:
+            progress_callback = None
+        self._copy_data_to_path(os.path.join(target_path, save_name),
+                                progress_callback)
 
         self._changed_db_path = os.path.join(target_path, save_name)
         self.connection.close()
@@ -736,17 +974,60 @@ class LiveStorage(signals.SignalEmitter):
         """Switches the sqlitedb file back to our regular one.
 
         This works together with _change_database_file() to handle database
-        upgrades.  Once the upgrade is finished, this method copies the
-        database we were using to the normal place, and switches our sqlite
-        connection to use that file
+        upgrades.  Once the upgrade is finished, this method links the
+        original database into the backups directory, moves the database we
+        were using to the normal place, and switches our sqlite connection to
+        use that file.
+
+        self.path holds a complete database the whole time, so if we crash
+        partway through we still have either the old or the upgraded data.
         """
-        # _changed_db_path uses the default journal mode instead of WAL mode,
-        # so we can do a simple move here instead of using
+        # Closing the connection checkpoints the WAL file for
+        # _changed_db_path, so we can do a simple move here instead of using
         # _copy_data_to_path()
         self.connection.close()
-        shutil.move(self._changed_db_path, self.path)
+        if self._upgrade_backup_path is not None:
+            self._link_database_file(self.path, self._upgrade_backup_path)
+        # Any WAL files for self.path belong to the original database, which
+        # is safe in the backup now.  Don't let sqlite apply them to the
+        # upgraded one.
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        # this replaces self.path with a single rename
+        self._move_database_file(self._changed_db_path, self.path)
         self.open_connection()
         del self._changed_db_path
+        del self._upgrade_backup_path
+
+    def _link_database_file(self, path, new_path):
+        """Make new_path a copy of a database file that isn't currently open.
+
+        path stays in place.  We use hard links where we can, since they
+        don't need to copy any data, and fall back to copying the file.  The
+        WAL file gets linked along with the database, if there is one.
+        """
+        for suffix in ('', '-wal'):
+            if suffix and not os.path.exists(path + suffix):
+                continue
+            try:
+                os.link(path + suffix, new_path + suffix)
+            except (AttributeError, OSError):
+                # no os.link() on windows, or the backup directory is on a
+                # different filesystem
+                shutil.copy2(path + suffix, new_path + suffix)
+
+    def _move_database_file(self, path, new_path):
+        """Move a database file that isn't currently open.
+
+        If another connection still has the database open, it may have a WAL
+        file.  Move that along with the database, so that the data stays
+        together.
+        """
+        shutil.move(path, new_path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                shutil.move(path + suffix, new_path + suffix)
 
     def show_upgrade_progress(self):
         return True
@@ -1155,20 +1436,161 @@ class LiveStorage(signals.SignalEmitter):
             rows.append(converted_row)
         return rows
 
+    def set_group_commit(self, max_time, max_statements=0):
+        """Keep transactions open across event loop callbacks.
+
+        Normally we commit after each event loop callback that changes the
+        database.  In group commit mode, we keep the transaction open until
+        it's been open for max_time seconds or has max_statements statements
+        in it, or until request_commit() is called.  This means a lot less
+        COMMITs (and fsyncs) when many callbacks make small changes, but
+        changes made in the last max_time seconds can be lost if we crash.
+
+        If a callback fails, only the changes it made are rolled back.
+
+        :param max_time: max seconds to keep a transaction open.  Pass 0 to
+        commit after every callback.
+        :param max_statements: max statements to put in a transaction before
+        committing.  0 means no limit.
+        """
+        self._group_commit_time = max_time
+        self._group_commit_statements = max_statements
+        if not max_time:
+            self.finish_transaction()
+
+    def request_commit(self):
+        """Commit the current transaction at the end of this callback.
+
+        Call this for changes that we don't want to lose if we crash, like
+        user actions and finished downloads.  This only has an effect in
+        group commit mode.
+        """
+        self._commit_requested = True
+
+    def has_uncommitted_changes(self):
+        """Are we holding changes from a finished callback uncommitted?
+
+        This only happens in group commit mode.  Other database connections
+        won't see these changes until we commit.
+        """
+        return (len(self._statements_in_transaction) > 0 and
+                self._callback_start_index > 0)
+
     def on_event_finished(self, eventloop, success):
-        self.finish_transaction(commit=success)
+        if not self._group_commit_time:
+            self.finish_transaction(commit=success)
+            return
+        if len(self._statements_in_transaction) == 0:
+            self._commit_requested = False
+            return
+        if success:
+            self._end_callback_changes()
+        else:
+            self._rollback_callback_changes()
+        if self._should_commit_group():
+            self.finish_transaction()
+        elif self._statements_in_transaction:
+            self._schedule_group_commit_timeout()
+
+    def _end_callback_changes(self):
+        if self._in_callback_savepoint:
+            if not self._quitting_from_operational_error:
+                self.cursor.execute("RELEASE SAVEPOINT callback")
+            self._in_callback_savepoint = False
+        self._callback_start_index = len(self._statements_in_transaction)
+
+    def _rollback_callback_changes(self):
+        if self._in_callback_savepoint:
+            if not self._quitting_from_operational_error:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT callback")
+                self.cursor.execute("RELEASE SAVEPOINT callback")
+            self._statements_in_transaction.truncate(
+                self._callback_start_index)
+            self._in_callback_savepoint = False
+        elif self._callback_start_index == 0:
+            # all the changes in the transaction are from this callback
+            self.finish_transaction(commit=False)
+
+    def _should_commit_group(self):
+        if not self._statements_in_transaction:
+            return False
+        if self._commit_requested:
+            return True
+        if (self._group_commit_statements and
+            len(self._statements_in_transaction) >=
+            self._group_commit_statements):
+            return True
+        age = time.time() - self._transaction_start_time
+        return age >= self._group_commit_time
+
+    def _schedule_group_commit_timeout(self):
+        if self._group_commit_timeout is not None:
+            return
+        age = time.time() - self._transaction_start_time
+        self._group_commit_timeout = eventloop.add_timeout(
+            max(self._group_commit_time - age, 0),
+            self._on_group_commit_timeout, 'group commit')
+
+    def _on_group_commit_timeout(self):
+        # on_event_finished() will run the commit once we return
+        self._group_commit_timeout = None
+        self.request_commit()
+
+    def _cancel_group_commit_timeout(self):
+        if self._group_commit_timeout is not None:
+            self._group_commit_timeout.cancel()
+            self._group_commit_timeout = None
 
     def finish_transaction(self, commit=True):
+        self._commit_requested = False
+        self._cancel_group_commit_timeout()
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
             if commit:
                 self.cursor.execute("COMMIT TRANSACTION")
+                self.commit_count += 1
             else:
                 self.cursor.execute("ROLLBACK TRANSACTION")
-        self._statements_in_transaction = []
+        self._log_replay_log_stats()
+        self._statements_in_transaction.clear()
+        self._callback_start_index = 0
+        self._in_callback_savepoint = False
+        self._transaction_start_time = None
         self.emit("transaction-finished", commit)
 
+    def _log_replay_log_stats(self):
+        replay_log = self._statements_in_transaction
+        if replay_log.spilled_bytes() > 0:
+            logging.timing("transaction replay log spilled to disk: "
+                           "%d statements, %d bytes on disk",
+                           len(replay_log), replay_log.spilled_bytes())
+
+    def get_transaction_stats(self):
+        """Get statistics about our transactions.
+
+        :returns: dict with these keys:
+            - commits: number of COMMITs that we've run
+            - replay_log_statements: statements in the current replay log
+            - replay_log_memory_values: values the replay log is holding in
+              memory
+            - replay_log_spilled_bytes: size of the replay log's
+              temporary file
+            - replay_log_peak_memory_values: max values that the replay log
+              has held in memory
+            - replay_log_spill_count: number of times the replay log spilled
+              to disk
+        """
+        replay_log = self._statements_in_transaction
+        return {
+            'commits': self.commit_count,
+            'replay_log_statements': len(replay_log),
+            'replay_log_memory_values': replay_log.memory_values(),
+            'replay_log_spilled_bytes': replay_log.spilled_bytes(),
+            'replay_log_peak_memory_values': replay_log.peak_memory_values,
+            'replay_log_spill_count': replay_log.spill_count,
+        }
+
     def execute(self, sql, values=None, is_update=False, many=False):
         """Execute an sql statement and return the results.
 
@@ -1186,6 +1608,14 @@ class LiveStorage(signals.SignalEmitter):
 
         if is_update and len(self._statements_in_transaction) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
+            self._transaction_start_time = time.time()
+        elif (is_update and self._callback_start_index > 0 and
+              not self._in_callback_savepoint):
+            # Group commit is holding a transaction open from previous
+            # callbacks.  Use a savepoint so that if this callback fails, we
+            # can roll back just its changes.
+            self.cursor.execute("SAVEPOINT callback")
+            self._in_callback_savepoint = True
 
         if values is None:
             values = ()
@@ -1235,9 +1665,9 @@ class LiveStorage(signals.SignalEmitter):
             # We may have only been trying to execute SELECT statements.  If
             # that's true, don't start a transaction. (#12885)
             self.cursor.execute("BEGIN TRANSACTION")
-        to_run = self._statements_in_transaction[:]
+        to_run = iter(self._statements_in_transaction)
         if self._current_select_statement:
-            to_run.append(self._current_select_statement)
+            to_run = itertools.chain(to_run, [self._current_select_statement])
         for (sql, values, many) in to_run:
             try:
                 self._time_execute(sql, values, many)
@@ -1249,6 +1679,10 @@ class LiveStorage(signals.SignalEmitter):
     def _handle_operational_error(self, e, is_update):
         if self._quitting_from_operational_error:
             return
+        # Rolling back loses any savepoint.  From now on, treat the whole
+        # transaction as belonging to the current callback.
+        self._callback_start_index = 0
+        self._in_callback_savepoint = False
         succeeded = False
         while True:
             # try to rollback our old transaction if SQLite hasn't done it
@@ -1292,7 +1726,7 @@ class LiveStorage(signals.SignalEmitter):
             self._switch_to_temp_mode()
             # reset _statements_in_transaction.  The data for the old DB is
             # now lost
-            self._statements_in_transaction = []
+            self._statements_in_transaction.clear()
             self.cursor = self.connection.cursor()
             self._init_database()
             return False
@@ -46,6 +46,7 @@ import struct
 import subprocess
 import sys
 import threading
+import time
 import trapcall
 import warnings
 import Queue
@@ -331,6 +332,48 @@ def _dump_obj(obj, pipe):
     pipe.write(pickle_data)
     pipe.flush()
 
+def _start_helper_process():
+    """Start a new miro_helper.py process.
+
+    :returns: Popen object for the process
+    """
+    cmd_line, env = utils.miro_helper_program_info()
+    kwargs = {
+              "stdout": subprocess.PIPE,
+              "stdin": subprocess.PIPE,
+              "stderr": open(os.devnull, 'wb'),
+              "env": env,
+              "close_fds": True
+    }
+    return Popen(cmd_line, **kwargs)
+
+def _get_config_dict():
+    """Generate a dict with the config items needed in the subprocess.
+
+    We just send over the bare minimum needed to make sure basic modules
+    like gtcache load properly.
+    """
+    # On OS X, the proxy information is in a CFDictionary, so we can't
+    # pickle it.  Just avoid sending it for now
+    prefs_to_send = [p for p in prefs.all_prefs()
+            if not p.key.startswith("HttpProxy")
+    ]
+    return dict((p.key, app.config.get(p)) for p in prefs_to_send)
+
+def make_startup_info(log_pathname=None):
+    """Create the StartupInfo message for a new subprocess.
+
+    This works both in the main process and inside a subprocess that starts
+    up a subprocess of its own.
+
+    :param log_pathname: if given, the subprocess logs to this file instead of
+    the HELPER_LOG_PATHNAME file.
+    """
+    config_dict = _get_config_dict()
+    if log_pathname is not None:
+        config_dict[prefs.HELPER_LOG_PATHNAME.key] = log_pathname
+    return StartupInfo(config_dict, hasattr(app, 'in_unit_tests'))
+
 class SubprocessManager(object):
     """Manages a running subprocess
 
@@ -400,15 +443,7 @@ class SubprocessManager(object):
         trapcall.trap_call("subprocess startup", self.responder.on_startup)
 
     def _start_subprocess(self):
-        cmd_line, env = utils.miro_helper_program_info()
-        kwargs = {
-                  "stdout": subprocess.PIPE,
-                  "stdin": subprocess.PIPE,
-                  "stderr": open(os.devnull, 'wb'),
-                  "env": env,
-                  "close_fds": True
-        }
-        process = Popen(cmd_line, **kwargs)
+        process = _start_helper_process()
         self.start_time = clock.clock()
         return process
 
@@ -533,29 +568,139 @@ class SubprocessManager(object):
         self.sent_quit = True
 
     def _send_startup_info(self):
-        self.send_message(StartupInfo(self._get_config_dict(),
-                                      hasattr(app, 'in_unit_tests')))
+        self.send_message(make_startup_info())
         self.send_message(HandlerInfo(self.handler_class, self.handler_args))
 
-    def _get_config_dict(self):
-        """Generate a dict with the config items needed in the subprocess.
-
-        We just send over the bare minimum needed to make sure basic modules
-        like gtcache load properly.
-        """
-        # On OS X, the proxy information is in a CFDictionary, so we can't
-        # pickle it.  Just avoid sending it for now
-        prefs_to_send = [p for p in prefs.all_prefs()
-                if not p.key.startswith("HttpProxy")
-        ]
-        return dict((p.key, app.config.get(p)) for p in prefs_to_send)
-
     # implement the MessageHandler interface
 
     def handle(self, msg):
         # just forward the message to our process
         self.send_message(msg)
 
+class SubprocessCallError(StandardError):
+    """A BlockingSubprocess didn't send back a response."""
+
+def _kill_process(process):
+    try:
+        process.kill()
+    except OSError:
+        # process already quit
+        pass
+
+class BlockingSubprocess(object):
+    """Runs a subprocess that handles one message at a time.
+
+    Unlike SubprocessManager, BlockingSubprocess doesn't use the eventloop or
+    a thread to read the subprocess output.  call() sends a message, then
+    blocks until the subprocess sends back a response.  This means it can be
+    used inside another subprocess, for example the worker process.
+
+    The subprocess gets started on the first call().  If it quits or crashes,
+    call() raises a SubprocessCallError and the next call() starts a new
+    process.
+    """
+
+    def __init__(self, handler_class, handler_args=None, log_pathname=None):
+        """Create a new BlockingSubprocess.
+
+        handler_class and handler_args are used to build the SubprocessHandler
+        inside the subprocess.  For each message it gets, the handler should
+        send back exactly one SubprocessResponse.
+
+        log_pathname is passed to make_startup_info().
+        """
+        if handler_args is None:
+            handler_args = ()
+        self.handler_class = handler_class
+        self.handler_args = handler_args
+        self.log_pathname = log_pathname
+        self.process = None
+
+    @property
+    def is_running(self):
+        return self.process is not None
+
+    def start(self):
+        """Startup the subprocess, if it's not already running."""
+        if self.is_running:
+            return
+        self.process = _start_helper_process()
+        try:
+            _dump_obj(make_startup_info(self.log_pathname),
+                      self.process.stdin)
+            _dump_obj(HandlerInfo(self.handler_class, self.handler_args),
+                      self.process.stdin)
+        except IOError, e:
+            self.kill()
+            raise SubprocessCallError("Error starting subprocess: %s" % e)
+
+    def call(self, msg, timeout=None):
+        """Send a message to the subprocess and wait for the response.
+
+        :param msg: SubprocessMessage to send
+        :param timeout: if the subprocess doesn't respond in this many
+        seconds, kill it.
+        :returns: SubprocessResponse sent back from the subprocess
+        :raises SubprocessCallError: the subprocess quit, was killed because
+        of the timeout, or the handler raised an exception
+        """
+        self.start()
+        process = self.process
+        timed_out = []
+        def on_timeout():
+            timed_out.append(True)
+            _kill_process(process)
+        if timeout is not None:
+            timer = threading.Timer(timeout, on_timeout)
+            timer.daemon = True
+            timer.start()
+        try:
+            _dump_obj(msg, process.stdin)
+            response = _load_obj(process.stdout)
+        except (IOError, LoadError):
+            response = None
+        finally:
+            if timeout is not None:
+                timer.cancel()
+        if response is None:
+            self.kill()
+            if timed_out:
+                raise SubprocessCallError("Subprocess didn't respond in %s "
+                                          "seconds" % timeout)
+            else:
+                raise SubprocessCallError("Subprocess quit unexpectedly")
+        if isinstance(response, SubprocessError):
+            raise SubprocessCallError(response.report)
+        return response
+
+    def kill(self):
+        """Stop the subprocess without waiting for it to quit."""
+        if self.process is not None:
+            _kill_process(self.process)
+            self.process = None
+
+    def shutdown(self, timeout=1.0):
+        """Shutdown the subprocess.
+
+        This method asks the subprocess to quit, waits until timeout expires,
+        then kills it.
+        """
+        if self.process is None:
+            return
+        process = self.process
+        self.process = None
+        try:
+            _dump_obj(None, process.stdin)
+            process.stdin.close()
+        except IOError:
+            # process already quit
+            pass
+        end_time = clock.clock() + timeout
+        while process.poll() is None and clock.clock() < end_time:
+            time.sleep(0.05)
+        if process.poll() is None:
+            _kill_process(process)
+
 def _read_from_pipe(pipe):
     """Read objects from a pipe.
 
@@ -705,7 +850,11 @@ def _subprocess_setup(stdin, stdout):
     config.load(config.ManualConfig())
     app.config.set_dictionary(msg.config_dict)
     gtcache.init()
-    if not msg.in_unit_tests:
+    if msg.in_unit_tests:
+        # let make_startup_info() pass this on if we start a subprocess of
+        # our own
+        app.in_unit_tests = True
+    else:
         utils.setup_logging(app.config.get(prefs.HELPER_LOG_PATHNAME))
         util.setup_logging()
     logging_setup = True
@@ -209,6 +209,18 @@ class DDBObjectTestCase(MiroTestCase):
         testobj.bar = 2
         self.assertEquals(testobj.changed_attributes, set(['foo']))
 
+    def test_changed_attributes_shared_until_changed(self):
+        testobj = TestDDBObject(self)
+        other = TestDDBObject(self)
+        # after being saved, objects should share the same empty
+        # changed_attributes
+        self.assert_(testobj.changed_attributes is other.changed_attributes)
+        testobj.foo = 1
+        self.assertEquals(testobj.changed_attributes, set(['foo']))
+        self.assertEquals(other.changed_attributes, set())
+        testobj.signal_change()
+        self.assert_(testobj.changed_attributes is other.changed_attributes)
+
 class DatabaseLoggingTest(MiroTestCase):
     def check_db_logs(self, count):
         records = self.log_filter.records
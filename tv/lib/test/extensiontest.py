@@ -1,5 +1,6 @@
 import ConfigParser
 import logging
+import sqlite3
 
 from miro import api
 from miro import app
@@ -90,6 +91,68 @@ class ExtensionStorageTest(ExtensionTestBase):
         self.assertEquals(self.storage_manager.key_exists('z'), False)
         self.assertEquals(self.storage_manager.key_exists('a'), False)
 
+    def test_cached_values_are_copied(self):
+        # changing a value we got back shouldn't change the stored value
+        self.storage_manager.set_value('a', [1, 2, 3])
+        self.storage_manager.get_value('a').append(4)
+        self.assertEquals(self.storage_manager.get_value('a'), [1, 2, 3])
+        # tuples should come back as lists, just like when they're read from
+        # disk
+        self.storage_manager.set_value('b', (1, 2))
+        self.assertEquals(self.storage_manager.get_value('b'), [1, 2])
+
+    def test_many(self):
+        self.storage_manager.set_many({'a': 1, 'b': [2], u'c\u03a0': 'three'})
+        self.assertEquals(self.storage_manager.get_many(['a', 'b', 'z']),
+                          {'a': 1, 'b': [2], 'z': None})
+        self.assertEquals(self.storage_manager.get_many([u'c\u03a0', 'z'],
+                                                        default=0),
+                          {u'c\u03a0': 'three', 'z': 0})
+
+    def test_write_behind(self):
+        self.storage_manager.set_value('a', 'foo')
+        self.storage_manager.enable_write_behind()
+        self.storage_manager.set_value('b', 'bar')
+        self.storage_manager.clear_value('a')
+        # changes should be visible right away
+        self.assertEquals(self.storage_manager.get_value('b'), 'bar')
+        self.assertEquals(self.storage_manager.key_exists('a'), False)
+        # but they shouldn't be on disk until we flush
+        other_manager = api.StorageManager(self.storage_manager._unique_name)
+        self.assertEquals(other_manager.get_value('a'), 'foo')
+        self.assertEquals(other_manager.key_exists('b'), False)
+        self.storage_manager.flush()
+        other_manager = api.StorageManager(self.storage_manager._unique_name)
+        self.assertEquals(other_manager.key_exists('a'), False)
+        self.assertEquals(other_manager.get_value('b'), 'bar')
+        # disabling write-behind should flush too
+        self.storage_manager.set_value('c', 3)
+        self.storage_manager.disable_write_behind()
+        other_manager = api.StorageManager(self.storage_manager._unique_name)
+        self.assertEquals(other_manager.get_value('c'), 3)
+
+    def test_write_behind_flush_error(self):
+        self.storage_manager.set_value('a', 'foo')
+        self.storage_manager.enable_write_behind()
+        self.storage_manager.set_value('a', 'bar')
+        self.storage_manager.set_value('b', 'baz')
+        # lock the database from another connection so that flush() fails
+        self.storage_manager.get_sqlite_connection().execute(
+            "PRAGMA busy_timeout=0")
+        other_manager = api.StorageManager(self.storage_manager._unique_name)
+        other_connection = other_manager.get_sqlite_connection()
+        other_connection.execute("BEGIN EXCLUSIVE")
+        self.assertRaises(sqlite3.OperationalError,
+                          self.storage_manager.flush)
+        # the changes should still be visible and waiting to be written
+        self.assertEquals(self.storage_manager.get_value('a'), 'bar')
+        self.assertEquals(self.storage_manager.get_value('b'), 'baz')
+        other_connection.execute("ROLLBACK")
+        self.storage_manager.flush()
+        other_manager = api.StorageManager(self.storage_manager._unique_name)
+        self.assertEquals(other_manager.get_value('a'), 'bar')
+        self.assertEquals(other_manager.get_value('b'), 'baz')
+
     def test_sqlite_store(self):
         # test that the sqlite connection works
         conn = self.storage_manager.get_sqlite_connection()
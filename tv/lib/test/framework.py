@@ -283,7 +283,7 @@ class MiroTestCase(unittest.TestCase):
         models.initialize()
         app.in_unit_tests = True
         app.device_manager = devices.DeviceManager()
-        models.Item._path_count_tracker.reset()
+        models.Item._path_index.reset()
         testobjects.test_started(self)
         # Tweak Item to allow us to make up fake paths for FileItems
         models.Item._allow_nonexistent_paths = True
@@ -320,6 +320,7 @@ class MiroTestCase(unittest.TestCase):
         app.controller = DummyController()
         self.httpserver = None
         httpauth.init()
+        httpclient.redirect_cache.clear()
         # reset any logging records from our setUp call()
         self.log_filter.reset_records()
         # create an extension manager that searches our tempdir for extensions
@@ -700,12 +701,12 @@ class EventLoopTest(MiroTestCase):
         eventloop.add_idle(function, name, args=None, kwargs=None)
 
     def hasIdles(self):
-        return not (eventloop._eventloop.idle_queue.queue.empty() and
-                    eventloop._eventloop.urgent_queue.queue.empty())
+        return (eventloop._eventloop.idle_queue.has_pending_idle() or
+                eventloop._eventloop.urgent_queue.has_pending_idle())
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        while eventloop._eventloop.threadpool.has_queued_calls():
             sleep(0.05)
         eventloop._eventloop.threadpool.close_threads()
 
@@ -1,5 +1,8 @@
+import email.utils
 import functools
+import json
 import os
+import time
 import logging
 import pycurl
 import pickle
@@ -14,7 +17,8 @@ from miro import httpclient
 from miro import signals
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                 uses_httpclient)
 
 from miro.gtcache import gettext as _
 
@@ -242,6 +246,52 @@ class HTTPClientTest(HTTPClientTestBase):
         self.check_redirects('temp-then-perm-redirect',
                 'temp-then-perm-redirect', 'test.txt')
 
+    @uses_httpclient
+    def test_redirect_cache(self):
+        self.grab_url(self.httpserver.build_url('perm-redirect'))
+        self.check_redirects('perm-redirect', 'test.txt', 'test.txt')
+        # the second time around we should skip the redirect
+        self.grab_url(self.httpserver.build_url('perm-redirect'))
+        self.check_redirects('perm-redirect', 'test.txt', 'test.txt')
+        self.grab_headers(self.httpserver.build_url('perm-redirect'))
+        self.check_redirects('perm-redirect', 'test.txt', 'test.txt')
+        stats = httpclient.redirect_cache.get_stats()
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['redirects_skipped'], 2)
+        # temporary redirects aren't cached by default
+        self.grab_url(self.httpserver.build_url('temp-redirect'))
+        self.grab_url(self.httpserver.build_url('temp-redirect'))
+        self.check_redirects('temp-redirect', 'temp-redirect', 'test.txt')
+        stats = httpclient.redirect_cache.get_stats()
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['size'], 1)
+
+    @uses_httpclient
+    def test_redirect_cache_cacheable_temp_redirect(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=60')
+        self.grab_url(self.httpserver.build_url('temp-redirect'))
+        self.grab_url(self.httpserver.build_url('temp-redirect'))
+        # we skipped a temporary redirect, so updated-url should still be
+        # the original URL
+        self.check_redirects('temp-redirect', 'temp-redirect', 'test.txt')
+        self.assertEquals(httpclient.redirect_cache.get_stats()['hits'], 1)
+
+    @uses_httpclient
+    def test_redirect_cache_stale(self):
+        # if a cached redirect stops working, we should retry with the
+        # original URL
+        httpclient.redirect_cache.add(
+            self.httpserver.build_url('perm-redirect'),
+            self.httpserver.build_url('nonexistant.txt'),
+            False, time.time() + 60, 0.1)
+        self.grab_url(self.httpserver.build_url('perm-redirect'))
+        self.check_redirects('perm-redirect', 'test.txt', 'test.txt')
+        # the good redirect should replace the stale one
+        self.assertEquals(httpclient.redirect_cache.resolve(
+            self.httpserver.build_url('perm-redirect')),
+            (self.httpserver.build_url('test.txt'), False))
+
     @uses_httpclient
     def test_redirect_headers(self):
         # check that we get the headers from the redirected URL, not the
@@ -483,6 +533,100 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+class RedirectCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = httpclient.RedirectCache(max_size=3)
+
+    def test_expiration(self):
+        now = time.time()
+        calc = httpclient.calc_redirect_expiration
+        self.assertClose(calc(301, {}),
+                         now + httpclient.PERMANENT_REDIRECT_MAX_AGE)
+        self.assertEquals(calc(302, {}), None)
+        self.assertClose(calc(302, {'cache-control': 'public, max-age=60'}),
+                         now + 60)
+        self.assertEquals(calc(301, {'cache-control': 'no-store'}), None)
+        self.assertEquals(calc(301, {'cache-control': 'max-age=0'}), None)
+        self.assertClose(calc(307, {'expires': email.utils.formatdate(
+            now + 100)}), now + 100, tolerance=1.0)
+        self.assertEquals(calc(301, {'expires': 'garbage'}), None)
+
+    def test_resolve(self):
+        expires = time.time() + 60
+        self.cache.add('http://a/', 'http://b/', False, expires, 0.1)
+        self.cache.add('http://b/', 'http://c/', True, expires, 0.2)
+        self.assertEquals(self.cache.resolve('http://a/'),
+                          ('http://c/', True))
+        self.assertEquals(self.cache.resolve('http://c/'),
+                          ('http://c/', False))
+        stats = self.cache.get_stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['redirects_skipped'], 2)
+        self.assertClose(stats['time_saved'], 0.3)
+        self.cache.invalidate('http://a/')
+        self.assertEquals(self.cache.resolve('http://a/'),
+                          ('http://a/', False))
+        self.assertEquals(self.cache.get_stats()['size'], 0)
+
+    def test_expired(self):
+        self.cache.add('http://a/', 'http://b/', False, time.time() - 1, 0.1)
+        self.assertEquals(self.cache.resolve('http://a/'),
+                          ('http://a/', False))
+        self.assertEquals(self.cache.get_stats()['size'], 0)
+
+    def test_size_limit(self):
+        expires = time.time() + 60
+        for i in range(4):
+            self.cache.add('http://%d/' % i, 'http://x/', False, expires, 0)
+        # the least recently used entry should be dropped
+        self.assertEquals(self.cache.resolve('http://0/'),
+                          ('http://0/', False))
+        self.assertEquals(self.cache.resolve('http://3/'),
+                          ('http://x/', False))
+
+    def test_write_and_restore(self):
+        expires = time.time() + 60
+        self.cache.add('http://a/', 'http://b/', True, expires, 0.1)
+        self.cache.add('http://c/', 'http://d/', False, time.time() - 1, 0.1)
+        path = os.path.join(self.tempdir, 'redirect-cache')
+        self.cache.write_to_file(path)
+        new_cache = httpclient.RedirectCache()
+        new_cache.restore_from_file(path)
+        self.assertEquals(new_cache.resolve('http://a/'), ('http://b/', True))
+        self.assertEquals(new_cache.get_stats()['size'], 1)
+
+    def check_restore(self, data):
+        path = os.path.join(self.tempdir, 'redirect-cache')
+        f = open(path, 'wt')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        new_cache = httpclient.RedirectCache()
+        with self.allow_warnings():
+            new_cache.restore_from_file(path)
+        return new_cache
+
+    def test_restore_malformed(self):
+        # bad files should be ignored
+        for data in ('not json', '5', '{"a": "b"}', '[1, 2]'):
+            new_cache = self.check_restore(data)
+            self.assertEquals(new_cache.get_stats()['size'], 0)
+        # bad entries should be skipped
+        expires = time.time() + 60
+        new_cache = self.check_restore(json.dumps([
+            ['http://a/', 'http://b/'],
+            [1, 2, 3, 4, 5],
+            [u'http://\u00e9/', 'http://b/', False, expires, 0.1],
+            ['http://c/', 'http://d/', False, 'soon', 0.1],
+            ['http://e/', 'http://f/', False, expires, 0.1],
+        ]))
+        self.assertEquals(new_cache.get_stats()['size'], 1)
+        self.assertEquals(new_cache.resolve('http://e/'),
+                          ('http://f/', False))
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -1,3 +1,7 @@
+import os
+import time
+from datetime import datetime, timedelta
+
 from miro import database
 
 from miro import iconcache
@@ -5,7 +9,8 @@ from miro import item
 from miro import feed
 from miro import guide
 
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test import mock
+from miro.test.framework import EventLoopTest, MiroTestCase, uses_httpclient
 
 class IconCacheTest(EventLoopTest):
     def setUp(self):
@@ -52,3 +57,159 @@ class IconCacheTest(EventLoopTest):
                 iconcache.IconCache.get_by_id, item_icon_cache_id)
         self.assertRaises(database.ObjectNotFoundError,
                 iconcache.IconCache.get_by_id, guide_icon_cache_id)
+
+class IconCacheUpdaterTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.grab_url = self.patch_for_test('miro.httpclient.grab_url')
+        self.updater = iconcache.IconCacheUpdater()
+        self.results = []
+
+    def fetch(self, url, **kwargs):
+        self.updater.fetch(url, lambda info: self.results.append((url, info)),
+                           lambda error: self.results.append((url, error)),
+                           **kwargs)
+
+    def fetched_urls(self):
+        return [args[0][0] for args in self.grab_url.call_args_list]
+
+    def finish_fetch(self, index, info):
+        callback = self.grab_url.call_args_list[index][0][1]
+        callback(info)
+
+    def test_dedup(self):
+        self.fetch(u'http://a.com/1.png')
+        self.fetch(u'http://a.com/1.png')
+        self.assertEquals(self.fetched_urls(), [u'http://a.com/1.png'])
+        self.finish_fetch(0, 'info')
+        self.assertEquals(self.results, [(u'http://a.com/1.png', 'info')] * 2)
+        # once the fetch is done, we should start a new one
+        self.fetch(u'http://a.com/1.png')
+        self.assertEquals(len(self.fetched_urls()), 2)
+
+    def test_dedup_different_validators(self):
+        # requests with different ETags can't share the same response
+        self.fetch(u'http://a.com/1.png')
+        self.fetch(u'http://b.com/1.png', etag=u'abc')
+        self.fetch(u'http://b.com/1.png', etag=u'def')
+        self.assertEquals(len(self.fetched_urls()), 3)
+
+    def test_host_limit(self):
+        for i in range(iconcache.RUNNING_MAX_PER_HOST + 1):
+            self.fetch(u'http://a.com/%d.png' % i)
+        self.fetch(u'http://b.com/0.png')
+        self.assertEquals(self.fetched_urls(),
+                          [u'http://a.com/%d.png' % i for i in
+                           range(iconcache.RUNNING_MAX_PER_HOST)] +
+                          [u'http://b.com/0.png'])
+        self.finish_fetch(0, 'info')
+        self.assertEquals(self.fetched_urls()[-1], u'http://a.com/%d.png' %
+                          iconcache.RUNNING_MAX_PER_HOST)
+
+    def test_running_max(self):
+        for i in range(iconcache.RUNNING_MAX + 1):
+            self.fetch(u'http://host%d.com/icon.png' % i)
+        self.assertEquals(len(self.fetched_urls()), iconcache.RUNNING_MAX)
+        self.finish_fetch(0, 'info')
+        self.assertEquals(len(self.fetched_urls()),
+                          iconcache.RUNNING_MAX + 1)
+
+    def test_priority(self):
+        for i in range(iconcache.RUNNING_MAX_PER_HOST):
+            self.fetch(u'http://a.com/%d.png' % i)
+        now = datetime.now()
+        self.fetch(u'http://a.com/new.png', priority=iconcache.REVALIDATE,
+                   sort_key=now)
+        self.fetch(u'http://a.com/old.png', priority=iconcache.REVALIDATE,
+                   sort_key=now - timedelta(days=1))
+        self.fetch(u'http://a.com/normal.png')
+        self.fetch(u'http://a.com/vital.png', priority=iconcache.VITAL)
+        for i in range(4):
+            self.finish_fetch(i, 'info')
+        self.assertEquals(self.fetched_urls()[2:], [
+            u'http://a.com/vital.png',
+            u'http://a.com/normal.png',
+            u'http://a.com/old.png',
+            u'http://a.com/new.png',
+        ])
+
+    def test_revalidate_null_last_checked(self):
+        # upgrade196 leaves last_checked NULL for existing icons.  Those
+        # should get queued along with icons that have been checked before.
+        for i in range(iconcache.RUNNING_MAX_PER_HOST):
+            self.fetch(u'http://a.com/%d.png' % i)
+        icon_path = os.path.join(self.tempdir, 'icon.png')
+        open(icon_path, 'w').close()
+        last_checked_values = [datetime.now() - timedelta(days=30), None]
+        for i, last_checked in enumerate(last_checked_values):
+            url = u'http://a.com/thumb%d.png' % i
+            db_item = mock.Mock(ICON_CACHE_VITAL=False)
+            db_item.get_thumbnail_url.return_value = url
+            icon_cache = iconcache.IconCache(db_item)
+            icon_cache.url = url
+            icon_cache.filename = icon_path
+            icon_cache.last_checked = last_checked
+            icon_cache.updating = False
+            with mock.patch.object(iconcache, 'icon_cache_updater',
+                                   self.updater):
+                icon_cache.request_icon()
+        for i in range(2):
+            self.finish_fetch(i, 'info')
+        # icons that have never been checked should go first
+        self.assertEquals(self.fetched_urls()[-2:], [
+            u'http://a.com/thumb1.png',
+            u'http://a.com/thumb0.png',
+        ])
+
+    def test_write_icon_file(self):
+        cachedir = os.path.join(self.tempdir, 'icon-cache')
+        filename = iconcache.write_icon_file(None, cachedir, 'icon.png',
+                                             'data')
+        self.assertEquals(os.path.dirname(filename), cachedir)
+        self.assertEquals(open(filename).read(), 'data')
+        # writing again should replace the old file
+        filename2 = iconcache.write_icon_file(filename, cachedir, 'icon.png',
+                                              'data2')
+        self.assertEquals(filename2, filename)
+        self.assertEquals(open(filename).read(), 'data2')
+        self.assertEquals(os.listdir(cachedir), ['icon.png'])
+
+class OrphanedFilesTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cachedir = os.path.join(self.tempdir, 'icon-cache')
+        os.makedirs(self.cachedir)
+        os.makedirs(os.path.join(self.cachedir, 'extracted'))
+        for name in ('used.png', 'orphan.png', 'orphan.png.part', '.hidden'):
+            f = open(os.path.join(self.cachedir, name), 'w')
+            f.write(name)
+            f.close()
+        self.known_icons = set([
+            os.path.normcase(os.path.join(self.cachedir, 'used.png'))])
+
+    def test_find_orphaned_files(self):
+        orphans = iconcache.find_orphaned_files(self.cachedir,
+                                                self.known_icons,
+                                                time.time() + 10)
+        self.assertEquals(sorted(orphans), [
+            (os.path.normcase(os.path.join(self.cachedir, 'orphan.png')), 10),
+            (os.path.normcase(os.path.join(self.cachedir, 'orphan.png.part')),
+             15),
+        ])
+
+    def test_find_skips_new_files(self):
+        # files modified after the cutoff could have been written after we
+        # calculated known_icons, so they shouldn't be touched
+        orphans = iconcache.find_orphaned_files(self.cachedir,
+                                                self.known_icons,
+                                                time.time() - 10)
+        self.assertEquals(orphans, [])
+
+    def test_remove_orphaned_files(self):
+        orphans = iconcache.find_orphaned_files(self.cachedir,
+                                                self.known_icons,
+                                                time.time() + 10)
+        orphans.append((os.path.join(self.cachedir, 'missing.png'), 100))
+        self.assertEquals(iconcache.remove_orphaned_files(orphans), (2, 25))
+        self.assertEquals(sorted(os.listdir(self.cachedir)),
+                          ['.hidden', 'extracted', 'used.png'])
@@ -32,21 +32,30 @@
 import gc
 import itertools
 import random
+import sqlite3
 import string
 import weakref
 
 from miro import app
+from miro import eventloop
+from miro import messages
 from miro import models
+from miro import prefs
 from miro import util
+from miro.data import itemindex
+from miro.data import namecollation
 from miro.frontends.widgets import itemlist
 from miro.frontends.widgets import itemsort
 from miro.test import mock, testobjects
 from miro.test.framework import MiroTestCase
 
 class ItemListTest(MiroTestCase):
+    use_column_index = False
+
     def setUp(self):
         MiroTestCase.setUp(self)
         self.init_data_package()
+        app.config.set(prefs.ITEM_LIST_COLUMN_INDEX, self.use_column_index)
         self.feed = models.Feed(u'http://example.com/feed.rss')
         self.items = [testobjects.make_item(self.feed, u'item-%s' % i)
                       for i in xrange(10)]
@@ -57,8 +66,11 @@ class ItemListTest(MiroTestCase):
         self.item_list.connect("items-changed", self.items_changed_handler)
         self.item_list.connect("list-changed", self.list_changed_handler)
 
-    def refresh_item_list(self):
+    def finish_changes(self):
         app.db.finish_transaction()
+
+    def refresh_item_list(self):
+        self.finish_changes()
         self.item_list._refetch_id_list()
 
     def check_list_changed_signal(self):
@@ -72,7 +84,7 @@ class ItemListTest(MiroTestCase):
             self.items[i].kind = u'podcast'
             self.items[i].signal_change()
             podcast_count += 1
-        app.db.finish_transaction()
+        self.finish_changes()
         # set the filter
         self.item_list.set_filters(['podcasts'])
         self.check_list_changed_signal()
@@ -94,7 +106,7 @@ class ItemListTest(MiroTestCase):
         self.items.sort(key=lambda i: i.title)
         for i in self.items:
             i.signal_change()
-        app.db.finish_transaction()
+        self.finish_changes()
         # test that the default sort is release date
         self.items.sort(key=lambda i: i.release_date)
         self.check_sort_order(self.items)
@@ -114,12 +126,30 @@ class ItemListTest(MiroTestCase):
         self.items[5].title = u'SeriesItem11'
         for i in self.items[:6]:
             i.signal_change()
-        app.db.finish_transaction()
+        self.finish_changes()
         # test that the default sort is release date
         self.item_list.set_sort(itemsort.TitleSort(True))
         self.items.sort(key=lambda i: util.name_sort_key(i.title))
         self.check_sort_order(self.items)
 
+    def test_profile(self):
+        self.assertEquals(self.item_list.get_first_item().select_info.profile,
+                          None)
+        self.item_list.set_profile('list')
+        self.check_list_changed_signal()
+        item_info = self.item_list.get_first_item()
+        self.assertEquals(item_info.select_info.profile, 'list')
+        # the list should still work with the column index and grouping
+        self.item_list.set_sort(itemsort.TitleSort())
+        self.item_list.set_grouping(itemlist.album_grouping)
+        self.check_list_changed_signal()
+        self.items.sort(key=lambda i: util.name_sort_key(i.title))
+        self.check_sort_order(self.items)
+        self.item_list.get_group_info(0)
+        # setting the same profile again shouldn't refetch the list
+        self.item_list.set_profile('list')
+        self.assertEquals(self.list_changed_handler.call_count, 0)
+
     def test_attrs(self):
         id1 = self.items[0].id
         id2 = self.items[-1].id
@@ -187,6 +217,144 @@ class ItemListTest(MiroTestCase):
         self.item_list.set_sort(itemsort.TitleSort())
         self.check_group_info(last_letter_grouping)
 
+class ColumnIndexItemListTest(ItemListTest):
+    # Run the ItemListTest tests again with the column index turned on, then
+    # test some things specific to it.
+    use_column_index = True
+
+    def setUp(self):
+        ItemListTest.setUp(self)
+        self.mock_message_handler = mock.Mock()
+        messages.FrontendMessage.install_handler(self.mock_message_handler)
+        eventloop._eventloop.emit('event-finished', True)
+        self.mock_message_handler.reset_mock()
+
+    def finish_changes(self):
+        # send the ItemChanges message to our item list so that the column
+        # index gets updated.
+        app.db.finish_transaction()
+        eventloop._eventloop.emit('event-finished', True)
+        for args, kwargs in self.mock_message_handler.handle.call_args_list:
+            if type(args[0]) is messages.ItemChanges:
+                self.item_list.on_item_changes(args[0])
+        self.mock_message_handler.reset_mock()
+
+    def check_ids_match_sql(self):
+        connection = self.item_list.item_source.get_connection()
+        try:
+            sql_ids = self.item_list.query.select_ids(connection)
+        finally:
+            self.item_list.item_source.release_connection(connection)
+        self.assertEquals(self.item_list.id_list, sql_ids)
+
+    def test_uses_index(self):
+        self.assert_(self.item_list.column_index is not None)
+        self.assertEquals(len(self.item_list.column_index), len(self.items))
+        self.assert_(self.item_list.column_index.can_handle(
+            self.item_list.query))
+        # searches and complex sorts need to go to the database
+        self.item_list.set_search(u'item')
+        self.assert_(not self.item_list.column_index.can_handle(
+            self.item_list.query))
+        self.check_ids_match_sql()
+        self.item_list.set_search(None)
+        self.item_list.set_sort(itemsort.StatusSort())
+        self.assert_(not self.item_list.column_index.can_handle(
+            self.item_list.query))
+        self.check_ids_match_sql()
+
+    def test_index_matches_sql(self):
+        titles = [u'Episode 10', u'episode 9', u'The Show', u'A Thing',
+                  u'b-side', None, u'Zed', u'\xc9clair', u'Episode 100',
+                  u'apple']
+        for i, item in enumerate(self.items):
+            item.title = titles[i]
+            item.artist = [u'Artist 2', u'artist 10', None][i % 3]
+            item.album = [u'The Album', u'album', u'Another'][i % 2]
+            item.track = i
+            item.size = [None, 100, 5000, 20][i % 4]
+            item.kind = [u'podcast', None][i % 2]
+            if i % 3 == 0:
+                item.watched_time = item.release_date
+            item.signal_change()
+        self.finish_changes()
+        sorts = [itemsort.TitleSort, itemsort.ArtistSort,
+                 itemsort.AlbumSort, itemsort.SizeSort, itemsort.DateSort,
+                 itemsort.DateAddedSort]
+        for filter_key in ('all', 'unplayed', 'podcasts'):
+            self.item_list.set_filters([filter_key])
+            for sort_class in sorts:
+                for ascending in (True, False):
+                    self.item_list.set_sort(sort_class(ascending))
+                    self.assert_(self.item_list.column_index.can_handle(
+                        self.item_list.query))
+                    if sort_class is itemsort.SizeSort:
+                        # there are ties in the size column, so the order
+                        # isn't well defined.  Just check the values.
+                        index_sizes = [self.item_list.get_item(id_).size
+                                       for id_ in self.item_list.id_list]
+                        self.check_ids_match_sql()
+                        sql_sizes = [self.item_list.get_item(id_).size
+                                     for id_ in self.item_list.id_list]
+                        self.assertEquals(index_sizes, sql_sizes)
+                    else:
+                        self.check_ids_match_sql()
+
+    def test_name_collation_key(self):
+        names = [u'Episode 10', u'episode 9', u'Episode 9b', u'The Show',
+                 u'A Thing', u'a', u'the', u'ab1', u'abc', u'ab', u'1ab',
+                 u'x 2 y 10', u'x 2 y 9', u'\xc9clair', u'eclair', u'Zed']
+        connection = sqlite3.connect(':memory:')
+        namecollation.setup_collation(connection)
+        connection.execute("CREATE TABLE names(name)")
+        connection.executemany("INSERT INTO names(name) VALUES (?)",
+                               [(name,) for name in names])
+        sql_order = [row[0] for row in connection.execute(
+            "SELECT name FROM names ORDER BY name collate name")]
+        names.sort(key=itemindex.name_collation_key)
+        self.assertEquals(names, sql_order)
+
+    def test_index_updates(self):
+        self.item_list.set_sort(itemsort.TitleSort())
+        self.items[0].title = u'zzz'
+        self.items[0].signal_change()
+        self.items[1].remove()
+        new_item = testobjects.make_item(self.feed, u'new-item')
+        new_item.title = u'aaa'
+        new_item.signal_change()
+        other_feed = models.Feed(u'http://example.com/feed2.rss')
+        testobjects.make_item(other_feed, u'other-feed-item')
+        self.finish_changes()
+        index = self.item_list.column_index
+        self.assertEquals(len(index), len(self.items))
+        self.assertEquals(self.item_list.id_list[0], new_item.id)
+        self.assertEquals(self.item_list.id_list[-1], self.items[0].id)
+        self.assert_(not self.item_list.item_in_list(self.items[1].id))
+        self.check_ids_match_sql()
+        # moving an item to another feed should remove it from the index
+        self.items[2].set_feed(other_feed.id)
+        self.finish_changes()
+        self.assertEquals(len(index), len(self.items) - 1)
+        self.assert_(not self.item_list.item_in_list(self.items[2].id))
+        self.check_ids_match_sql()
+
+    def test_group_starts(self):
+        for i, item in enumerate(self.items):
+            item.album = [u'Album 1', u'album 1', u'Album 2'][i % 3]
+            item.artist = [u'Artist', None][i % 2]
+            item.signal_change()
+        self.finish_changes()
+        self.item_list.set_sort(itemsort.AlbumSort())
+        self.item_list.set_grouping(itemlist.album_grouping)
+        self.check_group_info(itemlist.album_grouping)
+        self.assertNotEquals(self.item_list.group_starts, False)
+        # groupings without index_keys fall back to loading the rows
+        def title_grouping(info):
+            return info.title[0]
+        self.item_list.set_grouping(title_grouping)
+        self.check_group_info(title_grouping)
+        self.assertEquals(self.item_list.group_starts, False)
+
 class TestItemListPool(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
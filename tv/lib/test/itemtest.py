@@ -4,6 +4,8 @@ import shutil
 import tempfile
 
 from miro import app
+from miro import directorywatch
+from miro import item
 from miro import prefs
 from miro.feed import Feed
 from miro.item import Item, FileItem, FeedParserValues, on_new_metadata
@@ -280,6 +282,70 @@ class DeletedItemTest(MiroTestCase):
         with self.allow_warnings():
             FileItem("/non/existent/path/", feed.id)
 
+class DeletedFileCheckerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed = Feed(u'dtv:manualFeed', initiallyAutoDownloadable=False)
+        self.checker = item._deleted_file_checker
+        Item._allow_nonexistent_paths = False
+        self.items = []
+        for i in range(3):
+            path = os.path.join(self.tempdir, 'video-%d.avi' % i)
+            open(path, 'wb').write("data")
+            self.items.append(FileItem(path, self.feed.id))
+
+    def check_items(self):
+        for i in self.items:
+            self.checker.schedule_check(i)
+        self.runEventLoop(timeout=1, timeoutNormal=True)
+
+    def test_deleted_files(self):
+        os.remove(self.items[0].get_filename())
+        self.check_items()
+        self.assert_(not self.items[0].id_exists())
+        self.assert_(self.items[1].id_exists())
+        self.assert_(self.items[2].id_exists())
+
+    def test_deleted_directory(self):
+        path = os.path.join(self.tempdir, 'subdir', 'video.avi')
+        os.makedirs(os.path.dirname(path))
+        open(path, 'wb').write("data")
+        self.items.append(FileItem(path, self.feed.id))
+        shutil.rmtree(os.path.dirname(path))
+        self.check_items()
+        self.assert_(not self.items[-1].id_exists())
+        self.assert_(self.items[0].id_exists())
+
+    def test_device_cache_reset(self):
+        path = os.path.join(self.tempdir, 'subdir', 'video.avi')
+        os.makedirs(os.path.dirname(path))
+        open(path, 'wb').write("data")
+        self.items.append(FileItem(path, self.feed.id))
+        self.check_items()
+        self.assert_(os.path.dirname(path) in self.checker.device_cache)
+        # the next pass shouldn't use devices from the last one
+        shutil.rmtree(os.path.dirname(path))
+        self.checker.schedule_check(self.items[0])
+        self.runEventLoop(timeout=1, timeoutNormal=True)
+        self.assert_(os.path.dirname(path) not in self.checker.device_cache)
+        self.assert_(self.items[0].id_exists())
+
+    def test_directory_watcher_has_file(self):
+        # if a DirectoryWatcher knows about a file, we shouldn't stat it
+        watched_path = self.items[1].get_filename()
+        class TestDirectoryWatcher(directorywatch.DirectoryWatcher):
+            def startup(self, directory):
+                pass
+            def has_file(self, path):
+                return path == watched_path
+        watcher = TestDirectoryWatcher(self.tempdir)
+        os.remove(self.items[0].get_filename())
+        os.remove(self.items[1].get_filename())
+        self.check_items()
+        self.assert_(not self.items[0].id_exists())
+        self.assert_(self.items[1].id_exists())
+        del watcher
+
 class HaveItemForPathTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -287,8 +353,10 @@ class HaveItemForPathTest(MiroTestCase):
         self.added_items = {}
         self.deleted_paths = []
 
-    def add_item(self, filename):
-        path = os.path.join(self.tempdir, unicode_to_filename(filename))
+    def add_item(self, filename, directory=None):
+        if directory is None:
+            directory = self.tempdir
+        path = os.path.join(directory, unicode_to_filename(filename))
         # create a bogus file so we don't get a warning when we create a
         # filename.
         open(path, 'wb').write("data")
@@ -325,6 +393,63 @@ class HaveItemForPathTest(MiroTestCase):
         self.remove_item(u'VIDEO\xe4-3')
         self.check_have_item_for_path()
 
+    def test_ids_for_directory(self):
+        subdir = os.path.join(self.tempdir, 'SubDir')
+        os.mkdir(subdir)
+        self.add_item(u'video-1')
+        self.add_item(u'video-2', subdir)
+        self.add_item(u'video-3', subdir)
+        sub_ids = [self.added_items[os.path.join(subdir, name)].id
+                   for name in ('video-2', 'video-3')]
+        self.assertSameSet(Item.ids_for_path_or_directory(subdir), sub_ids)
+        self.assertSameSet(
+            Item.ids_for_path_or_directory(subdir.lower()), sub_ids)
+        self.assertSameSet(
+            Item.ids_for_path_or_directory(self.tempdir),
+            [i.id for i in self.added_items.values()])
+        # a directory that just shares a prefix shouldn't match
+        self.assertEquals(Item.ids_for_path_or_directory(subdir[:-1]), [])
+        self.assertEquals(Item.ids_for_path_or_directory(subdir,
+                                                         feed_id=-1), [])
+
+    def test_ids_for_nested_directory(self):
+        subdir = os.path.join(self.tempdir, 'a')
+        nested = os.path.join(subdir, 'b', 'c')
+        os.makedirs(nested)
+        self.add_item(u'video-1', nested)
+        path = os.path.join(nested, 'video-1')
+        nested_id = self.added_items[path].id
+        for directory in (self.tempdir, subdir, os.path.join(subdir, 'b'),
+                          nested):
+            self.assertEquals(Item.ids_for_path_or_directory(directory),
+                              [nested_id])
+        # once the only item is gone, the directories should be unlinked
+        self.added_items.pop(path).remove()
+        self.assertEquals(Item.ids_for_path_or_directory(self.tempdir), [])
+        self.assertEquals(Item._path_index.subdirectories, {})
+
+    def test_known_files(self):
+        self.add_item(u'video-1')
+        path = self.added_items.keys()[0]
+        other_path = os.path.join(self.tempdir, 'other')
+        known_files = item.KnownFiles()
+        known_files.add_path(other_path)
+        self.assertEquals(known_files.contains_path(path), True)
+        self.assertEquals(known_files.contains_path(other_path), True)
+        # items in the excluded feed shouldn't count
+        excluding = item.KnownFiles(exclude_feed_id=self.feed.id)
+        self.assertEquals(excluding.contains_path(path), False)
+        # the index should track changes to the item's feed
+        other_feed = Feed(u'http://example.com/2')
+        self.added_items[path].set_feed(other_feed.id)
+        self.added_items[path].signal_change()
+        self.assertEquals(excluding.contains_path(path), True)
+        self.assertEquals(
+            Item.ids_for_path_or_directory(path, feed_id=self.feed.id), [])
+        # removed items shouldn't count
+        self.remove_item(u'video-1')
+        self.assertEquals(known_files.contains_path(path), False)
+
 class ItemMetadataTest(MiroTestCase):
     # Test integration between the item and metadata modules.
     def setUp(self):
@@ -31,6 +31,8 @@
 
 import datetime
 import itertools
+import threading
+import time
 
 from miro import app
 from miro import downloader
@@ -306,6 +308,51 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
             self.assertNotEquals(row, None)
         self.check_tracker_items()
 
+    def test_background_fetch_size(self):
+        # test that we change the background fetch size to match how long
+        # fetches take
+        tracker = self.tracker
+        self.assertEquals(tracker.idle_fetch_size,
+                          tracker.MIN_IDLE_FETCH_SIZE)
+        # fast fetches should grow the size, but only double it at each step
+        tracker._update_idle_fetch_size(25, 0.0001)
+        self.assertEquals(tracker.idle_fetch_size,
+                          tracker.MIN_IDLE_FETCH_SIZE * 2)
+        tracker._update_idle_fetch_size(50, 0)
+        self.assertEquals(tracker.idle_fetch_size,
+                          tracker.MIN_IDLE_FETCH_SIZE * 4)
+        tracker._update_idle_fetch_size(100, 0.025)
+        self.assertEquals(tracker.idle_fetch_size, 200)
+        for i in xrange(10):
+            tracker._update_idle_fetch_size(1000, 0.0001)
+        self.assertEquals(tracker.idle_fetch_size,
+                          tracker.MAX_IDLE_FETCH_SIZE)
+        # slow fetches should shrink it
+        tracker._update_idle_fetch_size(1000, 10.0)
+        self.assertEquals(tracker.idle_fetch_size,
+                          tracker.MIN_IDLE_FETCH_SIZE)
+
+    def test_background_fetch_after_uncache(self):
+        # test that rows that get uncached during the background fetch get
+        # loaded again
+        self.tracker.MIN_IDLE_FETCH_SIZE = self.tracker.MAX_IDLE_FETCH_SIZE = 3
+        self.tracker.idle_fetch_size = 3
+        fetch_items = self.tracker.item_fetcher.fetch_items
+        fetch_sizes = []
+        def mock_fetch_items(id_list):
+            fetch_sizes.append(len(id_list))
+            return fetch_items(id_list)
+        self.tracker.item_fetcher.fetch_items = mock_fetch_items
+        self.run_tracker_idle()
+        self.assertEquals(fetch_sizes, [3])
+        self.tracker._uncache_row_data([self.tracker.id_list[0]])
+        self.run_all_tracker_idles()
+        self.assertEquals(sum(fetch_sizes), len(self.tracked_items) + 1)
+        self.assert_(max(fetch_sizes) <= 3)
+        self.assertSameSet(self.tracker.row_data.keys(),
+                           self.tracker.id_list)
+        self.check_tracker_items()
+
     def check_items_changed_after_message(self, changed_items):
         self.process_items_changed_messages()
         signal_args = self.check_one_signal('items-changed')
@@ -354,6 +401,19 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_items_changed_after_message([item1, item2])
         self.check_tracker_items()
 
+    def test_item_changes_with_group_commit(self):
+        # with group commit, we shouldn't send ItemChanges until the changes
+        # are committed, otherwise the tracker would read old data.
+        app.db.set_group_commit(60)
+        item1 = self.tracked_items[0]
+        item1.title = u'new title'
+        item1.signal_change()
+        self.process_items_changed_messages()
+        self.assertEquals(self.signal_handlers['items-changed'].call_count, 0)
+        app.db.request_commit()
+        self.check_items_changed_after_message([item1])
+        self.assertEquals(self.tracker.get_item(item1.id).title, u'new title')
+
     def test_add_remove(self):
         # adding items to our tracked feed should result in the list-changed
         # signal
@@ -632,6 +692,108 @@ class ItemTrackTestNonWALMode(ItemTrackTestWALMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
 
+class ItemTrackProfileTestWALMode(ItemTrackTestWALMode):
+    # Run the ItemTracker tests using a projection profile and check that
+    # the columns it leaves out get loaded lazily
+    def setup_tracker(self):
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', self.tracked_feed.id)
+        query.set_order_by(['release_date'])
+        self.tracker = itemtrack.ItemTracker(self.idle_scheduler, query,
+                                             item.ItemSource('list'))
+
+    def fetch_full_item_info(self, item_id):
+        connection = self.connection_pool.get_connection()
+        try:
+            return item.fetch_item_infos(connection, [item_id])[0]
+        finally:
+            self.connection_pool.release_connection(connection)
+
+    def check_attributes(self, item_info, full_item_info):
+        for select_column in item.ItemInfo.select_info.select_columns:
+            attr_name = select_column.attr_name
+            self.assertEquals(getattr(item_info, attr_name),
+                              getattr(full_item_info, attr_name),
+                              "%s differs" % attr_name)
+
+    def test_projection(self):
+        item_info = self.tracker.get_first_item()
+        select_info = item_info.select_info
+        self.assertEquals(select_info.profile, 'list')
+        self.assertEquals(len(item_info.row_data),
+                          len(select_info.select_columns))
+        self.assert_(len(item_info.row_data) <
+                     len(item.ItemInfo.select_info.select_columns))
+        self.assert_('license' not in
+                     [c.attr_name for c in select_info.select_columns])
+        self.assertEquals(select_info.joined_tables,
+                          set(['feed', 'remote_downloader', 'icon_cache']))
+        self.assertEquals(item_info.full_row_data, None)
+
+    # ItemInfo attributes that the list view columns use (see the renderers
+    # in frontends/widgets/style.py)
+    LIST_VIEW_ATTRIBUTES = [
+        'title', 'description_oneline', 'parent_title', 'feed_id',
+        'release_date', 'duration', 'eta_text', 'is_torrent', 'seeders',
+        'leechers', 'upload_rate_text', 'upload_size_text',
+        'download_rate_text', 'downloaded_size_text', 'upload_size',
+        'size', 'artist', 'album', 'track', 'year', 'genre', 'date_added',
+        'has_drm', 'file_format', 'show', 'kind', 'rating',
+        'auto_rating', 'is_download', 'pending_manual_download', 'device',
+        'remote', 'downloaded', 'is_paused', 'is_playable', 'video_watched',
+        'expiration_date', 'is_failed_download', 'short_reason_failed',
+        'rate', 'startup_activity', 'new', 'cover_art_path', 'thumbnail',
+        'download_progress',
+    ]
+
+    def test_list_view_attributes(self):
+        # rendering the list view columns shouldn't need any lazy loads
+        item_info = self.tracker.get_first_item()
+        for attr_name in self.LIST_VIEW_ATTRIBUTES:
+            getattr(item_info, attr_name)
+            self.assertEquals(item_info.full_row_data, None,
+                              "%s needed a lazy load" % attr_name)
+
+    def test_lazy_load(self):
+        item1 = self.tracked_items[0]
+        item1.license = u'http://example.com/license'
+        item1.signal_change()
+        self.process_items_changed_messages()
+        item_info = self.tracker.get_item(item1.id)
+        self.assertEquals(item_info.license, u'http://example.com/license')
+        self.assertNotEquals(item_info.full_row_data, None)
+        self.check_attributes(item_info, self.fetch_full_item_info(item1.id))
+
+    def test_lazy_load_after_destroy(self):
+        item1, item2 = self.tracked_items[:2]
+        item_info1 = self.tracker.get_item(item1.id)
+        item_info2 = self.tracker.get_item(item2.id)
+        item2.remove()
+        app.db.finish_transaction()
+        self.tracker.destroy()
+        # without the ItemFetcher's connection, we should use a connection
+        # from the pool
+        self.check_attributes(item_info1,
+                              self.fetch_full_item_info(item1.id))
+        # if the item is gone, we should use the default values
+        self.assertEquals(item_info2.license, None)
+        self.assertEquals(item_info2.resume_time, 0)
+        self.assertEquals(item_info2.feed_expire, item_info1.feed_expire)
+        self.assertEquals(item_info2.title, item2.title)
+
+    def test_change_item_source(self):
+        self.tracker.change_item_source(item.ItemSource())
+        self.check_one_signal('list-changed')
+        self.check_tracker_items()
+        item_info = self.tracker.get_first_item()
+        self.assertEquals(item_info.select_info.profile, None)
+        self.assertEquals(len(item_info.row_data),
+                          len(item.ItemInfo.select_info.select_columns))
+
+class ItemTrackProfileTestNonWALMode(ItemTrackProfileTestWALMode):
+    def force_wal_mode(self):
+        self.connection_pool.wal_mode = False
+
 class DeviceItemTrackTestWALMode(ItemTrackTestCase):
     def setup_items(self):
         self.device = testobjects.make_mock_device()
@@ -929,3 +1091,165 @@ class BackendItemTrackerTest(MiroTestCase):
         self.items[0].signal_change()
         self.process_item_changes()
         self.assertEquals(self.items_changed_callback.call_count, 0)
+
+class ConnectionPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.destroy()
+        MiroTestCase.tearDown(self)
+
+    def make_pool(self, **kwargs):
+        pool = connectionpool.ConnectionPool(self.make_temp_path('.sqlite'),
+                                             **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_warm_up(self):
+        pool = self.make_pool(min_connections=2)
+        self.assertEquals(len(pool.all_connections), 2)
+        self.assertEquals(len(pool.free_connections), 2)
+        connection = pool.get_connection()
+        cursor = connection.execute("PRAGMA temp_store")
+        self.assertEquals(cursor.fetchone()[0], 2) # 2 is MEMORY
+        cursor = connection.execute("PRAGMA cache_size")
+        self.assertEquals(cursor.fetchone()[0], 4000)
+        pool.release_connection(connection)
+
+    def test_thread_pinning(self):
+        pool = self.make_pool(min_connections=0, idle_timeout=60)
+        def get_and_release():
+            connection = pool.get_connection()
+            pool.release_connection(connection)
+            return connection
+        thread_connections = []
+        first_get_done = threading.Event()
+        run_second_get = threading.Event()
+        def thread_func():
+            thread_connections.append(get_and_release())
+            first_get_done.set()
+            run_second_get.wait()
+            thread_connections.append(get_and_release())
+        main_connection = get_and_release()
+        thread = threading.Thread(target=thread_func)
+        thread.start()
+        first_get_done.wait()
+        self.assertNotEquals(main_connection, thread_connections[0])
+        # each thread should get the same connection back
+        self.assertEquals(get_and_release(), main_connection)
+        run_second_get.set()
+        thread.join()
+        self.assertEquals(thread_connections[1], thread_connections[0])
+
+    def test_limit(self):
+        # if the current thread has all the connections, we shouldn't wait
+        pool = self.make_pool(min_connections=0, max_connections=2,
+                              wait_timeout=10)
+        connections = [pool.get_connection(), pool.get_connection()]
+        start = time.time()
+        self.assertRaises(connectionpool.ConnectionLimitError,
+                          pool.get_connection)
+        self.assert_(time.time() - start < 1.0)
+        for connection in connections:
+            pool.release_connection(connection)
+        self.assertEquals(pool.get_stats()['timeouts'], 1)
+
+    def start_thread_with_connection(self, pool):
+        """Start a thread that gets a connection and holds it until the
+        event that we return is set.
+        """
+        have_connection = threading.Event()
+        release = threading.Event()
+        def thread_func():
+            connection = pool.get_connection()
+            have_connection.set()
+            release.wait()
+            pool.release_connection(connection)
+        thread = threading.Thread(target=thread_func)
+        thread.start()
+        have_connection.wait()
+        return thread, release
+
+    def test_wait(self):
+        pool = self.make_pool(min_connections=0, max_connections=1)
+        thread, release = self.start_thread_with_connection(pool)
+        timer = threading.Timer(0.1, release.set)
+        timer.start()
+        connection = pool.get_connection()
+        pool.release_connection(connection)
+        thread.join()
+        stats = pool.get_stats()
+        self.assertEquals(stats['waits'], 1)
+        self.assert_(stats['wait_time'] > 0)
+        self.assertEquals(stats['timeouts'], 0)
+
+    def test_wait_timeout(self):
+        pool = self.make_pool(min_connections=0, max_connections=1)
+        thread, release = self.start_thread_with_connection(pool)
+        try:
+            self.assertRaises(connectionpool.ConnectionLimitError,
+                              pool.get_connection, timeout=0.1)
+        finally:
+            release.set()
+            thread.join()
+        stats = pool.get_stats()
+        self.assertEquals(stats['waits'], 1)
+        self.assertEquals(stats['timeouts'], 1)
+
+    def test_stats(self):
+        pool = self.make_pool(min_connections=1)
+        connections = [pool.get_connection() for i in xrange(3)]
+        pool.release_connection(connections.pop())
+        connections.append(pool.get_connection())
+        stats = pool.get_stats()
+        self.assertEquals(stats['checked_out'], 3)
+        self.assertEquals(stats['high_water_mark'], 3)
+        # the pool makes 1 checkout to check the WAL mode
+        self.assertEquals(stats['checkouts'], 5)
+        for connection in connections:
+            pool.release_connection(connection)
+        stats = pool.get_stats()
+        self.assertEquals(stats['checked_out'], 0)
+        self.assertEquals(stats['connections'], 1)
+        self.assertEquals(stats['high_water_mark'], 3)
+
+    def test_reap_idle_connections(self):
+        pool = self.make_pool(min_connections=1, idle_timeout=60)
+        connections = [pool.get_connection() for i in xrange(3)]
+        for connection in connections:
+            pool.release_connection(connection)
+        # connections past min_connections are kept until they're idle
+        self.assertEquals(len(pool.all_connections), 3)
+        self.assertEquals(pool.reap_idle_connections(), 0)
+        for connection in connections:
+            connection.last_used -= 61
+        self.assertEquals(pool.reap_idle_connections(), 2)
+        self.assertEquals(len(pool.all_connections), 1)
+
+    def test_device_pool(self):
+        # device pools shouldn't keep connections open once they're released
+        # or memory-map the database.  Either one could stop the device from
+        # being unmounted.
+        device_info = mock.Mock(sqlite_path=self.make_temp_path('.sqlite'))
+        pool = connectionpool.DeviceConnectionPool(device_info)
+        self.pools.append(pool)
+        connection = pool.get_connection()
+        cursor = connection.execute("PRAGMA mmap_size")
+        self.assertEquals(cursor.fetchone()[0], 0)
+        pool.release_connection(connection)
+        self.assertEquals(pool.all_connections, set())
+
+    def test_close_free_connections(self):
+        pool = self.make_pool(min_connections=0, idle_timeout=60)
+        connection = pool.get_connection()
+        connection2 = pool.get_connection()
+        pool.release_connection(connection2)
+        pool.close_free_connections()
+        self.assertEquals(pool.all_connections, set([connection]))
+        # connections released after close_free_connections() should be
+        # closed right away
+        pool.release_connection(connection)
+        self.assertEquals(pool.all_connections, set())
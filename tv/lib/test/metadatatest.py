@@ -277,7 +277,8 @@ class MetadataManagerTest(MiroTestCase):
         return os.path.join(*path_parts)
 
     def check_run_mutagen(self, filename, file_type, duration, title,
-                          album=None, drm=False, cover_art=True):
+                          album=None, drm=False, cover_art=True,
+                          fingerprint=None):
         # NOTE: real mutagen calls send more metadata, but this is enough to
         # test
         path = self.make_path(filename)
@@ -299,7 +300,10 @@ class MetadataManagerTest(MiroTestCase):
                 open(cover_art, 'wb').write("FAKE FILE")
                 mutagen_data['created_cover_art'] = True
         self.mutagen_data[path] = mutagen_data
-        self.processor.run_mutagen_callback(path, mutagen_data)
+        callback_data = mutagen_data.copy()
+        if fingerprint is not None:
+            callback_data['fingerprint'] = fingerprint
+        self.processor.run_mutagen_callback(path, callback_data)
         self.check_metadata(path)
 
     def check_queued_mutagen_calls(self, filenames):
@@ -794,8 +798,108 @@ class MetadataManagerTest(MiroTestCase):
             self.make_path('foo-5.mp3'),
         )
 
+    def test_batched_results(self):
+        # Test handling several results in a single run_updates() call
+        filenames = ['foo.mp3', 'foo-2.mp3', 'foo-3.mp3', 'bar.mp3']
+        for filename in filenames:
+            self.check_add_file(filename)
+        self.metadata_manager.run_updates()
+        signal_handler = mock.Mock()
+        self.metadata_manager.connect("new-metadata", signal_handler)
+        # Simulate mutagen finishing for all files before run_updates() gets
+        # called.  Two files from AlbumOne have cover art, but we should
+        # only need to update the rest of the album once.
+        for filename, album, cover_art in (
+            ('foo.mp3', 'AlbumOne', False),
+            ('foo-2.mp3', 'AlbumOne', True),
+            ('foo-3.mp3', 'AlbumOne', True),
+            ('bar.mp3', 'AlbumTwo', False)):
+            path = self.make_path(filename)
+            mutagen_data = {
+                'file_type': u'audio',
+                'duration': 100,
+                'title': u'title',
+                'album': unicode(album),
+                'drm': False,
+            }
+            if cover_art:
+                mutagen_data['cover_art'] = self.cover_art(album)
+                if not os.path.exists(mutagen_data['cover_art']):
+                    open(mutagen_data['cover_art'], 'wb').write("FAKE FILE")
+                    mutagen_data['created_cover_art'] = True
+            self.mutagen_data[path] = mutagen_data
+            self.processor.run_mutagen_callback(path, mutagen_data)
+        paths_for_album = mock.Mock(
+            wraps=metadata.MetadataStatus.paths_for_album)
+        with mock.patch.object(metadata.MetadataStatus, 'paths_for_album',
+                               paths_for_album):
+            self.metadata_manager.run_updates()
+        self.assertEquals(paths_for_album.call_count, 1)
+        self.assertEquals(paths_for_album.call_args[0][0], u'AlbumOne')
+        self.assertEquals(signal_handler.call_count, 1)
+        new_metadata = signal_handler.call_args[0][1]
+        self.assertSameSet(new_metadata.keys(),
+                           [self.make_path(f) for f in filenames])
+        cover_art = self.cover_art('AlbumOne')
+        for filename in ('foo.mp3', 'foo-2.mp3', 'foo-3.mp3'):
+            path = self.make_path(filename)
+            self.assertEquals(new_metadata[path]['cover_art'], cover_art)
+            self.check_metadata(path)
+        self.assert_('cover_art' not in
+                     new_metadata[self.make_path('bar.mp3')])
+        self.check_metadata('bar.mp3')
+        # check the bulk status lookup
+        paths = [self.make_path(f) for f in filenames]
+        statuses = metadata.MetadataStatus.get_by_paths(
+            paths + [self.make_path('missing.mp3')])
+        self.assertSameSet(statuses.keys(), paths)
+        for path in paths:
+            self.assertEquals(statuses[path].path, path)
+
+    def test_fingerprint_copies_metadata(self):
+        # Test that when we see a file with the same contents as one that
+        # we've already processed, we copy its metadata rather than running
+        # the movie data program again
+        self.check_add_file('foo.avi')
+        self.check_run_mutagen('foo.avi', 'video', 100, 'Foo',
+                               fingerprint=u'1000-abc')
+        self.check_run_movie_data('foo.avi', 'video', 100, True)
+        self.metadata_manager.run_updates()
+        # simulate the file getting moved outside of miro
+        old_path = self.make_path('foo.avi')
+        new_path = self.make_path('/music/foo.avi')
+        self.check_add_file(new_path)
+        self.movieprogram_data[new_path] = self.movieprogram_data[old_path]
+        self.check_run_mutagen(new_path, 'video', 100, 'Foo',
+                               fingerprint=u'1000-abc')
+        self.check_queued_moviedata_calls([])
+        status = metadata.MetadataStatus.get_by_path(new_path)
+        self.assertEquals(status.current_processor, None)
+        self.assertEquals(status.fingerprint, u'1000-abc')
+        # the copy should share the screenshot with the original
+        self.assertEquals(self.get_metadata(new_path)['screenshot'],
+                          self.get_metadata(old_path)['screenshot'])
+
+    def test_fingerprint_no_match(self):
+        # Test files with different fingerprints, or that match a file that
+        # we haven't finished processing
+        self.check_add_file('foo.avi')
+        self.check_add_file('bar.avi')
+        self.check_add_file('baz.avi')
+        self.check_run_mutagen('foo.avi', 'video', 100, 'Foo',
+                               fingerprint=u'1000-abc')
+        self.check_run_mutagen('bar.avi', 'video', 100, 'Foo',
+                               fingerprint=u'1000-abc')
+        self.check_run_movie_data('foo.avi', 'video', 100, True)
+        self.metadata_manager.run_updates()
+        self.check_run_mutagen('baz.avi', 'video', 100, 'Foo',
+                               fingerprint=u'2000-def')
+        self.check_queued_moviedata_calls(['bar.avi', 'baz.avi'])
+        status = metadata.MetadataStatus.get_by_path(self.make_path('baz.avi'))
+        self.assertEquals(status.fingerprint, u'2000-def')
+
     def test_restart_incomplete(self):
-        # test restarting incomplete 
+        # test restarting incomplete
         self.check_add_file('foo.avi')
         self.check_run_mutagen('foo.avi', 'video', 100, 'Foo')
         self.check_add_file('bar.avi')
@@ -0,0 +1,513 @@
+"""Performance tests.
+
+These don't run with the rest of the unit tests.  To run them, list them
+explicitly on the command line, for example::
+
+    ./test.sh -v miro.test.performancetest
+
+Each test prints out its timings.  Some of them also compare the results of
+different implementations.
+"""
+
+import gc
+import random
+import shutil
+import sqlite3
+import time
+
+from miro import app
+from miro import databaseupgrade
+from miro import eventloop
+from miro import metadata
+from miro import models
+from miro import prefs
+from miro import schema
+from miro import storedatabase
+from miro import util
+from miro import workerprocess
+from miro.data import item as dataitem
+from miro.data import itemtrack
+from miro.frontends.widgets import itemlist
+from miro.frontends.widgets import itemsort
+from miro.plat import resources
+from miro.test import testobjects
+from miro.test.framework import EventLoopTest, MiroTestCase
+
+def report(name, count, elapsed):
+    print
+    print '%s: %d in %.3f secs (%.0f/sec)' % (name, count, elapsed,
+                                             count / elapsed)
+
+class EventLoopDispatchPerformanceTest(EventLoopTest):
+    """Measure how quickly the event loop dispatches callbacks."""
+    CALL_COUNT = 100000
+    SOCKET_COUNT = 200
+    POLL_COUNT = 2000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.call_count = 0
+
+    def callback(self):
+        self.call_count += 1
+        if self.call_count == self.CALL_COUNT:
+            eventloop.shutdown()
+
+    def test_idle_dispatch(self):
+        start = time.time()
+        for i in xrange(self.CALL_COUNT):
+            eventloop.add_idle(self.callback, 'performance test')
+        self.runEventLoop(timeout=60)
+        report('idle calls', self.CALL_COUNT, time.time() - start)
+
+    def test_chained_idle_dispatch(self):
+        # Each idle call schedules the next one.  This measures the cost of
+        # going through the loop, including the add_idle() wakeup.
+        def chained_callback():
+            self.callback()
+            if self.call_count < self.CALL_COUNT:
+                eventloop.add_idle(chained_callback, 'performance test')
+        start = time.time()
+        eventloop.add_idle(chained_callback, 'performance test')
+        self.runEventLoop(timeout=60)
+        report('chained idle calls', self.CALL_COUNT, time.time() - start)
+
+    def test_thread_wakeups(self):
+        # Call wakeup() from a thread pool call for each idle.  Most of these
+        # should get coalesced.
+        def thread_func():
+            eventloop.add_idle(self.callback, 'performance test')
+            return None
+        def thread_callback(result):
+            pass
+        start = time.time()
+        for i in xrange(self.CALL_COUNT):
+            eventloop.call_in_thread(thread_callback, thread_callback,
+                                     thread_func, 'performance test')
+        self.runEventLoop(timeout=60)
+        report('thread pool wakeups', self.CALL_COUNT, time.time() - start)
+
+    def test_socket_dispatch(self):
+        # Register SOCKET_COUNT idle sockets and one active one, then count
+        # how fast we dispatch read callbacks for the active one.
+        pairs = [util.make_dummy_socket_pair()
+                 for i in xrange(self.SOCKET_COUNT)]
+        try:
+            for sock1, sock2 in pairs:
+                eventloop.add_read_callback(sock2, lambda: None)
+            sender, receiver = pairs[0]
+            sender.send('a')
+            def on_read():
+                self.callback()
+                if self.call_count >= self.CALL_COUNT / 10:
+                    eventloop.shutdown()
+            eventloop.add_read_callback(receiver, on_read)
+            start = time.time()
+            self.runEventLoop(timeout=60)
+            report('socket callbacks (%d sockets)' % self.SOCKET_COUNT,
+                   self.call_count, time.time() - start)
+        finally:
+            for sock1, sock2 in pairs:
+                eventloop.stop_handling_socket(sock2)
+                sock1.close()
+                sock2.close()
+
+    def check_poller(self, poller_class):
+        pairs = [util.make_dummy_socket_pair()
+                 for i in xrange(self.SOCKET_COUNT)]
+        try:
+            poller = poller_class()
+            for sock1, sock2 in pairs:
+                poller.update(sock2.fileno(), True, False)
+            pairs[0][0].send('a')
+            start = time.time()
+            for i in xrange(self.POLL_COUNT):
+                poller.poll(0)
+            report('%s polls (%d sockets)' % (poller_class.__name__,
+                                              self.SOCKET_COUNT),
+                   self.POLL_COUNT, time.time() - start)
+        finally:
+            for sock1, sock2 in pairs:
+                sock1.close()
+                sock2.close()
+
+    def test_pollers(self):
+        self.check_poller(eventloop.SelectPoller)
+        if hasattr(eventloop, 'EpollPoller') and hasattr(eventloop.select,
+                                                         'epoll'):
+            self.check_poller(eventloop.EpollPoller)
+
+class ItemListPerformanceTest(MiroTestCase):
+    """Compare sorting and grouping item lists with and without the column
+    index.
+    """
+    ITEM_COUNT = 5000
+    REPEAT_COUNT = 10
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        feed = models.Feed(u'http://example.com/feed.rss')
+        for i in xrange(self.ITEM_COUNT):
+            item = testobjects.make_item(feed, u'item-%s' % i)
+            item.title = u'Title %s' % random.randint(0, 100000)
+            item.artist = u'Artist %s' % random.randint(0, 50)
+            item.album = u'Album %s' % random.randint(0, 200)
+            item.track = random.randint(1, 20)
+            item.signal_change()
+        app.db.finish_transaction()
+        self.feed_id = feed.id
+
+    def time_item_list(self, use_column_index):
+        app.config.set(prefs.ITEM_LIST_COLUMN_INDEX, use_column_index)
+        start = time.time()
+        item_list = itemlist.ItemList('feed', self.feed_id)
+        report('create list (column index: %s)' % use_column_index, 1,
+               time.time() - start)
+        sorts = [itemsort.TitleSort(), itemsort.ArtistSort(False),
+                 itemsort.SizeSort()]
+        start = time.time()
+        for i in xrange(self.REPEAT_COUNT):
+            for sort in sorts:
+                item_list.set_sort(sort)
+        report('change sort (column index: %s)' % use_column_index,
+               self.REPEAT_COUNT * len(sorts), time.time() - start)
+        item_list.set_sort(itemsort.AlbumSort())
+        start = time.time()
+        for i in xrange(self.REPEAT_COUNT):
+            item_list.set_grouping(itemlist.album_grouping)
+            for row in xrange(len(item_list)):
+                item_list.get_group_info(row)
+        report('group list (column index: %s)' % use_column_index,
+               self.REPEAT_COUNT, time.time() - start)
+        item_list.destroy()
+
+    def test_item_list(self):
+        self.time_item_list(False)
+        self.time_item_list(True)
+
+class ItemTrackerIdleFetchPerformanceTest(MiroTestCase):
+    """Compare loading an ItemTracker in the background with fixed size
+    fetches and with adaptive ones.
+    """
+    ITEM_COUNT = 10000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        feed = models.Feed(u'http://example.com/feed.rss')
+        for i in xrange(self.ITEM_COUNT):
+            item = testobjects.make_item(feed, u'item-%s' % i)
+            item.title = u'Title %s' % random.randint(0, 100000)
+            item.signal_change()
+        app.db.finish_transaction()
+        self.feed_id = feed.id
+
+    def time_idle_fetch(self, adaptive):
+        idle_callbacks = []
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', self.feed_id)
+        query.set_order_by(['title'])
+        tracker = itemtrack.ItemTracker(idle_callbacks.append, query,
+                                        dataitem.ItemSource())
+        if not adaptive:
+            tracker.MAX_IDLE_FETCH_SIZE = tracker.MIN_IDLE_FETCH_SIZE
+        idle_count = 0
+        start = time.time()
+        while idle_callbacks:
+            idle_callbacks.pop()()
+            idle_count += 1
+        elapsed = time.time() - start
+        report('rows loaded (adaptive: %s, %d idle calls)' %
+               (adaptive, idle_count), len(tracker), elapsed)
+        tracker.destroy()
+
+    def test_idle_fetch(self):
+        self.time_idle_fetch(False)
+        self.time_idle_fetch(True)
+
+class ItemInfoProfilePerformanceTest(MiroTestCase):
+    """Compare fetching ItemInfos with each projection profile.
+
+    For each profile, we print the bytes fetched and the time it takes to
+    fetch 1000 rows, using the same chunk size as ItemTracker.
+    """
+    ITEM_COUNT = 5000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        feed = models.Feed(u'http://example.com/feed.rss')
+        description = u'<p>%s</p>' % (u'Some long description text. ' * 40)
+        for i in xrange(self.ITEM_COUNT):
+            item = testobjects.make_item(feed, u'item-%s' % i)
+            item.entry_description = description
+            item.artist = u'Artist %s' % random.randint(0, 50)
+            item.album = u'Album %s' % random.randint(0, 200)
+            item.signal_change()
+        app.db.finish_transaction()
+        self.id_list = [i.id for i in models.Item.make_view()]
+
+    def row_size(self, row):
+        size = 0
+        for value in row:
+            if isinstance(value, unicode):
+                size += len(value.encode('utf-8'))
+            elif isinstance(value, (str, buffer)):
+                size += len(value)
+            elif value is not None:
+                size += 8
+        return size
+
+    def time_profile(self, profile):
+        item_source = dataitem.ItemSource(profile)
+        connection = item_source.get_connection()
+        fetcher = itemtrack.ItemFetcherWAL(connection, item_source,
+                                           self.id_list)
+        chunk_size = itemtrack.ItemTracker.FETCH_ROW_CHUNK_SIZE
+        item_infos = []
+        start = time.time()
+        for i in xrange(0, len(self.id_list), chunk_size):
+            item_infos.extend(fetcher.fetch_items(
+                self.id_list[i:i+chunk_size]))
+        elapsed = time.time() - start
+        size = sum(self.row_size(info.row_data) for info in item_infos)
+        rows_per_k = len(item_infos) / 1000.0
+        print
+        print ('%s: %d columns, %.0f bytes and %.3f secs per 1k rows' %
+               (profile or 'full', len(item_source.select_info.select_columns),
+                size / rows_per_k, elapsed / rows_per_k))
+        if profile is not None:
+            # time lazily loading the rest of the columns for 100 items
+            start = time.time()
+            for info in item_infos[:100]:
+                info.description
+            print ('%s: lazy loading 100 items: %.3f secs' %
+                   (profile, time.time() - start))
+        fetcher.destroy()
+
+    def test_profiles(self):
+        self.time_profile(None)
+        for profile in sorted(dataitem.ItemSelectInfo.profiles):
+            self.time_profile(profile)
+
+class GroupCommitPerformanceTest(EventLoopTest):
+    """Compare committing after every event loop callback with group commit.
+
+    Each COMMIT is an fsync of the database (or the WAL file) with the
+    default synchronous setting, so the commit counts are also fsync counts.
+    """
+    CALLBACK_COUNT = 2000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.init_data_package()
+        feed = models.Feed(u'http://example.com/feed.rss')
+        self.items = [testobjects.make_item(feed, u'item-%s' % i)
+                      for i in xrange(100)]
+        app.db.finish_transaction()
+
+    def update_item(self, i):
+        item = self.items[i % len(self.items)]
+        item.title = u'title %s' % i
+        item.signal_change()
+        if i == self.CALLBACK_COUNT - 1:
+            eventloop.shutdown()
+
+    def time_updates(self, group_commit_time):
+        app.db.set_group_commit(group_commit_time)
+        commit_count = app.db.commit_count
+        start = time.time()
+        for i in xrange(self.CALLBACK_COUNT):
+            eventloop.add_idle(self.update_item, 'group commit test',
+                               args=(i,))
+        self.runEventLoop(timeout=120)
+        app.db.finish_transaction()
+        elapsed = time.time() - start
+        report('updates (group commit time: %s)' % group_commit_time,
+               self.CALLBACK_COUNT, elapsed)
+        commits = app.db.commit_count - commit_count
+        print 'commits: %d (%.0f/sec)' % (commits, commits / elapsed)
+
+    def test_group_commit(self):
+        self.time_updates(0)
+        self.time_updates(0.1)
+        self.time_updates(0.25)
+
+class DatabaseUpgradePerformanceTest(MiroTestCase):
+    """Time upgrading an old database with and without coalescing table
+    rewrites.
+
+    We start with the olddatabase.v79 fixture, convert it to a version 80
+    database and add ITEM_COUNT rows to the item table.  Then we time the
+    new-style upgrades from version 80 to the current version.
+    """
+    ITEM_COUNT = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.v80_path = self.make_temp_path('.db')
+        shutil.copy(resources.path("testdata/olddatabase.v79"),
+                    self.v80_path)
+        storage = storedatabase.LiveStorage(self.v80_path, schema_version=80)
+        storage._upgrade_20_database()
+        storage.close()
+        self.add_items(self.v80_path)
+
+    def add_items(self, path):
+        connection = sqlite3.connect(path, isolation_level=None)
+        connection.execute("BEGIN TRANSACTION")
+        max_id = connection.execute("SELECT MAX(id) FROM item").fetchone()[0]
+        item_ids = [row[0] for row in
+                    connection.execute("SELECT id FROM item")]
+        columns = [row[1] for row in
+                   connection.execute("PRAGMA table_info(item)")
+                   if row[1] != 'id']
+        for i in xrange(self.ITEM_COUNT):
+            connection.execute("INSERT INTO item(id, %s) SELECT ?, %s "
+                               "FROM item WHERE id=?" %
+                               (', '.join(columns), ', '.join(columns)),
+                               (max_id + i + 1, item_ids[i % len(item_ids)]))
+        connection.execute("COMMIT TRANSACTION")
+        connection.close()
+
+    def time_upgrade(self, coalesce_rewrites):
+        path = self.make_temp_path('.db')
+        shutil.copy(self.v80_path, path)
+        connection = sqlite3.connect(path, isolation_level=None)
+        start = time.time()
+        timings = databaseupgrade.new_style_upgrade(
+            connection.cursor(), 80, schema.VERSION, 'main', False,
+            coalesce_rewrites=coalesce_rewrites)
+        report('upgrade 80 -> %s (coalesce rewrites: %s)' %
+               (schema.VERSION, coalesce_rewrites),
+               len(timings), time.time() - start)
+        for version, elapsed in sorted(timings, key=lambda t: t[1],
+                                       reverse=True)[:5]:
+            print 'upgrade%s: %.3f secs' % (version, elapsed)
+        # return the schema and data so that we can check that coalescing
+        # rewrites gives the same results
+        contents = connection.execute("SELECT type, name, sql "
+                                      "FROM sqlite_master "
+                                      "ORDER BY type, name").fetchall()
+        for (table,) in connection.execute("SELECT name FROM sqlite_master "
+                                           "WHERE type='table' "
+                                           "ORDER BY name").fetchall():
+            contents.extend(connection.execute("SELECT * FROM %s "
+                                               "ORDER BY rowid" % table))
+        connection.close()
+        return contents
+
+    def test_upgrade(self):
+        contents = self.time_upgrade(False)
+        self.assert_(self.time_upgrade(True) == contents)
+
+class MetadataImportPerformanceTest(MiroTestCase):
+    """Time applying mutagen results when importing a batch of files.
+
+    We intercept the MutagenTasks that the metadata manager sends and reply
+    with synthetic results.  Every album has cover art, so this also covers
+    propagating the cover art to the rest of the album.
+    """
+    FILE_COUNT = 2000
+    ALBUM_SIZE = 10
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        self.tasks = []
+        self.patch_function('miro.workerprocess.send', self.send)
+
+    def send(self, task, callback, errback):
+        if isinstance(task, workerprocess.MutagenTask):
+            self.tasks.append((task, callback))
+
+    def mutagen_result(self, i, path):
+        album = u'Album %d' % (i // self.ALBUM_SIZE)
+        result = {
+            'source_path': path,
+            'file_type': u'audio',
+            'duration': 200,
+            'title': u'Title %d' % i,
+            'album': album,
+            'artist': u'Artist',
+            'drm': False,
+        }
+        if i % self.ALBUM_SIZE == 0:
+            result['cover_art'] = self.make_temp_path('.jpg')
+            result['created_cover_art'] = True
+        return result
+
+    def time_import(self, batch_size):
+        manager = metadata.LibraryMetadataManager(self.tempdir, self.tempdir)
+        paths = ['/videos/%d/file-%d.mp3' % (batch_size, i)
+                 for i in xrange(self.FILE_COUNT)]
+        app.bulk_sql_manager.start()
+        try:
+            for path in paths:
+                manager.add_file(path)
+        finally:
+            app.bulk_sql_manager.finish()
+        manager.run_updates()
+        path_indexes = dict((path, i) for i, path in enumerate(paths))
+        result_count = 0
+        start = time.time()
+        # the mutagen processor limits how many tasks are outstanding, so
+        # new tasks get sent as we process the results for the old ones
+        while self.tasks:
+            tasks, self.tasks = self.tasks, []
+            for task, callback in tasks:
+                path = task.source_path
+                callback(task, self.mutagen_result(path_indexes[path], path))
+                result_count += 1
+                if result_count % batch_size == 0:
+                    manager.run_updates()
+            manager.run_updates()
+        app.db.finish_transaction()
+        report('mutagen results (batch size: %d)' % batch_size,
+               result_count, time.time() - start)
+        self.assertEquals(result_count, self.FILE_COUNT)
+
+    def test_import(self):
+        self.time_import(1)
+        self.time_import(100)
+
+class ItemMemoryPerformanceTest(MiroTestCase):
+    """Measure the memory used by each Item restored from the database.
+
+    We print the RSS increase per item after restoring them, then again
+    after allocating the per-object signal and change tracking data that
+    SignalEmitter and DDBObject create lazily.  The second number is what
+    every item used to cost.
+    """
+    ITEM_COUNT = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        feed = models.Feed(u'http://example.com/feed.rss')
+        for i in xrange(self.ITEM_COUNT):
+            testobjects.make_item(feed, u'item-%s' % i)
+        app.db.finish_transaction()
+
+    def mem_usage(self):
+        gc.collect()
+        return util.get_mem_usage() * 1024
+
+    def report_usage(self, name, start_usage):
+        print
+        print '%s: %.0f bytes per item' % (
+            name, float(self.mem_usage() - start_usage) / self.ITEM_COUNT)
+
+    def test_item_memory(self):
+        app.db.forget_all_objects()
+        start_usage = self.mem_usage()
+        items = list(models.Item.make_view())
+        self.assertEquals(len(items), self.ITEM_COUNT)
+        self.report_usage('restored items', start_usage)
+        for item in items:
+            for name in item._signal_names:
+                item.get_callbacks(name)
+            item._currently_emitting = set()
+            item._okay_to_nest = set()
+            item.changed_attributes = set()
+        self.report_usage('with signal/change tracking data', start_usage)
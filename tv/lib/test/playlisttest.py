@@ -6,6 +6,7 @@ from miro.item import Item, FeedParserValues, setup_metadata_manager
 from miro.playlist import SavedPlaylist, PlaylistItemMap
 from miro.folder import PlaylistFolder, PlaylistFolderItemMap
 from miro import app
+from miro import playlist
 from miro import tabs
 from miro.test.framework import (
     EventLoopTest, MiroTestCase, skip_for_platforms)
@@ -101,6 +102,105 @@ class PlaylistTestCase(PlaylistTestBase):
             check_list.remove(i)
             self.check_list(playlist, check_list)
 
+class PlaylistBulkTestCase(PlaylistTestBase):
+    def setUp(self):
+        PlaylistTestBase.setUp(self)
+        self.items = [self.i1, self.i2, self.i3, self.i4]
+        for i in range(4):
+            self.items.append(Item(FeedParserValues({'title': u'item%d' % i}),
+                                   feed_id=self.feed.id))
+        self.playlist = SavedPlaylist(u"rocketboom")
+
+    def get_positions(self):
+        return dict((m.item_id, m.position) for m in
+                    PlaylistItemMap.playlist_view(self.playlist.id))
+
+    def test_add_ids(self):
+        self.playlist.add_ids([self.i3.id, self.i1.id])
+        self.playlist.add_ids([self.i1.id, self.i4.id, self.i2.id, self.i4.id])
+        self.check_list(self.playlist, [self.i3, self.i1, self.i4, self.i2])
+        self.assert_(self.i4.keep)
+        self.assert_(Item.change_tracker.playlists_changed)
+        # positions should be spaced out
+        self.assertEquals(sorted(self.get_positions().values()),
+                          [i * playlist.POSITION_GAP for i in range(4)])
+
+    def test_remove_ids(self):
+        self.playlist.add_ids([i.id for i in self.items])
+        removed = self.playlist.remove_ids([self.i2.id, self.i4.id, -1])
+        self.assertEquals(sorted(removed), sorted([self.i2.id, self.i4.id]))
+        self.check_list(self.playlist, [self.i1, self.i3] + self.items[4:])
+
+    def test_move_range(self):
+        self.playlist.add_ids([i.id for i in self.items])
+        old_positions = self.get_positions()
+        moved = [self.items[6], self.items[5]]
+        self.playlist.move_range([i.id for i in moved], self.i2.id)
+        self.check_list(self.playlist, [self.i1, self.items[6],
+                                        self.items[5], self.i2, self.i3,
+                                        self.i4, self.items[4],
+                                        self.items[7]])
+        # only the moved rows should have new positions
+        new_positions = self.get_positions()
+        for item_id in new_positions:
+            if item_id in (moved[0].id, moved[1].id):
+                self.assertNotEquals(old_positions[item_id],
+                                     new_positions[item_id])
+            else:
+                self.assertEquals(old_positions[item_id],
+                                  new_positions[item_id])
+        # test moving to the start and the end
+        self.playlist.move_range([self.i4.id], self.i1.id)
+        self.playlist.move_range([self.i1.id])
+        self.check_list(self.playlist, [self.i4, self.items[6],
+                                        self.items[5], self.i2, self.i3,
+                                        self.items[4], self.items[7],
+                                        self.i1])
+
+    def test_reorder_without_room(self):
+        # keep moving the last item between the first two items.  We should
+        # eventually run out of room and renumber the playlist.
+        self.playlist.add_ids([i.id for i in self.items])
+        order = [i.id for i in self.items]
+        for x in range(20):
+            order.insert(1, order.pop())
+            self.playlist.reorder(order)
+            self.assertEquals(self.playlist.get_item_ids(), order)
+
+    def test_compact_positions(self):
+        self.playlist.add_ids([i.id for i in self.items])
+        self.playlist.move_range([self.i4.id], self.i2.id)
+        playlist.compact_all_positions()
+        self.check_list(self.playlist, [self.i1, self.i4, self.i2, self.i3] +
+                        self.items[4:])
+        self.assertEquals(sorted(self.get_positions().values()),
+                          [i * playlist.POSITION_GAP for i in range(8)])
+
+    def test_compact_positions_periodically(self):
+        mock_add_timeout = self.patch_for_test('miro.eventloop.add_timeout')
+        self.playlist.add_ids([i.id for i in self.items])
+        self.playlist.move_range([self.i4.id], self.i2.id)
+        playlist.compact_positions_periodically()
+        self.assertEquals(sorted(self.get_positions().values()),
+                          [i * playlist.POSITION_GAP for i in range(8)])
+        # we should run again later
+        mock_add_timeout.assert_called_once_with(
+            playlist.COMPACT_INTERVAL,
+            playlist.compact_positions_periodically,
+            "compact playlist positions")
+
+    def test_calc_new_positions(self):
+        self.assertEquals(playlist.calc_new_positions([0, 10, 20]),
+                          [0, 10, 20])
+        self.assertEquals(playlist.calc_new_positions([20, 0, 10]),
+                          [-playlist.POSITION_GAP, 0, 10])
+        self.assertEquals(playlist.calc_new_positions([0, 20, 10]),
+                          [0, 5, 10])
+        self.assertEquals(playlist.calc_new_positions([0, 2, 3, 1]),
+                          [0, 2, 3, 3 + playlist.POSITION_GAP])
+        # no room between 0 and 1
+        self.assertEquals(playlist.calc_new_positions([0, 2, 1]), None)
+
 class PlaylistFolderTestCase(PlaylistTestBase):
     def setUp(self):
         PlaylistTestBase.setUp(self)
@@ -153,6 +253,17 @@ class PlaylistFolderTestCase(PlaylistTestBase):
         self.folder.reorder([self.i4.id, self.i3.id, self.i2.id, self.i1.id])
         self.check_list([self.i4, self.i3, self.i2, self.i1])
 
+    def test_bulk_changes(self):
+        self.p3.remove_ids([self.i2.id, self.i3.id])
+        # i3 is still in other children of self.folder, so it
+        # shouldn't be removed
+        self.check_list([self.i1, self.i3, self.i4])
+        self.p1.add_ids([self.i2.id, self.i4.id])
+        self.check_list([self.i1, self.i3, self.i4, self.i2])
+        self.p1.remove_ids([self.i2.id, self.i4.id])
+        # i4 is still in p2
+        self.check_list([self.i1, self.i3, self.i4])
+
     def test_remove_folder_removes_playlist(self):
         self.folder.remove()
         self.assertEquals(SavedPlaylist.make_view().count(), 0)
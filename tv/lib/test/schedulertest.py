@@ -2,7 +2,8 @@ from time import time, sleep
 import threading
 
 from miro import eventloop
-from miro.test.framework import EventLoopTest
+from miro import util
+from miro.test.framework import EventLoopTest, only_on_platforms
 
 class SchedulerTest(EventLoopTest):
     def setUp(self):
@@ -57,3 +58,361 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class IdlePriorityTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.calls = []
+
+    def callback(self, name):
+        self.calls.append(name)
+
+    def add_idle(self, name, priority=eventloop.PRIORITY_NORMAL, key=None):
+        return eventloop.add_idle(self.callback, name, args=(name,),
+                                  priority=priority, key=key)
+
+    def test_priority_order(self):
+        self.add_idle('background-1', eventloop.PRIORITY_BACKGROUND)
+        self.add_idle('normal-1')
+        self.add_idle('background-2', eventloop.PRIORITY_BACKGROUND)
+        self.add_idle('interactive', eventloop.PRIORITY_INTERACTIVE)
+        self.add_idle('normal-2')
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['interactive', 'normal-1', 'normal-2',
+                                       'background-1', 'background-2'])
+
+    def test_coalesce(self):
+        dc = self.add_idle('foo', key='foo')
+        self.assert_(self.add_idle('foo', key='foo') is dc)
+        self.add_idle('bar', key='bar')
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['foo', 'bar'])
+        # once the call runs, we should be able to schedule another one
+        self.add_idle('foo', key='foo')
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['foo', 'bar', 'foo'])
+
+    def test_coalesce_canceled(self):
+        dc = self.add_idle('foo', key='foo')
+        dc.cancel()
+        self.assert_(self.add_idle('foo', key='foo') is not dc)
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['foo'])
+
+    def test_idle_iterate_priority(self):
+        def iterator():
+            for i in xrange(3):
+                self.calls.append('iter-%d' % i)
+                yield
+        eventloop.idle_iterate(iterator, 'iterate',
+                               priority=eventloop.PRIORITY_BACKGROUND)
+        self.add_idle('normal')
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['normal', 'iter-0', 'iter-1',
+                                       'iter-2'])
+
+    def test_interactive_idle_iterator(self):
+        # work that the user is waiting on should run ahead of background
+        # work, even if the background work was queued first
+        @eventloop.interactive_idle_iterator
+        def iterator():
+            for i in xrange(3):
+                self.calls.append('iter-%d' % i)
+                yield
+        self.add_idle('background-1', eventloop.PRIORITY_BACKGROUND)
+        self.add_idle('normal')
+        self.add_idle('background-2', eventloop.PRIORITY_BACKGROUND)
+        iterator()
+        self.runPendingIdles()
+        self.assertEquals(self.calls, ['iter-0', 'iter-1', 'iter-2',
+                                       'normal', 'background-1',
+                                       'background-2'])
+
+    def test_time_budget(self):
+        # with a budget of 0, we should go back to select() after every idle,
+        # so a timeout added by the first idle runs before the others
+        def add_timeout(name):
+            self.callback(name)
+            eventloop.add_timeout(0, self.callback, 'timeout',
+                                  args=('timeout',))
+        old_budget = eventloop.IDLE_TIME_BUDGET
+        eventloop.IDLE_TIME_BUDGET = 0
+        try:
+            eventloop.add_idle(add_timeout, 'idle-0', args=('idle-0',))
+            for i in xrange(1, 3):
+                self.add_idle('idle-%d' % i)
+            eventloop.add_timeout(0.1, eventloop.shutdown, 'stop')
+            self.runEventLoop()
+        finally:
+            eventloop.IDLE_TIME_BUDGET = old_budget
+        self.assertEquals(self.calls, ['idle-0', 'timeout', 'idle-1',
+                                       'idle-2'])
+
+class SelectPollerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.poller = self.make_poller()
+        self.sock1, self.sock2 = util.make_dummy_socket_pair()
+
+    def tearDown(self):
+        self.sock1.close()
+        self.sock2.close()
+        EventLoopTest.tearDown(self)
+
+    def make_poller(self):
+        return eventloop.SelectPoller()
+
+    def check_poll(self, read_ready, write_ready):
+        results = self.poller.poll(0)
+        self.assertEquals(list(results[0]), read_ready)
+        self.assertEquals(list(results[1]), write_ready)
+
+    def test_poll(self):
+        fd = self.sock2.fileno()
+        self.check_poll([], [])
+        self.poller.update(fd, True, False)
+        self.check_poll([], [])
+        self.sock1.send('a')
+        self.check_poll([fd], [])
+        self.poller.update(fd, True, True)
+        self.check_poll([fd], [fd])
+        self.poller.update(fd, False, True)
+        self.check_poll([], [fd])
+        self.poller.update(fd, False, False)
+        self.check_poll([], [])
+
+    def test_hangup(self):
+        # when the other side closes, we should see the socket as readable
+        fd = self.sock2.fileno()
+        self.poller.update(fd, True, False)
+        self.sock1.close()
+        self.check_poll([fd], [])
+
+@only_on_platforms('linux')
+class EpollPollerTest(SelectPollerTest):
+    def make_poller(self):
+        return eventloop.EpollPoller()
+
+    def test_closed_fd(self):
+        # Stopping watching an fd after it's been closed shouldn't raise an
+        # error.
+        fd = self.sock2.fileno()
+        self.poller.update(fd, True, False)
+        self.sock2.close()
+        self.poller.update(fd, False, False)
+        self.check_poll([], [])
+
+class WakeupTest(EventLoopTest):
+    def test_wakeup_coalesced(self):
+        # wakeup() shouldn't write to the socket unless the loop is waiting
+        # for events.
+        loop = eventloop._eventloop
+        loop._wakeup_requested = False
+        loop.wakeup()
+        loop.wakeup()
+        self.assertEquals(loop._wakeup_requested, True)
+        self.assertEquals(loop._wakeup_sent, False)
+
+    def test_wakeup_from_thread(self):
+        # make sure wakeup() from other threads wakes up the loop
+        def thread():
+            sleep(0.2)
+            eventloop._eventloop.idle_queue.add_idle(eventloop.shutdown,
+                                                     'shutdown')
+            eventloop._eventloop.wakeup()
+        start = time()
+        threading.Thread(target=thread).start()
+        self.runEventLoop()
+        self.assert_(time() - start < 1.0)
+
+class ThreadPoolTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.pool = eventloop._eventloop.threadpool
+        self.results = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.close_threads()
+        EventLoopTest.tearDown(self)
+
+    def callback(self, result):
+        self.results.append(result)
+
+    def errback(self, error):
+        self.results.append(error)
+
+    def blocking_call(self, value):
+        self.release.wait(5)
+        return value
+
+    def wait_for(self, condition):
+        end = time() + 5
+        while not condition():
+            if time() > end:
+                raise AssertionError("timed out")
+            sleep(0.01)
+
+    def running_count(self, category):
+        return self.pool.categories[category].running
+
+    def test_category_limit(self):
+        self.pool.init_threads()
+        for i in xrange(3):
+            eventloop.call_in_thread_category('codegen', self.callback,
+                                              self.errback,
+                                              self.blocking_call, 'test', i)
+        # only 1 codegen call should run at once
+        self.wait_for(lambda: self.running_count('codegen') == 1)
+        sleep(0.1)
+        self.assertEquals(self.running_count('codegen'), 1)
+        self.assertEquals(len(self.pool.categories['codegen'].queue), 2)
+        # other categories shouldn't be held up
+        eventloop.call_in_thread(self.callback, self.errback, lambda: 'a',
+                                 'test')
+        self.wait_for(lambda: self.pool.categories['default'].run_times.count)
+        self.release.set()
+        self.wait_for(lambda: self.pool.categories['codegen'].run_times.count
+                      == 3)
+        self.runPendingIdles()
+        self.assertEquals(self.results, ['a', 0, 1, 2])
+
+    def test_elastic(self):
+        self.pool.init_threads()
+        self.assertEquals(len(self.pool.threads), self.pool.MIN_THREADS)
+        for i in xrange(4):
+            eventloop.call_in_thread(self.callback, self.errback,
+                                     self.blocking_call, 'test', i)
+        # we should start extra threads to handle the calls
+        self.wait_for(lambda: self.running_count('default') == 4)
+        self.assertEquals(len(self.pool.threads), 4)
+        # once the calls finish, the extra threads should exit
+        self.release.set()
+        self.wait_for(lambda: len(self.pool.threads) ==
+                      self.pool.MIN_THREADS)
+        self.runPendingIdles()
+        self.assertSameSet(self.results, range(4))
+
+    def test_backlog_thread_starts(self):
+        # draining a backlog shouldn't start a new thread for each call that
+        # finishes
+        self.pool.init_threads()
+        start_thread = self.pool._start_thread
+        thread_starts = []
+        def count_start_thread():
+            thread_starts.append(1)
+            start_thread()
+        self.pool._start_thread = count_start_thread
+        try:
+            for i in xrange(20):
+                eventloop.call_in_thread(self.callback, self.errback,
+                                         self.blocking_call, 'test', i)
+            self.wait_for(lambda: self.running_count('default') == 4)
+            del thread_starts[:]
+            self.release.set()
+            self.wait_for(lambda: self.pool.categories['default'].
+                          run_times.count == 20)
+        finally:
+            del self.pool._start_thread
+        # the threads that are already running should handle the rest
+        self.assertEquals(thread_starts, [])
+        self.runPendingIdles()
+        self.assertSameSet(self.results, range(20))
+
+    def test_errback(self):
+        def fail():
+            raise ValueError()
+        self.pool.init_threads()
+        eventloop.call_in_thread(self.callback, self.errback, fail, 'test')
+        self.wait_for(lambda: self.pool.categories['default'].run_times.count)
+        self.runPendingIdles()
+        self.assertEquals(len(self.results), 1)
+        self.assert_(isinstance(self.results[0], ValueError))
+
+    def test_cancel(self):
+        call = eventloop.call_in_thread(self.callback, self.errback,
+                                        lambda: 'a', 'test')
+        call2 = eventloop.call_in_thread(self.callback, self.errback,
+                                         lambda: 'b', 'test')
+        self.assertEquals(call.cancel(), True)
+        # canceling twice should be a no-op
+        self.assertEquals(call.cancel(), False)
+        self.pool.init_threads()
+        self.wait_for(lambda: not self.pool.has_queued_calls())
+        self.wait_for(lambda: self.pool.categories['default'].run_times.count)
+        self.runPendingIdles()
+        self.assertEquals(self.results, ['b'])
+        # we can't cancel calls that already ran
+        self.assertEquals(call2.cancel(), False)
+        stats = self.pool.get_stats()
+        self.assertEquals(len(stats), 1)
+        self.assertEquals(stats[0]['name'], 'default')
+        self.assertEquals(stats[0]['completed'], 1)
+        self.assertEquals(stats[0]['canceled'], 1)
+
+class LatencyHistogramTest(EventLoopTest):
+    def test_percentiles(self):
+        histogram = eventloop.LatencyHistogram()
+        self.assertEquals(histogram.percentile(50), 0.0)
+        for i in xrange(98):
+            histogram.add(0.001)
+        histogram.add(0.5)
+        histogram.add(2.0)
+        self.assertEquals(histogram.count, 100)
+        self.assertAlmostEqual(histogram.total, 2.598)
+        # percentiles are estimates, but they should be within a factor of 2
+        p50 = histogram.percentile(50)
+        self.assert_(0.001 <= p50 < 0.002, p50)
+        p99 = histogram.percentile(99)
+        self.assert_(0.5 <= p99 < 1.0, p99)
+        self.assertEquals(histogram.percentile(100), 2.0)
+
+    def test_huge_values(self):
+        histogram = eventloop.LatencyHistogram()
+        histogram.add(10000.0)
+        self.assertEquals(histogram.percentile(50), 10000.0)
+
+class LoopProfilerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        eventloop.enable_profiling()
+
+    def tearDown(self):
+        eventloop.disable_profiling()
+        EventLoopTest.tearDown(self)
+
+    def test_idle_calls(self):
+        for i in xrange(3):
+            eventloop.add_idle(lambda: None, "foo")
+        eventloop.add_timeout(0, lambda: None, "bar")
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stop")
+        self.runEventLoop()
+        calls = eventloop._profiler.calls
+        self.assertEquals(calls['idle (foo)'].count, 3)
+        self.assertEquals(calls['timeout (bar)'].count, 1)
+        self.assert_(eventloop._profiler.idle_queue_max >= 3)
+        report = eventloop.get_profile_report()
+        self.assert_('idle (foo)' in report)
+        self.assert_('Idle queue depth: max' in report)
+
+    def test_threadpool_wait(self):
+        eventloop.call_in_thread(lambda result: eventloop.shutdown(),
+                                 lambda error: eventloop.shutdown(),
+                                 lambda: None, 'thread call')
+        self.runEventLoop()
+        waits = eventloop._profiler.threadpool_waits
+        self.assertEquals(waits['thread call'].count, 1)
+
+    def test_reset(self):
+        eventloop.add_idle(lambda: None, "foo")
+        self.runPendingIdles()
+        eventloop.reset_profile()
+        self.assertEquals(eventloop._profiler.calls, {})
+
+    def test_disabled(self):
+        eventloop.disable_profiling()
+        self.assertEquals(eventloop.profiling_enabled(), False)
+        self.assertEquals(eventloop.get_profile_report(), None)
+        eventloop.add_idle(lambda: None, "foo")
+        self.runPendingIdles()
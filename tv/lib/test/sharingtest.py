@@ -360,6 +360,69 @@ class SharingTest(EventLoopTest):
             1, db_info=self.share.db_info)
         self.assertEquals(db_item.title, "title-one")
 
+    def setup_reconnect(self, revision):
+        """Connect to the share, then disconnect and start tracking again.
+
+        :param revision: revision the server reports when we reconnect
+        """
+        self.client.supports_update = True
+        self.client.db_id = 1
+        self.client.db_name = 'TestDB'
+        self.client.revision = 5
+        self.share.start_tracking()
+        self.client.set_items(self.make_daap_items(
+            {1: 'title-1', 2: 'title-2', 3: 'title-3'}))
+        self.client.add_playlist(
+            testobjects.make_mock_daap_playlist(101, 'playlist-1'))
+        self.client.set_playlist_items(101, [1, 2])
+        self.check_client_connect()
+        self.original_items = dict(
+            (i.daap_id, i) for i in
+            models.SharingItem.make_view(db_info=self.share.db_info))
+        self.share.stop_tracking()
+        self.client.revision = revision
+        self.share.start_tracking()
+        # item 1 is changed, item 2 is deleted, item 3 is unchanged and
+        # item 4 is added
+        self.client.set_items(self.make_daap_items(
+            {1: 'new-title-1', 3: 'title-3', 4: 'title-4'}))
+        self.client.set_playlist_items(101, [1, 3])
+        models.SharingItem.change_tracker.reset()
+
+    def check_reconnect(self, should_get_changes):
+        result = self.share.tracker.client_connect()
+        self.assertEquals(result.update, should_get_changes)
+        self.share.tracker.client_connect_callback(result)
+        db_items = dict(
+            (i.daap_id, i) for i in
+            models.SharingItem.make_view(db_info=self.share.db_info))
+        self.assertEquals(dict((k, i.title) for k, i in db_items.items()),
+                          {1: 'new-title-1', 3: 'title-3', 4: 'title-4'})
+        self.assertEquals(self.playlist_item_map.get_map(),
+                          {101: set([1, 3]), u'playlist': set([1, 3])})
+        # item 3 didn't change, so we shouldn't have touched it
+        change_tracker = models.SharingItem.change_tracker
+        self.assertEquals(db_items[3], self.original_items[3])
+        self.assertSameSet(change_tracker.changed[self.share.id],
+                           [db_items[1].id])
+        self.assertSameSet(change_tracker.added[self.share.id],
+                           [db_items[4].id])
+        self.assertSameSet(change_tracker.removed[self.share.id],
+                           [self.original_items[2].id])
+
+    def test_reconnect_gets_changes(self):
+        # test that when we reconnect, we only fetch changes since the last
+        # revision we saw
+        self.setup_reconnect(revision=7)
+        self.check_reconnect(should_get_changes=True)
+        self.assertEquals(self.client.old_revision, 5)
+
+    def test_reconnect_server_restarted(self):
+        # test that if the server has restarted, we fetch the entire
+        # listing and only apply the differences
+        self.setup_reconnect(revision=2)
+        self.check_reconnect(should_get_changes=False)
+
 class SharingServerTest(EventLoopTest):
     """Test the sharing server."""
     def setUp(self):
@@ -143,3 +143,25 @@ class SignalsTest(MiroTestCase):
         self.signaller.emit('signal1')
         self.assertEquals(self.callbacks, [])
 
+
+    def test_lazy_callback_data(self):
+        # we shouldn't create callback data until something is connected
+        signaller = TestSignaller()
+        signaller.emit('signal1', 'foo')
+        self.assertEquals(signaller.signal_callbacks, None)
+        self.assertRaises(KeyError, signaller.emit, 'bogus-signal')
+        self.assertRaises(KeyError, signaller.connect, 'bogus-signal',
+                          self.callback)
+        signaller.connect('signal1', self.callback)
+        self.assertEquals(signaller.signal_callbacks.keys(), ['signal1'])
+        signaller.emit('signal1', 'foo')
+        self.check_single_callback(signaller, 'foo')
+
+    def test_create_signal(self):
+        self.signaller.create_signal('signal4')
+        self.assertRaises(KeyError, self.signaller.create_signal, 'signal4')
+        self.signaller.connect('signal4', self.callback)
+        self.signaller.emit('signal4', 'foo')
+        self.check_single_callback(self.signaller, 'foo')
+        # other signallers shouldn't get the new signal
+        self.assertRaises(KeyError, TestSignaller().emit, 'signal4')
@@ -13,6 +13,7 @@ from miro import databaseupgrade
 from miro import devices
 from miro import dialogs
 from miro import downloader
+from miro import eventloop
 from miro import item
 from miro import feed
 from miro import folder
@@ -278,6 +279,103 @@ class DeviceDBUpgradeTest(DBUpgradeTest):
                         os.path.join(device_mount, '.miro', 'sqlite'))
         self.db = devices.load_sqlite_database(device_mount, 1024)
 
+class UpgradeCursorTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        # we run each test on 2 databases, one using UpgradeCursor and one
+        # using a regular cursor.  They should end up the same.
+        self.connection = sqlite3.connect(':memory:', isolation_level=None)
+        self.plain_connection = sqlite3.connect(':memory:',
+                                                isolation_level=None)
+        for connection in (self.connection, self.plain_connection):
+            connection.execute("CREATE TABLE foo (id integer PRIMARY KEY, "
+                               "a integer, b text, c text, d integer)")
+            connection.execute("CREATE INDEX foo_a ON foo (a)")
+            for i in xrange(10):
+                connection.execute("INSERT INTO foo (id, a, b, c, d) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   (i, i, 'b-%s' % i, 'c-%s' % i, i * 2))
+        self.cursor = databaseupgrade.UpgradeCursor(
+            self.connection.cursor())
+        self.plain_cursor = self.plain_connection.cursor()
+
+    def run_upgrade(self, func):
+        func(self.cursor)
+        func(self.plain_cursor)
+
+    def check_same_results(self):
+        self.cursor.flush()
+        for sql in ("SELECT type, name, sql FROM sqlite_master "
+                    "ORDER BY name",
+                    "SELECT * FROM foo ORDER BY id"):
+            self.assertEquals(self.connection.execute(sql).fetchall(),
+                              self.plain_connection.execute(sql).fetchall())
+
+    def test_coalesce(self):
+        def upgrade(cursor):
+            databaseupgrade.remove_column(cursor, 'foo', ['b'])
+            databaseupgrade.rename_column(cursor, 'foo', 'c', 'c2')
+            cursor.execute("ALTER TABLE foo ADD COLUMN e integer")
+            cursor.execute("UPDATE foo SET e=a + 1 WHERE a > 5")
+            databaseupgrade.rename_column(cursor, 'foo', 'd', 'd2', 'text')
+        self.run_upgrade(upgrade)
+        # the UPDATE doesn't use any columns that we changed, so we should
+        # rewrite the table once for all the changes.
+        self.assertEquals(self.cursor.rewrite_count, 0)
+        self.assertEquals(self.cursor.planned_rewrite_count, 3)
+        self.check_same_results()
+        self.assertEquals(self.cursor.rewrite_count, 1)
+
+    def test_flush_before_using_changed_column(self):
+        def upgrade(cursor):
+            databaseupgrade.rename_column(cursor, 'foo', 'c', 'c2')
+            cursor.execute("UPDATE foo SET c2='new' WHERE id=1")
+            databaseupgrade.remove_column(cursor, 'foo', ['b'])
+        self.run_upgrade(upgrade)
+        self.assertEquals(self.cursor.rewrite_count, 1)
+        self.check_same_results()
+        self.assertEquals(self.cursor.rewrite_count, 2)
+
+    def test_flush_before_schema_changes(self):
+        def upgrade(cursor):
+            databaseupgrade.remove_column(cursor, 'foo', ['b'])
+            cursor.execute("SELECT * FROM foo")
+            databaseupgrade.remove_column(cursor, 'foo', ['c'])
+            # adding a column that we are going to delete needs a flush too
+            cursor.execute("ALTER TABLE foo ADD COLUMN c integer")
+            databaseupgrade.remove_column(cursor, 'foo', ['d'])
+            cursor.execute("CREATE INDEX foo_c ON foo (c)")
+        self.run_upgrade(upgrade)
+        self.assertEquals(self.cursor.rewrite_count, 3)
+        self.check_same_results()
+
+    def test_new_style_upgrade(self):
+        def upgrade1(cursor):
+            databaseupgrade.remove_column(cursor, 'foo', ['b'])
+        def upgrade2(cursor):
+            cursor.execute("ALTER TABLE foo ADD COLUMN e text")
+            cursor.execute("UPDATE foo SET e='e'")
+        def upgrade3(cursor):
+            databaseupgrade.remove_column(cursor, 'foo', ['c'])
+        self.patch_for_test('miro.databaseupgrade._upgrade_overide')
+        databaseupgrade._upgrade_overide = {1: upgrade1, 2: upgrade2,
+                                            3: upgrade3}
+        rewrite_count = []
+        def alter_table_columns(cursor, *args):
+            if not isinstance(cursor, databaseupgrade.UpgradeCursor):
+                rewrite_count.append(args[0])
+            return real_alter_table_columns(cursor, *args)
+        real_alter_table_columns = databaseupgrade.alter_table_columns
+        self.patch_function('miro.databaseupgrade.alter_table_columns',
+                            alter_table_columns)
+        timings = databaseupgrade.new_style_upgrade(
+            self.connection.cursor(), 0, 3, 'main', False)
+        self.assertEquals([version for version, secs in timings], [1, 2, 3])
+        self.assertEquals(rewrite_count, ['foo'])
+        for func in (upgrade1, upgrade2, upgrade3):
+            func(self.plain_cursor)
+        self.check_same_results()
+
 class FakeSchemaTest(StoreDatabaseTest):
     OBJECT_SCHEMAS = test_object_schemas
 
@@ -414,6 +512,61 @@ class DiskTest(FakeSchemaTest):
         backup_lee_name = cursor.fetchone()[0]
         self.assertEquals(backup_lee_name, 'lee')
 
+    def test_upgrade_copies_database_once(self):
+        mock_progress = self.patch_for_test(
+            'miro.dbupgradeprogress.database_copy_progress')
+        original_size = os.path.getsize(self.save_path)
+        self.reload_test_database(version=1)
+        # we should have copied the file once, then moved the original file
+        # to the backups directory
+        self.assert_(mock_progress.call_count > 0)
+        copied_bytes, total_bytes = mock_progress.call_args[0]
+        self.assertEquals(copied_bytes, total_bytes)
+        backup_path = os.path.join(os.path.dirname(self.save_path),
+                                   'dbbackups', 'sqlitedb_backup_0')
+        self.assert_(os.path.exists(backup_path))
+        self.assertEquals(os.listdir(os.path.dirname(backup_path)),
+                          ['sqlitedb_backup_0'])
+        upgrading_path = os.path.join(os.path.dirname(self.save_path),
+                                      'upgrading_database_0')
+        self.assert_(not os.path.exists(upgrading_path))
+
+    def test_upgrade_keeps_database_file(self):
+        # There should be a database at save_path the whole time, so that a
+        # crash during the upgrade doesn't leave us without one
+        real_move = shutil.move
+        path_existed = []
+        def move(src, dst):
+            path_existed.append(os.path.exists(self.save_path))
+            real_move(src, dst)
+        mock_move = self.patch_for_test('shutil.move')
+        mock_move.side_effect = move
+        self.reload_test_database(version=1)
+        self.assert_(path_existed)
+        self.assert_(all(path_existed))
+        # the backup should still have the old data
+        backup_path = os.path.join(os.path.dirname(self.save_path),
+                                   'dbbackups', 'sqlitedb_backup_0')
+        backup_conn = sqlite3.connect(backup_path)
+        cursor = backup_conn.execute("SELECT name FROM human WHERE id=?",
+                                     (self.lee.id,))
+        self.assertEquals(cursor.fetchone()[0], 'lee')
+        self.assertEquals(Human.get_by_id(self.lee.id).name, 'new name')
+
+    def test_copy_uncheckpointed_data(self):
+        # Data that's only in the WAL file should be included when we copy
+        # the database file
+        self.lee.name = u'new lee'
+        self.lee.signal_change()
+        app.db.finish_transaction()
+        copy_path = os.path.join(self.tempdir, 'db-copy')
+        app.db._copy_data_to_path(copy_path)
+        conn = sqlite3.connect(copy_path)
+        cursor = conn.execute("SELECT name FROM human WHERE id=?",
+                              (self.lee.id,))
+        self.assertEquals(cursor.fetchone()[0], 'new lee')
+        conn.close()
+
     def test_restore_with_newer_version(self):
         self.reload_test_database(version=1)
         self.assertRaises(databaseupgrade.DatabaseTooNewError,
@@ -548,6 +701,173 @@ class DiskTest(FakeSchemaTest):
         lee_view = Human.make_view("id=?", values=(lee.id,))
         self.assertEquals(lee_view.count(), 0)
 
+class GroupCommitTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        self.finish_callback()
+        app.db.set_group_commit(60, 5)
+        self.other_connection = sqlite3.connect(self.save_path)
+
+    def tearDown(self):
+        self.other_connection.close()
+        FakeSchemaTest.tearDown(self)
+
+    def finish_callback(self, success=True):
+        eventloop._eventloop.emit('event-finished', success)
+
+    def committed_name(self, obj):
+        # read the name using a different connection, which only sees
+        # committed data
+        table = app.db.table_name(obj.__class__)
+        cursor = self.other_connection.execute(
+            "SELECT name FROM %s WHERE id=?" % table, (obj.id,))
+        return cursor.fetchone()[0]
+
+    def change_name(self, obj, name):
+        obj.name = name
+        obj.signal_change()
+
+    def test_group_commit(self):
+        commit_count = app.db.commit_count
+        self.change_name(self.lee, u'lee2')
+        self.finish_callback()
+        self.change_name(self.lee, u'lee3')
+        self.finish_callback()
+        self.assertEquals(self.committed_name(self.lee), u'lee')
+        self.assertEquals(app.db.commit_count, commit_count)
+        self.assert_(app.db.has_uncommitted_changes())
+        # request_commit() should force a commit when the callback finishes
+        self.change_name(self.lee, u'lee4')
+        app.db.request_commit()
+        self.assertEquals(self.committed_name(self.lee), u'lee')
+        self.finish_callback()
+        self.assertEquals(self.committed_name(self.lee), u'lee4')
+        self.assertEquals(app.db.commit_count, commit_count + 1)
+        self.assert_(not app.db.has_uncommitted_changes())
+
+    def test_statement_limit(self):
+        for i in xrange(4):
+            self.change_name(self.lee, u'lee%s' % i)
+            self.finish_callback()
+        self.assertEquals(self.committed_name(self.lee), u'lee')
+        self.change_name(self.lee, u'lee-final')
+        self.finish_callback()
+        self.assertEquals(self.committed_name(self.lee), u'lee-final')
+
+    def test_time_limit(self):
+        app.db.set_group_commit(0.05)
+        self.change_name(self.lee, u'lee2')
+        self.finish_callback()
+        self.assertEquals(self.committed_name(self.lee), u'lee')
+        # we should schedule a timeout to commit the transaction
+        self.runEventLoop(timeout=0.2, timeoutNormal=True)
+        self.assertEquals(self.committed_name(self.lee), u'lee2')
+
+    def test_failed_callback(self):
+        # if a callback fails, we should only roll back its changes
+        self.change_name(self.lee, u'lee2')
+        self.finish_callback()
+        self.change_name(self.joe, u'joe2')
+        self.finish_callback(success=False)
+        app.db.finish_transaction()
+        self.assertEquals(self.committed_name(self.lee), u'lee2')
+        self.assertEquals(self.committed_name(self.joe), u'joe')
+        # if the first callback fails, we roll back the transaction
+        self.change_name(self.ben, u'ben2')
+        self.finish_callback(success=False)
+        self.assert_(not app.db.has_uncommitted_changes())
+        app.db.finish_transaction()
+        self.assertEquals(self.committed_name(self.ben), u'ben')
+
+    def test_disable(self):
+        self.change_name(self.lee, u'lee2')
+        self.finish_callback()
+        # turning off group commit should commit right away
+        app.db.set_group_commit(0)
+        self.assertEquals(self.committed_name(self.lee), u'lee2')
+        self.change_name(self.lee, u'lee3')
+        self.finish_callback()
+        self.assertEquals(self.committed_name(self.lee), u'lee3')
+
+class TransactionReplayLogTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.log = storedatabase.TransactionReplayLog()
+        self.log.MEMORY_LIMIT = 10
+        self.statements = []
+        for i in xrange(10):
+            self.add_statement(("INSERT INTO foo(a, b) VALUES (?, ?)",
+                                (i, buffer('data-%s' % i)), False))
+        self.add_statement(("INSERT INTO foo(a, b) VALUES (?, ?)",
+                            [(100, 'a'), (101, 'b')], True))
+
+    def add_statement(self, statement):
+        self.log.append(statement)
+        self.statements.append(statement)
+
+    def check_log(self):
+        self.assertEquals(len(self.log), len(self.statements))
+        self.assertEquals(list(self.log), self.statements)
+
+    def test_spill(self):
+        self.assert_(self.log.spilled_bytes() > 0)
+        self.assert_(self.log.memory_values() <= self.log.MEMORY_LIMIT)
+        self.assertEquals(self.log.spill_count, 1)
+        self.check_log()
+        # adding after iterating should still work
+        self.add_statement(("DELETE FROM foo WHERE a=?", (1,), False))
+        self.check_log()
+
+    def test_truncate(self):
+        self.add_statement(("DELETE FROM foo WHERE a=?", (1,), False))
+        # truncate the in-memory statements
+        self.log.truncate(len(self.statements) - 1)
+        del self.statements[-1]
+        self.check_log()
+        # truncate the statements on disk
+        self.log.truncate(3)
+        del self.statements[3:]
+        self.check_log()
+        self.add_statement(("DELETE FROM foo WHERE a=?", (2,), False))
+        self.check_log()
+
+    def test_clear(self):
+        self.log.clear()
+        self.statements = []
+        self.check_log()
+        self.assertEquals(self.log.spilled_bytes(), 0)
+        self.add_statement(("DELETE FROM foo WHERE a=?", (1,), False))
+        self.check_log()
+
+class ReplayLogRetryTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        app.db._statements_in_transaction.MEMORY_LIMIT = 20
+        app.db.error_handler = mock.Mock()
+        app.db.error_handler.handle_save_error.return_value = (
+            storedatabase.LiveStorageErrorHandler.ACTION_RETRY)
+
+    def test_retry_with_spilled_log(self):
+        humans = [Human(u"human-%s" % i, i, 1.0, [], {})
+                  for i in xrange(20)]
+        stats = app.db.get_transaction_stats()
+        self.assert_(stats['replay_log_spilled_bytes'] > 0)
+        self.assert_(stats['replay_log_memory_values'] <= 20)
+        self.assertEquals(stats['replay_log_statements'], 20)
+        # make the next statement fail.  We should roll back the
+        # transaction, then re-run all the statements from the log.
+        with self.allow_warnings():
+            app.db.simulate_db_save_error()
+        self.assertEquals(app.db.error_handler.handle_save_error.call_count,
+                          1)
+        app.db.finish_transaction()
+        self.assertEquals(
+            app.db.get_transaction_stats()['replay_log_statements'], 0)
+        self.reload_test_database()
+        self.assertSameSet([h.name for h in Human.make_view()],
+                           [h.name for h in humans + [self.lee]])
+
 class ObjectMemoryTest(FakeSchemaTest):
     def test_remove_remove_object_map(self):
         self.reload_test_database()
@@ -1,4 +1,5 @@
 import os
+import signal
 import time
 import Queue
 
@@ -58,6 +59,17 @@ class TestSubprocessResponder(subprocessmanager.SubprocessResponder):
         if msg.event == 'startup':
             self.subprocess_ready = True
 
+class TestBlockingSubprocessHandler(subprocessmanager.SubprocessHandler):
+    def handle_ping(self, msg):
+        Pong().send_to_main_process()
+
+    def handle_force_exception(self, msg):
+        1/0
+
+    def handle_hang(self, msg):
+        time.sleep(30)
+        Pong().send_to_main_process()
+
 class TestMessage(subprocessmanager.SubprocessMessage):
     pass
 
@@ -67,6 +79,9 @@ class Ping(TestMessage):
 class ForceException(TestMessage):
     pass
 
+class Hang(TestMessage):
+    pass
+
 class Pong(subprocessmanager.SubprocessResponse):
     pass
 
@@ -226,6 +241,89 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+class BlockingSubprocessTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.subprocess = subprocessmanager.BlockingSubprocess(
+            TestBlockingSubprocessHandler)
+
+    def tearDown(self):
+        self.subprocess.shutdown()
+        EventLoopTest.tearDown(self)
+
+    def test_call(self):
+        self.assert_(isinstance(self.subprocess.call(Ping()), Pong))
+        # check that we reuse the same process for the next call
+        original_pid = self.subprocess.process.pid
+        self.assert_(isinstance(self.subprocess.call(Ping()), Pong))
+        self.assertEquals(original_pid, self.subprocess.process.pid)
+
+    def test_subprocess_exception(self):
+        self.subprocess.call(Ping())
+        original_pid = self.subprocess.process.pid
+        self.assertRaises(subprocessmanager.SubprocessCallError,
+                          self.subprocess.call, ForceException())
+        # exceptions in the handler shouldn't restart the process
+        self.assertEquals(original_pid, self.subprocess.process.pid)
+        self.assert_(isinstance(self.subprocess.call(Ping()), Pong))
+
+    def test_timeout(self):
+        self.subprocess.call(Ping())
+        original_pid = self.subprocess.process.pid
+        self.assertRaises(subprocessmanager.SubprocessCallError,
+                          self.subprocess.call, Hang(), 0.5)
+        self.assert_(not self.subprocess.is_running)
+        # the next call should start a new process
+        self.assert_(isinstance(self.subprocess.call(Ping()), Pong))
+        self.assertNotEquals(original_pid, self.subprocess.process.pid)
+
+    def test_shutdown(self):
+        self.subprocess.call(Ping())
+        process = self.subprocess.process
+        self.subprocess.shutdown()
+        self.assert_(not self.subprocess.is_running)
+        self.assertNotEquals(process.poll(), None)
+
+class MovieDataExtractorTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.extractor = moviedata.MovieDataExtractor()
+        self.extractor.FILES_PER_PROCESS = 3
+        self.process = mock.Mock()
+        self.process.is_running = False
+        self.process.call.return_value = moviedata.MovieDataResult(
+            ('video', 100, True))
+        self.extractor.process = self.process
+
+    def run_extractor(self):
+        result = self.extractor.run('/videos/foo.avi', '/screenshots/foo.png')
+        self.process.is_running = True
+        return result
+
+    def test_run(self):
+        self.assertEquals(self.run_extractor(), ('video', 100, True))
+        msg = self.process.call.call_args[0][0]
+        self.assertEquals(msg.movie_path, '/videos/foo.avi')
+        self.assertEquals(msg.thumbnail_path, '/screenshots/foo.png')
+
+    def test_restart_after_files_per_process(self):
+        self.run_extractor()
+        self.run_extractor()
+        self.assertEquals(self.process.shutdown.call_count, 0)
+        self.run_extractor()
+        self.assertEquals(self.process.shutdown.call_count, 1)
+        # after the process gets restarted, we should start counting again
+        self.process.is_running = False
+        self.run_extractor()
+        self.run_extractor()
+        self.assertEquals(self.process.shutdown.call_count, 1)
+
+    def test_error(self):
+        self.process.call.side_effect = subprocessmanager.SubprocessCallError
+        with self.allow_warnings():
+            self.assertRaises(moviedata.MovieDataExtractorError,
+                              self.run_extractor)
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
     def handle_feedparser_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
@@ -422,6 +520,27 @@ class MutagenTest(WorkerProcessTest):
         self.check_mutagen_call('drm.m4v', 'video', 2668832, 'Thinkers',
                                 True)
 
+class MutagenAlarmTest(EventLoopTest):
+    if hasattr(signal, 'SIGALRM'):
+        def test_fingerprint_outside_alarm(self):
+            # calc_fingerprint() shouldn't count against the time limit for
+            # mutagen
+            def check_no_alarm(path):
+                self.assertEquals(signal.getitimer(signal.ITIMER_REAL),
+                                  (0.0, 0.0))
+                return u'1000-abc'
+            mock_process_file = self.patch_for_test(
+                'miro.filetags.process_file')
+            mock_process_file.return_value = {'file_type': u'audio'}
+            mock_calc_fingerprint = self.patch_for_test(
+                'miro.fileutil.calc_fingerprint')
+            mock_calc_fingerprint.side_effect = check_no_alarm
+            handler = workerprocess.WorkerProcessHandler()
+            msg = workerprocess.MutagenTask('/foo/bar.mp3', self.tempdir)
+            result = handler.handle_mutagen_task_with_alarm(msg)
+            self.assertEquals(result, {'file_type': u'audio',
+                                       'fingerprint': u'1000-abc'})
+
 
 # TODO:
 #   Test task priority system in worker process
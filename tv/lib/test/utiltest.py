@@ -13,6 +13,7 @@ import zipfile
 
 from miro.test.framework import skip_for_platforms, MiroTestCase
 from miro import download_utils
+from miro import fileutil
 from miro import util
 from miro import buildutils
 from miro.fileobject import FilenameType
@@ -927,6 +928,127 @@ class TestGatherMediaFiles(unittest.TestCase):
         self.add_file('test.ogv', True)
         self.verify_results()
 
+class DirectoryWalkerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.root = os.path.join(self.tempdir, 'walk')
+        os.mkdir(self.root)
+
+    def add_file(self, relpath):
+        path = os.path.join(self.root, relpath)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        return path
+
+    def walk(self, **kwargs):
+        walker = fileutil.DirectoryWalker(self.root, **kwargs)
+        return list(itertools.chain(*walker.iter_batches()))
+
+    def test_walk(self):
+        correct_paths = [self.add_file('a.mp3'),
+                         self.add_file(os.path.join('b', 'c.mp3')),
+                         self.add_file(os.path.join('b', 'd', 'e.mp3'))]
+        self.assertSameSet(self.walk(), correct_paths)
+        self.assertSameSet(fileutil.miro_allfiles(self.root), correct_paths)
+
+    def test_skip(self):
+        correct_paths = [self.add_file('a.mp3')]
+        self.add_file('.hidden.mp3')
+        self.add_file('Thumbs.db')
+        self.add_file(os.path.join('.hidden', 'b.mp3'))
+        self.add_file(os.path.join('Incomplete Downloads', 'c.mp3'))
+        deleting = self.add_file(os.path.join('deleting', 'd.mp3'))
+        fileutil.deletes_in_progress.add(os.path.dirname(deleting))
+        try:
+            self.assertSameSet(self.walk(), correct_paths)
+        finally:
+            fileutil.deletes_in_progress.discard(os.path.dirname(deleting))
+
+    @skip_for_platforms('win32')
+    def test_symlink_loop(self):
+        correct_paths = [self.add_file(os.path.join('a', 'b.mp3'))]
+        os.symlink(self.root, os.path.join(self.root, 'a', 'loop'))
+        self.assertSameSet(self.walk(), correct_paths)
+
+    def test_batches(self):
+        # test lots of directories with small batches and several threads
+        correct_paths = []
+        for i in xrange(20):
+            for j in xrange(5):
+                correct_paths.append(self.add_file(
+                    os.path.join('dir-%s' % i, 'sub-%s' % j, 'file.mp3')))
+        walker = fileutil.DirectoryWalker(self.root, max_threads=3,
+                                          batch_size=2)
+        paths = []
+        for batch in walker.iter_batches():
+            paths.extend(batch)
+        self.assertEquals(len(paths), len(correct_paths))
+        self.assertSameSet(paths, correct_paths)
+        self.assert_(len(walker.threads) <= 3)
+
+    def test_parallel_directories(self):
+        # test several sibling directories getting walked at the same time
+        # with batches that don't fill up.  All paths should be sent before
+        # the walk finishes.
+        correct_paths = []
+        for i in xrange(8):
+            for j in xrange(3):
+                correct_paths.append(self.add_file(
+                    os.path.join('dir-%s' % i, 'file-%s.mp3' % j)))
+        for i in xrange(300):
+            paths = self.walk(max_threads=4, batch_size=1000)
+            self.assertEquals(len(paths), len(correct_paths))
+            self.assertSameSet(paths, correct_paths)
+
+    def test_dir_filter(self):
+        correct_paths = [self.add_file(os.path.join('a', 'b.mp3'))]
+        self.add_file(os.path.join('Miro', 'c.mp3'))
+        def dir_filter(root, dirs):
+            dirs.remove('Miro')
+        self.assertSameSet(self.walk(dir_filter=dir_filter), correct_paths)
+
+    def test_missing_directory(self):
+        walker = fileutil.DirectoryWalker(os.path.join(self.root, 'missing'))
+        self.assertEquals(list(walker.iter_batches()), [])
+
+class CalcFingerprintTest(MiroTestCase):
+    def write_file(self, data):
+        path = self.make_temp_path('.mp3')
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_fingerprint(self):
+        data = os.urandom(fileutil.FINGERPRINT_BLOCK_SIZE * 3)
+        fingerprint = fileutil.calc_fingerprint(self.write_file(data))
+        self.assert_(isinstance(fingerprint, unicode))
+        # the same contents at a different path should match
+        self.assertEquals(fileutil.calc_fingerprint(self.write_file(data)),
+                          fingerprint)
+        # changing the end or the size of the file should change it
+        changed_end = data[:-1] + chr((ord(data[-1]) + 1) % 256)
+        self.assertNotEquals(
+            fileutil.calc_fingerprint(self.write_file(changed_end)),
+            fingerprint)
+        self.assertNotEquals(
+            fileutil.calc_fingerprint(self.write_file(data + 'a')),
+            fingerprint)
+
+    def test_small_file(self):
+        path = self.write_file('small file')
+        self.assertEquals(fileutil.calc_fingerprint(path),
+                          fileutil.calc_fingerprint(self.write_file(
+                              'small file')))
+        self.assertNotEquals(fileutil.calc_fingerprint(path),
+                             fileutil.calc_fingerprint(self.write_file(
+                                 'small filf')))
+
+    def test_missing_file(self):
+        self.assertRaises(EnvironmentError, fileutil.calc_fingerprint,
+                          os.path.join(self.tempdir, 'missing.mp3'))
+
 class TestBackupSupportDir(MiroTestCase):
     # Test backing up the support directory
     def setUp(self):
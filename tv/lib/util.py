@@ -37,6 +37,7 @@ from hashlib import sha1 as sha
 from StringIO import StringIO
 import collections
 import contextlib
+import gc
 import itertools
 import logging
 import os
@@ -281,41 +282,48 @@ def gather_media_files(path):
     """Gather media files on the disk in a directory tree.
     This is used by the first time startup dialog.
 
+    The directory tree is walked by a fileutil.DirectoryWalker.  Each
+    iteration waits a short time for more results, so that callers on the
+    UI thread stay responsive.
+
     path -- absolute file path to search
     """
     from miro import prefs
     from miro import app
+    from miro import fileutil
     from miro.plat.utils import dirfilt
 
-    parsed = 0
-    found = []
     short_app_name = app.config.get(prefs.SHORT_APP_NAME)
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            parsed = parsed + 1
-            if (filetypes.is_video_filename(f) or
-                filetypes.is_audio_filename(f)):
-                found.append(os.path.join(root, f))
-
+    def dir_filter(root, dirs):
         if short_app_name in dirs:
             dirs.remove(short_app_name)
-
         # Filter out naughty directories on a platform-specific basis
-        # that we never want to be parsing.  This is mainly useful on 
-        # Mac OS X where we do not want to descend into file packages.  A bit
-        # of a wart, long term solution is to write our own os.walk() shim 
-        # that is platform aware cleanly but right now it's not worth the 
-        # effort.
+        # that we never want to be parsing.  This is mainly useful on
+        # Mac OS X where we do not want to descend into file packages.
         dirfilt(root, dirs)
 
-        if parsed > 1000:
-            adjusted_parsed = int(parsed / 100.0) * 100
-        elif parsed > 100:
-            adjusted_parsed = int(parsed / 10.0) * 10
-        else:
-            adjusted_parsed = parsed
+    parsed = 0
+    found = []
+    walker = fileutil.DirectoryWalker(path, dir_filter=dir_filter)
+    try:
+        for batch in walker.iter_batches(timeout=0.1):
+            for f in batch:
+                parsed = parsed + 1
+                if (filetypes.is_video_filename(f) or
+                    filetypes.is_audio_filename(f)):
+                    found.append(f)
+
+            if parsed > 1000:
+                adjusted_parsed = int(parsed / 100.0) * 100
+            elif parsed > 100:
+                adjusted_parsed = int(parsed / 10.0) * 10
+            else:
+                adjusted_parsed = parsed
 
-        yield adjusted_parsed, found
+            yield adjusted_parsed, found
+    finally:
+        # stop the walker threads if our caller stops iterating early
+        walker.cancel()
 
 def gather_subtitle_files(movie_path):
     """Given an absolute path for a video file, this returns a list of
@@ -450,8 +458,15 @@ def clamp_text(text, max_length=20):
         return text
 
 def db_mem_usage_test():
+    """Log how much memory the objects of each DDBObject class use.
+
+    Objects are restored from the database one class at a time and we log
+    the RSS increase for each class.  Set startup.DEBUG_DB_MEM_USAGE to
+    True to run this after the database is loaded.
+    """
     from miro import models
     from miro.database import DDBObject
+    gc.collect()
     last_usage = get_mem_usage()
     logging.debug("baseline memory usage: %s", last_usage)
     for name in dir(models):
@@ -468,6 +483,8 @@ def db_mem_usage_test():
 
         # make sure each object is loaded in memory and count the total
         count = len(list(ddb_object_class.make_view()))
+        # don't count garbage from loading the objects
+        gc.collect()
         current_usage = get_mem_usage()
         class_usage = current_usage-last_usage
         if count == 0:
@@ -42,6 +42,7 @@ import threading
 from miro import clock
 from miro import eventloop
 from miro import feedparserutil
+from miro import fileutil
 from miro import filetags
 from miro import messagetools
 from miro import moviedata
@@ -129,6 +130,8 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue = WorkerTaskQueue()
         self.main_thread_tasks = deque()
         self.supports_alarm = util.supports_alarm()
+        # created when we get our first MovieDataProgramTask
+        self.movie_data_extractor = None
 
     def call_handler(self, method, msg):
         try:
@@ -178,6 +181,8 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
 
     def on_shutdown(self):
         self.task_queue.shutdown()
+        if self.movie_data_extractor is not None:
+            self.movie_data_extractor.shutdown()
 
     def handle_worker_startup_info(self, msg):
         for i in xrange(msg.thread_count):
@@ -201,8 +206,11 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     # all other task handler methods
 
     def handle_movie_data_program_task(self, msg):
+        if self.movie_data_extractor is None:
+            self.movie_data_extractor = moviedata.MovieDataExtractor()
         return moviedata.process_file(msg.source_path,
-                                      msg.screenshot_directory)
+                                      msg.screenshot_directory,
+                                      self.movie_data_extractor)
 
 
     # NOTE: all of the handle_*_task() methods below get called in one of our
@@ -216,11 +224,28 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         return parsed_feed
 
     def handle_mutagen_task(self, msg):
-        return filetags.process_file(msg.source_path, msg.cover_art_directory)
+        result = filetags.process_file(msg.source_path,
+                                       msg.cover_art_directory)
+        self._add_fingerprint(result, msg)
+        return result
 
     def handle_mutagen_task_with_alarm(self, msg):
+        # Only limit the time that mutagen takes.  calc_fingerprint() needs
+        # to read from the file, which can be slow on network mounts, and
+        # we don't want that to cause the whole task to fail.
         with util.alarm(2):
-            return self.handle_mutagen_task(msg)
+            result = filetags.process_file(msg.source_path,
+                                           msg.cover_art_directory)
+        self._add_fingerprint(result, msg)
+        return result
+
+    def _add_fingerprint(self, result, msg):
+        # the metadata manager uses the fingerprint to recognize files that
+        # it's already processed under a different path
+        try:
+            result['fingerprint'] = fileutil.calc_fingerprint(msg.source_path)
+        except EnvironmentError:
+            pass
 
 class _SinglePriorityQueue(object):
     """Manages tasks at a single priority for WorkerTaskQueue